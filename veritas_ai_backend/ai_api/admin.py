@@ -1,3 +1,28 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import CachedContextHandle, ChatSession, GenerationJob, UploadedFileHandle
+
+
+@admin.register(UploadedFileHandle)
+class UploadedFileHandleAdmin(admin.ModelAdmin):
+    list_display = ("name", "content_hash", "mime_type", "expires_at", "updated_at")
+    search_fields = ("name", "content_hash")
+
+
+@admin.register(CachedContextHandle)
+class CachedContextHandleAdmin(admin.ModelAdmin):
+    list_display = ("name", "model", "key", "expires_at", "updated_at")
+    search_fields = ("name", "model", "key")
+
+
+@admin.register(ChatSession)
+class ChatSessionAdmin(admin.ModelAdmin):
+    list_display = ("id", "created_at", "updated_at", "expires_at")
+    readonly_fields = ("summary",)
+
+
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "status", "priority", "client_id", "created_at", "finished_at")
+    list_filter = ("status",)
+    readonly_fields = ("params", "result", "error")
@@ -0,0 +1,415 @@
+"""
+Admission control in front of the generate endpoints.
+
+* Rate limiting: each client (identified like the token budget, by remote
+  address or VERITAS_CLIENT_ID_HEADER, e.g. an API key header) has a token
+  bucket holding VERITAS_RATE_LIMIT_BURST requests, refilled at
+  VERITAS_RATE_LIMIT_PER_MINUTE. Requests finding it empty get 429.
+* Concurrency cap: at most VERITAS_MAX_CONCURRENT_UPSTREAM generations call
+  the model at the same time. Up to VERITAS_UPSTREAM_QUEUE_SIZE more wait
+  at most VERITAS_UPSTREAM_QUEUE_WAIT_SECONDS for a call slot; requests
+  finding the queue full, or still waiting at the end, get 503. FAQ, cached
+  and coalesced answers don't take a slot.
+
+Both rejections carry Retry-After. The state lives in the shared response
+cache so the limits hold across workers: a bucket is stored as the time it
+will be full again (GCRA), and call slots and queue places are cache keys
+taken with add() under a lease, so the slots of a crashed worker free
+themselves. Requests are admitted when the cache is unavailable, for example
+when "python manage.py createcachetable" wasn't run for the database cache;
+the first failure is logged as an error, and each admitted request is
+counted as "unavailable".
+"""
+# admission.py
+
+import asyncio
+import hashlib
+import logging
+import math
+import random
+import threading
+import time
+import uuid
+from collections.abc import AsyncIterator, Iterator
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+from .metrics import admission_rejections, timed, upstream_calls_active, upstream_queue_depth
+from .stats import StatCounters
+
+logger = logging.getLogger(__name__)
+
+admission_stats = StatCounters(
+    "admission",
+    "admitted",
+    "queued",
+    "rate_limited",
+    "queue_full",
+    "queue_timeout",
+    "unavailable",
+)
+
+# Rejection reasons, also the names of their counters
+REJECTED_RATE_LIMIT = "rate_limited"
+REJECTED_QUEUE_FULL = "queue_full"
+REJECTED_QUEUE_TIMEOUT = "queue_timeout"
+
+
+class RateLimited(Exception):
+    """
+    Raised when a client sends requests faster than its rate limit allows.
+    """
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Rate limit exceeded, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class UpstreamBusy(Exception):
+    """
+    Raised when no upstream call slot became free for a request.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def admission_enabled() -> bool:
+    return getattr(settings, "VERITAS_ADMISSION_ENABLED", True)
+
+
+def _shared_cache():
+    return caches[settings.VERITAS_RESPONSE_CACHE_ALIAS]
+
+
+def _reject(reason: str) -> None:
+    admission_stats.incr(reason)
+    admission_rejections.inc(reason=reason)
+
+
+_cache_failure_logged = False
+
+
+def _cache_failed(message: str, error: Exception) -> None:
+    """
+    Records a request admitted because the shared cache failed. Only the
+    first failure is an error; a missing cache table fails every request.
+    """
+    global _cache_failure_logged
+    admission_stats.incr("unavailable")
+    if _cache_failure_logged:
+        logger.warning(f"{message}: {error}")
+        return
+    _cache_failure_logged = True
+    logger.error(
+        f"{message}: {error}. Requests are admitted without rate limits or call "
+        f"slots until the shared cache works (did createcachetable run?)"
+    )
+
+
+# Rate limiting
+
+
+def _rate_limit() -> tuple[float, int] | None:
+    """
+    Seconds between requests at the sustained rate, and the burst size.
+    """
+    per_minute = getattr(settings, "VERITAS_RATE_LIMIT_PER_MINUTE", None)
+    if not admission_enabled() or not per_minute:
+        return None
+    return 60 / per_minute, max(settings.VERITAS_RATE_LIMIT_BURST, 1)
+
+
+_bucket_lock = threading.Lock()
+
+
+def _bucket_key(client_id: str) -> str:
+    return f"veritas:ratelimit:{hashlib.sha256(client_id.encode()).hexdigest()[:32]}"
+
+
+def _take_token(
+    full_at: float | None, now: float, interval: float, burst: int
+) -> tuple[float | None, float | None]:
+    """
+    GCRA step. `full_at` is when the bucket will be full again.
+
+    Returns:
+        (new full_at, None) if a token was taken, else (None, seconds until
+        one is available).
+    """
+    full_at = max(full_at or now, now) + interval
+    wait = full_at - burst * interval - now
+    if wait > 0:
+        return None, wait
+    return full_at, None
+
+
+def _check_bucket(full_at: float | None, now: float, limit: tuple[float, int]) -> float:
+    interval, burst = limit
+    new_full_at, wait = _take_token(full_at, now, interval, burst)
+    if new_full_at is None:
+        _reject(REJECTED_RATE_LIMIT)
+        raise RateLimited(math.ceil(wait))
+    return new_full_at
+
+
+def check_rate_limit(client_id: str) -> None:
+    """
+    Takes a token from the client's bucket. The read and write of the
+    bucket are serialized within the worker; across workers a burst can
+    overshoot by about one request per worker.
+
+    Raises:
+        RateLimited: The bucket is empty.
+    """
+    limit = _rate_limit()
+    if limit is None:
+        return
+    key = _bucket_key(client_id)
+    cache = _shared_cache()
+    with _bucket_lock:
+        now = time.time()
+        try:
+            full_at = cache.get(key)
+        except Exception as e:
+            _cache_failed("Rate limit unavailable", e)
+            return
+        new_full_at = _check_bucket(full_at, now, limit)
+        try:
+            cache.set(key, new_full_at, math.ceil(new_full_at - now) + 1)
+        except Exception as e:
+            logger.warning(f"Failed to update rate limit: {e}")
+
+
+async def acheck_rate_limit(client_id: str) -> None:
+    """
+    Async version of check_rate_limit.
+    """
+    if _rate_limit() is None:
+        return
+    await sync_to_async(check_rate_limit)(client_id)
+
+
+# Upstream call slots
+
+
+class _SlotPool:
+    """
+    Up to `size` slots shared by all workers: a slot is a cache key taken
+    with add(), deleted on release or expiring with its lease.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+
+    def _keys(self, size: int) -> list[str]:
+        return [f"{self.prefix}:{i}" for i in range(size)]
+
+    @staticmethod
+    def _free(keys: list[str], taken: dict) -> list[str]:
+        free = [key for key in keys if key not in taken]
+        # Spread contending workers over the free slots
+        random.shuffle(free)
+        return free
+
+    def try_acquire(self, size: int, lease: float) -> tuple[str, str] | None:
+        """
+        Returns the (key, owner) of a free slot, or None if all are taken.
+        """
+        cache = _shared_cache()
+        owner = uuid.uuid4().hex
+        keys = self._keys(size)
+        for key in self._free(keys, cache.get_many(keys)):
+            if cache.add(key, owner, math.ceil(lease)):
+                return key, owner
+        return None
+
+    async def atry_acquire(self, size: int, lease: float) -> tuple[str, str] | None:
+        cache = _shared_cache()
+        owner = uuid.uuid4().hex
+        keys = self._keys(size)
+        for key in self._free(keys, await cache.aget_many(keys)):
+            if await cache.aadd(key, owner, math.ceil(lease)):
+                return key, owner
+        return None
+
+    def release(self, slot: tuple[str, str]) -> None:
+        key, owner = slot
+        cache = _shared_cache()
+        try:
+            # Only if the lease didn't run out and pass the slot to another
+            if cache.get(key) == owner:
+                cache.delete(key)
+        except Exception as e:
+            logger.warning(f"Failed to release {key}: {e}")
+
+    async def arelease(self, slot: tuple[str, str]) -> None:
+        key, owner = slot
+        cache = _shared_cache()
+        try:
+            if await cache.aget(key) == owner:
+                await cache.adelete(key)
+        except Exception as e:
+            logger.warning(f"Failed to release {key}: {e}")
+
+
+_call_slots = _SlotPool("veritas:upstream:slot")
+_queue_places = _SlotPool("veritas:upstream:queue")
+
+
+def _concurrency_cap() -> int | None:
+    if not admission_enabled():
+        return None
+    return getattr(settings, "VERITAS_MAX_CONCURRENT_UPSTREAM", None)
+
+
+def _queue_wait() -> float:
+    return settings.VERITAS_UPSTREAM_QUEUE_WAIT_SECONDS
+
+
+def _busy(reason: str) -> UpstreamBusy:
+    _reject(reason)
+    message = (
+        "Too many requests are waiting for the AI service."
+        if reason == REJECTED_QUEUE_FULL
+        else "Timed out waiting for a free AI service slot."
+    )
+    return UpstreamBusy(message, max(math.ceil(_queue_wait()), 1))
+
+
+def acquire_upstream_slot() -> tuple[str, str] | None:
+    """
+    Takes an upstream call slot, queueing for one if all are taken.
+
+    Returns:
+        The slot to pass to release_upstream_slot, or None if there is no
+        cap (or the cache is unavailable).
+
+    Raises:
+        UpstreamBusy: The queue is full, or no slot freed up in time.
+    """
+    cap = _concurrency_cap()
+    if not cap:
+        return None
+    lease = settings.VERITAS_UPSTREAM_SLOT_LEASE_SECONDS
+    try:
+        slot = _call_slots.try_acquire(cap, lease)
+        if slot is not None:
+            admission_stats.incr("admitted")
+            return slot
+        place = _queue_places.try_acquire(
+            settings.VERITAS_UPSTREAM_QUEUE_SIZE, _queue_wait() + 1
+        )
+    except Exception as e:
+        _cache_failed("Upstream call slots unavailable", e)
+        return None
+    if place is None:
+        raise _busy(REJECTED_QUEUE_FULL)
+
+    admission_stats.incr("queued")
+    upstream_queue_depth.inc()
+    try:
+        with timed("upstream_queue"):
+            deadline = time.monotonic() + _queue_wait()
+            while time.monotonic() < deadline:
+                time.sleep(settings.VERITAS_UPSTREAM_SLOT_POLL_SECONDS)
+                slot = _call_slots.try_acquire(cap, lease)
+                if slot is not None:
+                    admission_stats.incr("admitted")
+                    return slot
+    except Exception as e:
+        _cache_failed("Upstream call slots unavailable", e)
+        return None
+    finally:
+        upstream_queue_depth.dec()
+        _queue_places.release(place)
+    raise _busy(REJECTED_QUEUE_TIMEOUT)
+
+
+async def aacquire_upstream_slot() -> tuple[str, str] | None:
+    """
+    Async version of acquire_upstream_slot.
+    """
+    cap = _concurrency_cap()
+    if not cap:
+        return None
+    lease = settings.VERITAS_UPSTREAM_SLOT_LEASE_SECONDS
+    try:
+        slot = await _call_slots.atry_acquire(cap, lease)
+        if slot is not None:
+            admission_stats.incr("admitted")
+            return slot
+        place = await _queue_places.atry_acquire(
+            settings.VERITAS_UPSTREAM_QUEUE_SIZE, _queue_wait() + 1
+        )
+    except Exception as e:
+        _cache_failed("Upstream call slots unavailable", e)
+        return None
+    if place is None:
+        raise _busy(REJECTED_QUEUE_FULL)
+
+    admission_stats.incr("queued")
+    upstream_queue_depth.inc()
+    try:
+        with timed("upstream_queue"):
+            deadline = time.monotonic() + _queue_wait()
+            while time.monotonic() < deadline:
+                await asyncio.sleep(settings.VERITAS_UPSTREAM_SLOT_POLL_SECONDS)
+                slot = await _call_slots.atry_acquire(cap, lease)
+                if slot is not None:
+                    admission_stats.incr("admitted")
+                    return slot
+    except Exception as e:
+        _cache_failed("Upstream call slots unavailable", e)
+        return None
+    finally:
+        upstream_queue_depth.dec()
+        await _queue_places.arelease(place)
+    raise _busy(REJECTED_QUEUE_TIMEOUT)
+
+
+def admitted_events(events: Iterator[tuple[str, dict]]) -> Iterator[tuple[str, dict]]:
+    """
+    Passes a generation's events through while holding an upstream call
+    slot, taken before the generation starts.
+
+    Raises:
+        UpstreamBusy: No slot was available; raised before any event.
+    """
+    slot = acquire_upstream_slot()
+    upstream_calls_active.inc()
+    try:
+        yield from events
+    finally:
+        upstream_calls_active.dec()
+        if slot is not None:
+            _call_slots.release(slot)
+
+
+async def aadmitted_events(
+    events: AsyncIterator[tuple[str, dict]],
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Async version of admitted_events.
+    """
+    slot = await aacquire_upstream_slot()
+    upstream_calls_active.inc()
+    try:
+        async for event in events:
+            yield event
+    finally:
+        upstream_calls_active.dec()
+        if slot is not None:
+            await _call_slots.arelease(slot)
+
+
+def reset_admission() -> None:
+    """
+    Resets the counters and the logged cache failure (used by tests).
+    """
+    global _cache_failure_logged
+    _cache_failure_logged = False
+    admission_stats.reset()
@@ -1,14 +1,52 @@
 # ai_helpers.py
 
+import hashlib
 import logging
 import os
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from google.genai import (
     types,
     client as genai_client,
 )  # Renamed client import to avoid confusion
 
+from .client_provider import get_genai_client
+from .context_cache import context_cache_enabled, get_cached_context
+from .file_registry import (
+    FileHandle,
+    aget_file_handle,
+    file_content_hash,
+    get_file_handle,
+)
+from .knowledge_bases import resident
+from .knowledge_store import get_knowledge_store, text_hash
+from .metrics import passage_fallbacks, prompt_only_fallbacks, prompt_template_requests
+from .prompts import (  # noqa: F401 (VERITAS_SYSTEM_INSTRUCTION_TEXT is re-exported)
+    VERITAS_SYSTEM_INSTRUCTION_TEXT,
+    CompiledPrompt,
+    get_prompt_template,
+)
+from .retrieval import (
+    CONTEXT_MODE_RETRIEVAL,
+    Passage,
+    context_mode,
+    format_passages,
+    get_passage_index,
+    retrieval_available,
+    retrieve_passages,
+)
+from .sessions import ChatHistory
+from .tracing import span
+
 logger = logging.getLogger(__name__)
 
+
+class BlockedPromptError(Exception):
+    """
+    Raised when the API refuses a prompt for safety reasons.
+    """
+
+
 # --- Moved Content ---
 # Define the long hardcoded text as a constant for clarity
 VERITAS_MODEL_PREAMBLE_TEXT = """Okay, I've reviewed the text you provided. Here's a summary of the key information about Veritas University, Abuja, along with answers to potential questions a user might have, presented in a respectful and informative way:
@@ -114,86 +152,437 @@ I believe this comprehensively covers the information provided in the text, addr
 """
 
 
+PREAMBLE_HASH = hashlib.sha256(VERITAS_MODEL_PREAMBLE_TEXT.encode("utf-8")).hexdigest()
+
+# Section of the knowledge base store (see knowledge_store.py)
+PREAMBLE_SECTION = "preamble"
+
+
+class _PreambleSlot:
+    """
+    The preamble a knowledge base's store holds (see knowledge_bases.py).
+    """
+
+    # (store, preamble) of the last preamble read from the store
+    entry: tuple | None = None
+
+
+PREAMBLE_SLOT = "preamble"
+
+
+def model_preamble() -> str:
+    """
+    Returns the model preamble of the current knowledge base: the one
+    ingested into its store (from its preamble file, VERITAS_PREAMBLE_PATH
+    for the default base), or VERITAS_MODEL_PREAMBLE_TEXT if there is no
+    store.
+    """
+    store = get_knowledge_store()
+    if store is None or not store.has(PREAMBLE_SECTION):
+        return VERITAS_MODEL_PREAMBLE_TEXT
+    slot = resident().slot(PREAMBLE_SLOT, _PreambleSlot)
+    entry = slot.entry
+    if entry is None or entry[0] is not store:
+        entry = slot.entry = (store, store.strings(PREAMBLE_SECTION, "text")[0])
+    return entry[1]
+
+
+def _preamble_hash() -> str:
+    preamble = model_preamble()
+    if preamble is VERITAS_MODEL_PREAMBLE_TEXT:
+        return PREAMBLE_HASH
+    return text_hash(preamble)
+
+
+def prompt_template(version: str | None = None) -> CompiledPrompt:
+    """
+    Returns the prompt template requests are assembled with (see
+    prompts.py), compiled for the current model preamble.
+    """
+    return get_prompt_template(model_preamble(), version)
+
+
+def knowledge_base_version(file_path: str) -> str:
+    """
+    Returns a short hash identifying the knowledge base sent to the model:
+    the content of the data file, the model preamble, the prompt template
+    and how the context is selected (full file or retrieved passages).
+    Anything derived from the knowledge base (such as cached answers) should
+    be keyed by it.
+
+    Args:
+        file_path: The path to the Veritas data file.
+
+    Returns:
+        A 16-character hex version string.
+    """
+    file_hash = file_content_hash(file_path) if os.path.exists(file_path) else "missing"
+    mode = context_mode()
+    if mode == CONTEXT_MODE_RETRIEVAL:
+        mode = (
+            f"{mode}:{settings.VERITAS_RETRIEVAL_TOP_K}"
+            f":{settings.VERITAS_RETRIEVAL_PASSAGE_WORDS}"
+            f":{settings.VERITAS_RETRIEVAL_PASSAGE_OVERLAP_WORDS}"
+        )
+    return hashlib.sha256(
+        f"{file_hash}:{_preamble_hash()}:{mode}:{prompt_template().content_hash}".encode()
+    ).hexdigest()[:16]
+
+
+def _prompt_only_contents(
+    prompt: str, history: ChatHistory | None = None, template: CompiledPrompt | None = None
+) -> list[types.Content]:
+    """
+    Contents used when the Veritas data file cannot be attached.
+    """
+    return (template or prompt_template()).turns(prompt, history)
+
+
+def _contents_with_passages(
+    passages: list[Passage],
+    prompt: str,
+    history: ChatHistory | None = None,
+    template: CompiledPrompt | None = None,
+) -> list[types.Content]:
+    """
+    Contents with the knowledge base passages relevant to the prompt.
+    """
+    return (template or prompt_template()).turns(
+        prompt, history, passages_text=format_passages(passages)
+    )
+
+
+def _retrieved_contents(
+    file_path: str,
+    prompt: str,
+    history: ChatHistory | None = None,
+    always: bool = False,
+    template: CompiledPrompt | None = None,
+) -> list[types.Content] | None:
+    """
+    Contents with retrieved passages, or None if the full data file should
+    be sent instead (full context mode unless `always`, or no relevant
+    passage found). Follow-up questions are matched together with the
+    previous question.
+    """
+    if context_mode() != CONTEXT_MODE_RETRIEVAL and not always:
+        return None
+    query = prompt
+    if history and history.last_user_text():
+        query = f"{history.last_user_text()}\n{prompt}"
+    try:
+        with span("retrieval"):
+            passages = retrieve_passages(file_path, query, model_preamble())
+    except Exception as e:
+        logger.error(f"Passage retrieval failed, sending the full data file: {e}")
+        return None
+    if not passages:
+        logger.info("No relevant passages found, sending the full data file.")
+        return None
+    logger.info(f"Using {len(passages)} retrieved passages as context.")
+    return _contents_with_passages(passages, prompt, history, template)
+
+
+def _fallback_contents(
+    file_path: str,
+    prompt: str,
+    history: ChatHistory | None = None,
+    template: CompiledPrompt | None = None,
+) -> list[types.Content]:
+    """
+    Contents used when the data file could not be attached: the passages
+    relevant to the prompt if the file's text can be read locally, otherwise
+    only the prompt.
+    """
+    if context_mode() != CONTEXT_MODE_RETRIEVAL and retrieval_available():
+        contents = _retrieved_contents(
+            file_path, prompt, history, always=True, template=template
+        )
+        if contents is not None:
+            logger.warning("Falling back to the retrieved passages of the data file.")
+            passage_fallbacks.inc()
+            return contents
+    logger.warning("Falling back to using only the user prompt for generation.")
+    prompt_only_fallbacks.inc()
+    return _prompt_only_contents(prompt, history, template)
+
+
+def _prefix_contents(
+    veritas_file: FileHandle, template: CompiledPrompt | None = None
+) -> list[types.Content]:
+    """
+    The fixed turns sent before every prompt in full-file mode: the uploaded
+    data file, the model preamble and the template's few-shot turns.
+    """
+    return (template or prompt_template()).file_prefix(veritas_file.uri, veritas_file.mime_type)
+
+
+def _contents_with_file(
+    veritas_file: FileHandle,
+    prompt: str,
+    history: ChatHistory | None = None,
+    template: CompiledPrompt | None = None,
+) -> list[types.Content]:
+    """
+    Contents with the uploaded data file, the model preamble and the prompt.
+    """
+    template = template or prompt_template()
+    return _prefix_contents(veritas_file, template) + template.turns(
+        prompt, history, few_shot=False
+    )
+
+
+def _prefix_version(file_path: str, template: CompiledPrompt) -> str:
+    """
+    Identifies the content of the cached prefix: data file and prompt
+    template (system instruction, preamble and few-shot turns).
+    """
+    return hashlib.sha256(
+        f"{file_content_hash(file_path)}:{template.content_hash}".encode()
+    ).hexdigest()
+
+
+def _cached_context_name(
+    client, model_name: str, file_path: str, template: CompiledPrompt | None = None
+) -> str | None:
+    """
+    Returns the upstream cached context holding the fixed prefix, or None if
+    the prefix has to be sent inline.
+    """
+    template = template or prompt_template()
+
+    def build_config(**kwargs) -> types.CreateCachedContentConfig:
+        veritas_file = get_file_handle(client, file_path)
+        return types.CreateCachedContentConfig(
+            contents=_prefix_contents(veritas_file, template),
+            system_instruction=template.system_instruction,
+            **kwargs,
+        )
+
+    with span("context_cache"):
+        return get_cached_context(
+            client, model_name, _prefix_version(file_path, template), build_config
+        )
+
+
+def prepare_cached_context(client, model_name: str, file_path: str) -> str | None:
+    """
+    Makes sure the upstream cached context holding the fixed prefix exists
+    for a model, ahead of the requests that will use it.
+
+    Returns:
+        The cached context name, or None if requests don't use one
+        (retrieval mode, context caching off or unsupported by the model).
+    """
+    if context_mode() == CONTEXT_MODE_RETRIEVAL or not context_cache_enabled():
+        return None
+    return _cached_context_name(client, model_name, file_path)
+
+
+def _with_cached_context(config, cached_context: str):
+    return config.model_copy(update={"cached_content": cached_context})
+
+
+def _request_template() -> CompiledPrompt:
+    """
+    The prompt template of a request being built, logged and counted.
+    """
+    template = prompt_template()
+    logger.info(f"Using prompt template {template.label}")
+    prompt_template_requests.inc(template=template.version)
+    return template
+
+
 def build_veritas_chat_contents(
-    client: genai_client.Client, file_path: str, prompt: str
+    client: genai_client.Client | None,
+    file_path: str,
+    prompt: str,
+    history: ChatHistory | None = None,
 ) -> list[types.Content] | None:
     """
-    Builds the 'contents' list for the Gemini API call, potentially uploading
-    the Veritas data file.
+    Builds the 'contents' list for the Gemini API call, always inlining the
+    full-file prefix; see build_veritas_request.
+    """
+    contents, _ = build_veritas_request(
+        client, None, file_path, prompt, None, history=history
+    )
+    return contents
+
+
+def build_veritas_request(
+    client: genai_client.Client | None,
+    model_name: str | None,
+    file_path: str,
+    prompt: str,
+    config: types.GenerateContentConfig | None,
+    history: ChatHistory | None = None,
+) -> tuple[list[types.Content], types.GenerateContentConfig | None]:
+    """
+    Builds the 'contents' list and generation config for the Gemini API call.
+
+    In retrieval mode (VERITAS_CONTEXT_MODE) only the passages of the data
+    file relevant to the prompt are sent. Otherwise, or if nothing relevant
+    is found, the uploaded Veritas data file is reused from the file registry
+    and uploaded only when needed. The file and preamble prefix is then
+    referenced through an upstream cached context when the model supports it.
+    The fixed parts come from the precompiled prompt template (see
+    prompts.py); only the user turn and chat history are built per request.
 
     Args:
-        client: The initialized Google AI client.
+        client: The initialized Google AI client, or None to use the shared
+            client from get_genai_client().
+        model_name: The model to generate with, or None to never use a
+            cached context.
         file_path: The path to the Veritas data file.
         prompt: The user's input prompt.
+        config: The GenerateContentConfig for the request.
+        history: The chat session turns to send before the prompt, after
+            the knowledge base prefix.
 
     Returns:
-        A list of google.genai.types.Content objects for the API call,
-        or None if a critical error occurs during file upload.
-        Returns a simplified list if file upload fails but can proceed.
+        The google.genai.types.Content objects for the API call and the
+        config to send them with. Falls back to the retrieved passages, or
+        only the prompt, if the data file cannot be uploaded.
     """
-    contents = []
+    if client is None:
+        client = get_genai_client()
+    template = _request_template()
+    inline_config = template.request_config(config)
     try:
-        logger.info(f"Attempting to upload Veritas data file from {file_path}")
+        logger.info(f"Resolving uploaded Veritas data file for {file_path}")
         # Ensure the file exists before attempting upload within this function as well
         if not os.path.exists(file_path):
             logger.error(
                 f"Veritas data file confirmed missing at {file_path} during content build."
             )
             # Fallback to prompt-only mode if file is missing
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[types.Part.from_text(text=prompt)],
-                ),
-            ]
-            return contents  # Return the simplified list
-
-        veritas_file = client.files.upload(file=file_path)
+            prompt_only_fallbacks.inc()
+            return _prompt_only_contents(prompt, history, template), inline_config
+
+        contents = _retrieved_contents(file_path, prompt, history, template=template)
+        if contents is not None:
+            return contents, inline_config
+
+        if model_name and config is not None:
+            cached_context = _cached_context_name(client, model_name, file_path, template)
+            if cached_context:
+                logger.info(f"Using cached context: {cached_context}")
+                return (
+                    template.turns(prompt, history, few_shot=False),
+                    _with_cached_context(config, cached_context),
+                )
+
+        veritas_file = get_file_handle(client, file_path)
         logger.info(
-            f"Successfully uploaded file: {veritas_file.name}, URI: {veritas_file.uri}"
+            f"Using uploaded file: {veritas_file.name}, URI: {veritas_file.uri}"
+        )
+        return _contents_with_file(veritas_file, prompt, history, template), inline_config
+
+    except Exception as e:
+        logger.error(
+            f"Error uploading Veritas data file or building contents: {str(e)}"
         )
+        return _fallback_contents(file_path, prompt, history, template), inline_config
 
-        # Build contents with the uploaded file and preamble
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_uri(
-                        file_uri=veritas_file.uri,
-                        mime_type=veritas_file.mime_type,
-                    ),
-                    types.Part.from_text(
-                        text="This is some of the school's data"  # Context for the file
-                    ),
-                ],
-            ),
-            types.Content(
-                role="model",
-                parts=[
-                    types.Part.from_text(
-                        text=VERITAS_MODEL_PREAMBLE_TEXT
-                    )  # Use the constant
-                ],
-            ),
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=prompt),  # The actual user query
-                ],
-            ),
-        ]
-        return contents
+
+async def abuild_veritas_chat_contents(
+    client: genai_client.Client | None,
+    file_path: str,
+    prompt: str,
+    history: ChatHistory | None = None,
+) -> list[types.Content]:
+    """
+    Async version of build_veritas_chat_contents.
+    """
+    contents, _ = await abuild_veritas_request(
+        client, None, file_path, prompt, None, history=history
+    )
+    return contents
+
+
+async def abuild_veritas_request(
+    client: genai_client.Client | None,
+    model_name: str | None,
+    file_path: str,
+    prompt: str,
+    config: types.GenerateContentConfig | None,
+    history: ChatHistory | None = None,
+) -> tuple[list[types.Content], types.GenerateContentConfig | None]:
+    """
+    Async version of build_veritas_request that uploads the data file
+    through client.aio when the registry has no fresh handle and the full
+    file is needed.
+    """
+    if client is None:
+        client = get_genai_client()
+    template = _request_template()
+    inline_config = template.request_config(config)
+    try:
+        if not os.path.exists(file_path):
+            logger.error(
+                f"Veritas data file confirmed missing at {file_path} during content build."
+            )
+            prompt_only_fallbacks.inc()
+            return _prompt_only_contents(prompt, history, template), inline_config
+
+        # Building the index the first time reads the PDF; keep it off the loop
+        contents = await sync_to_async(_retrieved_contents, thread_sensitive=False)(
+            file_path, prompt, history, template=template
+        )
+        if contents is not None:
+            return contents, inline_config
+
+        if model_name and config is not None:
+            # Reads the handle from the database and rarely creates or
+            # extends the cache; all blocking calls
+            cached_context = await sync_to_async(_cached_context_name)(
+                client, model_name, file_path, template
+            )
+            if cached_context:
+                return (
+                    template.turns(prompt, history, few_shot=False),
+                    _with_cached_context(config, cached_context),
+                )
+
+        veritas_file = await aget_file_handle(client, file_path)
+        return _contents_with_file(veritas_file, prompt, history, template), inline_config
 
     except Exception as e:
         logger.error(
             f"Error uploading Veritas data file or building contents: {str(e)}"
         )
-        logger.warning("Falling back to using only the user prompt for generation.")
-        # Fallback to just using the prompt if file upload fails
-        contents = [
-            types.Content(
-                role="user",
-                parts=[types.Part.from_text(text=prompt)],
-            ),
-        ]
-        return contents  # Return the simplified list even on error
+        # Reading the PDF to index it the first time blocks
+        contents = await sync_to_async(_fallback_contents, thread_sensitive=False)(
+            file_path, prompt, history, template
+        )
+        return contents, inline_config
+
+
+async def aprepare_veritas_context(
+    client: genai_client.Client | None, model_name: str, file_path: str
+) -> None:
+    """
+    Builds the shared context once ahead of a batch of prompts: the passage
+    index in retrieval mode, otherwise the uploaded data file and the cached
+    context, so the items don't all wait on it at the same time. Failures
+    are logged; each prompt falls back as usual.
+
+    Args:
+        client: The initialized Google AI client, or None to use the shared
+            client from get_genai_client().
+        model_name: The model the batch is generated with.
+        file_path: The path to the Veritas data file.
+    """
+    if client is None:
+        client = get_genai_client()
+    try:
+        if context_mode() == CONTEXT_MODE_RETRIEVAL:
+            await sync_to_async(get_passage_index, thread_sensitive=False)(
+                file_path, model_preamble()
+            )
+            return
+        await aget_file_handle(client, file_path)
+        if context_cache_enabled():
+            await sync_to_async(_cached_context_name)(client, model_name, file_path)
+    except Exception as e:
+        logger.error(f"Failed to prepare the shared context: {e}")
@@ -1,6 +1,46 @@
+import logging
+
 from django.apps import AppConfig
 
+logger = logging.getLogger(__name__)
+
 
 class AiApiConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "ai_api"
+
+    def ready(self):
+        from .warmup import serves_requests, start_warmup, warmup_enabled
+
+        # Resume the jobs left queued when the workers last stopped
+        if serves_requests():
+            from .jobs import start_job_workers
+
+            start_job_workers()
+
+        # Build the indexes, client, uploaded file and cached context before
+        # the first request; /api/health/ready reports when it's done.
+        if warmup_enabled() and serves_requests():
+            start_warmup()
+            return
+
+        # Build the FAQ index at startup so the first matching request is
+        # served from memory.
+        from .faq import get_faq_matcher
+
+        try:
+            get_faq_matcher()
+        except Exception as e:
+            logger.error(f"Failed to preload the FAQ index: {e}")
+
+        # Extract and index the data file once, before the first request.
+        from .retrieval import CONTEXT_MODE_RETRIEVAL, context_mode, get_passage_index
+
+        if context_mode() == CONTEXT_MODE_RETRIEVAL:
+            from .ai_helpers import model_preamble
+            from .views import VERITAS_DATA_FILE_PATH
+
+            try:
+                get_passage_index(VERITAS_DATA_FILE_PATH, model_preamble())
+            except Exception as e:
+                logger.error(f"Failed to preload the passage index: {e}")
@@ -0,0 +1,94 @@
+"""
+Bounded-concurrency fan-out for the batch generate endpoint.
+
+Bulk jobs (regenerating the answers in data.csv, trying a prompt change
+against hundreds of questions) send many prompts in one request. The items
+run concurrently on the event loop, at most `concurrency` at a time, each
+with its own timeout, and a failing item never fails the batch.
+"""
+# batch.py
+
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator, Awaitable, Callable
+
+from rest_framework import status
+
+from .stats import StatCounters
+
+logger = logging.getLogger(__name__)
+
+batch_stats = StatCounters("batch", "batches", "items", "item_errors", "item_timeouts")
+
+
+async def _run_item(
+    index: int,
+    item: dict,
+    worker: Callable[[dict], Awaitable[dict]],
+    semaphore: asyncio.Semaphore,
+    timeout: float,
+) -> dict:
+    """
+    Runs one item, turning a timeout into an error result and adding the
+    index and elapsed time to the result.
+    """
+    async with semaphore:
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(worker(item), timeout)
+        except asyncio.TimeoutError:
+            batch_stats.incr("item_timeouts")
+            result = {
+                "error": "Timed out waiting for the AI service.",
+                "status": status.HTTP_504_GATEWAY_TIMEOUT,
+            }
+        except Exception as e:
+            logger.exception(f"Batch item {index} failed: {e}")
+            result = {
+                "error": "Internal server error.",
+                "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+            }
+        if "error" in result:
+            batch_stats.incr("item_errors")
+        batch_stats.incr("items")
+        return {
+            "index": index,
+            **result,
+            "elapsed_ms": round((time.monotonic() - started) * 1000),
+        }
+
+
+async def run_batch(
+    items: list[dict],
+    worker: Callable[[dict], Awaitable[dict]],
+    concurrency: int,
+    timeout: float,
+) -> AsyncIterator[dict]:
+    """
+    Runs worker over every item and yields the results as they finish.
+
+    Args:
+        items: The batch items.
+        worker: Coroutine function returning the result dict of one item;
+            it reports its own errors as {"error": ..., "status": ...}.
+        concurrency: Maximum number of items running at the same time.
+        timeout: Seconds after which a running item is abandoned.
+
+    Yields:
+        Each item's result with its "index" and "elapsed_ms", in completion
+        order.
+    """
+    batch_stats.incr("batches")
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = [
+        asyncio.ensure_future(_run_item(index, item, worker, semaphore, timeout))
+        for index, item in enumerate(items)
+    ]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # The client went away; don't keep calling the model for it.
+        for task in tasks:
+            task.cancel()
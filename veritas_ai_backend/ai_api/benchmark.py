@@ -0,0 +1,533 @@
+"""
+Offline replay benchmark of the generate stack.
+
+Prompts from data.csv (or a JSONL file) are replayed through GenerateTextView
+against FakeGenaiClient, a local stand-in for the Gemini API with
+configurable upload, first-chunk and per-chunk latency and error rate. The
+report has per-stage latency percentiles, throughput, upstream calls per
+request and a score of each answer against the curated response, so changes
+to caching, retrieval or the FAQ shortcut can be checked for both speed and
+correctness without spending API quota.
+
+Run it with `python manage.py bench_replay`.
+"""
+# benchmark.py
+
+import contextvars
+import json
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import timedelta
+from types import SimpleNamespace
+
+import requests
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+from google.genai import errors as genai_errors
+
+from .client_provider import use_genai_client
+from .faq import load_faq_entries
+from .stats import percentile
+from .text_index import estimate_text_tokens, normalize_text, tokenize
+
+NO_ANSWER = "I don't have that specific information."
+
+
+@dataclass
+class ReplayItem:
+    prompt: str
+    reference: str | None = None
+
+
+def load_replay_items(path: str) -> list[ReplayItem]:
+    """
+    Reads prompts to replay from a prompt/response CSV like data.csv, or
+    from a JSONL file with one object per line holding "prompt" (or "body",
+    as in requests.jsonl) and optionally "response".
+    """
+    if str(path).endswith(".jsonl"):
+        items = []
+        with open(path, encoding="utf-8") as jsonl_file:
+            for line in jsonl_file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                prompt = record.get("prompt") or record.get("body")
+                if prompt:
+                    items.append(ReplayItem(prompt, record.get("response")))
+        return items
+    return [ReplayItem(entry.prompt, entry.response) for entry in load_faq_entries(path)]
+
+
+def token_f1(answer: str, reference: str) -> float:
+    """
+    Token-level F1 between an answer and the reference answer.
+    """
+    answer_tokens = Counter(tokenize(answer))
+    reference_tokens = Counter(tokenize(reference))
+    common = sum((answer_tokens & reference_tokens).values())
+    if not common:
+        return 0.0
+    precision = common / sum(answer_tokens.values())
+    recall = common / sum(reference_tokens.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def latency_summary(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values), 2) if values else None,
+        "p50_ms": percentile(values, 0.50),
+        "p95_ms": percentile(values, 0.95),
+        "p99_ms": percentile(values, 0.99),
+    }
+
+
+def _api_error(error_class, code: int, message: str):
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({"error": {"code": code, "message": message}}).encode()
+    return error_class(code, response)
+
+
+class FakeGenaiClient:
+    """
+    Local stand-in for genai.Client covering the surface the generate views
+    use: files.upload, caches.create/update and models.generate_content_stream.
+
+    The fake "model" answers with the curated reference for the prompt when
+    the context it was sent covers at least half of the reference's words,
+    and with NO_ANSWER otherwise, so dropping the relevant passages costs
+    correctness the same way it would with the real model.
+
+    Timings of the current request are recorded in the dict returned by
+    start_timings(), which follows the request into the threads dispatch
+    runs generations in.
+    """
+
+    def __init__(
+        self,
+        knowledge_text: str,
+        references: dict[str, str] | None = None,
+        upload_latency: float = 0.0,
+        first_chunk_latency: float = 0.0,
+        chunk_latency: float = 0.0,
+        model_first_chunk_latency: dict[str, float] | None = None,
+        error_rate: float = 0.0,
+        words_per_chunk: int = 8,
+        seed: int | None = None,
+    ):
+        self.knowledge_text = knowledge_text
+        self._knowledge_tokens = set(tokenize(knowledge_text))
+        self.references = {
+            normalize_text(prompt): answer for prompt, answer in (references or {}).items()
+        }
+        self.upload_latency = upload_latency
+        self.first_chunk_latency = first_chunk_latency
+        self.chunk_latency = chunk_latency
+        # First-chunk latency of specific models, e.g. a faster flash model
+        self.model_first_chunk_latency = model_first_chunk_latency or {}
+        self.error_rate = error_rate
+        self.words_per_chunk = words_per_chunk
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.generations_by_model = Counter()
+        self._stages = contextvars.ContextVar("bench_stages", default=None)
+
+        self.files = SimpleNamespace(upload=self._upload)
+        self.caches = SimpleNamespace(create=self._create_cache, update=self._update_cache)
+        self.models = SimpleNamespace(generate_content_stream=self._generate_content_stream)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    def start_timings(self) -> dict:
+        """
+        Starts recording stage timings for the current request.
+        """
+        stages = {}
+        self._stages.set(stages)
+        return stages
+
+    def _record(self, stage: str, seconds: float) -> None:
+        stages = self._stages.get()
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds * 1000
+
+    def _fails(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _upload(self, file):
+        self._count("uploads")
+        started = time.monotonic()
+        time.sleep(self.upload_latency)
+        self._record("upload", time.monotonic() - started)
+        number = self.calls["uploads"]
+        return SimpleNamespace(
+            name=f"files/bench-{number}",
+            uri=f"https://example.invalid/files/bench-{number}",
+            mime_type="application/pdf",
+            expiration_time=timezone.now() + timedelta(hours=48),
+        )
+
+    def _create_cache(self, model, config):
+        self._count("cache_creates")
+        return SimpleNamespace(
+            name=f"cachedContents/bench-{self.calls['cache_creates']}",
+            expire_time=timezone.now() + timedelta(hours=1),
+        )
+
+    def _update_cache(self, name, config):
+        self._count("cache_updates")
+        return SimpleNamespace(
+            name=name, expire_time=timezone.now() + timedelta(hours=1)
+        )
+
+    def _context(self, contents, config) -> tuple[str, str, bool]:
+        """
+        Returns the prompt, the context text sent with it, and whether the
+        context came from a cached context.
+        """
+        texts, attached = [], False
+        for content in contents:
+            for part in content.parts:
+                if getattr(part, "file_data", None) is not None:
+                    attached = True
+                elif part.text:
+                    texts.append(part.text)
+        cached = bool(getattr(config, "cached_content", None))
+        context = texts[:-1]
+        if attached or cached:
+            context.append(self.knowledge_text)
+        return (texts[-1] if texts else ""), "\n".join(context), cached
+
+    def answer(self, prompt: str, context: str) -> str:
+        reference = self.references.get(normalize_text(prompt))
+        if reference is None:
+            return NO_ANSWER
+        reference_tokens = set(tokenize(reference))
+        if not reference_tokens:
+            return reference
+        context_tokens = set(tokenize(context.replace(self.knowledge_text, "")))
+        if self.knowledge_text in context:
+            context_tokens |= self._knowledge_tokens
+        covered = len(reference_tokens & context_tokens) / len(reference_tokens)
+        return reference if covered >= 0.5 else NO_ANSWER
+
+    def _generate_content_stream(self, model, contents, config):
+        self._count("generations")
+        with self._lock:
+            self.generations_by_model[model] += 1
+        first_chunk_latency = self.model_first_chunk_latency.get(model, self.first_chunk_latency)
+        prompt, context, cached = self._context(contents, config)
+        text = self.answer(prompt, context)
+        words = text.split(" ")
+        chunks = [
+            " ".join(words[start : start + self.words_per_chunk])
+            + (" " if start + self.words_per_chunk < len(words) else "")
+            for start in range(0, len(words), self.words_per_chunk)
+        ]
+        prompt_tokens = estimate_text_tokens(context + prompt)
+        fails = self._fails()
+
+        def stream():
+            started = time.monotonic()
+            time.sleep(first_chunk_latency)
+            if fails:
+                raise _api_error(genai_errors.ServerError, 503, "Simulated outage")
+            self._record("first_chunk", time.monotonic() - started)
+            for index, chunk in enumerate(chunks):
+                if index:
+                    time.sleep(self.chunk_latency)
+                last = index == len(chunks) - 1
+                yield SimpleNamespace(
+                    text=chunk,
+                    prompt_feedback=None,
+                    candidates=[SimpleNamespace(finish_reason="STOP" if last else None)],
+                    usage_metadata=SimpleNamespace(
+                        prompt_token_count=prompt_tokens,
+                        candidates_token_count=estimate_text_tokens(text),
+                        total_token_count=prompt_tokens + estimate_text_tokens(text),
+                        cached_content_token_count=prompt_tokens if cached else 0,
+                    )
+                    if last
+                    else None,
+                )
+            self._record("generation", time.monotonic() - started)
+
+        return stream()
+
+
+@dataclass
+class ReplayRecord:
+    prompt: str
+    status: int
+    source: str | None
+    cached: bool
+    total_ms: float
+    stages: dict
+    score: float | None
+    upstream_calls: int = 0
+
+
+@dataclass
+class ReplayReport:
+    records: list[ReplayRecord] = field(default_factory=list)
+    elapsed_seconds: float = 0.0
+    upstream_calls: dict = field(default_factory=dict)
+
+    def summary(self) -> dict:
+        """
+        Machine-readable summary of the run.
+        """
+        count = len(self.records)
+        stage_names = sorted({stage for record in self.records for stage in record.stages})
+        scores = [record.score for record in self.records if record.score is not None]
+        upstream_total = sum(self.upstream_calls.values())
+        return {
+            "requests": count,
+            "errors": sum(record.status >= 400 for record in self.records),
+            "elapsed_seconds": round(self.elapsed_seconds, 3),
+            "requests_per_second": round(count / self.elapsed_seconds, 2)
+            if self.elapsed_seconds
+            else None,
+            "latency": {
+                "request": latency_summary([record.total_ms for record in self.records]),
+                **{
+                    stage: latency_summary(
+                        [
+                            record.stages[stage]
+                            for record in self.records
+                            if stage in record.stages
+                        ]
+                    )
+                    for stage in stage_names
+                },
+            },
+            "upstream_calls": dict(self.upstream_calls),
+            "upstream_calls_per_request": round(upstream_total / count, 3)
+            if count
+            else None,
+            "sources": dict(
+                Counter(
+                    "cache" if record.cached else (record.source or "error")
+                    for record in self.records
+                )
+            ),
+            "score": {
+                "scored": len(scores),
+                "mean_f1": round(sum(scores) / len(scores), 3) if scores else None,
+                "correct": sum(score >= 0.5 for score in scores),
+            },
+        }
+
+
+def replay(items: list[ReplayItem], client: FakeGenaiClient, concurrency: int = 1) -> ReplayReport:
+    """
+    Replays the items through GenerateTextView with client standing in for
+    the Gemini API, without the per-client rate limit.
+
+    Args:
+        items: The prompts to send, with optional reference answers.
+        client: The fake client answering upstream calls.
+        concurrency: Number of requests in flight at the same time.
+
+    Returns:
+        The ReplayReport.
+    """
+    from .views import GenerateTextView
+
+    view = GenerateTextView.as_view()
+    factory = RequestFactory()
+
+    def send(item: ReplayItem) -> ReplayRecord:
+        stages = client.start_timings()
+        request = factory.post(
+            "/api/generate/", {"prompt": item.prompt}, content_type="application/json"
+        )
+        before = sum(client.calls.values())
+        started = time.monotonic()
+        response = view(request)
+        response.render()
+        total_ms = (time.monotonic() - started) * 1000
+        data = json.loads(response.content or b"{}")
+        answer = data.get("response")
+        return ReplayRecord(
+            prompt=item.prompt,
+            status=response.status_code,
+            source=data.get("source"),
+            cached=bool(data.get("cached")),
+            total_ms=round(total_ms, 3),
+            stages={name: round(ms, 3) for name, ms in stages.items()},
+            score=token_f1(answer or "", item.reference)
+            if item.reference is not None
+            else None,
+            # Approximate under concurrency: counts calls made meanwhile.
+            upstream_calls=sum(client.calls.values()) - before,
+        )
+
+    report = ReplayReport()
+    started = time.monotonic()
+    # Every replayed request comes from the same address
+    with use_genai_client(client), override_settings(VERITAS_RATE_LIMIT_PER_MINUTE=None):
+        if concurrency > 1:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                report.records = list(pool.map(send, items))
+        else:
+            report.records = [send(item) for item in items]
+    report.elapsed_seconds = time.monotonic() - started
+    report.upstream_calls = dict(client.calls)
+    return report
+
+
+def write_report(path: str, config: dict, report: ReplayReport, details: bool) -> None:
+    """
+    Writes the run configuration and summary (and per-request records) as
+    JSON for regression tracking.
+    """
+    payload = {"config": config, "summary": report.summary()}
+    if details:
+        payload["requests"] = [record.__dict__ for record in report.records]
+    with open(path, "w", encoding="utf-8") as report_file:
+        json.dump(payload, report_file, indent=2, default=str)
+
+
+def _forget_warm_state() -> None:
+    """
+    Puts the process back in the state of a freshly started worker: no
+    indexes, client, uploaded file handle or cached context.
+    """
+    from .client_provider import reset_genai_client
+    from .context_cache import reset_context_cache
+    from .faq import reset_faq_matcher
+    from .file_registry import reset_file_registry
+    from .models import CachedContextHandle, UploadedFileHandle
+    from .response_cache import clear_memory_cache
+    from .retrieval import reset_passage_indexes
+    from .warmup import reset_warmup
+
+    reset_faq_matcher()
+    reset_passage_indexes()
+    reset_genai_client()
+    reset_file_registry()
+    reset_context_cache()
+    clear_memory_cache()
+    reset_warmup()
+    UploadedFileHandle.objects.all().delete()
+    CachedContextHandle.objects.all().delete()
+
+
+def measure_cold_start(client: FakeGenaiClient, prompt: str) -> dict:
+    """
+    Times the first generate request of a fresh worker without and with
+    warm-up, with client standing in for the Gemini API and the FAQ shortcut
+    off.
+
+    Clears the handle tables, so it must run against a throwaway database.
+
+    Args:
+        client: The fake client answering upstream calls.
+        prompt: The prompt of the first request.
+
+    Returns:
+        The first request's milliseconds cold and warm, and the warm-up
+        report.
+    """
+    from .views import GenerateTextView
+    from .warmup import run_warmup
+
+    view = GenerateTextView.as_view()
+    factory = RequestFactory()
+
+    def first_request_ms() -> float:
+        request = factory.post(
+            "/api/generate/",
+            {"prompt": prompt, "use_cache": False},
+            content_type="application/json",
+        )
+        started = time.monotonic()
+        view(request).render()
+        return round((time.monotonic() - started) * 1000, 3)
+
+    # The FAQ would answer the prompt without the model
+    with use_genai_client(client), override_settings(
+        VERITAS_RATE_LIMIT_PER_MINUTE=None, VERITAS_FAQ_ENABLED=False
+    ):
+        _forget_warm_state()
+        cold_ms = first_request_ms()
+        _forget_warm_state()
+        warmup = run_warmup()
+        warm_ms = first_request_ms()
+    return {"cold_first_request_ms": cold_ms, "warm_first_request_ms": warm_ms, "warmup": warmup}
+
+
+def evaluate_routing(
+    items: list[ReplayItem], client: FakeGenaiClient, file_path: str, concurrency: int = 1
+) -> dict:
+    """
+    Replays the items with every prompt sent to VERITAS_AI_MODEL, then with
+    the router on, and compares the latency of each route. The FAQ shortcut
+    and the response cache are off so every request reaches the model.
+
+    Args:
+        items: The prompts to send, with optional reference answers.
+        client: The fake client answering upstream calls, usually with a
+            faster first chunk for the routed models.
+        file_path: The path to the Veritas data file.
+        concurrency: Number of requests in flight at the same time.
+
+    Returns:
+        Per route: its model, the share of prompts it took, their latency
+        without and with routing and the milliseconds saved per request.
+    """
+    from .ai_helpers import model_preamble
+    from .routing import prompt_features, route_prompt
+
+    preamble = model_preamble()
+    decisions = [route_prompt(prompt_features(item.prompt, file_path, preamble)) for item in items]
+    reports = {}
+    with override_settings(VERITAS_FAQ_ENABLED=False, VERITAS_RESPONSE_CACHE_ENABLED=False):
+        for routed in (False, True):
+            client.generations_by_model.clear()
+            with override_settings(VERITAS_ROUTER_ENABLED=routed):
+                reports[routed] = replay(items, client, concurrency)
+            reports[routed].upstream_calls["generations_by_model"] = dict(
+                client.generations_by_model
+            )
+
+    def compare(indexes: list[int]) -> dict:
+        baseline = latency_summary([reports[False].records[i].total_ms for i in indexes])
+        routed = latency_summary([reports[True].records[i].total_ms for i in indexes])
+        return {
+            "requests": len(indexes),
+            "share": round(len(indexes) / len(items), 3),
+            "baseline": baseline,
+            "routed": routed,
+            "saved_ms_per_request": round(baseline["mean_ms"] - routed["mean_ms"], 2),
+        }
+
+    by_route: dict[str, list[int]] = {}
+    for index, decision in enumerate(decisions):
+        by_route.setdefault(decision.route, []).append(index)
+    return {
+        "routes": {
+            route: {"model": decisions[indexes[0]].model, **compare(indexes)}
+            for route, indexes in by_route.items()
+        },
+        "overall": compare(list(range(len(items)))) if items else None,
+        "errors": {
+            "baseline": sum(record.status >= 400 for record in reports[False].records),
+            "routed": sum(record.status >= 400 for record in reports[True].records),
+        },
+        "generations_by_model": {
+            "baseline": reports[False].upstream_calls["generations_by_model"],
+            "routed": reports[True].upstream_calls["generations_by_model"],
+        },
+    }
@@ -0,0 +1,339 @@
+"""
+Token budgets checked before a prompt reaches the model.
+
+* The prompt alone is checked against VERITAS_MAX_PROMPT_TOKENS. Longer
+  prompts are rejected, or trimmed in the middle when
+  VERITAS_PROMPT_OVERFLOW is "trim".
+* The tokens a client used in the current window are checked against
+  VERITAS_CLIENT_TOKEN_BUDGET. Clients are charged the usage the model
+  reports once an answer completes.
+* The assembled request (knowledge base context and prompt) is checked
+  against VERITAS_MAX_INPUT_TOKENS.
+
+Token counts are local estimates (about four characters per token and
+PDF_PAGE_TOKENS per attached PDF page). With VERITAS_EXACT_TOKEN_COUNT, the
+model counts the tokens of requests close enough to the limit for the
+estimate to matter.
+"""
+# budgets.py
+
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .ai_helpers import prompt_template
+from .retrieval import attached_file_tokens
+from .stats import StatCounters
+from .text_index import estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+budget_stats = StatCounters(
+    "budgets",
+    "prompts_trimmed",
+    "prompts_rejected",
+    "inputs_rejected",
+    "clients_rejected",
+    "exact_counts",
+    "exact_count_failures",
+    "charged_tokens",
+)
+
+PROMPT_OVERFLOW_REJECT = "reject"
+PROMPT_OVERFLOW_TRIM = "trim"
+TRIM_MARKER = "\n[...]\n"
+
+
+class TokenBudgetExceeded(Exception):
+    """
+    Raised when a prompt or an assembled request has more tokens than its
+    budget allows.
+    """
+
+    def __init__(self, message: str, tokens: int, budget: int):
+        super().__init__(message)
+        self.tokens = tokens
+        self.budget = budget
+
+
+class ClientBudgetExceeded(Exception):
+    """
+    Raised when a client has used up its token budget for the current window.
+    """
+
+    def __init__(self, used: int, budget: int, retry_after: int):
+        super().__init__(f"Used {used} of {budget} tokens in the current window")
+        self.used = used
+        self.budget = budget
+        self.retry_after = retry_after
+
+
+def trim_text(text: str, max_tokens: int) -> str:
+    """
+    Cuts the middle out of a text so that its estimate fits max_tokens,
+    keeping the start (what the prompt is about) and the end (usually the
+    actual question).
+    """
+    keep = max(max_tokens * 4 - len(TRIM_MARKER), 0)
+    head = keep // 2
+    tail = keep - head
+    return text[:head].rstrip() + TRIM_MARKER + text[len(text) - tail :].lstrip()
+
+
+def apply_prompt_budget(prompt: str) -> str:
+    """
+    Checks a prompt against VERITAS_MAX_PROMPT_TOKENS.
+
+    Returns:
+        The prompt, trimmed if it was too long and VERITAS_PROMPT_OVERFLOW
+        is "trim".
+
+    Raises:
+        TokenBudgetExceeded: The prompt is too long and is not trimmed.
+    """
+    limit = getattr(settings, "VERITAS_MAX_PROMPT_TOKENS", None)
+    tokens = estimate_text_tokens(prompt)
+    if limit is None or tokens <= limit:
+        return prompt
+    if settings.VERITAS_PROMPT_OVERFLOW != PROMPT_OVERFLOW_TRIM:
+        budget_stats.incr("prompts_rejected")
+        raise TokenBudgetExceeded(
+            f"The prompt is about {tokens} tokens long; the limit is {limit}.",
+            tokens,
+            limit,
+        )
+    budget_stats.incr("prompts_trimmed")
+    logger.info(f"Trimming prompt of about {tokens} tokens to {limit}.")
+    return trim_text(prompt, limit)
+
+
+def _cached_prefix_tokens(file_path: str) -> int:
+    """
+    Estimated tokens of the prefix held by the upstream cached context.
+    """
+    return attached_file_tokens(file_path) + prompt_template().cached_prefix_tokens
+
+
+def estimate_request_tokens(contents, config, file_path: str) -> int:
+    """
+    Estimates the input tokens of an assembled request, including the data
+    file attached to it or referenced through a cached context. The fixed
+    parts of the prompt template are not tokenized again.
+    """
+    template = prompt_template()
+    tokens = 0
+    for content in contents:
+        known = template.known_tokens(content)
+        if known is not None:
+            tokens += known
+            continue
+        for part in content.parts or []:
+            if part.file_data is not None:
+                tokens += attached_file_tokens(file_path)
+            elif part.text:
+                tokens += estimate_text_tokens(part.text)
+    if config is not None and config.cached_content:
+        tokens += _cached_prefix_tokens(file_path)
+    elif config is not None and config.system_instruction:
+        tokens += template.system_instruction_tokens
+    return tokens
+
+
+def _needs_exact_count(estimate: int, limit: int) -> bool:
+    return getattr(settings, "VERITAS_EXACT_TOKEN_COUNT", False) and (
+        estimate >= limit * settings.VERITAS_EXACT_TOKEN_COUNT_MARGIN
+    )
+
+
+def _exact_tokens(counted, config, file_path: str) -> int:
+    budget_stats.incr("exact_counts")
+    tokens = counted.total_tokens
+    if config is not None and config.cached_content:
+        # count_tokens can't reference a cached context
+        tokens += _cached_prefix_tokens(file_path)
+    return tokens
+
+
+def _check_input(tokens: int, limit: int) -> int:
+    if tokens > limit:
+        budget_stats.incr("inputs_rejected")
+        raise TokenBudgetExceeded(
+            f"The request is about {tokens} input tokens; the limit is {limit}.",
+            tokens,
+            limit,
+        )
+    return tokens
+
+
+def enforce_input_budget(client, model_name: str, contents, config, file_path: str) -> int:
+    """
+    Checks an assembled request against VERITAS_MAX_INPUT_TOKENS.
+
+    Args:
+        client: The initialized Google AI client (for exact counts).
+        model_name: The model the request is for.
+        contents: The contents built for the request.
+        config: The GenerateContentConfig the contents are sent with.
+        file_path: The path to the Veritas data file.
+
+    Returns:
+        The input tokens, counted or estimated.
+
+    Raises:
+        TokenBudgetExceeded: The request is over the limit.
+    """
+    tokens = estimate_request_tokens(contents, config, file_path)
+    limit = getattr(settings, "VERITAS_MAX_INPUT_TOKENS", None)
+    if limit is None:
+        return tokens
+    if _needs_exact_count(tokens, limit):
+        try:
+            counted = client.models.count_tokens(model=model_name, contents=contents)
+            tokens = _exact_tokens(counted, config, file_path)
+        except Exception as e:
+            budget_stats.incr("exact_count_failures")
+            logger.warning(f"Token count failed, using the estimate: {e}")
+    return _check_input(tokens, limit)
+
+
+async def aenforce_input_budget(
+    client, model_name: str, contents, config, file_path: str
+) -> int:
+    """
+    Async version of enforce_input_budget.
+    """
+    tokens = estimate_request_tokens(contents, config, file_path)
+    limit = getattr(settings, "VERITAS_MAX_INPUT_TOKENS", None)
+    if limit is None:
+        return tokens
+    if _needs_exact_count(tokens, limit):
+        try:
+            counted = await client.aio.models.count_tokens(
+                model=model_name, contents=contents
+            )
+            tokens = _exact_tokens(counted, config, file_path)
+        except Exception as e:
+            budget_stats.incr("exact_count_failures")
+            logger.warning(f"Token count failed, using the estimate: {e}")
+    return _check_input(tokens, limit)
+
+
+def client_identifier(request) -> str:
+    """
+    Identifies the client a request is charged to: the first address in
+    VERITAS_CLIENT_ID_HEADER if set (behind a proxy), else the remote address.
+    """
+    header = getattr(settings, "VERITAS_CLIENT_ID_HEADER", None)
+    if header and request.headers.get(header):
+        return request.headers[header].split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR") or "unknown"
+
+
+def usage_tokens(done_data: dict) -> int:
+    """
+    Tokens to charge for a completed generation. Coalesced answers are
+    charged to the request that generated them.
+    """
+    if done_data.get("coalesced"):
+        return 0
+    if done_data.get("total_tokens") is not None:
+        return done_data["total_tokens"]
+    return (done_data.get("prompt_tokens") or 0) + (done_data.get("completion_tokens") or 0)
+
+
+def _client_budget() -> int | None:
+    return getattr(settings, "VERITAS_CLIENT_TOKEN_BUDGET", None)
+
+
+def _budget_cache():
+    return caches[settings.VERITAS_RESPONSE_CACHE_ALIAS]
+
+
+def _window_key(client_id: str) -> tuple[str, int]:
+    """
+    Returns the cache key counting the client's tokens in the current window
+    and the seconds until the window ends.
+    """
+    window = settings.VERITAS_CLIENT_TOKEN_WINDOW_SECONDS
+    now = time.time()
+    index = int(now // window)
+    client_hash = hashlib.sha256(client_id.encode()).hexdigest()[:32]
+    return f"veritas:tokens:{client_hash}:{index}", int((index + 1) * window - now) + 1
+
+
+def _check_client(used: int, tokens: int, retry_after: int) -> None:
+    budget = _client_budget()
+    if used + tokens > budget:
+        budget_stats.incr("clients_rejected")
+        raise ClientBudgetExceeded(used, budget, retry_after)
+
+
+def check_client_budget(client_id: str, tokens: int = 0) -> None:
+    """
+    Checks that a client has tokens left in the current window for a
+    request expected to use about `tokens`.
+
+    Raises:
+        ClientBudgetExceeded: The client has used up its budget.
+    """
+    if not _client_budget():
+        return
+    key, retry_after = _window_key(client_id)
+    try:
+        used = _budget_cache().get(key, 0)
+    except Exception as e:
+        logger.warning(f"Client token budget unavailable: {e}")
+        return
+    _check_client(used, tokens, retry_after)
+
+
+async def acheck_client_budget(client_id: str, tokens: int = 0) -> None:
+    """
+    Async version of check_client_budget.
+    """
+    if not _client_budget():
+        return
+    key, retry_after = _window_key(client_id)
+    try:
+        used = await _budget_cache().aget(key, 0)
+    except Exception as e:
+        logger.warning(f"Client token budget unavailable: {e}")
+        return
+    _check_client(used, tokens, retry_after)
+
+
+def charge_client_tokens(client_id: str, tokens: int) -> None:
+    """
+    Adds tokens to the client's usage in the current window.
+    """
+    if not _client_budget() or not tokens:
+        return
+    key, _ = _window_key(client_id)
+    cache = _budget_cache()
+    try:
+        cache.add(key, 0, settings.VERITAS_CLIENT_TOKEN_WINDOW_SECONDS)
+        cache.incr(key, tokens)
+    except Exception as e:
+        logger.warning(f"Failed to charge client tokens: {e}")
+        return
+    budget_stats.incr("charged_tokens", tokens)
+
+
+async def acharge_client_tokens(client_id: str, tokens: int) -> None:
+    """
+    Async version of charge_client_tokens.
+    """
+    if not _client_budget() or not tokens:
+        return
+    key, _ = _window_key(client_id)
+    cache = _budget_cache()
+    try:
+        await cache.aadd(key, 0, settings.VERITAS_CLIENT_TOKEN_WINDOW_SECONDS)
+        await cache.aincr(key, tokens)
+    except Exception as e:
+        logger.warning(f"Failed to charge client tokens: {e}")
+        return
+    budget_stats.incr("charged_tokens", tokens)
@@ -0,0 +1,166 @@
+"""
+Cancellation of generations nobody is waiting for any more.
+
+A generate request has a deadline: VERITAS_REQUEST_DEADLINE_SECONDS, or less
+if the client asks for it with "deadline_seconds" in the body or the
+X-Veritas-Deadline-Seconds header (the Next.js route can set it to what it
+will wait itself). Dispatch (see dispatch.py) stops waiting once it passes,
+closes the upstream stream and the request fails with 504, or with an error
+event once the answer is streaming. A job (see jobs.py) also passes dispatch
+a check for its cancellation, which is polled every CANCEL_POLL_SECONDS
+while the model is generating.
+
+A client that disconnects stops reading the events: under ASGI the view is
+cancelled as soon as the server sees the disconnect, under WSGI the next
+write of a streamed answer fails. Either way the event stream is closed,
+which closes the upstream stream instead of reading the answer to its end.
+
+Each stopped generation is counted by reason ("deadline", or "disconnect"
+when whoever read the events went away: the client, a cancelled job or a
+timed out batch item) in veritas_cancelled_generations_total, with an
+estimate of the output tokens that weren't generated in
+veritas_cancelled_tokens_saved_total: the model's median answer length over
+its recent answers less what it had already produced.
+"""
+# cancellation.py
+
+import logging
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .metrics import cancelled_generations, cancelled_tokens_saved
+from .stats import StatCounters, percentile
+
+logger = logging.getLogger(__name__)
+
+cancellation_stats = StatCounters("cancellation", "disconnects", "deadlines", "tokens_saved")
+
+CANCEL_DISCONNECT = "disconnect"
+CANCEL_DEADLINE = "deadline"
+DEADLINE_HEADER = "X-Veritas-Deadline-Seconds"
+# How often a generation checks whether it is still wanted while it waits
+# for the model
+CANCEL_POLL_SECONDS = 0.25
+# Recent answer lengths remembered per model
+_COMPLETION_WINDOW = 200
+
+
+class RequestDeadlineExceeded(Exception):
+    """
+    Raised when a request's deadline passed before its answer was complete.
+    """
+
+    def __init__(self, model: str | None = None):
+        if model is None:
+            # A coalesced request waiting for another request's answer
+            super().__init__("Deadline passed while waiting for an identical request's answer")
+        else:
+            super().__init__(f"Deadline passed while waiting for model {model}")
+        self.model = model
+
+
+class RequestCancelled(Exception):
+    """
+    Raised when whoever wanted a request's answer cancelled it (a cancelled
+    job).
+    """
+
+
+def request_deadline(request, validated_data: dict) -> float | None:
+    """
+    Returns the time.monotonic() by which a generate request must be
+    answered, or None if it has no deadline.
+
+    The shortest of "deadline_seconds", the X-Veritas-Deadline-Seconds
+    header and VERITAS_REQUEST_DEADLINE_SECONDS applies. Invalid header
+    values are logged and ignored.
+    """
+    limits = [
+        validated_data.get("deadline_seconds"),
+        getattr(settings, "VERITAS_REQUEST_DEADLINE_SECONDS", None),
+    ]
+    header = request.headers.get(DEADLINE_HEADER)
+    if header:
+        try:
+            seconds = float(header)
+        except ValueError:
+            seconds = None
+        if seconds is not None and seconds > 0:
+            limits.append(seconds)
+        else:
+            logger.warning(f"Ignoring invalid {DEADLINE_HEADER} header: {header!r}")
+    limits = [limit for limit in limits if limit is not None]
+    if not limits:
+        return None
+    return time.monotonic() + min(limits)
+
+
+_completions: dict[str, deque] = {}
+_completions_lock = threading.Lock()
+
+
+def record_completion(model: str, completion_tokens: int | None) -> None:
+    """
+    Remembers the length of an answer a model finished.
+    """
+    if not completion_tokens:
+        return
+    with _completions_lock:
+        window = _completions.get(model)
+        if window is None:
+            window = _completions[model] = deque(maxlen=_COMPLETION_WINDOW)
+        window.append(completion_tokens)
+
+
+def expected_completion_tokens(model: str) -> int:
+    """
+    The median length of the model's recent answers, or
+    VERITAS_CANCEL_DEFAULT_ANSWER_TOKENS before it has any.
+    """
+    with _completions_lock:
+        values = list(_completions.get(model, ()))
+    if not values:
+        return settings.VERITAS_CANCEL_DEFAULT_ANSWER_TOKENS
+    return int(percentile(values, 0.5))
+
+
+def record_cancellation(
+    reason: str, model: str, generated_tokens: int, max_output_tokens: int | None
+) -> int:
+    """
+    Records a generation stopped before it finished.
+
+    Args:
+        reason: CANCEL_DISCONNECT or CANCEL_DEADLINE.
+        model: The model that was generating (or the first one tried).
+        generated_tokens: Output tokens produced before it stopped.
+        max_output_tokens: The request's output limit, if any.
+
+    Returns:
+        The estimated output tokens saved.
+    """
+    expected = expected_completion_tokens(model)
+    if max_output_tokens:
+        expected = min(expected, max_output_tokens)
+    saved = max(expected - generated_tokens, 0)
+    cancellation_stats.incr("deadlines" if reason == CANCEL_DEADLINE else "disconnects")
+    cancellation_stats.incr("tokens_saved", saved)
+    cancelled_generations.inc(reason=reason, model=model)
+    cancelled_tokens_saved.inc(saved, reason=reason)
+    logger.info(
+        f"Stopped generation on model {model} ({reason}) after {generated_tokens} tokens, "
+        f"about {saved} tokens saved"
+    )
+    return saved
+
+
+def reset_cancellation() -> None:
+    """
+    Forgets the answer lengths and the counters (used by tests).
+    """
+    with _completions_lock:
+        _completions.clear()
+    cancellation_stats.reset()
@@ -0,0 +1,244 @@
+"""
+Process-wide provider for the Google AI client.
+
+google-genai opens a new requests.Session / httpx.AsyncClient for every call,
+so each chat turn paid for a fresh TLS handshake on top of building a new
+genai.Client. The provider builds one client per process on first use, backs
+it with persistent connection pools, and rebuilds it when the API key or model
+settings change.
+"""
+# client_provider.py
+
+import asyncio
+import contextlib
+import json
+import logging
+import threading
+import weakref
+
+import httpx
+import requests
+from django.conf import settings
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai._api_client import BaseApiClient, HttpResponse
+
+logger = logging.getLogger(__name__)
+
+# Retired clients are closed after this many seconds so requests still using
+# them can finish.
+RETIRED_CLIENT_GRACE_SECONDS = 60
+
+
+class PooledApiClient(BaseApiClient):
+    """
+    BaseApiClient that reuses one requests.Session per process and one
+    httpx.AsyncClient per event loop instead of opening new ones per call.
+    """
+
+    def __init__(self, *args, pool_maxsize: int = 32, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_maxsize
+        )
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._pool_maxsize = pool_maxsize
+        # httpx.AsyncClient pools are bound to the loop they were first used on.
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._async_clients_lock = threading.Lock()
+
+    def _async_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._async_clients_lock:
+            aclient = self._async_clients.get(loop)
+            if aclient is None:
+                aclient = httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=self._pool_maxsize,
+                        max_keepalive_connections=self._pool_maxsize,
+                    )
+                )
+                self._async_clients[loop] = aclient
+            return aclient
+
+    def _request_unauthorized(self, http_request, stream: bool = False):
+        data = None
+        if http_request.data:
+            if not isinstance(http_request.data, bytes):
+                data = json.dumps(http_request.data)
+            else:
+                data = http_request.data
+
+        response = self._session.request(
+            method=http_request.method,
+            url=http_request.url,
+            headers=http_request.headers,
+            data=data,
+            timeout=http_request.timeout,
+            stream=stream,
+        )
+        genai_errors.APIError.raise_for_response(response)
+        return HttpResponse(response.headers, response if stream else [response.text])
+
+    async def _async_request(self, http_request, stream: bool = False):
+        if self.vertexai:
+            return await super()._async_request(http_request, stream)
+
+        aclient = self._async_client()
+        httpx_request = aclient.build_request(
+            method=http_request.method,
+            url=http_request.url,
+            content=json.dumps(http_request.data) if http_request.data else None,
+            headers=http_request.headers,
+            timeout=http_request.timeout,
+        )
+        response = await aclient.send(httpx_request, stream=stream)
+        if stream and response.status_code != 200:
+            await response.aread()
+        genai_errors.APIError.raise_for_response(response)
+        return HttpResponse(response.headers, response if stream else [response.text])
+
+    def request_streamed(self, http_method, path, request_dict, http_options=None):
+        http_request = self._build_request(
+            http_method, path, request_dict, http_options
+        )
+        session_response = self._request(http_request, stream=True)
+        try:
+            for chunk in session_response.segments():
+                yield chunk
+        finally:
+            # Return the connection to the pool even if the caller stops early.
+            close = getattr(session_response.response_stream, "close", None)
+            if close:
+                close()
+
+    async def async_request_streamed(
+        self, http_method, path, request_dict, http_options=None
+    ):
+        http_request = self._build_request(
+            http_method, path, request_dict, http_options
+        )
+        response = await self._async_request(http_request=http_request, stream=True)
+
+        async def async_generator():
+            try:
+                async for chunk in response:
+                    yield chunk
+            finally:
+                aclose = getattr(response.response_stream, "aclose", None)
+                if aclose:
+                    await aclose()
+
+        return async_generator()
+
+    def close(self) -> None:
+        """
+        Closes the pooled sync connections and drops the async pools.
+        """
+        self._session.close()
+        with self._async_clients_lock:
+            # Async pools can only be closed on their own loop; dropping the
+            # references lets their connections be garbage collected.
+            self._async_clients.clear()
+
+
+class PooledClient(genai.Client):
+    """
+    genai.Client backed by a PooledApiClient.
+    """
+
+    pool_maxsize = 32
+
+    def __init__(self, *args, pool_maxsize: int | None = None, **kwargs):
+        if pool_maxsize:
+            self.pool_maxsize = pool_maxsize
+        super().__init__(*args, **kwargs)
+
+    def _get_api_client(self, debug_config=None, **kwargs):
+        return PooledApiClient(pool_maxsize=self.pool_maxsize, **kwargs)
+
+    def close(self) -> None:
+        self._api_client.close()
+
+
+_lock = threading.Lock()
+_client: PooledClient | None = None
+_client_signature: tuple | None = None
+_override = None
+
+
+def _current_signature() -> tuple:
+    return (
+        settings.GOOGLE_AI_API_KEY,
+        settings.VERITAS_AI_MODEL,
+        settings.DEFAULT_GEMINI_MODEL,
+        getattr(settings, "VERITAS_GENAI_POOL_MAXSIZE", 32),
+    )
+
+
+def _retire(client: PooledClient) -> None:
+    timer = threading.Timer(RETIRED_CLIENT_GRACE_SECONDS, client.close)
+    timer.daemon = True
+    timer.start()
+
+
+def get_genai_client():
+    """
+    Returns the process-wide Google AI client, building it on first use and
+    rebuilding it if GOOGLE_AI_API_KEY or the model settings changed.
+
+    Safe to call from threads and from async code; the lock is only taken
+    when the client has to be (re)built.
+
+    Returns:
+        The shared genai client.
+    """
+    global _client, _client_signature
+
+    if _override is not None:
+        return _override
+
+    signature = _current_signature()
+    client = _client
+    if client is not None and _client_signature == signature:
+        return client
+
+    with _lock:
+        if _client is not None and _client_signature == signature:
+            return _client
+        if _client is not None:
+            logger.info("Google AI settings changed; rebuilding the shared client.")
+            _retire(_client)
+        _client = PooledClient(api_key=signature[0], pool_maxsize=signature[3])
+        _client_signature = signature
+        logger.info("Built shared Google AI client.")
+        return _client
+
+
+def reset_genai_client() -> None:
+    """
+    Closes and forgets the shared client; the next call builds a new one.
+    """
+    global _client, _client_signature
+    with _lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _client_signature = None
+
+
+@contextlib.contextmanager
+def use_genai_client(client):
+    """
+    Makes get_genai_client return the given client inside the block. Used by
+    tests and benchmarks to swap in a stand-in for the real API.
+    """
+    global _override
+    previous = _override
+    _override = client
+    try:
+        yield client
+    finally:
+        _override = previous
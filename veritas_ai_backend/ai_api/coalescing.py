@@ -0,0 +1,471 @@
+"""
+Single-flight coalescing of identical in-flight generations.
+
+When an announcement goes out, many students ask the same question within
+seconds, before the first answer has reached the response cache. The first
+request for a key (normalized prompt, model, parameters and knowledge base
+version) becomes the leader and calls the model; identical requests arriving
+while it runs follow it and receive the same events as they are produced,
+so they stream too, without another upstream call.
+
+Followers give up on a leader that produces nothing for
+VERITAS_COALESCE_WAIT_SECONDS and generate the answer themselves, unless
+their own request deadline passed first (see cancellation.py). With
+VERITAS_COALESCE_SHARED the leader also takes a lock in the shared response
+cache, and leaders in other workers wait for its answer to be cached instead
+of generating it again.
+"""
+# coalescing.py
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from collections.abc import AsyncIterator, Callable, Iterator
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .cancellation import RequestCancelled, RequestDeadlineExceeded
+from .stats import StatCounters
+
+logger = logging.getLogger(__name__)
+
+coalesce_stats = StatCounters(
+    "coalescing",
+    "leaders",
+    "followers",
+    "saved_calls",
+    "follower_timeouts",
+    "follower_fallbacks",
+    "shared_waits",
+    "shared_hits",
+)
+
+
+class FlightTimeout(Exception):
+    """
+    Raised to a follower when the leader produced nothing for too long.
+    """
+
+
+class FlightAbandoned(Exception):
+    """
+    Raised to a follower when the leader stopped before finishing, for
+    example because its client disconnected or its deadline passed.
+    """
+
+
+class Flight:
+    """
+    One in-flight generation: the events produced so far and how it ended.
+
+    Thread-safe; followers may wait in other threads or on event loops.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.events: list[tuple[str, dict]] = []
+        self.finished = False
+        self.error: Exception | None = None
+        self._condition = threading.Condition()
+        # (event loop, asyncio.Event) of async followers waiting for news
+        self._async_waiters: set = set()
+
+    def _notify(self) -> None:
+        self._condition.notify_all()
+        for loop, waiter in self._async_waiters:
+            loop.call_soon_threadsafe(waiter.set)
+
+    def publish(self, event: tuple[str, dict]) -> None:
+        with self._condition:
+            self.events.append(event)
+            self._notify()
+
+    def finish(self, error: Exception | None = None) -> None:
+        with self._condition:
+            if self.finished:
+                return
+            self.finished = True
+            self.error = error
+            self._notify()
+
+    def _snapshot(self, index: int):
+        # Must hold the condition. Returns None if there is nothing new.
+        if len(self.events) <= index and not self.finished:
+            return None
+        return self.events[index:], self.finished, self.error
+
+    def follow(
+        self, timeout: float, deadline: float | None = None
+    ) -> Iterator[tuple[str, dict]]:
+        """
+        Yields every event of the flight, waiting up to timeout seconds for
+        each new one (never past the time.monotonic() deadline), and
+        re-raises the leader's error.
+        """
+        index = 0
+        while True:
+            with self._condition:
+                if not self._condition.wait_for(
+                    lambda: self._snapshot(index) is not None, _bounded(timeout, deadline)
+                ):
+                    raise FlightTimeout(self.key)
+                events, finished, error = self._snapshot(index)
+            index += len(events)
+            yield from events
+            if finished:
+                if error is not None:
+                    raise error
+                return
+
+    async def afollow(
+        self, timeout: float, deadline: float | None = None
+    ) -> AsyncIterator[tuple[str, dict]]:
+        """
+        Async version of follow.
+        """
+        loop = asyncio.get_running_loop()
+        index = 0
+        while True:
+            waiter = (loop, asyncio.Event())
+            with self._condition:
+                snapshot = self._snapshot(index)
+                if snapshot is None:
+                    self._async_waiters.add(waiter)
+            if snapshot is None:
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), _bounded(timeout, deadline))
+                except asyncio.TimeoutError:
+                    raise FlightTimeout(self.key) from None
+                finally:
+                    with self._condition:
+                        self._async_waiters.discard(waiter)
+                continue
+            events, finished, error = snapshot
+            index += len(events)
+            for event in events:
+                yield event
+            if finished:
+                if error is not None:
+                    raise error
+                return
+
+
+_flights: dict[str, Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def coalescing_enabled() -> bool:
+    return getattr(settings, "VERITAS_COALESCE_ENABLED", True)
+
+
+def _wait_seconds() -> float:
+    return settings.VERITAS_COALESCE_WAIT_SECONDS
+
+
+def _bounded(seconds: float, deadline: float | None) -> float:
+    """
+    Seconds to wait, cut to what is left before the time.monotonic()
+    deadline.
+    """
+    if deadline is None:
+        return seconds
+    return max(min(seconds, deadline - time.monotonic()), 0)
+
+
+def _deadline_passed(deadline: float | None) -> bool:
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _join(key: str) -> tuple[Flight, bool]:
+    """
+    Returns the flight for a key and whether the caller leads it.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            return flight, False
+        flight = _flights[key] = Flight(key)
+        return flight, True
+
+
+def _leave(flight: Flight) -> None:
+    with _flights_lock:
+        if _flights.get(flight.key) is flight:
+            del _flights[flight.key]
+
+
+def _mark_coalesced(event: tuple[str, dict]) -> tuple[str, dict]:
+    name, data = event
+    if name == "done":
+        return name, {**data, "coalesced": True}
+    return event
+
+
+def _cached_answer_events(data: dict) -> list[tuple[str, dict]]:
+    """
+    Events for an answer another worker stored in the response cache.
+    """
+    return [
+        ("chunk", {"text": data["response"]}),
+        (
+            "done",
+            {
+                "model": data.get("model"),
+                "finish_reason": "STOP",
+                "prompt_tokens": None,
+                "completion_tokens": None,
+                "total_tokens": None,
+                "coalesced": True,
+            },
+        ),
+    ]
+
+
+def _shared_lock_key(key: str) -> str:
+    return f"veritas:inflight:{key}"
+
+
+def _shared_cache():
+    return caches[settings.VERITAS_RESPONSE_CACHE_ALIAS]
+
+
+def _lead(
+    key: str, produce: Callable[[], Iterator], deadline: float | None = None
+) -> Iterator[tuple[str, dict]]:
+    """
+    Produces the events of a flight, first waiting for another worker that
+    is already generating the same answer when shared coalescing is on.
+    """
+    if not getattr(settings, "VERITAS_COALESCE_SHARED", False):
+        yield from produce()
+        return
+
+    cache = _shared_cache()
+    lock_key = _shared_lock_key(key)
+    try:
+        acquired = cache.add(lock_key, uuid.uuid4().hex, _wait_seconds())
+    except Exception as e:
+        logger.warning(f"Shared coalescing lock unavailable: {e}")
+        acquired = True
+    if acquired:
+        try:
+            yield from produce()
+        finally:
+            try:
+                cache.delete(lock_key)
+            except Exception as e:
+                logger.warning(f"Failed to release shared coalescing lock: {e}")
+        return
+
+    coalesce_stats.incr("shared_waits")
+    wait_until = time.monotonic() + _bounded(_wait_seconds(), deadline)
+    data = None
+    try:
+        while time.monotonic() < wait_until:
+            data = cache.get(key)
+            if data is not None or cache.get(lock_key) is None:
+                data = data or cache.get(key)
+                break
+            time.sleep(settings.VERITAS_COALESCE_POLL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Shared coalescing wait failed: {e}")
+    if data is not None:
+        coalesce_stats.incr("shared_hits")
+        coalesce_stats.incr("saved_calls")
+        yield from _cached_answer_events(data)
+        return
+    if _deadline_passed(deadline):
+        raise RequestDeadlineExceeded()
+    yield from produce()
+
+
+async def _alead(
+    key: str, produce: Callable[[], AsyncIterator], deadline: float | None = None
+) -> AsyncIterator:
+    """
+    Async version of _lead.
+    """
+    if not getattr(settings, "VERITAS_COALESCE_SHARED", False):
+        async for event in produce():
+            yield event
+        return
+
+    cache = _shared_cache()
+    lock_key = _shared_lock_key(key)
+    try:
+        acquired = await cache.aadd(lock_key, uuid.uuid4().hex, _wait_seconds())
+    except Exception as e:
+        logger.warning(f"Shared coalescing lock unavailable: {e}")
+        acquired = True
+    if acquired:
+        try:
+            async for event in produce():
+                yield event
+        finally:
+            try:
+                await cache.adelete(lock_key)
+            except Exception as e:
+                logger.warning(f"Failed to release shared coalescing lock: {e}")
+        return
+
+    coalesce_stats.incr("shared_waits")
+    wait_until = time.monotonic() + _bounded(_wait_seconds(), deadline)
+    data = None
+    try:
+        while time.monotonic() < wait_until:
+            data = await cache.aget(key)
+            if data is not None or await cache.aget(lock_key) is None:
+                data = data or await cache.aget(key)
+                break
+            await asyncio.sleep(settings.VERITAS_COALESCE_POLL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Shared coalescing wait failed: {e}")
+    if data is not None:
+        coalesce_stats.incr("shared_hits")
+        coalesce_stats.incr("saved_calls")
+        for event in _cached_answer_events(data):
+            yield event
+        return
+    if _deadline_passed(deadline):
+        raise RequestDeadlineExceeded()
+    async for event in produce():
+        yield event
+
+
+def coalesced_events(
+    key: str,
+    produce: Callable[[], Iterator[tuple[str, dict]]],
+    deadline: float | None = None,
+) -> Iterator[tuple[str, dict]]:
+    """
+    Streams the (event, data) pairs of a generation, sharing one upstream
+    call between identical concurrent requests.
+
+    Args:
+        key: Identifies identical requests (the response cache key).
+        produce: Starts the generation; only called by the leader, or by a
+            follower whose leader timed out or went away before producing
+            anything.
+        deadline: The time.monotonic() by which the request must be
+            answered; waits for other requests' answers end there.
+
+    Yields:
+        The events of the generation. Followers get "coalesced": true in the
+        done event.
+
+    Raises:
+        RequestDeadlineExceeded: The deadline passed while waiting for
+            another request's answer.
+    """
+    if not coalescing_enabled():
+        yield from produce()
+        return
+
+    flight, leader = _join(key)
+    if not leader:
+        coalesce_stats.incr("followers")
+        received = False
+        try:
+            for event in flight.follow(_wait_seconds(), deadline):
+                received = True
+                yield _mark_coalesced(event)
+        except (FlightTimeout, FlightAbandoned) as e:
+            if _deadline_passed(deadline):
+                raise RequestDeadlineExceeded() from None
+            if isinstance(e, FlightTimeout):
+                coalesce_stats.incr("follower_timeouts")
+            if received:
+                raise
+            coalesce_stats.incr("follower_fallbacks")
+            logger.warning("In-flight request for the same prompt stalled; generating directly.")
+            yield from produce()
+            return
+        coalesce_stats.incr("saved_calls")
+        return
+
+    coalesce_stats.incr("leaders")
+    try:
+        for event in _lead(key, produce, deadline):
+            flight.publish(event)
+            yield event
+        flight.finish()
+    except (RequestDeadlineExceeded, RequestCancelled):
+        # The leader's own deadline or cancelled job; its followers may still
+        # want the answer
+        flight.finish(FlightAbandoned(key))
+        raise
+    except Exception as e:
+        flight.finish(e)
+        raise
+    finally:
+        _leave(flight)
+        # The leader's client went away mid-stream; release the followers.
+        flight.finish(FlightAbandoned(key))
+
+
+async def acoalesced_events(
+    key: str,
+    produce: Callable[[], AsyncIterator[tuple[str, dict]]],
+    deadline: float | None = None,
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Async version of coalesced_events; flights are shared with the sync
+    view, so sync and async requests coalesce with each other.
+    """
+    if not coalescing_enabled():
+        async for event in produce():
+            yield event
+        return
+
+    flight, leader = _join(key)
+    if not leader:
+        coalesce_stats.incr("followers")
+        received = False
+        try:
+            async for event in flight.afollow(_wait_seconds(), deadline):
+                received = True
+                yield _mark_coalesced(event)
+        except (FlightTimeout, FlightAbandoned) as e:
+            if _deadline_passed(deadline):
+                raise RequestDeadlineExceeded() from None
+            if isinstance(e, FlightTimeout):
+                coalesce_stats.incr("follower_timeouts")
+            if received:
+                raise
+            coalesce_stats.incr("follower_fallbacks")
+            logger.warning("In-flight request for the same prompt stalled; generating directly.")
+            async for event in produce():
+                yield event
+            return
+        coalesce_stats.incr("saved_calls")
+        return
+
+    coalesce_stats.incr("leaders")
+    try:
+        async for event in _alead(key, produce, deadline):
+            flight.publish(event)
+            yield event
+        flight.finish()
+    except (RequestDeadlineExceeded, RequestCancelled):
+        # The leader's own deadline or cancelled job; its followers may still
+        # want the answer
+        flight.finish(FlightAbandoned(key))
+        raise
+    except Exception as e:
+        flight.finish(e)
+        raise
+    finally:
+        _leave(flight)
+        flight.finish(FlightAbandoned(key))
+
+
+def reset_coalescing() -> None:
+    """
+    Forgets all in-flight generations and the counters (used by tests).
+    """
+    with _flights_lock:
+        _flights.clear()
+    coalesce_stats.reset()
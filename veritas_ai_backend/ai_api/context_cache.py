@@ -0,0 +1,233 @@
+"""
+Upstream context caching of the fixed request prefix.
+
+When the whole data file is sent, every request starts with the same system
+instruction, uploaded Veritas_data.pdf and model preamble. That prefix is
+stored once as a cached-content object through the Caches API and referenced
+by name in each generate call, so the model does not process those tokens
+again on every request and they are billed at the cached rate.
+
+Handles are keyed by the model and the prefix version and stored in the
+database so every worker shares one cache. The TTL is extended shortly before
+it runs out, a changed file or preamble produces a new key, and models that
+do not support caching fall back to sending the prefix inline.
+"""
+# context_cache.py
+
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+from google.genai import errors as genai_errors
+from google.genai import types
+
+from .models import CachedContextHandle
+from .stats import StatCounters
+
+logger = logging.getLogger(__name__)
+
+context_cache_stats = StatCounters(
+    "context_cache",
+    "hits",
+    "creates",
+    "refreshes",
+    "create_failures",
+    "unsupported",
+    "invalidations",
+    "cached_prompt_tokens",
+    "uncached_prompt_tokens",
+)
+
+
+@dataclass(frozen=True)
+class ContextHandle:
+    key: str
+    name: str
+    expires_at: datetime | None
+
+
+# Process-local tier in front of the database, keyed by handle key.
+_local_handles: dict[str, ContextHandle] = {}
+# model name -> time.monotonic() until which caching is not attempted again
+_unsupported_models: dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def context_cache_enabled() -> bool:
+    return getattr(settings, "VERITAS_CONTEXT_CACHE_ENABLED", True)
+
+
+def _ttl_seconds() -> int:
+    return settings.VERITAS_CONTEXT_CACHE_TTL_SECONDS
+
+
+def _refresh_margin() -> timedelta:
+    return timedelta(seconds=settings.VERITAS_CONTEXT_CACHE_REFRESH_MARGIN_SECONDS)
+
+
+def context_cache_key(model_name: str, prefix_version: str) -> str:
+    """
+    Returns the handle key for a model and a version of the request prefix.
+    """
+    return hashlib.sha256(f"{model_name}:{prefix_version}".encode()).hexdigest()
+
+
+def _needs_refresh(handle: ContextHandle) -> bool:
+    if handle.expires_at is None:
+        return False
+    return handle.expires_at - _refresh_margin() <= timezone.now()
+
+
+def _is_expired(handle: ContextHandle) -> bool:
+    return handle.expires_at is not None and handle.expires_at <= timezone.now()
+
+
+def _expires_at(cached_content) -> datetime:
+    expire_time = getattr(cached_content, "expire_time", None)
+    return expire_time or timezone.now() + timedelta(seconds=_ttl_seconds())
+
+
+def _store(key: str, model_name: str, handle: ContextHandle) -> ContextHandle:
+    CachedContextHandle.objects.update_or_create(
+        key=key,
+        defaults={
+            "model": model_name,
+            "name": handle.name,
+            "expires_at": handle.expires_at,
+        },
+    )
+    _local_handles[key] = handle
+    return handle
+
+
+def _create(client, model_name: str, key: str, build_config) -> ContextHandle | None:
+    try:
+        cached_content = client.caches.create(
+            model=model_name,
+            config=build_config(
+                ttl=f"{_ttl_seconds()}s",
+                display_name=f"veritas-{key[:12]}",
+            ),
+        )
+    except genai_errors.ClientError as e:
+        # 400: the model does not support caching or the prefix is below its
+        # minimum cache size. Don't try again for a while.
+        context_cache_stats.incr("unsupported")
+        _unsupported_models[model_name] = (
+            time.monotonic() + settings.VERITAS_CONTEXT_CACHE_RETRY_SECONDS
+        )
+        logger.warning(f"Context caching unavailable for {model_name}: {e}")
+        return None
+    except Exception as e:
+        context_cache_stats.incr("create_failures")
+        logger.error(f"Failed to create cached context for {model_name}: {e}")
+        return None
+
+    context_cache_stats.incr("creates")
+    logger.info(f"Created cached context {cached_content.name} for {model_name}")
+    return _store(
+        key,
+        model_name,
+        ContextHandle(key, cached_content.name, _expires_at(cached_content)),
+    )
+
+
+def _refresh(client, model_name: str, handle: ContextHandle) -> ContextHandle | None:
+    try:
+        cached_content = client.caches.update(
+            name=handle.name,
+            config=types.UpdateCachedContentConfig(ttl=f"{_ttl_seconds()}s"),
+        )
+    except Exception as e:
+        logger.warning(f"Failed to extend cached context {handle.name}: {e}")
+        return None
+    context_cache_stats.incr("refreshes")
+    return _store(
+        handle.key,
+        model_name,
+        ContextHandle(handle.key, handle.name, _expires_at(cached_content)),
+    )
+
+
+def get_cached_context(
+    client, model_name: str, prefix_version: str, build_config
+) -> str | None:
+    """
+    Returns the name of the cached context for the request prefix, creating
+    it or extending its TTL when needed.
+
+    Args:
+        client: The initialized Google AI client.
+        model_name: The model the cache is created for.
+        prefix_version: Identifies the content of the prefix; a new version
+            creates a new cache.
+        build_config: Called with ttl and display_name to build the
+            CreateCachedContentConfig holding the prefix. Only called when a
+            cache has to be created.
+
+    Returns:
+        The cached content name, or None if the prefix has to be sent inline.
+    """
+    if not context_cache_enabled():
+        return None
+    if _unsupported_models.get(model_name, 0) > time.monotonic():
+        return None
+
+    key = context_cache_key(model_name, prefix_version)
+    handle = _local_handles.get(key)
+    if handle is not None and not _needs_refresh(handle):
+        context_cache_stats.incr("hits")
+        return handle.name
+
+    with _lock:
+        row = CachedContextHandle.objects.filter(key=key).exclude(name="").first()
+        handle = ContextHandle(key, row.name, row.expires_at) if row else None
+        if handle and not _needs_refresh(handle):
+            _local_handles[key] = handle
+            context_cache_stats.incr("hits")
+            return handle.name
+        if handle and not _is_expired(handle):
+            refreshed = _refresh(client, model_name, handle)
+            if refreshed is not None:
+                return refreshed.name
+        handle = _create(client, model_name, key, build_config)
+        return handle.name if handle else None
+
+
+def invalidate_cached_context(name: str) -> None:
+    """
+    Forgets a cached context the API rejected (deleted or expired early), so
+    the next request creates it again.
+    """
+    context_cache_stats.incr("invalidations")
+    for key, handle in list(_local_handles.items()):
+        if handle.name == name:
+            _local_handles.pop(key, None)
+    CachedContextHandle.objects.filter(name=name).update(name="", expires_at=None)
+    logger.warning(f"Invalidated cached context {name}")
+
+
+def record_prompt_usage(result) -> None:
+    """
+    Counts the prompt tokens of a finished generation that were served from
+    the cache and those processed from scratch.
+    """
+    if result.prompt_tokens is None:
+        return
+    cached = result.cached_tokens or 0
+    context_cache_stats.incr("cached_prompt_tokens", cached)
+    context_cache_stats.incr("uncached_prompt_tokens", result.prompt_tokens - cached)
+
+
+def reset_context_cache() -> None:
+    """
+    Clears the process-local handles and unsupported models (used by tests).
+    """
+    _local_handles.clear()
+    _unsupported_models.clear()
+    context_cache_stats.reset()
@@ -0,0 +1,738 @@
+"""
+Model dispatch: deadlines, hedged requests and fallback between models.
+
+The default model (VERITAS_AI_MODEL) is an experimental pro model that is
+sometimes slow or overloaded. Requests that don't ask for a specific model
+are dispatched over a chain of models, the default followed by
+VERITAS_FALLBACK_MODELS:
+
+* Each attempt must produce its first chunk within the model's deadline
+  (VERITAS_MODEL_DEADLINES, VERITAS_MODEL_DEFAULT_DEADLINE_SECONDS).
+* If the primary has produced nothing once its recent first-chunk latency
+  percentile (VERITAS_HEDGE_PERCENTILE) has passed, a hedged request goes to
+  the next model. Whichever produces a first chunk first answers and the
+  other is cancelled.
+* When an attempt fails or misses its deadline before producing anything,
+  the next model is tried. Transient failures are first retried within the
+  attempt's deadline (see resilience.py).
+* Models whose circuit breaker is open are skipped.
+* Once the request's own deadline passes (see cancellation.py), every
+  attempt is cancelled and RequestDeadlineExceeded is raised, even
+  mid-answer. The same goes, with RequestCancelled, for a job cancelled
+  while it waits for the model.
+
+Attempts stop as soon as nobody reads their events any more: the upstream
+stream is closed and the stopped generation is recorded with the tokens it
+saved.
+
+The "done" event reports the model that actually answered.
+"""
+# dispatch.py
+
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from collections.abc import AsyncIterator, Callable, Iterator
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .ai_helpers import BlockedPromptError, abuild_veritas_request, build_veritas_request
+from .budgets import aenforce_input_budget, enforce_input_budget
+from .cancellation import (
+    CANCEL_DEADLINE,
+    CANCEL_DISCONNECT,
+    CANCEL_POLL_SECONDS,
+    RequestCancelled,
+    RequestDeadlineExceeded,
+    record_cancellation,
+    record_completion,
+)
+from .context_cache import invalidate_cached_context, record_prompt_usage
+from .file_registry import invalidate_file_handle, is_file_handle_rejection
+from .generation import (
+    GenerationResult,
+    aiter_generation,
+    astream_veritas_events,
+    iter_generation,
+    stream_veritas_events,
+)
+from .resilience import CircuitOpen, circuit_breakers, resilience_stats
+from .sessions import ChatHistory
+from .stats import LatencyWindows, StatCounters
+from .text_index import estimate_text_tokens
+from .tracing import record_span
+
+logger = logging.getLogger(__name__)
+
+dispatch_stats = StatCounters(
+    "dispatch",
+    "requests",
+    "hedges",
+    "hedge_wins",
+    "fallbacks",
+    "deadline_exceeded",
+)
+# Time to first chunk per model, plus "served": what users actually waited.
+# Comparing "served" with the primary model's window shows the tail latency
+# saved by hedging.
+first_chunk_latency = LatencyWindows("first_chunk_latency")
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when no model produced a first chunk within its deadline.
+    """
+
+
+def dispatch_enabled() -> bool:
+    return getattr(settings, "VERITAS_MODEL_DISPATCH_ENABLED", True)
+
+
+def model_chain(model_name: str, explicit: bool = False) -> list[str]:
+    """
+    Returns the models to dispatch a request over, in order: the model,
+    VERITAS_AI_MODEL (for requests routed to another model, see
+    routing.py) and VERITAS_FALLBACK_MODELS.
+
+    Args:
+        model_name: The model the request is for.
+        explicit: True if the client asked for this model; such requests
+            are never answered by another model.
+    """
+    if explicit or not dispatch_enabled():
+        return [model_name]
+    fallbacks = getattr(settings, "VERITAS_FALLBACK_MODELS", [])
+    return list(dict.fromkeys([model_name, settings.VERITAS_AI_MODEL, *fallbacks]))
+
+
+def model_deadline(model_name: str) -> float:
+    """
+    Seconds a model has to produce its first chunk.
+    """
+    return settings.VERITAS_MODEL_DEADLINES.get(
+        model_name, settings.VERITAS_MODEL_DEFAULT_DEADLINE_SECONDS
+    )
+
+
+def hedge_delay(model_name: str) -> float | None:
+    """
+    Seconds to wait for a model's first chunk before hedging, or None if
+    hedging is off.
+
+    Uses the VERITAS_HEDGE_PERCENTILE of the model's recent first-chunk
+    latencies once VERITAS_HEDGE_MIN_SAMPLES have been seen, and
+    VERITAS_HEDGE_DEFAULT_DELAY_SECONDS before that.
+    """
+    if not getattr(settings, "VERITAS_HEDGE_ENABLED", True):
+        return None
+    samples = first_chunk_latency.values(model_name)
+    if len(samples) < settings.VERITAS_HEDGE_MIN_SAMPLES:
+        return settings.VERITAS_HEDGE_DEFAULT_DELAY_SECONDS
+    threshold = first_chunk_latency.percentile(model_name, settings.VERITAS_HEDGE_PERCENTILE)
+    return max(threshold / 1000, settings.VERITAS_HEDGE_MIN_DELAY_SECONDS)
+
+
+def _check_stopped(
+    model: str, deadline: float | None, cancelled: Callable[[], bool] | None
+) -> None:
+    """
+    Raises:
+        RequestDeadlineExceeded: The request's deadline passed.
+        RequestCancelled: The request was cancelled.
+    """
+    if deadline is not None and time.monotonic() >= deadline:
+        raise RequestDeadlineExceeded(model)
+    if cancelled is not None and cancelled():
+        raise RequestCancelled(f"Request for model {model} was cancelled")
+
+
+def _stop_check(
+    deadline: float | None, cancelled: Callable[[], bool] | None
+) -> Callable[[], bool] | None:
+    """
+    Returns the should_stop for iter_generation of a request with this
+    deadline and cancellation, or None if it can't be stopped.
+    """
+    if deadline is None and cancelled is None:
+        return None
+
+    def should_stop() -> bool:
+        if deadline is not None and time.monotonic() >= deadline:
+            return True
+        return cancelled is not None and cancelled()
+
+    return should_stop
+
+
+class _Attempt:
+    """
+    One generation attempt against one model.
+    """
+
+    def __init__(self, model: str, retried: bool = False):
+        self.model = model
+        self.retried = retried
+        self.result = GenerationResult(model=model)
+        self.started = time.monotonic()
+        self.deadline = self.started + model_deadline(model)
+        self.contents = None
+        self.config = None
+        self.cancelled = threading.Event()
+        self.task = None
+
+    def elapsed_ms(self) -> float:
+        return (time.monotonic() - self.started) * 1000
+
+
+class _Dispatch:
+    """
+    The bookkeeping shared by the sync and async dispatch loops: which
+    attempts are running, when to hedge, and what to do when one fails.
+    """
+
+    def __init__(
+        self,
+        models: list[str],
+        deadline: float | None = None,
+        cancelled: Callable[[], bool] | None = None,
+    ):
+        dispatch_stats.incr("requests")
+        self.deadline = deadline
+        self.cancelled = cancelled
+        self.pending = list(models)
+        self.primary_model = models[0]
+        self.active: list[_Attempt] = []
+        self.hedged = False
+        self.hedge_at = None
+        self.last_error: Exception | None = None
+
+    def _skip_open_circuits(self) -> None:
+        """
+        Drops the pending models whose circuit breaker is open.
+        """
+        for model in list(self.pending):
+            retry_in = circuit_breakers.retry_in(model)
+            if retry_in:
+                logger.info(f"Skipping model {model}: its circuit breaker is open")
+                resilience_stats.incr("short_circuits")
+                self.pending.remove(model)
+                self.last_error = CircuitOpen(model, retry_in)
+
+    def first_model(self) -> str:
+        """
+        Returns the model to start with.
+
+        Raises:
+            CircuitOpen: The circuit breakers of all models are open.
+        """
+        self._skip_open_circuits()
+        if not self.pending:
+            raise self.last_error
+        return self.pending.pop(0)
+
+    def started(self, attempt: _Attempt) -> None:
+        self.active.append(attempt)
+        if attempt.model == self.primary_model and not attempt.retried and self.pending:
+            delay = hedge_delay(attempt.model)
+            if delay is not None:
+                self.hedge_at = attempt.started + delay
+
+    def next_action(self) -> tuple[str, float | None]:
+        """
+        Returns ("start", None) if another model should be started now,
+        ("wait", seconds) until the next deadline or hedge otherwise.
+
+        Raises:
+            RequestDeadlineExceeded: The request's deadline passed.
+            RequestCancelled: The request was cancelled.
+            The last error if every model failed.
+        """
+        self._skip_open_circuits()
+        self.check_stopped(self.primary_model)
+        now = time.monotonic()
+        for attempt in list(self.active):
+            if now >= attempt.deadline:
+                dispatch_stats.incr("deadline_exceeded")
+                circuit_breakers.record_failure(attempt.model)
+                logger.warning(
+                    f"Model {attempt.model} produced nothing within "
+                    f"{model_deadline(attempt.model)}s"
+                )
+                first_chunk_latency.observe(attempt.model, attempt.elapsed_ms())
+                self.cancel(attempt)
+                self.last_error = DeadlineExceeded(attempt.model)
+                if attempt.model == self.primary_model:
+                    self.hedge_at = None
+        if not self.active:
+            if not self.pending:
+                raise self.last_error or DeadlineExceeded(self.primary_model)
+            dispatch_stats.incr("fallbacks")
+            return "start", None
+        if self.hedge_at is not None and now >= self.hedge_at and self.pending:
+            self.hedge_at = None
+            self.hedged = True
+            dispatch_stats.incr("hedges")
+            logger.info(f"Hedging slow model {self.primary_model} with {self.pending[0]}")
+            return "start", None
+        wake = min(attempt.deadline for attempt in self.active)
+        if self.hedge_at is not None and self.pending:
+            wake = min(wake, self.hedge_at)
+        if self.deadline is not None:
+            wake = min(wake, self.deadline)
+        if self.cancelled is not None:
+            wake = min(wake, now + CANCEL_POLL_SECONDS)
+        return "wait", max(wake - now, 0)
+
+    def check_stopped(self, model: str) -> None:
+        _check_stopped(model, self.deadline, self.cancelled)
+
+    def remaining(self) -> float | None:
+        """
+        Seconds left until the request's deadline, or None without one.
+        """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.monotonic(), 0)
+
+    def wait_seconds(self) -> float | None:
+        """
+        Seconds to wait for the next event before checking again whether
+        the request is still wanted, or None to wait as long as it takes.
+        """
+        seconds = self.remaining()
+        if self.cancelled is None:
+            return seconds
+        if seconds is None:
+            return CANCEL_POLL_SECONDS
+        return min(seconds, CANCEL_POLL_SECONDS)
+
+    def failed(self, attempt: _Attempt, error: Exception) -> bool:
+        """
+        Records an attempt that failed before producing anything.
+
+        Returns:
+            True if the same model should be retried once (the data file or
+            cached context was rejected).
+
+        Raises:
+            BlockedPromptError: Every model would refuse the prompt.
+        """
+        self.active.remove(attempt)
+        if attempt.model == self.primary_model:
+            # A failed primary falls back right away rather than hedging
+            self.hedge_at = None
+        if isinstance(error, BlockedPromptError):
+            self.cancel_all()
+            raise error
+        if is_file_handle_rejection(error) and not attempt.retried:
+            logger.warning(f"Data file or cached context was rejected by the API: {error}")
+            return True
+        logger.warning(f"Model {attempt.model} failed: {error}")
+        self.last_error = error
+        return False
+
+    def won(self, winner: _Attempt) -> None:
+        elapsed = winner.elapsed_ms()
+        first_chunk_latency.observe(winner.model, elapsed)
+        first_chunk_latency.observe("served", elapsed)
+        # Time from sending the request to the model's first chunk
+        record_span(
+            "upstream", time.perf_counter() - elapsed / 1000, elapsed / 1000, winner.model
+        )
+        if self.hedged and winner.model != self.primary_model:
+            dispatch_stats.incr("hedge_wins")
+        for attempt in list(self.active):
+            if attempt is not winner:
+                # Lower bound of the loser's latency, so a slow model's
+                # percentile doesn't look better than it is.
+                first_chunk_latency.observe(attempt.model, attempt.elapsed_ms())
+                self.cancel(attempt)
+
+    def cancel(self, attempt: _Attempt) -> None:
+        attempt.cancelled.set()
+        if attempt.task is not None:
+            attempt.task.cancel()
+        if attempt in self.active:
+            self.active.remove(attempt)
+
+    def cancel_all(self) -> None:
+        for attempt in list(self.active):
+            self.cancel(attempt)
+
+    def stopped(self, reason: str, winner: _Attempt | None, config) -> None:
+        """
+        Records a request whose generation was stopped before it finished.
+        """
+        model = winner.model if winner is not None else self.primary_model
+        generated = estimate_text_tokens(winner.result.text) if winner is not None else 0
+        record_cancellation(reason, model, generated, _max_output_tokens(config))
+
+    def done_data(self, winner: _Attempt) -> dict:
+        record_prompt_usage(winner.result)
+        record_completion(winner.model, winner.result.completion_tokens)
+        summary = winner.result.summary()
+        if self.hedged:
+            summary["hedged"] = True
+        return summary
+
+
+def _max_output_tokens(config) -> int | None:
+    return getattr(config, "max_output_tokens", None)
+
+
+def _undispatched_events(
+    events,
+    model: str,
+    config,
+    deadline: float | None,
+    cancelled: Callable[[], bool] | None = None,
+):
+    """
+    Passes the events of a generation sent to a single model through,
+    checking the request's deadline and cancellation at each event and
+    recording the generation if it is stopped.
+
+    The generation itself must stop waiting for the model when either
+    happens (see _stop_check); it then ends early and its last event raises
+    here.
+    """
+    parts, stopped, done = [], None, False
+    try:
+        for event, data in events:
+            _check_stopped(model, deadline, cancelled)
+            if event == "chunk":
+                parts.append(data["text"])
+            elif event == "done":
+                done = True
+                record_completion(model, data.get("completion_tokens"))
+            yield event, data
+    except RequestDeadlineExceeded:
+        stopped = CANCEL_DEADLINE
+        raise
+    except (GeneratorExit, RequestCancelled):
+        stopped = None if done else CANCEL_DISCONNECT
+        raise
+    finally:
+        events.close()
+        if stopped:
+            generated = estimate_text_tokens("".join(parts))
+            record_cancellation(stopped, model, generated, _max_output_tokens(config))
+
+
+async def _aundispatched_events(events, model: str, config, deadline: float | None):
+    """
+    Async version of _undispatched_events; waits for each event until the
+    deadline, which cancels the generation mid-wait.
+    """
+    parts, stopped, done = [], None, False
+    try:
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                event, data = await asyncio.wait_for(anext(events), timeout)
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise RequestDeadlineExceeded(model) from None
+            if event == "chunk":
+                parts.append(data["text"])
+            elif event == "done":
+                done = True
+                record_completion(model, data.get("completion_tokens"))
+            yield event, data
+    except RequestDeadlineExceeded:
+        stopped = CANCEL_DEADLINE
+        raise
+    except (GeneratorExit, asyncio.CancelledError):
+        stopped = None if done else CANCEL_DISCONNECT
+        raise
+    finally:
+        await events.aclose()
+        if stopped:
+            generated = estimate_text_tokens("".join(parts))
+            record_cancellation(stopped, model, generated, _max_output_tokens(config))
+
+
+def _run_attempt(client, attempt: _Attempt, events: queue.Queue) -> None:
+    """
+    Streams an attempt in a background thread, posting (attempt, kind,
+    payload) to events. Only the upstream call runs in the thread.
+    """
+
+    def run():
+        try:
+            stream = iter_generation(
+                client,
+                attempt.model,
+                attempt.contents,
+                attempt.config,
+                attempt.result,
+                deadline=attempt.deadline,
+                cancelled=attempt.cancelled,
+            )
+            try:
+                for text in stream:
+                    if attempt.cancelled.is_set():
+                        return
+                    events.put((attempt, "text", text))
+            finally:
+                stream.close()
+            events.put((attempt, "end", None))
+        except Exception as e:
+            events.put((attempt, "error", e))
+
+    # The thread runs in a copy of the request's context, like a task would
+    context = contextvars.copy_context()
+    threading.Thread(
+        target=context.run, args=(run,), daemon=True, name=f"veritas-dispatch-{attempt.model}"
+    ).start()
+
+
+def dispatch_veritas_events(
+    client,
+    models: list[str],
+    prompt: str,
+    config,
+    file_path: str,
+    history: ChatHistory | None = None,
+    deadline: float | None = None,
+    cancelled: Callable[[], bool] | None = None,
+) -> Iterator[tuple[str, dict]]:
+    """
+    Streams the answer for a prompt as (event, data) pairs like
+    stream_veritas_events, dispatched over a chain of models (see
+    model_chain).
+
+    Args:
+        client: The initialized Google AI client.
+        models: The models to try, primary first.
+        prompt: The user's input prompt.
+        config: The GenerateContentConfig for the request.
+        file_path: The path to the Veritas data file.
+        history: The chat session turns to send before the prompt.
+        deadline: The time.monotonic() by which the answer must be
+            complete (see cancellation.request_deadline).
+        cancelled: Returns True once the answer is no longer wanted (a
+            cancelled job); polled every CANCEL_POLL_SECONDS, so it should
+            be cheap.
+
+    Raises:
+        RequestDeadlineExceeded: The deadline passed.
+        RequestCancelled: The request was cancelled.
+    """
+    if not dispatch_enabled():
+        yield from _undispatched_events(
+            stream_veritas_events(
+                client,
+                models[0],
+                prompt,
+                config,
+                file_path,
+                history,
+                should_stop=_stop_check(deadline, cancelled),
+            ),
+            models[0],
+            config,
+            deadline,
+            cancelled,
+        )
+        return
+
+    dispatch = _Dispatch(models, deadline, cancelled)
+    events: queue.Queue = queue.Queue()
+
+    def next_event() -> tuple:
+        while True:
+            dispatch.check_stopped(winner.model)
+            try:
+                return events.get(timeout=dispatch.wait_seconds())
+            except queue.Empty:
+                pass
+
+    def start(model: str, retried: bool = False) -> None:
+        attempt = _Attempt(model, retried=retried)
+        attempt.contents, attempt.config = build_veritas_request(
+            client, model, file_path, prompt, config, history=history
+        )
+        enforce_input_budget(client, model, attempt.contents, attempt.config, file_path)
+        logger.info(
+            f"Sending request to Gemini model '{model}' with {len(attempt.contents)} content parts."
+        )
+        dispatch.started(attempt)
+        _run_attempt(client, attempt, events)
+
+    start(dispatch.first_model())
+    winner, first = None, None
+    stopped, done = None, False
+    try:
+        while winner is None:
+            action, timeout = dispatch.next_action()
+            if action == "start":
+                start(dispatch.pending.pop(0))
+                continue
+            try:
+                attempt, kind, payload = events.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if attempt not in dispatch.active:
+                continue  # Cancelled
+            if kind == "error":
+                if dispatch.failed(attempt, payload):
+                    if attempt.config.cached_content:
+                        invalidate_cached_context(attempt.config.cached_content)
+                    invalidate_file_handle(file_path)
+                    start(attempt.model, retried=True)
+                continue
+            winner, first = attempt, (kind, payload)
+        dispatch.won(winner)
+
+        kind, payload = first
+        while kind != "end":
+            if kind == "error":
+                raise payload
+            yield "chunk", {"text": payload}
+            attempt, kind, payload = next_event()
+            while attempt is not winner:
+                attempt, kind, payload = next_event()
+        done = True
+        yield "done", dispatch.done_data(winner)
+    except RequestDeadlineExceeded:
+        stopped = CANCEL_DEADLINE
+        raise
+    except (GeneratorExit, RequestCancelled):
+        # Nobody reads the answer any more
+        stopped = None if done else CANCEL_DISCONNECT
+        raise
+    finally:
+        dispatch.cancel_all()
+        if winner is not None:
+            winner.cancelled.set()
+        if stopped:
+            dispatch.stopped(stopped, winner, config)
+
+
+async def adispatch_veritas_events(
+    client,
+    models: list[str],
+    prompt: str,
+    config,
+    file_path: str,
+    history: ChatHistory | None = None,
+    deadline: float | None = None,
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Async version of dispatch_veritas_events; attempts run as tasks on the
+    event loop and losers are cancelled outright, as is everything when the
+    task reading the events is cancelled (the client disconnected).
+    """
+    if not dispatch_enabled():
+        async for event in _aundispatched_events(
+            astream_veritas_events(client, models[0], prompt, config, file_path, history),
+            models[0],
+            config,
+            deadline,
+        ):
+            yield event
+        return
+
+    dispatch = _Dispatch(models, deadline)
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def next_event() -> tuple:
+        try:
+            return await asyncio.wait_for(events.get(), dispatch.remaining())
+        except asyncio.TimeoutError:
+            raise RequestDeadlineExceeded(winner.model) from None
+
+    async def run(attempt: _Attempt) -> None:
+        try:
+            async for text in aiter_generation(
+                client,
+                attempt.model,
+                attempt.contents,
+                attempt.config,
+                attempt.result,
+                deadline=attempt.deadline,
+            ):
+                await events.put((attempt, "text", text))
+            await events.put((attempt, "end", None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await events.put((attempt, "error", e))
+
+    async def start(model: str, retried: bool = False) -> None:
+        attempt = _Attempt(model, retried=retried)
+        attempt.contents, attempt.config = await abuild_veritas_request(
+            client, model, file_path, prompt, config, history=history
+        )
+        await aenforce_input_budget(
+            client, model, attempt.contents, attempt.config, file_path
+        )
+        logger.info(
+            f"Sending async request to Gemini model '{model}' with {len(attempt.contents)} content parts."
+        )
+        dispatch.started(attempt)
+        attempt.task = asyncio.ensure_future(run(attempt))
+
+    await start(dispatch.first_model())
+    winner, first = None, None
+    stopped, done = None, False
+    try:
+        while winner is None:
+            action, timeout = dispatch.next_action()
+            if action == "start":
+                await start(dispatch.pending.pop(0))
+                continue
+            try:
+                attempt, kind, payload = await asyncio.wait_for(events.get(), timeout)
+            except asyncio.TimeoutError:
+                continue
+            if attempt not in dispatch.active:
+                continue
+            if kind == "error":
+                if dispatch.failed(attempt, payload):
+                    if attempt.config.cached_content:
+                        await sync_to_async(invalidate_cached_context)(
+                            attempt.config.cached_content
+                        )
+                    await sync_to_async(invalidate_file_handle)(file_path)
+                    await start(attempt.model, retried=True)
+                continue
+            winner, first = attempt, (kind, payload)
+        dispatch.won(winner)
+
+        kind, payload = first
+        while kind != "end":
+            if kind == "error":
+                raise payload
+            yield "chunk", {"text": payload}
+            attempt, kind, payload = await next_event()
+            while attempt is not winner:
+                attempt, kind, payload = await next_event()
+        done = True
+        yield "done", dispatch.done_data(winner)
+    except RequestDeadlineExceeded:
+        stopped = CANCEL_DEADLINE
+        raise
+    except (GeneratorExit, asyncio.CancelledError):
+        stopped = None if done else CANCEL_DISCONNECT
+        raise
+    finally:
+        dispatch.cancel_all()
+        if winner is not None and winner.task is not None:
+            winner.task.cancel()
+        if stopped:
+            dispatch.stopped(stopped, winner, config)
+
+
+def reset_dispatch() -> None:
+    """
+    Forgets the latency windows and the counters (used by tests).
+    """
+    first_chunk_latency.reset()
+    dispatch_stats.reset()
@@ -0,0 +1,298 @@
+"""
+Curated FAQ answers served from data.csv without calling the model.
+
+data.csv holds prompt/response pairs for the questions students ask most
+(resumption dates, required documents, contacts). Prompts that closely match
+one of them are answered locally in a few milliseconds; everything else falls
+through to the model. Each knowledge base (see knowledge_bases.py) has its
+own CSV; bases without one have no FAQ.
+"""
+# faq.py
+
+import csv
+import functools
+import logging
+import os
+import threading
+import time
+from collections.abc import Sequence
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .file_registry import file_content_hash
+from .knowledge_store import (
+    KnowledgeStore,
+    MappedRecords,
+    StoreSection,
+    get_knowledge_store,
+    section_inputs,
+)
+from .knowledge_bases import drop_slots, resident
+from .stats import StatCounters
+from .text_index import (
+    FlatPostings,
+    FlatTfidfIndex,
+    SortedVocabulary,
+    TfidfIndex,
+    flatten_postings,
+    tokenize,
+)
+
+logger = logging.getLogger(__name__)
+
+faq_stats = StatCounters("faq", "lookups", "hits", "misses", "reloads")
+
+# Section of the knowledge base store (see knowledge_store.py)
+FAQ_SECTION = "faq"
+
+
+@dataclass(frozen=True)
+class FaqEntry:
+    prompt: str
+    response: str
+
+
+@dataclass(frozen=True)
+class FaqMatch:
+    entry: FaqEntry
+    score: float
+
+
+def load_faq_entries(csv_path: str) -> list[FaqEntry]:
+    """
+    Reads prompt/response pairs from the FAQ CSV.
+
+    Some responses contain unquoted commas, so everything after the prompt
+    column is joined back together.
+
+    Args:
+        csv_path: Path to the CSV with a "prompt,response" header.
+
+    Returns:
+        The FAQ entries, skipping rows without a prompt or response.
+    """
+    entries = []
+    with open(csv_path, newline="", encoding="utf-8") as csv_file:
+        reader = csv.reader(csv_file)
+        next(reader, None)  # Header
+        for row in reader:
+            if len(row) < 2:
+                continue
+            prompt = row[0].strip()
+            response = ",".join(row[1:]).strip().rstrip(",").strip()
+            if prompt and response:
+                entries.append(FaqEntry(prompt=prompt, response=response))
+    return entries
+
+
+class FaqMatcher:
+    """
+    Matches prompts against the curated FAQ prompts with a TF-IDF index.
+
+    The confidence of a match is its cosine similarity scaled by the share of
+    the prompt's words found in the FAQ prompt, so a question that merely
+    shares one rare word with an entry ("bursar email" vs "Who is the
+    Bursar?") does not count as a match.
+    """
+
+    def __init__(self, entries: Sequence[FaqEntry], index: TfidfIndex | None = None):
+        self.entries = entries
+        self.index = index or TfidfIndex([entry.prompt for entry in entries])
+
+    @classmethod
+    def from_store(cls, store: KnowledgeStore) -> "FaqMatcher":
+        """
+        The matcher over the FAQ entries of the store, read in place.
+        """
+        mapped = functools.partial(store.array, FAQ_SECTION)
+        postings = FlatPostings(
+            SortedVocabulary(store.strings(FAQ_SECTION, "vocabulary")),
+            mapped("idf"),
+            mapped("starts"),
+            mapped("documents"),
+            mapped("weights"),
+        )
+        prompts = store.strings(FAQ_SECTION, "prompt")
+        return cls(
+            MappedRecords(FaqEntry, prompts, store.strings(FAQ_SECTION, "response")),
+            FlatTfidfIndex(len(prompts), postings),
+        )
+
+    def write_section(self, section: StoreSection) -> None:
+        """
+        Writes the FAQ entries and the TF-IDF index into a store section.
+        """
+        vocabulary, idf, starts, documents, weights = flatten_postings(
+            self.index.idf, self.index.postings
+        )
+        section.add_strings("prompt", [entry.prompt for entry in self.entries])
+        section.add_strings("response", [entry.response for entry in self.entries])
+        section.add_strings("vocabulary", vocabulary)
+        section.add_array("idf", "d", idf)
+        section.add_array("starts", "Q", starts)
+        section.add_array("documents", "I", documents)
+        section.add_array("weights", "d", weights)
+
+    def best_match(self, prompt: str) -> FaqMatch | None:
+        results = self.index.search(prompt, limit=1)
+        if not results:
+            return None
+        doc_index, similarity = results[0]
+        entry = self.entries[doc_index]
+        tokens = tokenize(prompt)
+        prompt_tokens = set(tokenize(entry.prompt))
+        coverage = sum(token in prompt_tokens for token in tokens) / len(tokens)
+        return FaqMatch(entry=entry, score=similarity * coverage)
+
+
+def faq_section_inputs(csv_hash: str) -> str:
+    """
+    Identifies a FAQ index: the content of the CSV.
+    """
+    return section_inputs(FAQ_SECTION, csv_hash)
+
+
+class _FaqSlot:
+    """
+    The FAQ matcher of a knowledge base (see knowledge_bases.py).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.matcher: FaqMatcher | None = None
+        self.loaded = False
+        # (path, mtime_ns, size) of the CSV the matcher was built from and
+        # the version of the knowledge base store at the time
+        self.signature: tuple | None = None
+        self.last_checked = 0.0
+
+
+FAQ_SLOT = "faq"
+
+
+def _csv_signature(csv_path: str | None) -> tuple | None:
+    if not csv_path:
+        return None
+    try:
+        stat_result = os.stat(csv_path)
+    except OSError:
+        return None
+    store = get_knowledge_store()
+    return (
+        str(csv_path),
+        stat_result.st_mtime_ns,
+        stat_result.st_size,
+        store.version if store else None,
+    )
+
+
+def _build_matcher(csv_path: str) -> FaqMatcher:
+    """
+    The matcher from the knowledge base store if data.csv was ingested in
+    its current state, otherwise built from the CSV.
+    """
+    store = get_knowledge_store()
+    if store is not None and store.section_matches(
+        FAQ_SECTION, faq_section_inputs(file_content_hash(csv_path))
+    ):
+        return FaqMatcher.from_store(store)
+    return FaqMatcher(load_faq_entries(csv_path))
+
+
+def _matcher_size(matcher: FaqMatcher | None) -> int:
+    """
+    Rough memory held by a matcher built from the CSV: the entries and their
+    index. Matchers read from the store are counted with the store.
+    """
+    if matcher is None or isinstance(matcher.entries, MappedRecords):
+        return 0
+    return 4 * sum(len(entry.prompt) + len(entry.response) for entry in matcher.entries)
+
+
+def reload_faq_matcher() -> FaqMatcher | None:
+    """
+    Rebuilds the matcher from the current knowledge base's FAQ CSV
+    (VERITAS_FAQ_CSV_PATH for the default base).
+
+    Returns:
+        The new matcher, or None if the CSV is missing or unreadable.
+    """
+    state = resident()
+    slot = state.slot(FAQ_SLOT, _FaqSlot)
+    csv_path = state.base.faq_csv_path
+    with slot.lock:
+        signature = _csv_signature(csv_path)
+        try:
+            matcher = _build_matcher(csv_path) if signature else None
+        except (OSError, csv.Error, UnicodeDecodeError) as e:
+            logger.error(f"Failed to load FAQ from {csv_path}: {e}")
+            matcher = None
+        if matcher is None:
+            logger.warning(f"FAQ fast path disabled: no usable CSV at {csv_path}")
+        else:
+            logger.info(f"Loaded {len(matcher.entries)} FAQ entries from {csv_path}")
+        faq_stats.incr("reloads")
+        slot.matcher, slot.signature = matcher, signature
+        slot.loaded = True
+        slot.last_checked = time.monotonic()
+    state.set_size(FAQ_SLOT, _matcher_size(matcher))
+    return matcher
+
+
+def get_faq_matcher() -> FaqMatcher | None:
+    """
+    Returns the FAQ matcher of the current knowledge base, rebuilding it
+    when its CSV changed on disk.
+
+    The file is checked at most every VERITAS_FAQ_RELOAD_CHECK_SECONDS, so
+    edits are picked up by every worker without a restart.
+    """
+    state = resident()
+    slot = state.slot(FAQ_SLOT, _FaqSlot)
+    interval = getattr(settings, "VERITAS_FAQ_RELOAD_CHECK_SECONDS", 5)
+    if slot.loaded:
+        if time.monotonic() - slot.last_checked < interval:
+            return slot.matcher
+        if _csv_signature(state.base.faq_csv_path) == slot.signature:
+            slot.last_checked = time.monotonic()
+            return slot.matcher
+    return reload_faq_matcher()
+
+
+def answer_from_faq(prompt: str, threshold: float | None = None) -> FaqMatch | None:
+    """
+    Returns the curated answer for a prompt if it matches an FAQ entry with
+    at least VERITAS_FAQ_MATCH_THRESHOLD confidence.
+
+    Args:
+        prompt: The user's input prompt.
+        threshold: The confidence required instead of
+            VERITAS_FAQ_MATCH_THRESHOLD.
+
+    Returns:
+        The FaqMatch, or None if the prompt should go to the model.
+    """
+    if not getattr(settings, "VERITAS_FAQ_ENABLED", True):
+        return None
+    matcher = get_faq_matcher()
+    if matcher is None:
+        return None
+
+    faq_stats.incr("lookups")
+    match = matcher.best_match(prompt)
+    if threshold is None:
+        threshold = settings.VERITAS_FAQ_MATCH_THRESHOLD
+    if match and match.score >= threshold:
+        faq_stats.incr("hits")
+        logger.info(f"Answered from FAQ (score {match.score:.2f}): {match.entry.prompt}")
+        return match
+    faq_stats.incr("misses")
+    return None
+
+
+def reset_faq_matcher() -> None:
+    """
+    Forgets the loaded matchers; the next lookup reads the CSV again.
+    """
+    drop_slots(FAQ_SLOT)
@@ -0,0 +1,376 @@
+"""
+Registry of files uploaded to the Google AI Files API.
+
+Uploading Veritas_data.pdf on every request put a network round trip on the
+critical path of each chat message and left thousands of duplicate remote
+files behind. The registry keys uploads by the SHA-256 of the file content and
+stores the returned handle in the database so every worker reuses it until it
+expires, the file changes, or the API rejects it.
+"""
+# file_registry.py
+
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+from google.genai import errors as genai_errors
+
+from .metrics import timed
+from .models import UploadedFileHandle
+from .stats import StatCounters
+
+logger = logging.getLogger(__name__)
+
+# Uploaded files are kept by the Files API for 48 hours. Used when the upload
+# response does not carry an expiration time.
+DEFAULT_FILE_HANDLE_LIFETIME = timedelta(hours=47)
+
+registry_stats = StatCounters(
+    "file_registry",
+    "hits",
+    "misses",
+    "uploads",
+    "upload_failures",
+    "lock_waits",
+    "invalidations",
+)
+
+
+@dataclass(frozen=True)
+class FileHandle:
+    """
+    The parts of an uploaded file needed to reference it in a request.
+    """
+
+    content_hash: str
+    name: str
+    uri: str
+    mime_type: str
+    expires_at: datetime | None
+
+
+# Process-local tier in front of the database, keyed by content hash.
+_local_handles: dict[str, FileHandle] = {}
+# Per-hash locks so only one thread per process goes to the database/upload
+# path for a given file at a time.
+_hash_locks: dict[str, threading.Lock] = {}
+_hash_locks_guard = threading.Lock()
+# The asyncio counterpart, per event loop since asyncio locks are loop-bound.
+_async_hash_locks = weakref.WeakKeyDictionary()
+# file path -> (mtime_ns, size, sha256) so the file is only re-hashed when it
+# changes on disk.
+_content_hashes: dict[str, tuple[int, int, str]] = {}
+
+
+def _expiry_margin() -> timedelta:
+    return timedelta(
+        seconds=getattr(settings, "VERITAS_FILE_HANDLE_EXPIRY_MARGIN_SECONDS", 600)
+    )
+
+
+def _lock_timeout() -> timedelta:
+    return timedelta(
+        seconds=getattr(settings, "VERITAS_FILE_UPLOAD_LOCK_TIMEOUT_SECONDS", 60)
+    )
+
+
+def file_content_hash(file_path: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a file, cached by its mtime and size.
+
+    Args:
+        file_path: Path of the file to hash.
+
+    Returns:
+        The hex digest of the file content.
+    """
+    stat_result = os.stat(file_path)
+    signature = (stat_result.st_mtime_ns, stat_result.st_size)
+    cached = _content_hashes.get(file_path)
+    if cached and cached[:2] == signature:
+        return cached[2]
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as data_file:
+        for block in iter(lambda: data_file.read(1024 * 1024), b""):
+            digest.update(block)
+    content_hash = digest.hexdigest()
+    _content_hashes[file_path] = (*signature, content_hash)
+    return content_hash
+
+
+def _is_fresh(handle: FileHandle) -> bool:
+    if not handle.uri:
+        return False
+    if handle.expires_at is None:
+        return True
+    return handle.expires_at - _expiry_margin() > timezone.now()
+
+
+def _handle_from_row(row: UploadedFileHandle) -> FileHandle:
+    return FileHandle(
+        content_hash=row.content_hash,
+        name=row.name,
+        uri=row.uri,
+        mime_type=row.mime_type,
+        expires_at=row.expires_at,
+    )
+
+
+def _lock_for(content_hash: str) -> threading.Lock:
+    with _hash_locks_guard:
+        return _hash_locks.setdefault(content_hash, threading.Lock())
+
+
+def _async_lock_for(content_hash: str) -> asyncio.Lock:
+    loop = asyncio.get_running_loop()
+    with _hash_locks_guard:
+        loop_locks = _async_hash_locks.setdefault(loop, {})
+        return loop_locks.setdefault(content_hash, asyncio.Lock())
+
+
+def _load_stored_handle(content_hash: str) -> FileHandle | None:
+    row = UploadedFileHandle.objects.filter(content_hash=content_hash).first()
+    if row is None:
+        return None
+    handle = _handle_from_row(row)
+    return handle if _is_fresh(handle) else None
+
+
+def _acquire_upload_lease(content_hash: str, owner: str) -> bool:
+    """
+    Tries to take the cross-worker upload lease for a content hash.
+    """
+    try:
+        UploadedFileHandle.objects.get_or_create(content_hash=content_hash)
+    except IntegrityError:
+        # Another worker created the row between our lookup and insert.
+        pass
+    now = timezone.now()
+    updated = (
+        UploadedFileHandle.objects.filter(content_hash=content_hash)
+        .filter(Q(lock_owner="") | Q(lock_expires_at__lt=now))
+        .update(lock_owner=owner, lock_expires_at=now + _lock_timeout())
+    )
+    return updated == 1
+
+
+def _release_upload_lease(content_hash: str, owner: str) -> None:
+    UploadedFileHandle.objects.filter(
+        content_hash=content_hash, lock_owner=owner
+    ).update(lock_owner="", lock_expires_at=None)
+
+
+def _store_uploaded_file(content_hash: str, uploaded_file) -> FileHandle:
+    expires_at = uploaded_file.expiration_time or (
+        timezone.now() + DEFAULT_FILE_HANDLE_LIFETIME
+    )
+    handle = FileHandle(
+        content_hash=content_hash,
+        name=uploaded_file.name or "",
+        uri=uploaded_file.uri or "",
+        mime_type=uploaded_file.mime_type or "application/pdf",
+        expires_at=expires_at,
+    )
+    UploadedFileHandle.objects.update_or_create(
+        content_hash=content_hash,
+        defaults={
+            "name": handle.name,
+            "uri": handle.uri,
+            "mime_type": handle.mime_type,
+            "expires_at": handle.expires_at,
+        },
+    )
+    return handle
+
+
+def _upload(client, file_path: str, content_hash: str) -> FileHandle:
+    logger.info(f"Uploading {file_path} (sha256 {content_hash[:12]}) to the Files API")
+    try:
+        with timed("upload"):
+            uploaded_file = client.files.upload(file=file_path)
+    except Exception:
+        registry_stats.incr("upload_failures")
+        raise
+    registry_stats.incr("uploads")
+    logger.info(
+        f"Successfully uploaded file: {uploaded_file.name}, URI: {uploaded_file.uri}"
+    )
+    return _store_uploaded_file(content_hash, uploaded_file)
+
+
+def _upload_with_lease(client, file_path: str, content_hash: str) -> FileHandle:
+    """
+    Uploads the file while holding the cross-worker lease, or waits for the
+    worker that holds it to finish.
+    """
+    owner = uuid.uuid4().hex
+    wait_deadline = time.monotonic() + _lock_timeout().total_seconds()
+    poll_interval = getattr(settings, "VERITAS_FILE_UPLOAD_POLL_SECONDS", 0.25)
+
+    while True:
+        if _acquire_upload_lease(content_hash, owner):
+            try:
+                # The previous holder may have finished just before we got in.
+                handle = _load_stored_handle(content_hash)
+                return handle or _upload(client, file_path, content_hash)
+            finally:
+                _release_upload_lease(content_hash, owner)
+
+        registry_stats.incr("lock_waits")
+        if time.monotonic() >= wait_deadline:
+            logger.warning(
+                f"Timed out waiting for another worker to upload {file_path}; uploading directly."
+            )
+            return _upload(client, file_path, content_hash)
+        time.sleep(poll_interval)
+        handle = _load_stored_handle(content_hash)
+        if handle:
+            return handle
+
+
+def get_file_handle(client, file_path: str) -> FileHandle:
+    """
+    Returns a usable Files API handle for a local file, uploading it only when
+    no fresh handle exists for its current content.
+
+    Args:
+        client: The initialized Google AI client.
+        file_path: The path of the local file.
+
+    Returns:
+        The FileHandle to reference in the request contents.
+    """
+    content_hash = file_content_hash(file_path)
+    handle = _local_handles.get(content_hash)
+    if handle and _is_fresh(handle):
+        registry_stats.incr("hits")
+        return handle
+
+    with _lock_for(content_hash):
+        handle = _local_handles.get(content_hash)
+        if not (handle and _is_fresh(handle)):
+            handle = _load_stored_handle(content_hash)
+        if handle:
+            registry_stats.incr("hits")
+        else:
+            registry_stats.incr("misses")
+            handle = _upload_with_lease(client, file_path, content_hash)
+        _local_handles[content_hash] = handle
+        return handle
+
+
+async def _aupload(client, file_path: str, content_hash: str) -> FileHandle:
+    logger.info(f"Uploading {file_path} (sha256 {content_hash[:12]}) to the Files API")
+    try:
+        with timed("upload"):
+            uploaded_file = await client.aio.files.upload(file=file_path)
+    except Exception:
+        registry_stats.incr("upload_failures")
+        raise
+    registry_stats.incr("uploads")
+    logger.info(
+        f"Successfully uploaded file: {uploaded_file.name}, URI: {uploaded_file.uri}"
+    )
+    return await sync_to_async(_store_uploaded_file)(content_hash, uploaded_file)
+
+
+async def _aupload_with_lease(client, file_path: str, content_hash: str) -> FileHandle:
+    owner = uuid.uuid4().hex
+    wait_deadline = time.monotonic() + _lock_timeout().total_seconds()
+    poll_interval = getattr(settings, "VERITAS_FILE_UPLOAD_POLL_SECONDS", 0.25)
+
+    while True:
+        if await sync_to_async(_acquire_upload_lease)(content_hash, owner):
+            try:
+                handle = await sync_to_async(_load_stored_handle)(content_hash)
+                return handle or await _aupload(client, file_path, content_hash)
+            finally:
+                await sync_to_async(_release_upload_lease)(content_hash, owner)
+
+        registry_stats.incr("lock_waits")
+        if time.monotonic() >= wait_deadline:
+            logger.warning(
+                f"Timed out waiting for another worker to upload {file_path}; uploading directly."
+            )
+            return await _aupload(client, file_path, content_hash)
+        await asyncio.sleep(poll_interval)
+        handle = await sync_to_async(_load_stored_handle)(content_hash)
+        if handle:
+            return handle
+
+
+async def aget_file_handle(client, file_path: str) -> FileHandle:
+    """
+    Async version of get_file_handle that uploads through client.aio.
+
+    Args:
+        client: The initialized Google AI client.
+        file_path: The path of the local file.
+
+    Returns:
+        The FileHandle to reference in the request contents.
+    """
+    content_hash = file_content_hash(file_path)
+    handle = _local_handles.get(content_hash)
+    if handle and _is_fresh(handle):
+        registry_stats.incr("hits")
+        return handle
+
+    async with _async_lock_for(content_hash):
+        handle = _local_handles.get(content_hash)
+        if not (handle and _is_fresh(handle)):
+            handle = await sync_to_async(_load_stored_handle)(content_hash)
+        if handle:
+            registry_stats.incr("hits")
+        else:
+            registry_stats.incr("misses")
+            handle = await _aupload_with_lease(client, file_path, content_hash)
+        _local_handles[content_hash] = handle
+        return handle
+
+
+def invalidate_file_handle(file_path: str) -> None:
+    """
+    Forgets the stored handle for a file so the next request uploads it again.
+    Used when the API rejects a handle before its recorded expiry.
+
+    Args:
+        file_path: The path of the local file whose handle was rejected.
+    """
+    content_hash = file_content_hash(file_path)
+    registry_stats.incr("invalidations")
+    _local_handles.pop(content_hash, None)
+    UploadedFileHandle.objects.filter(content_hash=content_hash).update(
+        name="", uri="", expires_at=None
+    )
+    logger.warning(f"Invalidated uploaded file handle for {file_path}")
+
+
+def is_file_handle_rejection(error: Exception) -> bool:
+    """
+    Returns True if an API error means a referenced file no longer exists or
+    is not accessible with the current key.
+    """
+    return isinstance(error, genai_errors.ClientError) and error.code in (403, 404)
+
+
+def reset_file_registry() -> None:
+    """
+    Clears the process-local handle and hash caches and the counters.
+    """
+    _local_handles.clear()
+    _content_hashes.clear()
+    registry_stats.reset()
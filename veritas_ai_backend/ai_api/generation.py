@@ -0,0 +1,545 @@
+"""
+Generation logic shared by the sync and async generate endpoints.
+"""
+# generation.py
+
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+import time
+from collections.abc import AsyncIterator, Callable, Iterator
+from dataclasses import dataclass, field
+
+from asgiref.sync import sync_to_async
+from google.genai import types, errors as genai_errors
+
+from .ai_helpers import (
+    BlockedPromptError,
+    abuild_veritas_request,
+    build_veritas_request,
+)
+from .budgets import aenforce_input_budget, enforce_input_budget
+from .cancellation import CANCEL_POLL_SECONDS
+from .context_cache import invalidate_cached_context, record_prompt_usage
+from .file_registry import invalidate_file_handle, is_file_handle_rejection
+from .metrics import blocked_prompts, record_upstream_error
+from .resilience import (
+    circuit_breakers,
+    record_upstream_failure,
+    retry_deadline,
+    retry_delay,
+)
+from .sessions import ChatHistory
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPERATURE = 0.9
+DEFAULT_TOP_P = 0.95
+DEFAULT_TOP_K = 64
+DEFAULT_MAX_OUTPUT_TOKENS = 8192
+
+
+def build_generate_content_config(validated_data: dict) -> types.GenerateContentConfig:
+    """
+    Builds the generation config from validated PromptSerializer data.
+
+    Args:
+        validated_data: The serializer's validated_data.
+
+    Returns:
+        The GenerateContentConfig for the request.
+    """
+    return types.GenerateContentConfig(
+        temperature=validated_data.get("temperature", DEFAULT_TEMPERATURE),
+        top_p=validated_data.get("top_p", DEFAULT_TOP_P),
+        top_k=validated_data.get("top_k", DEFAULT_TOP_K),
+        max_output_tokens=validated_data.get(
+            "max_output_tokens", DEFAULT_MAX_OUTPUT_TOKENS
+        ),
+        response_mime_type="text/plain",
+        # The system instruction is sent with the cached context (a request
+        # that references one may not set it again), or inline if the prompt
+        # template says so (see prompts.py)
+    )
+
+
+def chunk_text(chunk) -> str:
+    """
+    Returns the text of a streamed chunk, or "" for chunks without text.
+
+    Raises:
+        BlockedPromptError: If the API blocked the prompt.
+    """
+    feedback = getattr(chunk, "prompt_feedback", None)
+    if feedback is not None and feedback.block_reason:
+        raise BlockedPromptError(str(feedback.block_reason))
+    try:
+        return chunk.text or ""
+    except ValueError:
+        logger.warning(
+            f"Received chunk without text, possibly finish reason: {chunk.candidates[0].finish_reason}"
+        )
+    except Exception as chunk_err:
+        logger.error(f"Error processing chunk: {chunk_err}")
+    return ""
+
+
+@dataclass
+class GenerationResult:
+    """
+    Accumulates the text, finish reason and token usage of a streamed
+    generation.
+    """
+
+    model: str
+    parts: list[str] = field(default_factory=list)
+    finish_reason: str | None = None
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    total_tokens: int | None = None
+    # Prompt tokens served from an upstream cached context
+    cached_tokens: int | None = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def add_chunk(self, chunk) -> str:
+        """
+        Records a streamed chunk and returns its text.
+        """
+        text = chunk_text(chunk)
+        if text:
+            self.parts.append(text)
+
+        usage = getattr(chunk, "usage_metadata", None)
+        if usage is not None:
+            self.prompt_tokens = usage.prompt_token_count
+            self.completion_tokens = usage.candidates_token_count
+            self.total_tokens = usage.total_token_count
+            self.cached_tokens = getattr(usage, "cached_content_token_count", None)
+
+        candidates = getattr(chunk, "candidates", None)
+        if candidates and candidates[0].finish_reason:
+            finish_reason = candidates[0].finish_reason
+            self.finish_reason = getattr(finish_reason, "value", str(finish_reason))
+        return text
+
+    def summary(self) -> dict:
+        """
+        The model, finish reason and token usage, as sent in the final
+        streaming event.
+        """
+        return {
+            "model": self.model,
+            "finish_reason": self.finish_reason,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+        }
+
+
+def _polled_chunks(response_stream, should_stop: Callable[[], bool]) -> Iterator:
+    """
+    Reads an upstream stream in a background thread, so that should_stop
+    is polled every CANCEL_POLL_SECONDS even while the model sends nothing.
+
+    Ends once should_stop() returns True or the stream is closed; the thread
+    then closes the upstream stream when its next chunk arrives.
+    """
+    chunks: queue.Queue = queue.Queue()
+    stopped = threading.Event()
+
+    def read():
+        try:
+            for chunk in response_stream:
+                if stopped.is_set():
+                    return
+                chunks.put(("chunk", chunk))
+            chunks.put(("end", None))
+        except Exception as e:
+            chunks.put(("error", e))
+        finally:
+            close = getattr(response_stream, "close", None)
+            if close:
+                close()
+
+    context = contextvars.copy_context()
+    threading.Thread(
+        target=context.run, args=(read,), daemon=True, name="veritas-stream"
+    ).start()
+    try:
+        while not should_stop():
+            try:
+                kind, payload = chunks.get(timeout=CANCEL_POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if kind == "end":
+                return
+            if kind == "error":
+                raise payload
+            yield payload
+    finally:
+        stopped.set()
+
+
+def _backoff(
+    delay: float,
+    cancelled: threading.Event | None,
+    should_stop: Callable[[], bool] | None,
+) -> bool:
+    """
+    Waits delay seconds before a retry.
+
+    Returns:
+        True if the generation was stopped meanwhile.
+    """
+    if should_stop is None:
+        if cancelled is None:
+            time.sleep(delay)
+            return False
+        return cancelled.wait(delay)
+    until = time.monotonic() + delay
+    while not should_stop():
+        remaining = until - time.monotonic()
+        if remaining <= 0:
+            return False
+        step = min(remaining, CANCEL_POLL_SECONDS)
+        if cancelled is None:
+            time.sleep(step)
+        elif cancelled.wait(step):
+            return True
+    return True
+
+
+def iter_generation(
+    client,
+    model_name: str,
+    contents,
+    config,
+    result: GenerationResult,
+    deadline: float | None = None,
+    cancelled: threading.Event | None = None,
+    should_stop: Callable[[], bool] | None = None,
+) -> Iterator[str]:
+    """
+    Streams a generation from the model, recording it in result and yielding
+    the text of each chunk as it arrives.
+
+    Transient failures before the first chunk are retried with backoff until
+    the deadline, and every call goes through the model's circuit breaker
+    (see resilience.py).
+
+    Args:
+        deadline: time.monotonic() after which failed calls are not retried;
+            VERITAS_RETRY_DEADLINE_SECONDS from now by default.
+        cancelled: Set when the generation is no longer wanted; ends the
+            wait for a retry, or the stream at its next chunk.
+        should_stop: Returns True once the generation is no longer wanted
+            (the request's deadline passed or it was cancelled). It is
+            polled every CANCEL_POLL_SECONDS, also while the model sends
+            nothing: the stream is then read in a background thread.
+
+    The upstream stream is closed when the generation ends early, including
+    when the caller stops iterating, so the API stops generating.
+
+    Raises:
+        CircuitOpen: The model's circuit breaker is open.
+    """
+    if deadline is None:
+        deadline = retry_deadline()
+    retries = 0
+    while True:
+        circuit_breakers.before_call(model_name)
+        try:
+            response_stream = client.models.generate_content_stream(
+                model=model_name,
+                contents=contents,
+                config=config,
+            )
+            if should_stop is not None:
+                response_stream = _polled_chunks(response_stream, should_stop)
+            try:
+                for chunk in response_stream:
+                    text = result.add_chunk(chunk)
+                    if cancelled is not None and cancelled.is_set():
+                        return
+                    if text:
+                        yield text
+            finally:
+                close = getattr(response_stream, "close", None)
+                if close:
+                    close()
+            if should_stop is not None and should_stop():
+                return
+            circuit_breakers.record_success(model_name)
+            return
+        except BlockedPromptError:
+            blocked_prompts.inc()
+            raise
+        except Exception as e:
+            record_upstream_error(e)
+            record_upstream_failure(model_name, e)
+            delay = None if result.parts else retry_delay(model_name, e, retries, deadline)
+            if delay is None:
+                raise
+        retries += 1
+        if _backoff(delay, cancelled, should_stop):
+            return
+
+
+async def aiter_generation(
+    client,
+    model_name: str,
+    contents,
+    config,
+    result: GenerationResult,
+    deadline: float | None = None,
+) -> AsyncIterator[str]:
+    """
+    Async version of iter_generation using client.aio; cancelling the task
+    iterating it closes the upstream stream.
+    """
+    if deadline is None:
+        deadline = retry_deadline()
+    retries = 0
+    while True:
+        circuit_breakers.before_call(model_name)
+        try:
+            response_stream = await client.aio.models.generate_content_stream(
+                model=model_name,
+                contents=contents,
+                config=config,
+            )
+            try:
+                async for chunk in response_stream:
+                    text = result.add_chunk(chunk)
+                    if text:
+                        yield text
+            finally:
+                # Also runs when the task is cancelled
+                aclose = getattr(response_stream, "aclose", None)
+                if aclose:
+                    await aclose()
+            circuit_breakers.record_success(model_name)
+            return
+        except BlockedPromptError:
+            blocked_prompts.inc()
+            raise
+        except Exception as e:
+            record_upstream_error(e)
+            record_upstream_failure(model_name, e)
+            delay = None if result.parts else retry_delay(model_name, e, retries, deadline)
+            if delay is None:
+                raise
+        retries += 1
+        await asyncio.sleep(delay)
+
+
+def iter_veritas_generation(
+    client,
+    model_name: str,
+    prompt: str,
+    config,
+    file_path: str,
+    result: GenerationResult,
+    history: ChatHistory | None = None,
+    should_stop: Callable[[], bool] | None = None,
+) -> Iterator[str]:
+    """
+    Builds the Veritas contents for a prompt and streams the answer.
+
+    If the API rejects the uploaded data file or the cached context (it
+    expired early or was deleted) before any text was produced, both are
+    invalidated and the request is retried once with a fresh upload.
+
+    Raises:
+        TokenBudgetExceeded: The request is over VERITAS_MAX_INPUT_TOKENS.
+
+    Args:
+        client: The initialized Google AI client.
+        model_name: The model to generate with.
+        prompt: The user's input prompt.
+        config: The GenerateContentConfig for the request.
+        file_path: The path to the Veritas data file.
+        result: Collects the text, finish reason and usage.
+        history: The chat session turns to send before the prompt.
+        should_stop: Ends the generation early; see iter_generation.
+
+    Yields:
+        The text of each chunk as it arrives.
+    """
+    contents, request_config = build_veritas_request(
+        client, model_name, file_path, prompt, config, history=history
+    )
+    enforce_input_budget(client, model_name, contents, request_config, file_path)
+    logger.info(
+        f"Sending request to Gemini model '{model_name}' with {len(contents)} content parts."
+    )
+    try:
+        yield from iter_generation(
+            client, model_name, contents, request_config, result, should_stop=should_stop
+        )
+    except genai_errors.ClientError as e:
+        if result.parts or not is_file_handle_rejection(e):
+            raise
+        logger.warning(f"Data file or cached context was rejected by the API: {e}")
+        if request_config.cached_content:
+            invalidate_cached_context(request_config.cached_content)
+        invalidate_file_handle(file_path)
+        contents, request_config = build_veritas_request(
+            client, model_name, file_path, prompt, config, history=history
+        )
+        yield from iter_generation(
+            client, model_name, contents, request_config, result, should_stop=should_stop
+        )
+    record_prompt_usage(result)
+
+
+async def aiter_veritas_generation(
+    client,
+    model_name: str,
+    prompt: str,
+    config,
+    file_path: str,
+    result: GenerationResult,
+    history: ChatHistory | None = None,
+) -> AsyncIterator[str]:
+    """
+    Async version of iter_veritas_generation using client.aio for both the
+    upload and the generation.
+    """
+    contents, request_config = await abuild_veritas_request(
+        client, model_name, file_path, prompt, config, history=history
+    )
+    await aenforce_input_budget(client, model_name, contents, request_config, file_path)
+    logger.info(
+        f"Sending async request to Gemini model '{model_name}' with {len(contents)} content parts."
+    )
+    try:
+        async for text in aiter_generation(
+            client, model_name, contents, request_config, result
+        ):
+            yield text
+    except genai_errors.ClientError as e:
+        if result.parts or not is_file_handle_rejection(e):
+            raise
+        logger.warning(f"Data file or cached context was rejected by the API: {e}")
+        if request_config.cached_content:
+            await sync_to_async(invalidate_cached_context)(request_config.cached_content)
+        await sync_to_async(invalidate_file_handle)(file_path)
+        contents, request_config = await abuild_veritas_request(
+            client, model_name, file_path, prompt, config, history=history
+        )
+        async for text in aiter_generation(
+            client, model_name, contents, request_config, result
+        ):
+            yield text
+    record_prompt_usage(result)
+
+
+def generate_veritas_response(
+    client,
+    model_name: str,
+    prompt: str,
+    config,
+    file_path: str,
+    history: ChatHistory | None = None,
+) -> GenerationResult:
+    """
+    Generates the full answer for a prompt; see iter_veritas_generation.
+    """
+    result = GenerationResult(model=model_name)
+    for _ in iter_veritas_generation(
+        client, model_name, prompt, config, file_path, result, history
+    ):
+        pass
+    return result
+
+
+async def agenerate_veritas_response(
+    client,
+    model_name: str,
+    prompt: str,
+    config,
+    file_path: str,
+    history: ChatHistory | None = None,
+) -> GenerationResult:
+    """
+    Async version of generate_veritas_response.
+    """
+    result = GenerationResult(model=model_name)
+    async for _ in aiter_veritas_generation(
+        client, model_name, prompt, config, file_path, result, history
+    ):
+        pass
+    return result
+
+
+def stream_veritas_events(
+    client,
+    model_name: str,
+    prompt: str,
+    config,
+    file_path: str,
+    history: ChatHistory | None = None,
+    should_stop: Callable[[], bool] | None = None,
+) -> Iterator[tuple[str, dict]]:
+    """
+    Streams the answer for a prompt as (event, data) pairs: one "chunk" event
+    per piece of text, then a "done" event with the model, finish reason and
+    token usage.
+    """
+    result = GenerationResult(model=model_name)
+    for text in iter_veritas_generation(
+        client, model_name, prompt, config, file_path, result, history, should_stop
+    ):
+        yield "chunk", {"text": text}
+    yield "done", result.summary()
+
+
+async def astream_veritas_events(
+    client,
+    model_name: str,
+    prompt: str,
+    config,
+    file_path: str,
+    history: ChatHistory | None = None,
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Async version of stream_veritas_events.
+    """
+    result = GenerationResult(model=model_name)
+    async for text in aiter_veritas_generation(
+        client, model_name, prompt, config, file_path, result, history
+    ):
+        yield "chunk", {"text": text}
+    yield "done", result.summary()
+
+
+def collect_events(events: Iterator[tuple[str, dict]]) -> tuple[str, dict]:
+    """
+    Consumes an event stream, returning the full text and the done event data.
+    """
+    parts, done_data = [], {}
+    for event, data in events:
+        if event == "chunk":
+            parts.append(data["text"])
+        elif event == "done":
+            done_data = data
+    return "".join(parts), done_data
+
+
+async def acollect_events(events: AsyncIterator[tuple[str, dict]]) -> tuple[str, dict]:
+    """
+    Async version of collect_events.
+    """
+    parts, done_data = [], {}
+    async for event, data in events:
+        if event == "chunk":
+            parts.append(data["text"])
+        elif event == "done":
+            done_data = data
+    return "".join(parts), done_data
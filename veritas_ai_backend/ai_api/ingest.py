@@ -0,0 +1,169 @@
+"""
+Ingestion of the knowledge base sources into the store the workers map (see
+knowledge_store.py).
+
+The sources are Veritas_data.pdf, data.csv and the model preamble, read from
+VERITAS_PREAMBLE_PATH when that file exists so it can be edited without a
+code deploy; other knowledge bases (see knowledge_bases.py) are ingested
+from their own files into their own store while they are the current one.
+Each section of the store records a hash of what it was built from. On the
+next run a section whose sources and settings didn't change is copied from
+the current version as is; the PDF in particular is only parsed again when
+its content changed. Nothing is written if no section changed.
+
+Run it with `python manage.py ingest_kb`.
+"""
+# ingest.py
+
+import logging
+import os
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from .ai_helpers import PREAMBLE_SECTION, VERITAS_MODEL_PREAMBLE_TEXT
+from .faq import FAQ_SECTION, FaqMatcher, faq_section_inputs, load_faq_entries
+from .file_registry import file_content_hash
+from .knowledge_bases import current_knowledge_base
+from .knowledge_store import (
+    StoreSection,
+    open_current_store,
+    prune_versions,
+    section_inputs,
+    store_dir,
+    text_hash,
+    write_store,
+)
+from .retrieval import (
+    PAGES_SECTION,
+    PASSAGES_SECTION,
+    PassageIndex,
+    extract_pdf_pages,
+    passage_section_inputs,
+    passages_from_pages,
+    retrieval_available,
+)
+
+logger = logging.getLogger(__name__)
+
+BUILT = "built"
+REUSED = "reused"
+
+
+def read_preamble() -> tuple[str, str]:
+    """
+    Returns the model preamble to ingest into the current knowledge base and
+    where it was read from.
+    """
+    path = current_knowledge_base().preamble_path
+    if path and os.path.isfile(path):
+        with open(path, encoding="utf-8") as preamble_file:
+            return preamble_file.read(), str(path)
+    return VERITAS_MODEL_PREAMBLE_TEXT, "built-in"
+
+
+def ingest_knowledge_base(
+    data_file_path: str, directory: Path | None = None, force: bool = False
+) -> dict:
+    """
+    Writes a new version of the current knowledge base's store if a source
+    changed.
+
+    Args:
+        data_file_path: The path to the knowledge base's data file.
+        directory: The store directory instead of the knowledge base's.
+        force: Rebuild every section even if its sources didn't change.
+
+    Returns:
+        The ingest report: the new and previous version, whether a new
+        version was written, and which sections were built or reused.
+    """
+    started = time.perf_counter()
+    directory = Path(directory or store_dir())
+    try:
+        previous = open_current_store(directory)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Ignoring the unreadable current knowledge base store: {e}")
+        previous = None
+
+    sources: dict[str, dict] = {}
+    sections: dict[str, StoreSection] = {}
+    report: dict[str, str] = {}
+
+    def add_section(name: str, inputs: str, build) -> None:
+        if not force and previous is not None and previous.section_matches(name, inputs):
+            sections[name] = previous.section(name)
+            report[name] = REUSED
+            return
+        section = StoreSection(inputs)
+        build(section)
+        sections[name] = section
+        report[name] = BUILT
+        logger.info(f"Built knowledge base section {name}")
+
+    preamble, preamble_path = read_preamble()
+    sources["preamble"] = {"path": preamble_path, "hash": text_hash(preamble)}
+    add_section(
+        PREAMBLE_SECTION,
+        section_inputs(PREAMBLE_SECTION, text_hash(preamble)),
+        lambda section: section.add_strings("text", [preamble]),
+    )
+
+    if not os.path.exists(data_file_path):
+        logger.warning(f"Data file {data_file_path} not found; passages not ingested")
+    elif not retrieval_available():
+        logger.warning("pypdf is not installed; passages not ingested")
+    else:
+        file_hash = file_content_hash(data_file_path)
+        sources["data_file"] = {"path": str(data_file_path), "hash": file_hash}
+        pages_inputs = section_inputs(PAGES_SECTION, file_hash)
+        if not force and previous is not None and previous.section_matches(
+            PAGES_SECTION, pages_inputs
+        ):
+            pages = previous.strings(PAGES_SECTION, "text")[:]
+        else:
+            pages = extract_pdf_pages(data_file_path)
+        add_section(
+            PAGES_SECTION, pages_inputs, lambda section: section.add_strings("text", pages)
+        )
+        add_section(
+            PASSAGES_SECTION,
+            passage_section_inputs(file_hash, preamble),
+            lambda section: PassageIndex(passages_from_pages(pages, preamble)).write_section(
+                section
+            ),
+        )
+
+    csv_path = current_knowledge_base().faq_csv_path
+    if csv_path and os.path.exists(csv_path):
+        csv_hash = file_content_hash(csv_path)
+        sources["faq"] = {"path": str(csv_path), "hash": csv_hash}
+        add_section(
+            FAQ_SECTION,
+            faq_section_inputs(csv_hash),
+            lambda section: FaqMatcher(load_faq_entries(csv_path)).write_section(section),
+        )
+    else:
+        logger.warning(f"FAQ file {csv_path} not found; FAQ not ingested")
+
+    version = section_inputs(
+        *(f"{name}={section.inputs}" for name, section in sorted(sections.items()))
+    )[:16]
+    previous_version = previous.version if previous else None
+    written = force or version != previous_version
+    path = None
+    if written:
+        path = write_store(version, sources, sections, directory)
+        prune_versions(directory, settings.VERITAS_KB_KEEP_VERSIONS)
+        logger.info(f"Knowledge base store version {version} written to {path}")
+    return {
+        "version": version,
+        "previous_version": previous_version,
+        "written": written,
+        "path": str(path) if path else None,
+        "size_bytes": path.stat().st_size if path else None,
+        "sections": report,
+        "sources": sources,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
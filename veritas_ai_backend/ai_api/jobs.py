@@ -0,0 +1,542 @@
+"""
+Generation jobs: long generations queued through /api/jobs/ instead of
+holding an HTTP connection (and the Next.js proxy) open until the model
+finishes.
+
+A job is a GenerationJob row in the project database, so the queue survives
+restarts and is shared by every worker process. Jobs are run by a bounded
+pool of worker threads (VERITAS_JOB_WORKERS per process serving requests, or
+`python manage.py run_jobs` in a process of its own):
+
+* Queued jobs are claimed highest priority first, then oldest first, with a
+  compare-and-set update so each job runs once.
+* The answer is generated like a generate request (see views.answer_job) and
+  streamed into the job's partial_text every VERITAS_JOB_PROGRESS_SECONDS,
+  which also extends the worker's lease on the job.
+* A cancelled job stops at the next progress update, or within
+  VERITAS_JOB_PROGRESS_SECONDS while the model sends nothing; a job past
+  its deadline fails, whether it is still queued or running.
+* A running job whose lease lapsed (its worker died) is queued again, up to
+  VERITAS_JOB_MAX_ATTEMPTS attempts.
+* Finished jobs are kept VERITAS_JOB_RESULT_TTL_SECONDS, then deleted.
+
+Enqueueing fails with QueueFull once VERITAS_JOB_MAX_QUEUED jobs (or
+VERITAS_JOB_MAX_QUEUED_PER_CLIENT of one client) are waiting.
+"""
+# jobs.py
+
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .metrics import job_queue_seconds
+from .models import GenerationJob
+from .stats import StatCounters
+
+logger = logging.getLogger(__name__)
+
+job_stats = StatCounters(
+    "jobs",
+    "enqueued",
+    "rejected",
+    "started",
+    "succeeded",
+    "failed",
+    "cancelled",
+    "deadline_exceeded",
+    "requeued",
+    "expired",
+)
+
+STOPPED_CANCELLED = "cancelled"
+STOPPED_DEADLINE = "deadline"
+
+
+class QueueFull(Exception):
+    """
+    Too many jobs are waiting to be run.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class JobStopped(Exception):
+    """
+    A running job was cancelled or missed its deadline.
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(f"Job stopped: {reason}")
+        self.reason = reason
+
+
+def enqueue_job(
+    params: dict, client_id: str, priority: int = 0, deadline_seconds: int | None = None
+) -> GenerationJob:
+    """
+    Queues a generation and wakes a job worker.
+
+    Args:
+        params: The generate request parameters (PromptSerializer fields).
+        client_id: The client the job's tokens are charged to.
+        priority: Jobs with a higher priority run first.
+        deadline_seconds: Seconds the job may take from now, at most
+            VERITAS_JOB_MAX_DEADLINE_SECONDS (the default).
+
+    Returns:
+        The queued GenerationJob.
+
+    Raises:
+        QueueFull: Too many jobs are waiting, in total or for the client.
+    """
+    queued = GenerationJob.objects.filter(status=GenerationJob.STATUS_QUEUED)
+    retry_after = max(1, int(settings.VERITAS_JOB_POLL_SECONDS))
+    if queued.count() >= settings.VERITAS_JOB_MAX_QUEUED:
+        job_stats.incr("rejected")
+        raise QueueFull("Too many jobs are queued.", retry_after)
+    if queued.filter(client_id=client_id).count() >= settings.VERITAS_JOB_MAX_QUEUED_PER_CLIENT:
+        job_stats.incr("rejected")
+        raise QueueFull("Too many of your jobs are queued.", retry_after)
+
+    max_deadline = settings.VERITAS_JOB_MAX_DEADLINE_SECONDS
+    deadline_seconds = min(deadline_seconds or max_deadline, max_deadline)
+    job = GenerationJob.objects.create(
+        params=params,
+        client_id=client_id,
+        priority=priority,
+        deadline=timezone.now() + timedelta(seconds=deadline_seconds),
+    )
+    job_stats.incr("enqueued")
+    logger.info(f"Queued job {job.id} (priority {priority}).")
+    wake_job_workers()
+    return job
+
+
+def cancel_job(job_id: uuid.UUID) -> bool:
+    """
+    Cancels a queued or running job; a running job stops at its next
+    progress update.
+
+    Returns:
+        False if the job doesn't exist or already finished.
+    """
+    cancelled = GenerationJob.objects.filter(
+        id=job_id,
+        status__in=(GenerationJob.STATUS_QUEUED, GenerationJob.STATUS_RUNNING),
+    ).update(
+        status=GenerationJob.STATUS_CANCELLED,
+        finished_at=timezone.now(),
+        expires_at=_expiry(),
+    )
+    if cancelled:
+        job_stats.incr("cancelled")
+        logger.info(f"Cancelled job {job_id}.")
+    return bool(cancelled)
+
+
+def get_job(job_id: uuid.UUID) -> GenerationJob | None:
+    """
+    Returns a job, or None if it doesn't exist or its result expired.
+    """
+    return (
+        GenerationJob.objects.filter(id=job_id)
+        .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+        .first()
+    )
+
+
+def _queue_position(job: GenerationJob) -> int:
+    """
+    The number of queued jobs that run before this one.
+    """
+    return (
+        GenerationJob.objects.filter(status=GenerationJob.STATUS_QUEUED)
+        .filter(
+            Q(priority__gt=job.priority)
+            | Q(priority=job.priority, created_at__lt=job.created_at)
+        )
+        .count()
+    )
+
+
+def job_payload(job: GenerationJob) -> dict:
+    """
+    The response data describing a job.
+    """
+    payload = {
+        "id": str(job.id),
+        "status": job.status,
+        "priority": job.priority,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "deadline": job.deadline,
+        "expires_at": job.expires_at,
+        "partial_text": job.partial_text,
+        "result": job.result,
+        "error": job.error,
+    }
+    if job.status == GenerationJob.STATUS_QUEUED:
+        payload["position"] = _queue_position(job)
+    return payload
+
+
+def _lease_expiry():
+    return timezone.now() + timedelta(seconds=settings.VERITAS_JOB_LEASE_SECONDS)
+
+
+def _expiry():
+    return timezone.now() + timedelta(seconds=settings.VERITAS_JOB_RESULT_TTL_SECONDS)
+
+
+def claim_job(worker: str) -> GenerationJob | None:
+    """
+    Takes the next queued job for a worker: highest priority first, then
+    oldest first, skipping jobs past their deadline.
+
+    Returns:
+        The claimed job, or None if there is nothing to run.
+    """
+    now = timezone.now()
+    candidates = (
+        GenerationJob.objects.filter(status=GenerationJob.STATUS_QUEUED)
+        .filter(Q(deadline__isnull=True) | Q(deadline__gt=now))
+        .order_by("-priority", "created_at")
+        .values_list("id", flat=True)[:5]
+    )
+    for job_id in candidates:
+        # Another worker may claim the same job between our lookup and update
+        claimed = GenerationJob.objects.filter(
+            id=job_id, status=GenerationJob.STATUS_QUEUED
+        ).update(
+            status=GenerationJob.STATUS_RUNNING,
+            worker=worker,
+            lease_expires_at=_lease_expiry(),
+            started_at=now,
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return GenerationJob.objects.get(id=job_id)
+    return None
+
+
+class JobProgress:
+    """
+    Collects a running job's answer and writes it to partial_text every
+    VERITAS_JOB_PROGRESS_SECONDS, extending the worker's lease.
+
+    Raises JobStopped from add() and flush() once the job was cancelled (or
+    taken over after the lease lapsed) or its deadline passed.
+    """
+
+    def __init__(self, job: GenerationJob):
+        self.job_id = job.id
+        self.worker = job.worker
+        self.deadline = job.deadline
+        self._parts = []
+        self._last_flush = time.monotonic()
+        self._last_check = self._last_flush
+        self._cancelled = False
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def check_deadline(self) -> None:
+        if self.deadline is not None and timezone.now() >= self.deadline:
+            raise JobStopped(STOPPED_DEADLINE)
+
+    def monotonic_deadline(self) -> float | None:
+        """
+        The job's deadline as a time.monotonic() value for dispatch, which
+        stops waiting for the model once it passes.
+        """
+        if self.deadline is None:
+            return None
+        return time.monotonic() + (self.deadline - timezone.now()).total_seconds()
+
+    def cancelled(self) -> bool:
+        """
+        True once the job was cancelled or taken over. Dispatch polls it
+        while waiting for the model; the job is looked up at most every
+        VERITAS_JOB_PROGRESS_SECONDS.
+        """
+        now = time.monotonic()
+        if self._cancelled or now - self._last_check < settings.VERITAS_JOB_PROGRESS_SECONDS:
+            return self._cancelled
+        self._last_check = now
+        self._cancelled = not self._holds_job().exists()
+        return self._cancelled
+
+    def _holds_job(self):
+        return GenerationJob.objects.filter(
+            id=self.job_id, status=GenerationJob.STATUS_RUNNING, worker=self.worker
+        )
+
+    def add(self, text: str) -> None:
+        self._parts.append(text)
+        self.check_deadline()
+        if time.monotonic() - self._last_flush >= settings.VERITAS_JOB_PROGRESS_SECONDS:
+            self.flush()
+
+    def flush(self) -> None:
+        self._last_flush = time.monotonic()
+        updated = self._holds_job().update(
+            partial_text=self.text, lease_expires_at=_lease_expiry()
+        )
+        if not updated:
+            raise JobStopped(STOPPED_CANCELLED)
+
+    def track(self, events):
+        """
+        Passes (event, data) pairs through, adding the chunks' text. The
+        events are closed (ending the upstream stream) if the job stops.
+        """
+        try:
+            for event, data in events:
+                if event == "chunk":
+                    self.add(data["text"])
+                yield event, data
+        finally:
+            events.close()
+
+
+def finish_job(
+    job: GenerationJob,
+    status: str,
+    text: str,
+    result: dict | None = None,
+    error: dict | None = None,
+) -> bool:
+    """
+    Records the outcome of a job the worker still holds.
+
+    Returns:
+        False if the job was cancelled or taken over meanwhile.
+    """
+    now = timezone.now()
+    return bool(
+        GenerationJob.objects.filter(
+            id=job.id, status=GenerationJob.STATUS_RUNNING, worker=job.worker
+        ).update(
+            status=status,
+            partial_text=text,
+            result=result,
+            error=error,
+            finished_at=now,
+            lease_expires_at=None,
+            expires_at=_expiry(),
+        )
+    )
+
+
+DEADLINE_ERROR = {"error": "The job did not finish before its deadline.", "status": 504}
+FAILED_ERROR = {"error": "The job failed unexpectedly.", "status": 500}
+
+
+def run_job(job: GenerationJob) -> None:
+    """
+    Generates the answer of a claimed job and records the outcome.
+    """
+    from .views import answer_job
+
+    job_stats.incr("started")
+    job_queue_seconds.observe((job.started_at - job.created_at).total_seconds())
+    logger.info(f"Running job {job.id} on {job.worker} (attempt {job.attempts}).")
+    progress = JobProgress(job)
+    try:
+        progress.check_deadline()
+        output = answer_job(job.params, job.client_id, progress)
+    except JobStopped as e:
+        if e.reason == STOPPED_DEADLINE:
+            job_stats.incr("deadline_exceeded")
+            finish_job(job, GenerationJob.STATUS_FAILED, progress.text, error=DEADLINE_ERROR)
+        logger.info(f"Job {job.id} stopped: {e.reason}.")
+        return
+    except Exception as e:
+        logger.exception(f"Job {job.id} failed: {e}")
+        output = FAILED_ERROR
+
+    if "error" in output:
+        if finish_job(job, GenerationJob.STATUS_FAILED, progress.text, error=output):
+            job_stats.incr("failed")
+        return
+    if finish_job(job, GenerationJob.STATUS_SUCCEEDED, output["response"], result=output):
+        job_stats.incr("succeeded")
+        logger.info(f"Job {job.id} succeeded.")
+
+
+def run_next_job(worker: str) -> GenerationJob | None:
+    """
+    Claims and runs the next queued job.
+
+    Returns:
+        The job that was run, or None if the queue was empty.
+    """
+    job = claim_job(worker)
+    if job is not None:
+        run_job(job)
+    return job
+
+
+def sweep_jobs() -> None:
+    """
+    Queues again (or fails, after VERITAS_JOB_MAX_ATTEMPTS) the running jobs
+    whose lease lapsed, fails queued jobs past their deadline and deletes
+    expired jobs.
+    """
+    now = timezone.now()
+    stale = GenerationJob.objects.filter(
+        status=GenerationJob.STATUS_RUNNING, lease_expires_at__lt=now
+    )
+    failed = stale.filter(attempts__gte=settings.VERITAS_JOB_MAX_ATTEMPTS).update(
+        status=GenerationJob.STATUS_FAILED,
+        error=FAILED_ERROR,
+        finished_at=now,
+        expires_at=_expiry(),
+    )
+    requeued = stale.update(
+        status=GenerationJob.STATUS_QUEUED, worker="", lease_expires_at=None
+    )
+    missed = GenerationJob.objects.filter(
+        status=GenerationJob.STATUS_QUEUED, deadline__lte=now
+    ).update(
+        status=GenerationJob.STATUS_FAILED,
+        error=DEADLINE_ERROR,
+        finished_at=now,
+        expires_at=_expiry(),
+    )
+    _, by_model = GenerationJob.objects.filter(expires_at__lte=now).delete()
+    expired = by_model.get(GenerationJob._meta.label, 0)
+
+    job_stats.incr("failed", failed)
+    job_stats.incr("requeued", requeued)
+    job_stats.incr("deadline_exceeded", missed)
+    job_stats.incr("expired", expired)
+    if failed or requeued or missed or expired:
+        logger.info(
+            f"Job sweep: {requeued} requeued, {failed} out of attempts, "
+            f"{missed} past their deadline, {expired} expired."
+        )
+
+
+_last_sweep = 0.0
+_sweep_lock = threading.Lock()
+
+
+def _maybe_sweep() -> None:
+    global _last_sweep
+    with _sweep_lock:
+        now = time.monotonic()
+        if _last_sweep and now - _last_sweep < settings.VERITAS_JOB_SWEEP_INTERVAL_SECONDS:
+            return
+        _last_sweep = now
+    try:
+        sweep_jobs()
+    except Exception as e:
+        logger.error(f"Failed to sweep generation jobs: {e}")
+
+
+class JobWorkerPool:
+    """
+    A fixed number of threads running queued jobs, woken when a job is
+    queued and polling the database every VERITAS_JOB_POLL_SECONDS for jobs
+    queued by other processes.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.name = f"jobs-{uuid.uuid4().hex[:8]}"
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        for number in range(self.workers):
+            worker = f"{self.name}-{number}"
+            thread = threading.Thread(target=self._run, args=(worker,), name=worker, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Started {self.workers} job workers ({self.name}).")
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def join(self) -> None:
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self, worker: str) -> None:
+        # Pools started by AppConfig.ready() wait for the app registry
+        while not apps.ready and not self._stop.is_set():
+            time.sleep(0.1)
+        try:
+            while not self._stop.is_set():
+                close_old_connections()
+                _maybe_sweep()
+                try:
+                    job = run_next_job(worker)
+                except Exception as e:
+                    logger.error(f"Job worker {worker} failed to run a job: {e}")
+                    job = None
+                if job is None:
+                    self._wake.wait(settings.VERITAS_JOB_POLL_SECONDS)
+                    self._wake.clear()
+        finally:
+            connections.close_all()
+
+
+_pool: JobWorkerPool | None = None
+_pool_lock = threading.Lock()
+
+
+def start_job_workers(workers: int | None = None) -> JobWorkerPool | None:
+    """
+    Starts this process's job worker pool (VERITAS_JOB_WORKERS threads) if it
+    isn't running yet.
+
+    Returns:
+        The pool, or None if job workers are switched off.
+    """
+    global _pool
+    workers = settings.VERITAS_JOB_WORKERS if workers is None else workers
+    with _pool_lock:
+        if _pool is None and workers > 0:
+            _pool = JobWorkerPool(workers)
+            _pool.start()
+        return _pool
+
+
+def wake_job_workers() -> None:
+    """
+    Wakes this process's job workers, starting them on first use.
+    """
+    pool = start_job_workers()
+    if pool is not None:
+        pool.wake()
+
+
+def reset_jobs() -> None:
+    """
+    Resets the sweep timer and the counters (for tests).
+    """
+    global _last_sweep
+    with _sweep_lock:
+        _last_sweep = 0.0
+    job_stats.reset()
@@ -0,0 +1,431 @@
+"""
+Knowledge bases: separate document sets (admissions, bursary, a faculty,
+the postgraduate school...) served by the same deployment.
+
+Each base in VERITAS_KNOWLEDGE_BASES has its own data file, FAQ CSV, model
+preamble and ingested store (see knowledge_store.py); the default base
+(VERITAS_DEFAULT_KNOWLEDGE_BASE) is made of the single-base settings
+(VERITAS_DATA_FILE_PATH, VERITAS_FAQ_CSV_PATH, VERITAS_PREAMBLE_PATH and
+VERITAS_KB_STORE_DIR). Requests pick a base with "knowledge_base"; the views
+run each request with its base as the current one, and the FAQ, store,
+passage index and preamble lookups use the current base. Uploaded data
+files, cached contexts and cached answers are keyed by the content of the
+data file and the preamble, so they are never shared between bases with
+different documents.
+
+A base is loaded on first use. What a worker holds in memory for each base
+(mapped store, FAQ and passage indexes built from the sources) is kept in a
+least-recently-used set of at most VERITAS_KB_MAX_RESIDENT bases and about
+VERITAS_KB_MAX_RESIDENT_BYTES; the least recently used bases are dropped
+beyond that and loaded again when next used. Requests already holding a
+dropped index keep using it.
+
+Requests are counted per base (veritas_knowledge_base_requests_total) and
+the counts are added up in the shared cache, so warm-up can load the most
+used bases (VERITAS_KB_WARMUP_COUNT) before the worker takes traffic.
+"""
+# knowledge_bases.py
+
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import Counter as UsageCounter
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+from .metrics import (
+    knowledge_base_evictions,
+    knowledge_base_loads,
+    knowledge_base_requests,
+    knowledge_base_resident_bytes,
+)
+from .stats import StatCounters, register
+
+logger = logging.getLogger(__name__)
+
+knowledge_base_stats = StatCounters("knowledge_bases", "loads", "evictions")
+
+DEFAULT_KNOWLEDGE_BASE = "default"
+DEFINITION_KEYS = ("data_file", "faq_csv", "preamble", "store_dir")
+USAGE_KEY_PREFIX = "veritas:kb-usage:"
+# How often a worker adds its request counts to the shared cache
+USAGE_FLUSH_SECONDS = 60
+
+
+class UnknownKnowledgeBase(Exception):
+    """
+    A request named a knowledge base that isn't configured.
+    """
+
+
+@dataclass(frozen=True)
+class KnowledgeBase:
+    name: str
+    data_file_path: str
+    # None: the base has no curated FAQ
+    faq_csv_path: str | None
+    # Read by ingest_kb; None uses the built-in preamble
+    preamble_path: str | None
+    store_dir: str
+
+
+def default_knowledge_base_name() -> str:
+    return getattr(settings, "VERITAS_DEFAULT_KNOWLEDGE_BASE", DEFAULT_KNOWLEDGE_BASE)
+
+
+def _optional_path(value) -> str | None:
+    return os.fspath(value) if value else None
+
+
+def _build_knowledge_bases() -> dict[str, KnowledgeBase]:
+    default_name = default_knowledge_base_name()
+    definitions = dict(getattr(settings, "VERITAS_KNOWLEDGE_BASES", {}))
+    bases = {
+        default_name: KnowledgeBase(
+            name=default_name,
+            data_file_path=os.fspath(settings.VERITAS_DATA_FILE_PATH),
+            faq_csv_path=_optional_path(settings.VERITAS_FAQ_CSV_PATH),
+            preamble_path=_optional_path(getattr(settings, "VERITAS_PREAMBLE_PATH", None)),
+            store_dir=os.fspath(settings.VERITAS_KB_STORE_DIR),
+        )
+    }
+    for name, definition in definitions.items():
+        unknown = set(definition) - set(DEFINITION_KEYS)
+        default = bases.get(name)
+        if unknown or (default is None and "data_file" not in definition):
+            logger.error(
+                f"Ignoring knowledge base {name}: unknown keys {sorted(unknown)} or no data_file"
+            )
+            continue
+        bases[name] = KnowledgeBase(
+            name=name,
+            data_file_path=os.fspath(definition.get("data_file") or default.data_file_path),
+            faq_csv_path=_optional_path(
+                definition.get("faq_csv", default.faq_csv_path if default else None)
+            ),
+            preamble_path=_optional_path(
+                definition.get("preamble", default.preamble_path if default else None)
+            ),
+            store_dir=os.fspath(
+                definition.get("store_dir")
+                or (default.store_dir if default else Path(settings.VERITAS_KB_STORE_DIR) / name)
+            ),
+        )
+    return bases
+
+
+# The settings the bases were built from, compared by identity since they
+# are read on every lookup, and the bases
+_configured: tuple | None = None
+_bases: dict[str, KnowledgeBase] = {}
+_config_lock = threading.Lock()
+
+
+def knowledge_bases() -> dict[str, KnowledgeBase]:
+    """
+    Returns the configured knowledge bases by name, the default one first.
+    """
+    global _configured, _bases
+    configured = (
+        getattr(settings, "VERITAS_KNOWLEDGE_BASES", None),
+        getattr(settings, "VERITAS_DEFAULT_KNOWLEDGE_BASE", None),
+        settings.VERITAS_DATA_FILE_PATH,
+        settings.VERITAS_FAQ_CSV_PATH,
+        getattr(settings, "VERITAS_PREAMBLE_PATH", None),
+        settings.VERITAS_KB_STORE_DIR,
+    )
+    current = _configured
+    if current is not None and all(a is b for a, b in zip(current, configured)):
+        return _bases
+    with _config_lock:
+        _bases = _build_knowledge_bases()
+        _configured = configured
+        return _bases
+
+
+def get_knowledge_base(name: str | None = None) -> KnowledgeBase:
+    """
+    Returns a knowledge base by name, or the default one.
+
+    Raises:
+        UnknownKnowledgeBase: No knowledge base has this name.
+    """
+    bases = knowledge_bases()
+    base = bases.get(name or default_knowledge_base_name())
+    if base is None:
+        raise UnknownKnowledgeBase(f"Unknown knowledge base {name!r}")
+    return base
+
+
+_current: contextvars.ContextVar[KnowledgeBase | None] = contextvars.ContextVar(
+    "veritas_knowledge_base", default=None
+)
+
+
+def current_knowledge_base() -> KnowledgeBase:
+    """
+    Returns the knowledge base of the request being handled, or the default
+    one outside of a request.
+    """
+    return _current.get() or get_knowledge_base()
+
+
+@contextmanager
+def use_knowledge_base(base: KnowledgeBase):
+    """
+    Makes a knowledge base the current one for the enclosed code (and the
+    threads and tasks it starts).
+    """
+    token = _current.set(base)
+    try:
+        yield base
+    finally:
+        _current.reset(token)
+
+
+def knowledge_base_events(base: KnowledgeBase, events):
+    """
+    Passes (event, data) pairs through, producing each with the knowledge
+    base current, so a streamed response that is consumed after the view
+    returned still builds its fallback requests from the right base.
+    """
+    while True:
+        with use_knowledge_base(base):
+            try:
+                item = next(events)
+            except StopIteration:
+                return
+        yield item
+
+
+async def aknowledge_base_events(base: KnowledgeBase, events):
+    """
+    Async version of knowledge_base_events.
+    """
+    while True:
+        with use_knowledge_base(base):
+            try:
+                item = await anext(events)
+            except StopAsyncIteration:
+                return
+        yield item
+
+
+# Resident state
+
+
+class ResidentKnowledgeBase:
+    """
+    What a worker holds in memory for one knowledge base: a slot per
+    component (the FAQ matcher, the mapped store...) and their estimated
+    sizes in bytes.
+    """
+
+    def __init__(self, base: KnowledgeBase):
+        self.base = base
+        self._slots: dict[str, object] = {}
+        self._sizes: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def slot(self, name: str, factory):
+        """
+        Returns the component's slot, creating it with factory() on first
+        use.
+        """
+        slot = self._slots.get(name)
+        if slot is None:
+            with self._lock:
+                slot = self._slots.get(name)
+                if slot is None:
+                    slot = self._slots[name] = factory()
+        return slot
+
+    def drop(self, name: str) -> None:
+        with self._lock:
+            self._slots.pop(name, None)
+        self.set_size(name, 0)
+
+    @property
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def set_size(self, name: str, size: int) -> None:
+        """
+        Records the estimated memory held by a component, evicting the least
+        recently used bases if the resident set is now over its budget.
+        """
+        with self._lock:
+            delta = size - self._sizes.get(name, 0)
+            self._sizes[name] = size
+        if delta:
+            knowledge_base_resident_bytes.inc(delta, knowledge_base=self.base.name)
+            _evict(keep=self.base.name)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"bytes": sum(self._sizes.values()), "sizes": dict(self._sizes)}
+
+
+_resident: "OrderedDict[str, ResidentKnowledgeBase]" = OrderedDict()
+_resident_lock = threading.Lock()
+
+
+def resident(base: KnowledgeBase | None = None) -> ResidentKnowledgeBase:
+    """
+    Returns the resident state of a knowledge base (the current one by
+    default), loading it on first use and marking it most recently used.
+    """
+    base = base or current_knowledge_base()
+    with _resident_lock:
+        state = _resident.get(base.name)
+        if state is not None and state.base is base:
+            _resident.move_to_end(base.name)
+            return state
+        # New, or its configuration changed
+        if state is not None:
+            knowledge_base_resident_bytes.dec(state.size, knowledge_base=base.name)
+        state = _resident[base.name] = ResidentKnowledgeBase(base)
+    knowledge_base_stats.incr("loads")
+    knowledge_base_loads.inc(knowledge_base=base.name)
+    logger.info(f"Loading knowledge base {base.name}")
+    _evict(keep=base.name)
+    return state
+
+
+def _evict(keep: str) -> None:
+    """
+    Drops the least recently used bases (never `keep`, the one in use) until
+    the resident set is within VERITAS_KB_MAX_RESIDENT bases and
+    VERITAS_KB_MAX_RESIDENT_BYTES.
+    """
+    max_bases = max(getattr(settings, "VERITAS_KB_MAX_RESIDENT", 4), 1)
+    max_bytes = getattr(settings, "VERITAS_KB_MAX_RESIDENT_BYTES", None)
+    evicted = []
+    with _resident_lock:
+        while len(_resident) > 1:
+            total = sum(state.size for state in _resident.values())
+            if len(_resident) <= max_bases and (max_bytes is None or total <= max_bytes):
+                break
+            name = next(name for name in _resident if name != keep)
+            evicted.append(_resident.pop(name))
+    for state in evicted:
+        knowledge_base_stats.incr("evictions")
+        knowledge_base_evictions.inc(knowledge_base=state.base.name)
+        knowledge_base_resident_bytes.dec(state.size, knowledge_base=state.base.name)
+        logger.info(f"Evicted knowledge base {state.base.name} ({state.size} bytes)")
+
+
+def resident_states() -> list[ResidentKnowledgeBase]:
+    """
+    The resident bases, least recently used first.
+    """
+    with _resident_lock:
+        return list(_resident.values())
+
+
+def drop_slots(name: str) -> None:
+    """
+    Drops a component's slot from every resident base (used by the reset
+    functions of the components).
+    """
+    for state in resident_states():
+        state.drop(name)
+
+
+class ResidentSet:
+    """
+    The resident knowledge bases and their estimated sizes, reported at
+    /api/stats/.
+    """
+
+    component = "knowledge_bases_resident"
+
+    def snapshot(self) -> dict:
+        return {state.base.name: state.snapshot() for state in resident_states()}
+
+
+register(ResidentSet())
+
+
+# Usage
+
+_usage = UsageCounter()
+_usage_lock = threading.Lock()
+_last_usage_flush = time.monotonic()
+
+
+def _usage_cache():
+    return caches[settings.VERITAS_RESPONSE_CACHE_ALIAS]
+
+
+def _flush_usage(counts: dict[str, int]) -> None:
+    cache = _usage_cache()
+    try:
+        for name, count in counts.items():
+            key = USAGE_KEY_PREFIX + name
+            if not cache.add(key, count, timeout=None):
+                cache.incr(key, count)
+    except Exception as e:
+        logger.warning(f"Failed to record knowledge base usage: {e}")
+    finally:
+        connections.close_all()
+
+
+def record_request(base: KnowledgeBase) -> None:
+    """
+    Counts a request to a knowledge base. The counts are added to the
+    shared cache every USAGE_FLUSH_SECONDS, in a background thread so
+    requests never wait on it.
+    """
+    global _last_usage_flush
+    knowledge_base_requests.inc(knowledge_base=base.name)
+    with _usage_lock:
+        _usage[base.name] += 1
+        now = time.monotonic()
+        if now - _last_usage_flush < USAGE_FLUSH_SECONDS:
+            return
+        counts = dict(_usage)
+        _usage.clear()
+        _last_usage_flush = now
+    threading.Thread(target=_flush_usage, args=(counts,), daemon=True).start()
+
+
+def most_used_knowledge_bases(count: int) -> list[KnowledgeBase]:
+    """
+    Returns the default base followed by the `count` most used other bases,
+    by the request counts in the shared cache.
+    """
+    bases = knowledge_bases()
+    default_name = default_knowledge_base_name()
+    others = [name for name in bases if name != default_name]
+    usage = {}
+    if others and count > 0:
+        try:
+            usage = _usage_cache().get_many([USAGE_KEY_PREFIX + name for name in others])
+        except Exception as e:
+            logger.warning(f"Knowledge base usage unavailable: {e}")
+    ranked = sorted(others, key=lambda name: usage.get(USAGE_KEY_PREFIX + name, 0), reverse=True)
+    return [bases[default_name]] + [bases[name] for name in ranked[: max(count, 0)]]
+
+
+def reset_knowledge_bases() -> None:
+    """
+    Forgets the resident bases and the usage counts (used by tests).
+    """
+    global _configured, _last_usage_flush
+    with _resident_lock:
+        _resident.clear()
+    with _config_lock:
+        _configured = None
+    with _usage_lock:
+        _usage.clear()
+        _last_usage_flush = time.monotonic()
+    knowledge_base_stats.reset()
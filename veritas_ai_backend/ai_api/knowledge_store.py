@@ -0,0 +1,406 @@
+"""
+Compact on-disk store of the pre-processed knowledge base.
+
+"python manage.py ingest_kb" (see ingest.py) writes the extracted text of
+Veritas_data.pdf, the model preamble, the knowledge base passages with their
+BM25 index and the data.csv FAQ pairs with their TF-IDF index into one file
+per version under VERITAS_KB_STORE_DIR. Workers memory-map the current
+version instead of parsing the sources and building the indexes themselves,
+so they share one copy of it through the page cache and start in
+milliseconds.
+
+A store file holds a magic number, the length of a JSON header, the header
+(version, source hashes, and the offset, type and length of every array of
+every section) and the sections, each a group of flat native-endian arrays.
+Lists of strings are stored as an array of offsets into an array of UTF-8
+bytes and decoded on access.
+
+A new version is written next to the old ones and then named in the CURRENT
+file, both with an atomic rename. Workers check CURRENT at most every
+VERITAS_KB_RELOAD_CHECK_SECONDS and switch to the new version between
+requests; requests still using the old one keep their mapping.
+
+Each knowledge base (see knowledge_bases.py) has a store directory of its
+own; the lookups here use the current base's.
+"""
+# knowledge_store.py
+
+import functools
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections.abc import Sequence
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from django.conf import settings
+
+from .knowledge_bases import current_knowledge_base, drop_slots, resident
+from .stats import StatCounters
+
+logger = logging.getLogger(__name__)
+
+knowledge_store_stats = StatCounters("knowledge_store", "loads", "load_failures")
+
+MAGIC = b"VERITKB1"
+FORMAT_VERSION = 1
+CURRENT_FILE = "CURRENT"
+STORE_SUFFIX = ".vkb"
+_LENGTH = struct.Struct("<Q")
+_ALIGNMENT = 8
+
+
+def _padding(size: int) -> int:
+    return -size % _ALIGNMENT
+
+
+@functools.lru_cache(maxsize=8)
+def text_hash(text: str) -> str:
+    """
+    SHA-256 hex digest of a text, such as the model preamble.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def section_inputs(*parts) -> str:
+    """
+    Identifies what a section is built from: its name, the hashes of its
+    sources and the settings that shape it.
+    """
+    return hashlib.sha256(":".join(map(str, parts)).encode()).hexdigest()
+
+
+def store_dir() -> Path:
+    """
+    The store directory of the current knowledge base.
+    """
+    return Path(current_knowledge_base().store_dir)
+
+
+def store_enabled() -> bool:
+    return getattr(settings, "VERITAS_KB_STORE_ENABLED", True)
+
+
+class MappedStrings(Sequence):
+    """
+    A list of strings stored as UTF-8 bytes and the offsets between them,
+    decoded on access.
+    """
+
+    def __init__(self, offsets: Sequence[int], data: memoryview):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+            if index < 0:
+                raise IndexError(index)
+        offsets = self.offsets
+        # offsets[len(self) + 1] raises the IndexError
+        return str(self.data[offsets[index] : offsets[index + 1]], "utf-8")
+
+
+class MappedRecords(Sequence):
+    """
+    Records built on access from the same position of several columns, e.g.
+    FaqEntry(prompt, response) from two MappedStrings.
+    """
+
+    def __init__(self, factory, *columns: Sequence):
+        self.factory = factory
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns[0])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.factory(*(column[index] for column in self.columns))
+
+
+@dataclass
+class StoreSection:
+    """
+    A section of a store: a group of arrays plus small metadata. `inputs`
+    identifies what it was built from, so an unchanged section can be copied
+    into the next version instead of being rebuilt.
+    """
+
+    inputs: str
+    meta: dict = field(default_factory=dict)
+    # name -> (typecode, offset, length in items)
+    arrays: dict[str, tuple[str, int, int]] = field(default_factory=dict)
+    data: bytearray = field(default_factory=bytearray)
+
+    def add_array(self, name: str, typecode: str, values) -> None:
+        values = array(typecode, values)
+        self.data += bytes(_padding(len(self.data)))
+        self.arrays[name] = (typecode, len(self.data), len(values))
+        self.data += values.tobytes()
+
+    def add_strings(self, name: str, texts: list[str]) -> None:
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = [0]
+        for text in encoded:
+            offsets.append(offsets[-1] + len(text))
+        self.add_array(f"{name}.offsets", "Q", offsets)
+        self.add_array(f"{name}.data", "B", b"".join(encoded))
+
+
+class KnowledgeStore:
+    """
+    A memory-mapped version of the store.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as store_file:
+            self._mmap = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        if bytes(view[: len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a knowledge base store")
+        (header_length,) = _LENGTH.unpack_from(view, len(MAGIC))
+        start = len(MAGIC) + _LENGTH.size
+        header = json.loads(bytes(view[start : start + header_length]))
+        if header["format"] != FORMAT_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written in an incompatible format")
+        data_start = start + header_length + _padding(start + header_length)
+        self.version: str = header["version"]
+        self.created_at: float = header["created_at"]
+        self.sources: dict[str, dict] = header["sources"]
+        self.sections: dict[str, dict] = header["sections"]
+        self._view = view[data_start:]
+        self._strings: dict[tuple, MappedStrings] = {}
+
+    def has(self, section: str) -> bool:
+        return section in self.sections
+
+    def section_matches(self, section: str, inputs: str) -> bool:
+        """
+        Returns True if the store has the section built from these inputs.
+        """
+        return section in self.sections and self.sections[section]["inputs"] == inputs
+
+    def source_hash(self, source: str) -> str | None:
+        return self.sources.get(source, {}).get("hash")
+
+    def meta(self, section: str) -> dict:
+        return self.sections[section]["meta"]
+
+    def array(self, section: str, name: str) -> memoryview:
+        entry = self.sections[section]
+        typecode, offset, length = entry["arrays"][name]
+        start = entry["offset"] + offset
+        size = array(typecode).itemsize
+        return self._view[start : start + length * size].cast(typecode)
+
+    def strings(self, section: str, name: str) -> MappedStrings:
+        key = (section, name)
+        strings = self._strings.get(key)
+        if strings is None:
+            strings = self._strings[key] = MappedStrings(
+                self.array(section, f"{name}.offsets"), self.array(section, f"{name}.data")
+            )
+        return strings
+
+    def section(self, name: str) -> StoreSection:
+        """
+        Copies a section out of the store, to write it into the next version.
+        """
+        entry = self.sections[name]
+        return StoreSection(
+            inputs=entry["inputs"],
+            meta=dict(entry["meta"]),
+            arrays={key: tuple(value) for key, value in entry["arrays"].items()},
+            data=bytearray(self._view[entry["offset"] : entry["offset"] + entry["length"]]),
+        )
+
+
+def _replace_atomically(path: Path, data: bytes) -> None:
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=".tmp-", delete=False) as tmp:
+        tmp.write(data)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+    os.replace(tmp.name, path)
+
+
+def store_path(version: str, directory: Path | None = None) -> Path:
+    return (directory or store_dir()) / f"kb-{version}{STORE_SUFFIX}"
+
+
+def write_store(
+    version: str, sources: dict[str, dict], sections: dict[str, StoreSection], directory: Path
+) -> Path:
+    """
+    Writes a version of the store and makes it the current one.
+
+    Args:
+        version: The version name.
+        sources: Path and content hash of each source it was built from.
+        sections: The sections, by name.
+        directory: The store directory.
+
+    Returns:
+        The path of the new store file.
+    """
+    layout, offset = {}, 0
+    for name, section in sections.items():
+        offset += _padding(offset)
+        layout[name] = {
+            "inputs": section.inputs,
+            "meta": section.meta,
+            "arrays": section.arrays,
+            "offset": offset,
+            "length": len(section.data),
+        }
+        offset += len(section.data)
+    header = json.dumps(
+        {
+            "format": FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "version": version,
+            "created_at": time.time(),
+            "sources": sources,
+            "sections": layout,
+        }
+    ).encode()
+
+    parts = [MAGIC, _LENGTH.pack(len(header)), header]
+    size = sum(len(part) for part in parts)
+    parts.append(bytes(_padding(size)))
+    written = 0
+    for section in sections.values():
+        parts.append(bytes(_padding(written)))
+        parts.append(section.data)
+        written += _padding(written) + len(section.data)
+
+    directory.mkdir(parents=True, exist_ok=True)
+    path = store_path(version, directory)
+    _replace_atomically(path, b"".join(parts))
+    _replace_atomically(directory / CURRENT_FILE, version.encode())
+    return path
+
+
+def current_version(directory: Path | None = None) -> str | None:
+    try:
+        return (Path(directory or store_dir()) / CURRENT_FILE).read_text().strip() or None
+    except OSError:
+        return None
+
+
+def open_current_store(directory: Path | None = None) -> KnowledgeStore | None:
+    """
+    Opens the current version of the store, or returns None if there is
+    none.
+    """
+    version = current_version(directory)
+    return KnowledgeStore(store_path(version, directory)) if version else None
+
+
+def prune_versions(directory: Path, keep: int) -> list[Path]:
+    """
+    Deletes all but the `keep` newest versions besides the current one.
+    Workers that still map a deleted version keep reading it.
+
+    Returns:
+        The deleted files.
+    """
+    version = current_version(directory)
+    current = store_path(version, directory) if version else None
+    versions = sorted(
+        (path for path in directory.glob(f"kb-*{STORE_SUFFIX}") if path != current),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True,
+    )
+    deleted = []
+    for path in versions[keep:]:
+        try:
+            path.unlink()
+            deleted.append(path)
+        except OSError as e:
+            # Mapped files can't be deleted on Windows
+            logger.warning(f"Could not delete old knowledge base store {path}: {e}")
+    return deleted
+
+
+class _StoreSlot:
+    """
+    The mapped store of a knowledge base (see knowledge_bases.py).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.store: KnowledgeStore | None = None
+        # (store directory, version) of the store, or of the failed attempt
+        self.signature: tuple | None = None
+        self.last_checked = 0.0
+
+
+STORE_SLOT = "store"
+
+
+def get_knowledge_store() -> KnowledgeStore | None:
+    """
+    Returns the current version of the current knowledge base's store,
+    switching to a new one at most every VERITAS_KB_RELOAD_CHECK_SECONDS.
+
+    Returns:
+        The store, or None if no store was ingested (or it can't be read),
+        in which case the indexes are built from the sources.
+    """
+    if not store_enabled():
+        return None
+    state = resident()
+    slot = state.slot(STORE_SLOT, _StoreSlot)
+    # Checked on every request: compare the directory itself, not a new Path
+    configured_dir = state.base.store_dir
+    interval = getattr(settings, "VERITAS_KB_RELOAD_CHECK_SECONDS", 5)
+    if (
+        slot.signature is not None
+        and slot.signature[0] is configured_dir
+        and time.monotonic() - slot.last_checked < interval
+    ):
+        return slot.store
+    with slot.lock:
+        directory = Path(configured_dir)
+        signature = (configured_dir, current_version(directory))
+        if signature != slot.signature:
+            store = None
+            if signature[1]:
+                try:
+                    store = KnowledgeStore(store_path(signature[1], directory))
+                    knowledge_store_stats.incr("loads")
+                    logger.info(
+                        f"Mapped knowledge base store version {store.version} ({state.base.name})"
+                    )
+                except (OSError, ValueError, KeyError) as e:
+                    knowledge_store_stats.incr("load_failures")
+                    logger.error(f"Failed to open knowledge base store {signature[1]}: {e}")
+            slot.store, slot.signature = store, signature
+            state.set_size(STORE_SLOT, len(store._mmap) if store else 0)
+        slot.last_checked = time.monotonic()
+        return slot.store
+
+
+def reset_knowledge_store() -> None:
+    """
+    Forgets the mapped stores; the next lookup reads CURRENT again (used by
+    tests).
+    """
+    drop_slots(STORE_SLOT)
+    knowledge_store_stats.reset()
@@ -0,0 +1,131 @@
+"""
+Replays prompts through the generate view against a local fake of the Gemini
+API and reports latency, throughput, upstream calls and answer quality.
+
+    python manage.py bench_replay
+    python manage.py bench_replay --no-faq --context-mode full --passes 2
+    python manage.py bench_replay --first-chunk-latency 0.4 --output bench.json
+    python manage.py bench_replay --no-faq --prompt-template v2
+
+The run uses a throwaway test database, so the project database is never
+touched.
+"""
+# bench_replay.py
+
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from ai_api.ai_helpers import model_preamble
+from ai_api.benchmark import FakeGenaiClient, load_replay_items, replay, write_report
+from ai_api.response_cache import clear_memory_cache
+from ai_api.retrieval import extract_pdf_pages, retrieval_available
+from ai_api.views import VERITAS_DATA_FILE_PATH
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays data.csv (or a JSONL file of prompts) through the generate "
+        "view against a local fake of the Gemini API."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "dataset",
+            nargs="?",
+            default=str(settings.VERITAS_FAQ_CSV_PATH),
+            help="prompt/response CSV or JSONL file (default: data.csv)",
+        )
+        parser.add_argument("--limit", type=int, help="Replay at most this many prompts.")
+        parser.add_argument(
+            "--passes",
+            type=int,
+            default=1,
+            help="Replay the prompts this many times (later passes hit caches).",
+        )
+        parser.add_argument("--concurrency", type=int, default=1)
+        parser.add_argument("--upload-latency", type=float, default=0.5)
+        parser.add_argument("--first-chunk-latency", type=float, default=0.3)
+        parser.add_argument("--chunk-latency", type=float, default=0.02)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--context-mode", choices=["retrieval", "full"], help="Override VERITAS_CONTEXT_MODE."
+        )
+        parser.add_argument(
+            "--prompt-template", help="Override VERITAS_PROMPT_TEMPLATE (a template version)."
+        )
+        parser.add_argument("--no-faq", action="store_true", help="Disable the FAQ shortcut.")
+        parser.add_argument(
+            "--no-cache", action="store_true", help="Disable the response cache."
+        )
+        parser.add_argument("--output", help="Write the JSON report to this file.")
+        parser.add_argument(
+            "--details", action="store_true", help="Include every request in the report."
+        )
+
+    def handle(self, *args, **options):
+        items = load_replay_items(options["dataset"])[: options["limit"]]
+        if not items:
+            raise CommandError(f"No prompts found in {options['dataset']}")
+        items = items * options["passes"]
+
+        pages = extract_pdf_pages(VERITAS_DATA_FILE_PATH) if retrieval_available() else []
+        client = FakeGenaiClient(
+            knowledge_text="\n".join(pages + [model_preamble()]),
+            references={item.prompt: item.reference for item in items if item.reference},
+            upload_latency=options["upload_latency"],
+            first_chunk_latency=options["first_chunk_latency"],
+            chunk_latency=options["chunk_latency"],
+            error_rate=options["error_rate"],
+            seed=options["seed"],
+        )
+
+        overrides = {}
+        if options["context_mode"]:
+            overrides["VERITAS_CONTEXT_MODE"] = options["context_mode"]
+        if options["prompt_template"]:
+            overrides["VERITAS_PROMPT_TEMPLATE"] = options["prompt_template"]
+        if options["no_faq"]:
+            overrides["VERITAS_FAQ_ENABLED"] = False
+        if options["no_cache"]:
+            overrides["VERITAS_RESPONSE_CACHE_ENABLED"] = False
+
+        config = {
+            key: options[key]
+            for key in (
+                "dataset",
+                "passes",
+                "concurrency",
+                "upload_latency",
+                "first_chunk_latency",
+                "chunk_latency",
+                "error_rate",
+                "seed",
+            )
+        }
+        config.update(
+            prompts=len(items),
+            context_mode=overrides.get("VERITAS_CONTEXT_MODE", settings.VERITAS_CONTEXT_MODE),
+            prompt_template=overrides.get(
+                "VERITAS_PROMPT_TEMPLATE", settings.VERITAS_PROMPT_TEMPLATE
+            ),
+            faq=not options["no_faq"],
+            response_cache=not options["no_cache"],
+        )
+
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            clear_memory_cache()
+            with override_settings(**overrides):
+                report = replay(items, client, concurrency=options["concurrency"])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        summary = report.summary()
+        self.stdout.write(json.dumps(summary, indent=2))
+        if options["output"]:
+            write_report(options["output"], config, report, options["details"])
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
@@ -0,0 +1,19 @@
+"""
+Deletes expired chat sessions and their turns; workers also do this on their
+own (see ai_api/sessions.py), this is for running from cron.
+
+    python manage.py clear_expired_sessions
+"""
+# clear_expired_sessions.py
+
+from django.core.management.base import BaseCommand
+
+from ai_api.sessions import evict_expired_sessions
+
+
+class Command(BaseCommand):
+    help = "Deletes expired chat sessions."
+
+    def handle(self, *args, **options):
+        count = evict_expired_sessions()
+        self.stdout.write(f"Deleted {count} expired chat sessions.")
@@ -0,0 +1,131 @@
+"""
+Compares the input size (and optionally the latency) of the full-file and
+retrieval context modes for a set of prompts.
+
+    python manage.py compare_context_modes
+    python manage.py compare_context_modes "Who is the bursar?" --live
+"""
+# compare_context_modes.py
+
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_api.ai_helpers import (
+    _contents_with_file,
+    _contents_with_passages,
+    model_preamble,
+)
+from ai_api.client_provider import get_genai_client
+from ai_api.faq import load_faq_entries
+from ai_api.file_registry import get_file_handle
+from ai_api.generation import (
+    GenerationResult,
+    build_generate_content_config,
+    iter_generation,
+)
+from ai_api.retrieval import (
+    PDF_PAGE_TOKENS,
+    extract_pdf_pages,
+    format_passages,
+    get_passage_index,
+    retrieval_available,
+)
+from ai_api.text_index import estimate_text_tokens
+from ai_api.views import VERITAS_DATA_FILE_PATH
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares input tokens and latency of sending the full data file "
+        "against sending retrieved passages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "prompts",
+            nargs="*",
+            help="Prompts to compare (default: the prompts in the FAQ CSV).",
+        )
+        parser.add_argument(
+            "--live",
+            action="store_true",
+            help="Call the model in both modes and report the reported prompt "
+            "tokens and latency instead of local estimates only.",
+        )
+        parser.add_argument("--model", default=settings.VERITAS_AI_MODEL)
+
+    def handle(self, *args, **options):
+        if not retrieval_available():
+            raise CommandError("Retrieval needs pypdf; install it with pip.")
+
+        prompts = options["prompts"] or [
+            entry.prompt for entry in load_faq_entries(settings.VERITAS_FAQ_CSV_PATH)
+        ]
+        top_k = settings.VERITAS_RETRIEVAL_TOP_K
+        preamble = model_preamble()
+        index = get_passage_index(VERITAS_DATA_FILE_PATH, preamble)
+        full_base_tokens = len(
+            extract_pdf_pages(VERITAS_DATA_FILE_PATH)
+        ) * PDF_PAGE_TOKENS + estimate_text_tokens(preamble)
+
+        if options["live"]:
+            client = get_genai_client()
+            config = build_generate_content_config({})
+            veritas_file = get_file_handle(client, VERITAS_DATA_FILE_PATH)
+
+        full_total = retrieval_total = 0
+        for prompt in prompts:
+            passages = index.search(prompt, top_k)
+            full_tokens = full_base_tokens + estimate_text_tokens(prompt)
+            retrieval_tokens = (
+                estimate_text_tokens(format_passages(passages) + prompt)
+                if passages
+                else full_tokens
+            )
+            line = f"{prompt[:50]:<50} full ~{full_tokens:>6}  retrieval ~{retrieval_tokens:>6}"
+
+            if options["live"]:
+                full = self._measure(
+                    client, options["model"], _contents_with_file(veritas_file, prompt), config
+                )
+                retrieval = (
+                    self._measure(
+                        client,
+                        options["model"],
+                        _contents_with_passages(passages, prompt),
+                        config,
+                    )
+                    if passages
+                    else full
+                )
+                full_tokens, retrieval_tokens = full[0], retrieval[0]
+                line = (
+                    f"{prompt[:50]:<50} full {full[0]:>6} tok {full[1]:6.2f}s  "
+                    f"retrieval {retrieval[0]:>6} tok {retrieval[1]:6.2f}s"
+                )
+
+            full_total += full_tokens
+            retrieval_total += retrieval_tokens
+            self.stdout.write(line)
+
+        if prompts:
+            reduction = 100 * (1 - retrieval_total / full_total)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Input tokens over {len(prompts)} prompts: full {full_total}, "
+                    f"retrieval {retrieval_total} ({reduction:.0f}% fewer)"
+                )
+            )
+
+    def _measure(self, client, model_name, contents, config) -> tuple[int, float]:
+        """
+        Generates an answer and returns the prompt tokens reported by the API
+        and the total latency in seconds.
+        """
+        result = GenerationResult(model=model_name)
+        started = time.monotonic()
+        for _ in iter_generation(client, model_name, contents, config, result):
+            pass
+        return result.prompt_tokens or 0, time.monotonic() - started
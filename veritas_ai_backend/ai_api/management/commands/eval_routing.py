@@ -0,0 +1,100 @@
+"""
+Replays prompts through the generate view with and without the model router,
+against a local fake of the Gemini API, and reports the latency saved per
+route.
+
+    python manage.py eval_routing
+    python manage.py eval_routing --model-latency gemini-2.0-flash=0.25
+
+The fake answers every model the same way, so the report measures latency,
+not answer quality; the first-chunk latency of each model is set with
+--first-chunk-latency (the default model) and --model-latency. The run uses
+a throwaway test database, so the project database is never touched.
+"""
+# eval_routing.py
+
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_databases, teardown_databases
+
+from ai_api.ai_helpers import model_preamble
+from ai_api.benchmark import FakeGenaiClient, evaluate_routing, load_replay_items
+from ai_api.response_cache import clear_memory_cache
+from ai_api.retrieval import extract_pdf_pages, retrieval_available
+from ai_api.views import VERITAS_DATA_FILE_PATH
+
+
+def model_latency(value: str) -> tuple[str, float]:
+    model, separator, seconds = value.rpartition("=")
+    if not separator or not model:
+        raise ValueError(value)
+    return model, float(seconds)
+
+
+class Command(BaseCommand):
+    help = "Compares the generate latency per route with and without the model router."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "dataset",
+            nargs="?",
+            default=str(settings.VERITAS_FAQ_CSV_PATH),
+            help="prompt/response CSV or JSONL file (default: data.csv)",
+        )
+        parser.add_argument("--limit", type=int, help="Replay at most this many prompts.")
+        parser.add_argument("--concurrency", type=int, default=1)
+        parser.add_argument(
+            "--first-chunk-latency",
+            type=float,
+            default=0.9,
+            help="First-chunk latency of models without --model-latency.",
+        )
+        parser.add_argument(
+            "--model-latency",
+            type=model_latency,
+            action="append",
+            metavar="MODEL=SECONDS",
+            help=f"First-chunk latency of a model (default: {settings.DEFAULT_GEMINI_MODEL}=0.3).",
+        )
+        parser.add_argument("--chunk-latency", type=float, default=0.02)
+        parser.add_argument("--output", help="Write the JSON report to this file.")
+
+    def handle(self, *args, **options):
+        items = load_replay_items(options["dataset"])[: options["limit"]]
+        if not items:
+            raise CommandError(f"No prompts found in {options['dataset']}")
+
+        pages = extract_pdf_pages(VERITAS_DATA_FILE_PATH) if retrieval_available() else []
+        latencies = dict(options["model_latency"] or [(settings.DEFAULT_GEMINI_MODEL, 0.3)])
+        client = FakeGenaiClient(
+            knowledge_text="\n".join(pages + [model_preamble()]),
+            references={item.prompt: item.reference for item in items if item.reference},
+            first_chunk_latency=options["first_chunk_latency"],
+            chunk_latency=options["chunk_latency"],
+            model_first_chunk_latency=latencies,
+        )
+
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            clear_memory_cache()
+            report = evaluate_routing(
+                items, client, VERITAS_DATA_FILE_PATH, concurrency=options["concurrency"]
+            )
+        finally:
+            teardown_databases(old_config, verbosity=0)
+
+        report["config"] = {
+            "dataset": options["dataset"],
+            "prompts": len(items),
+            "default_model": settings.VERITAS_AI_MODEL,
+            "first_chunk_latency": options["first_chunk_latency"],
+            "model_latency": latencies,
+            "rules": settings.VERITAS_ROUTER_RULES,
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as report_file:
+                json.dump(report, report_file, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
@@ -0,0 +1,71 @@
+"""
+Ingests the knowledge base (Veritas_data.pdf, data.csv and the model
+preamble) into the store the workers memory-map.
+
+    python manage.py ingest_kb
+    python manage.py ingest_kb --force
+    python manage.py ingest_kb --knowledge-base admissions
+    python manage.py ingest_kb --all
+
+Only sections whose sources changed since the last run are rebuilt. Running
+workers switch to the new version within VERITAS_KB_RELOAD_CHECK_SECONDS.
+"""
+# ingest_kb.py
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_api.ingest import ingest_knowledge_base
+from ai_api.knowledge_bases import (
+    UnknownKnowledgeBase,
+    get_knowledge_base,
+    knowledge_bases,
+    use_knowledge_base,
+)
+
+
+class Command(BaseCommand):
+    help = "Ingests the knowledge base sources into the memory-mapped store."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rebuild every section even if its sources didn't change.",
+        )
+        parser.add_argument("--store-dir", help="Override the knowledge base's store directory.")
+        parser.add_argument(
+            "--knowledge-base",
+            help="The knowledge base to ingest (default: VERITAS_DEFAULT_KNOWLEDGE_BASE).",
+        )
+        parser.add_argument(
+            "--all", action="store_true", help="Ingest every configured knowledge base."
+        )
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            if options["store_dir"]:
+                raise CommandError("--store-dir can't be used with --all")
+            bases = list(knowledge_bases().values())
+        else:
+            try:
+                bases = [get_knowledge_base(options["knowledge_base"])]
+            except UnknownKnowledgeBase as e:
+                raise CommandError(str(e))
+
+        for base in bases:
+            with use_knowledge_base(base):
+                report = ingest_knowledge_base(
+                    base.data_file_path, directory=options["store_dir"], force=options["force"]
+                )
+            report["knowledge_base"] = base.name
+            self.stdout.write(json.dumps(report, indent=2))
+            if report["written"]:
+                self.stdout.write(
+                    self.style.SUCCESS(f"Knowledge base {base.name} version {report['version']}")
+                )
+            else:
+                self.stdout.write(
+                    f"Knowledge base {base.name} unchanged (version {report['version']})"
+                )
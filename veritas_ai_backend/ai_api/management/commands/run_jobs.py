@@ -0,0 +1,32 @@
+"""
+Runs generation jobs queued through /api/jobs/ in a process of its own, for
+deployments that set VERITAS_JOB_WORKERS to 0 to keep generations off the
+web workers (see ai_api/jobs.py).
+
+    python manage.py run_jobs --workers 4
+"""
+# run_jobs.py
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ai_api.jobs import JobWorkerPool
+
+
+class Command(BaseCommand):
+    help = "Runs queued generation jobs until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=2, help="Jobs run at the same time."
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        pool = JobWorkerPool(options["workers"])
+        pool.start()
+        self.stdout.write(f"Running jobs with {options['workers']} workers; Ctrl-C to stop.")
+        try:
+            pool.join()
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping; running jobs are queued again once their lease lapses.")
@@ -0,0 +1,60 @@
+"""
+Warms up the AI API (indexes, client, data file upload, cached context)
+and prints the step timings.
+
+    python manage.py warmup
+    python manage.py warmup --compare --upload-latency 0.5
+
+Run it before starting the server so the workers find the data file and
+cached context already created. --compare instead measures the first request
+of a fresh worker with and without warm-up against a local fake of the
+Gemini API, in a throwaway test database.
+"""
+# warmup.py
+
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.utils import setup_databases, teardown_databases
+
+from ai_api.ai_helpers import model_preamble
+from ai_api.benchmark import FakeGenaiClient, measure_cold_start
+from ai_api.faq import load_faq_entries
+from ai_api.warmup import run_warmup
+
+
+class Command(BaseCommand):
+    help = "Warms up the AI API, or compares a cold and a warm first request."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--compare",
+            action="store_true",
+            help="Time a cold and a warm first request against a fake Gemini API.",
+        )
+        parser.add_argument("--prompt", help="Prompt of the first request (--compare).")
+        parser.add_argument("--upload-latency", type=float, default=0.5)
+        parser.add_argument("--first-chunk-latency", type=float, default=0.3)
+        parser.add_argument("--chunk-latency", type=float, default=0.02)
+
+    def handle(self, *args, **options):
+        if not options["compare"]:
+            self.stdout.write(json.dumps(run_warmup(), indent=2))
+            return
+
+        entries = load_faq_entries(settings.VERITAS_FAQ_CSV_PATH)
+        prompt = options["prompt"] or (entries[0].prompt if entries else "When does school resume?")
+        client = FakeGenaiClient(
+            knowledge_text=model_preamble(),
+            references={entry.prompt: entry.response for entry in entries},
+            upload_latency=options["upload_latency"],
+            first_chunk_latency=options["first_chunk_latency"],
+            chunk_latency=options["chunk_latency"],
+        )
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            report = measure_cold_start(client, prompt)
+        finally:
+            teardown_databases(old_config, verbosity=0)
+        self.stdout.write(json.dumps(report, indent=2))
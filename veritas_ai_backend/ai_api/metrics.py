@@ -0,0 +1,538 @@
+"""
+Prometheus metrics for the generate endpoints.
+
+Per-stage latency histograms, upstream error and fallback counters and
+in-flight gauges, exposed in the Prometheus text format at /api/metrics/
+together with the component counters from stats.py.
+
+Recording is cheap enough to leave on: every thread writes to its own shard
+of plain dicts, so the hot path takes no lock, and shards are only merged
+when metrics are scraped. Under WSGI or ASGI servers with several worker
+processes, set VERITAS_METRICS_DIR to a directory shared by the workers;
+each one periodically writes its values there and a scrape of any worker
+reports the sum of all of them (gauges only from live workers). Clear the
+directory when deploying.
+"""
+# metrics.py
+
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import AsyncIterator, Iterator
+
+from django.conf import settings
+
+from .stats import snapshot_all
+from .tracing import current_trace, record_span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# name -> metric definition, in registration order
+_metrics: dict[str, "Metric"] = {}
+
+# One dict of values per thread: (metric name, label values) -> number, or
+# for histograms a list of per-bucket counts followed by the sum.
+_local = threading.local()
+_shards: list[tuple[threading.Thread, dict]] = []
+# Values of shards whose thread has ended
+_retired: dict = {}
+_shards_lock = threading.Lock()
+
+
+def _shard() -> dict:
+    try:
+        return _local.values
+    except AttributeError:
+        pass
+    values = _local.values = {}
+    with _shards_lock:
+        # Short-lived threads (such as dispatch workers) would otherwise
+        # leave a shard each behind.
+        if len(_shards) > 2 * threading.active_count():
+            _retire_dead_shards()
+        _shards.append((threading.current_thread(), values))
+    return values
+
+
+def _merge(into: dict, values: dict) -> None:
+    for key, value in list(values.items()):
+        if isinstance(value, list):
+            merged = into.get(key)
+            if merged is None:
+                into[key] = list(value)
+            else:
+                for index, count in enumerate(value):
+                    merged[index] += count
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def _retire_dead_shards() -> None:
+    # Must hold _shards_lock. A dead thread no longer writes to its shard.
+    alive = []
+    for thread, values in _shards:
+        if thread.is_alive():
+            alive.append((thread, values))
+        else:
+            _merge(_retired, values)
+    _shards[:] = alive
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        _metrics[name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        return self.name, tuple(str(labels[label]) for label in self.labels)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        values = _shard()
+        key = self._key(labels)
+        values[key] = values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        values = _shard()
+        key = self._key(labels)
+        counts = values.get(key)
+        if counts is None:
+            # One count per bucket, one for +Inf, then the sum
+            counts = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+stage_seconds = Histogram(
+    "veritas_stage_seconds",
+    "Time spent in each stage of a generate request.",
+    ("stage",),
+)
+upstream_errors = Counter(
+    "veritas_upstream_errors_total",
+    "Failed calls to the Gemini API, by error type and code.",
+    ("type", "code"),
+)
+prompt_only_fallbacks = Counter(
+    "veritas_prompt_only_fallbacks_total",
+    "Requests sent without the knowledge base because it could not be attached.",
+)
+blocked_prompts = Counter(
+    "veritas_blocked_prompts_total",
+    "Prompts blocked by the API's safety filters.",
+)
+requests_in_flight = Gauge(
+    "veritas_requests_in_flight",
+    "Generate requests being handled, by endpoint.",
+    ("endpoint",),
+)
+streams_in_flight = Gauge(
+    "veritas_streams_in_flight",
+    "Answers being generated or streamed to the client.",
+)
+upstream_calls_active = Gauge(
+    "veritas_upstream_calls_active",
+    "Generations holding an upstream call slot.",
+)
+upstream_queue_depth = Gauge(
+    "veritas_upstream_queue_depth",
+    "Requests waiting for an upstream call slot.",
+)
+admission_rejections = Counter(
+    "veritas_admission_rejections_total",
+    "Requests turned away by admission control, by reason.",
+    ("reason",),
+)
+upstream_retries = Counter(
+    "veritas_upstream_retries_total",
+    "Upstream calls retried after a transient failure, by model.",
+    ("model",),
+)
+circuit_breakers_open = Gauge(
+    "veritas_circuit_breakers_open",
+    "Workers whose circuit breaker for a model is open, by model.",
+    ("model",),
+)
+degraded_answers = Counter(
+    "veritas_degraded_answers_total",
+    "Answers served from local knowledge while the AI service was unavailable, by source.",
+    ("source",),
+)
+passage_fallbacks = Counter(
+    "veritas_passage_fallbacks_total",
+    "Requests sent with retrieved passages because the data file could not be attached.",
+)
+warmup_seconds = Histogram(
+    "veritas_warmup_seconds",
+    "Time spent in each step of a worker's warm-up.",
+    ("step",),
+)
+first_request_seconds = Histogram(
+    "veritas_first_request_seconds",
+    "Latency of the first generate request of a worker, by whether it was warmed up.",
+    ("warm",),
+)
+routed_requests = Counter(
+    "veritas_routed_requests_total",
+    "Generate requests by routing decision and the model they were routed to.",
+    ("route", "model"),
+)
+prompt_template_requests = Counter(
+    "veritas_prompt_template_requests_total",
+    "Upstream requests assembled with each prompt template version.",
+    ("template",),
+)
+job_queue_seconds = Histogram(
+    "veritas_job_queue_seconds",
+    "Time generation jobs waited in the queue before a worker started them.",
+    buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+knowledge_base_requests = Counter(
+    "veritas_knowledge_base_requests_total",
+    "Generate requests by knowledge base.",
+    ("knowledge_base",),
+)
+knowledge_base_loads = Counter(
+    "veritas_knowledge_base_loads_total",
+    "Knowledge bases loaded into a worker, on first use or after an eviction.",
+    ("knowledge_base",),
+)
+knowledge_base_evictions = Counter(
+    "veritas_knowledge_base_evictions_total",
+    "Knowledge bases dropped from a worker's resident set.",
+    ("knowledge_base",),
+)
+knowledge_base_resident_bytes = Gauge(
+    "veritas_knowledge_base_resident_bytes",
+    "Estimated memory the workers hold for each knowledge base.",
+    ("knowledge_base",),
+)
+cancelled_generations = Counter(
+    "veritas_cancelled_generations_total",
+    "Upstream generations stopped before they finished, by reason and model.",
+    ("reason", "model"),
+)
+cancelled_tokens_saved = Counter(
+    "veritas_cancelled_tokens_saved_total",
+    "Estimated output tokens not generated because generations were stopped, by reason.",
+    ("reason",),
+)
+component_events = Counter(
+    "veritas_component_events_total",
+    "The component counters reported at /api/stats/.",
+    ("component", "event"),
+)
+
+
+def metrics_enabled() -> bool:
+    return getattr(settings, "VERITAS_METRICS_ENABLED", True)
+
+
+class timed:
+    """
+    Context manager recording the time spent in a stage, in the stage
+    histogram and as a span of the request's trace:
+
+        with timed("validation"):
+            ...
+    """
+
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        stage_seconds.observe(elapsed, stage=self.stage)
+        record_span(self.stage, self.started, elapsed)
+
+
+class in_flight:
+    """
+    Context manager counting a request in veritas_requests_in_flight.
+    """
+
+    __slots__ = ("endpoint",)
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+
+    def __enter__(self):
+        requests_in_flight.inc(endpoint=self.endpoint)
+        return self
+
+    def __exit__(self, *exc_info):
+        requests_in_flight.dec(endpoint=self.endpoint)
+        maybe_flush()
+
+
+def record_upstream_error(error: Exception) -> None:
+    upstream_errors.inc(type=type(error).__name__, code=getattr(error, "code", None) or "")
+
+
+class _StreamTimer:
+    """
+    Times the first chunk and the end of a stream of generation events.
+
+    The trace is taken when the stream starts, inside the view, since the
+    rest of a streamed answer is sent after the request's trace has ended.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.trace = current_trace()
+        self.first = True
+
+    def _record(self, stage: str) -> None:
+        elapsed = time.perf_counter() - self.started
+        stage_seconds.observe(elapsed, stage=stage)
+        if self.trace is not None:
+            self.trace.add(stage, self.started, elapsed)
+
+    def event(self, event: tuple[str, dict]) -> None:
+        if self.first and event[0] == "chunk":
+            self.first = False
+            self._record("first_chunk")
+
+    def end(self) -> None:
+        self._record("stream")
+
+
+def timed_events(events: Iterator[tuple[str, dict]]) -> Iterator[tuple[str, dict]]:
+    """
+    Passes through the events of a generation, recording the time to the
+    first chunk and to the end of the stream.
+    """
+    timer = _StreamTimer()
+    streams_in_flight.inc()
+    try:
+        for event in events:
+            timer.event(event)
+            yield event
+        timer.end()
+    finally:
+        streams_in_flight.dec()
+
+
+async def atimed_events(
+    events: AsyncIterator[tuple[str, dict]],
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Async version of timed_events.
+    """
+    timer = _StreamTimer()
+    streams_in_flight.inc()
+    try:
+        async for event in events:
+            timer.event(event)
+            yield event
+        timer.end()
+    finally:
+        streams_in_flight.dec()
+
+
+def _local_values() -> dict:
+    """
+    The values recorded by this process, merged across threads.
+    """
+    merged = {}
+    with _shards_lock:
+        _retire_dead_shards()
+        _merge(merged, _retired)
+        shards = [values for _, values in _shards]
+    for values in shards:
+        _merge(merged, values)
+    for component, counters in snapshot_all().items():
+        for event, value in counters.items():
+            if isinstance(value, (int, float)):
+                merged[component_events._key({"component": component, "event": event})] = value
+    return merged
+
+
+# Sharing between worker processes
+
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+
+
+def _metrics_dir() -> str | None:
+    return getattr(settings, "VERITAS_METRICS_DIR", None)
+
+
+def _worker_file(directory: str, pid: int) -> str:
+    return os.path.join(directory, f"worker-{pid}.json")
+
+
+def flush() -> None:
+    """
+    Writes this process's values to VERITAS_METRICS_DIR.
+    """
+    directory = _metrics_dir()
+    if not directory:
+        return
+    records = [[name, list(labels), value] for (name, labels), value in _local_values().items()]
+    path = _worker_file(directory, os.getpid())
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as metrics_file:
+            json.dump(records, metrics_file)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning(f"Failed to write metrics to {directory}: {e}")
+
+
+def maybe_flush() -> None:
+    """
+    Flushes at most every VERITAS_METRICS_FLUSH_SECONDS; never waits for a
+    flush already running in another thread.
+    """
+    global _last_flush
+    if not _metrics_dir():
+        return
+    now = time.monotonic()
+    if now - _last_flush < settings.VERITAS_METRICS_FLUSH_SECONDS:
+        return
+    if not _flush_lock.acquire(blocking=False):
+        return
+    try:
+        _last_flush = now
+        flush()
+    finally:
+        _flush_lock.release()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _other_workers_values() -> dict:
+    directory = _metrics_dir()
+    merged = {}
+    if not directory or not os.path.isdir(directory):
+        return merged
+    own_file = os.path.basename(_worker_file(directory, os.getpid()))
+    for file_name in os.listdir(directory):
+        if not file_name.startswith("worker-") or not file_name.endswith(".json"):
+            continue
+        if file_name == own_file:
+            continue
+        pid = int(file_name[len("worker-") : -len(".json")])
+        alive = _pid_alive(pid)
+        try:
+            with open(os.path.join(directory, file_name), encoding="utf-8") as metrics_file:
+                records = json.load(metrics_file)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable metrics file {file_name}: {e}")
+            continue
+        values = {}
+        for name, labels, value in records:
+            metric = _metrics.get(name)
+            if metric is None or (metric.type == "gauge" and not alive):
+                continue
+            values[name, tuple(labels)] = value
+        _merge(merged, values)
+    return merged
+
+
+atexit.register(flush)
+
+
+# Exposition
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels_text(names, values, extra: tuple = ()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value: float) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def render_metrics() -> str:
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    values = _local_values()
+    _merge(values, _other_workers_values())
+    by_metric: dict[str, list] = {}
+    for (name, labels), value in sorted(values.items()):
+        by_metric.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, metric in _metrics.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        for labels, value in by_metric.get(name, []):
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                bounds = [repr(bound) for bound in metric.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, value):
+                    cumulative += count
+                    label_text = _labels_text(metric.labels, labels, (("le", bound),))
+                    lines.append(f"{name}_bucket{label_text} {cumulative}")
+                label_text = _labels_text(metric.labels, labels)
+                lines.append(f"{name}_sum{label_text} {_format_number(value[-1])}")
+                lines.append(f"{name}_count{label_text} {cumulative}")
+            else:
+                label_text = _labels_text(metric.labels, labels)
+                lines.append(f"{name}{label_text} {_format_number(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def reset_metrics() -> None:
+    """
+    Clears the values recorded by this process (used by tests).
+    """
+    with _shards_lock:
+        for _, values in _shards:
+            values.clear()
+        _retired.clear()
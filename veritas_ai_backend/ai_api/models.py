@@ -1,3 +1,138 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class UploadedFileHandle(models.Model):
+    """
+    A file uploaded to the Google AI Files API, keyed by the SHA-256 of its
+    content so every worker can reuse the same remote copy.
+
+    The lock fields act as a lease: the worker that manages to set them is the
+    only one allowed to upload while the handle is missing or stale.
+    """
+
+    content_hash = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, blank=True)
+    uri = models.CharField(max_length=512, blank=True)
+    mime_type = models.CharField(max_length=100, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    lock_owner = models.CharField(max_length=64, blank=True)
+    lock_expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name or '<pending>'} ({self.content_hash[:12]})"
+
+
+class CachedContextHandle(models.Model):
+    """
+    An upstream cached-content object holding the fixed prefix of every
+    request (system instruction, data file and model preamble), keyed by the
+    model and the version of that prefix so every worker references the same
+    cache.
+    """
+
+    key = models.CharField(max_length=64, unique=True)
+    model = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name or '<pending>'} ({self.model})"
+
+
+class ChatSession(models.Model):
+    """
+    A conversation kept on the server so clients only send the new message.
+
+    Turns that no longer fit the history window are folded into `summary`
+    and deleted (see sessions.py). The session is deleted once `expires_at`
+    has passed.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    summary = models.TextField(blank=True)
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return str(self.id)
+
+
+class ChatTurn(models.Model):
+    """
+    One message of a chat session, from the user or the model.
+    """
+
+    ROLE_USER = "user"
+    ROLE_MODEL = "model"
+    ROLE_CHOICES = [(ROLE_USER, "User"), (ROLE_MODEL, "Model")]
+
+    session = models.ForeignKey(ChatSession, on_delete=models.CASCADE, related_name="turns")
+    role = models.CharField(max_length=10, choices=ROLE_CHOICES)
+    text = models.TextField()
+    # Estimated, see text_index.estimate_text_tokens
+    tokens = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"{self.role}: {self.text[:40]}"
+
+
+class GenerationJob(models.Model):
+    """
+    A generation queued through /api/jobs/ and run by a job worker (see
+    jobs.py).
+
+    A worker claims a queued job by setting `worker` and `lease_expires_at`
+    and extends the lease while it streams the answer into `partial_text`.
+    A running job whose lease lapsed (its worker died) is queued again.
+    Finished jobs are deleted once `expires_at` has passed.
+    """
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CANCELLED = "cancelled"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_SUCCEEDED, "Succeeded"),
+        (STATUS_FAILED, "Failed"),
+        (STATUS_CANCELLED, "Cancelled"),
+    ]
+    FINISHED_STATUSES = (STATUS_SUCCEEDED, STATUS_FAILED, STATUS_CANCELLED)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    # Higher runs first
+    priority = models.SmallIntegerField(default=0)
+    # The generate request body (PromptSerializer fields)
+    params = models.JSONField()
+    client_id = models.CharField(max_length=255, blank=True)
+    partial_text = models.TextField(blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.JSONField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    worker = models.CharField(max_length=64, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    deadline = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "-priority", "created_at"])]
+
+    def __str__(self):
+        return f"{self.id} ({self.status})"
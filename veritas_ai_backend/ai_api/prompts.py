@@ -0,0 +1,271 @@
+"""
+Precompiled prompt templates.
+
+A template holds the fixed parts of every request: the system instruction,
+the text introducing the attached data file or the retrieved passages, and
+optional few-shot turns sent after the model preamble.
+VERITAS_PROMPT_TEMPLATES defines the versions (keys left out use the
+built-in texts) and VERITAS_PROMPT_TEMPLATE picks the one requests use, so a
+new wording can be compared against the current one by switching it, e.g.
+with `bench_replay --prompt-template`.
+
+Each version is compiled once per model preamble into shared Content
+objects, with their estimated token counts and a content hash; a request
+only builds its own user turn (and its chat history) and appends it. The
+compiled contents are shared by every request and must not be modified.
+
+The content hash is part of the cached context version and of
+knowledge_base_version, so cached contexts and cached answers built with one
+version are never used for another. Requests are logged and counted per
+version (veritas_prompt_template_requests_total).
+"""
+# prompts.py
+
+import hashlib
+import json
+import logging
+import threading
+from dataclasses import asdict, dataclass
+
+from django.conf import settings
+from google.genai import types
+
+from .sessions import ChatHistory
+from .text_index import estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+# System instruction for the chatbot. It is sent as part of the cached
+# context (see context_cache.py); inline requests only carry it with
+# templates setting "inline_system_instruction" (tuned models reject it).
+VERITAS_SYSTEM_INSTRUCTION_TEXT = "You are An AI chatbot for Veritas University Abuja. You will answer questions respectfully and give accurate answers based primarily on the provided document and context. If the answer isn't in the document or context, state that you don't have that specific information."
+
+DEFAULT_TEMPLATE_VERSION = "v1"
+HISTORY_SUMMARY_INTRO = "Summary of our conversation so far:\n"
+# Attached data files remembered per compiled template
+_MAX_FILE_CONTENTS = 4
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    """
+    A version of the fixed parts of a request, as defined in
+    VERITAS_PROMPT_TEMPLATES.
+    """
+
+    version: str
+    system_instruction: str = VERITAS_SYSTEM_INSTRUCTION_TEXT
+    document_intro: str = "This is some of the school's data"
+    passages_intro: str = "These are excerpts from the school's data:\n\n"
+    # (question, answer) turns sent after the model preamble
+    few_shot: tuple[tuple[str, str], ...] = ()
+    inline_system_instruction: bool = False
+
+    @classmethod
+    def from_settings(cls, version: str, definition: dict) -> "PromptTemplate":
+        """
+        Builds a template from its VERITAS_PROMPT_TEMPLATES entry.
+
+        Raises:
+            ValueError: The entry has unknown keys or malformed few-shot
+                turns.
+        """
+        unknown = set(definition) - set(cls.__dataclass_fields__) - {"version"}
+        if unknown or "version" in definition:
+            raise ValueError(f"Unknown keys {sorted(unknown)} in prompt template {version}")
+        few_shot = tuple(
+            (str(question), str(answer)) for question, answer in definition.get("few_shot", ())
+        )
+        return cls(version=version, **{**definition, "few_shot": few_shot})
+
+
+def _text_content(role: str, text: str) -> types.Content:
+    return types.Content(role=role, parts=[types.Part.from_text(text=text)])
+
+
+class CompiledPrompt:
+    """
+    A template compiled for one model preamble: the shared contents of the
+    request prefix with their token estimates, and the per-request assembly.
+    """
+
+    def __init__(self, template: PromptTemplate, preamble: str):
+        self.template = template
+        self.version = template.version
+        self.preamble = preamble
+        fields = asdict(template)
+        del fields["version"]
+        self.content_hash = hashlib.sha256(
+            json.dumps([fields, preamble], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+        self.preamble_content = _text_content("model", preamble)
+        self.few_shot_contents = tuple(
+            content
+            for question, answer in template.few_shot
+            for content in (_text_content("user", question), _text_content("model", answer))
+        )
+        # id() of each shared content -> its estimated tokens
+        self._tokens = {
+            id(content): estimate_text_tokens(content.parts[0].text)
+            for content in (self.preamble_content, *self.few_shot_contents)
+        }
+        self.few_shot_tokens = sum(self._tokens[id(c)] for c in self.few_shot_contents)
+        self.system_instruction_tokens = estimate_text_tokens(template.system_instruction)
+        self.passages_intro_tokens = estimate_text_tokens(template.passages_intro)
+        # Tokens of the full-file prefix besides the file itself
+        self.prefix_tokens = (
+            estimate_text_tokens(template.document_intro)
+            + self._tokens[id(self.preamble_content)]
+            + self.few_shot_tokens
+        )
+        self._file_contents: dict[tuple[str, str], types.Content] = {}
+
+    @property
+    def label(self) -> str:
+        """
+        The version and a short content hash, for logs.
+        """
+        return f"{self.version}@{self.content_hash[:8]}"
+
+    @property
+    def system_instruction(self) -> str:
+        return self.template.system_instruction
+
+    @property
+    def cached_prefix_tokens(self) -> int:
+        """
+        Estimated tokens of what a cached context holds besides the data
+        file: the prefix and the system instruction.
+        """
+        return self.prefix_tokens + self.system_instruction_tokens
+
+    def known_tokens(self, content: types.Content) -> int | None:
+        """
+        The estimated tokens of one of the shared contents, or None for a
+        content built for the request.
+        """
+        return self._tokens.get(id(content))
+
+    def file_prefix(self, file_uri: str, mime_type: str) -> list[types.Content]:
+        """
+        The fixed turns sent before every prompt in full-file mode: the data
+        file, the model preamble and the few-shot turns.
+        """
+        key = (file_uri, mime_type)
+        file_content = self._file_contents.get(key)
+        if file_content is None:
+            file_content = types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_uri(file_uri=file_uri, mime_type=mime_type),
+                    types.Part.from_text(text=self.template.document_intro),
+                ],
+            )
+            # Uploads expire after 48 hours; only the current one matters
+            if len(self._file_contents) >= _MAX_FILE_CONTENTS:
+                self._file_contents.clear()
+            self._file_contents[key] = file_content
+        return [file_content, self.preamble_content, *self.few_shot_contents]
+
+    def turns(
+        self,
+        prompt: str,
+        history: ChatHistory | None = None,
+        passages_text: str | None = None,
+        few_shot: bool = True,
+    ) -> list[types.Content]:
+        """
+        The contents built per request: the few-shot turns (unless they are
+        already in the prefix), the chat session turns, with the summary of
+        older turns leading the first one, and the user turn.
+
+        Args:
+            prompt: The user's input prompt.
+            history: The chat session turns to send before the prompt.
+            passages_text: Knowledge base passages to send with the prompt.
+            few_shot: False if the few-shot turns were sent in the prefix.
+        """
+        parts = [types.Part.from_text(text=prompt)]
+        if passages_text is not None:
+            parts.insert(0, types.Part.from_text(text=self.template.passages_intro + passages_text))
+        contents = [types.Content(role="user", parts=parts)]
+        if history:
+            contents[:0] = [_text_content(role, text) for role, text in history.turns]
+            if history.summary:
+                contents[0].parts.insert(
+                    0, types.Part.from_text(text=HISTORY_SUMMARY_INTRO + history.summary)
+                )
+        if few_shot and self.few_shot_contents:
+            contents[:0] = self.few_shot_contents
+        return contents
+
+    def request_config(self, config: types.GenerateContentConfig | None):
+        """
+        The generation config of a request without a cached context, with
+        the system instruction if the template sends it inline.
+        """
+        if config is None or not self.template.inline_system_instruction:
+            return config
+        return config.model_copy(update={"system_instruction": self.system_instruction})
+
+
+def prompt_template_version() -> str:
+    return getattr(settings, "VERITAS_PROMPT_TEMPLATE", DEFAULT_TEMPLATE_VERSION)
+
+
+_lock = threading.Lock()
+# (version, preamble) -> (definition it was compiled from, compiled template);
+# each knowledge base has its own preamble
+_compiled: dict[tuple[str, str], tuple[dict | None, CompiledPrompt]] = {}
+_MAX_COMPILED = 32
+
+
+def _compile(version: str, definition: dict | None, preamble: str) -> CompiledPrompt:
+    if definition is None:
+        if version != DEFAULT_TEMPLATE_VERSION:
+            logger.error(f"Unknown prompt template {version}, using the built-in texts")
+        return CompiledPrompt(PromptTemplate(version), preamble)
+    try:
+        template = PromptTemplate.from_settings(version, definition)
+    except (TypeError, ValueError) as e:
+        logger.error(f"Invalid prompt template {version}, using the built-in texts: {e}")
+        template = PromptTemplate(version)
+    return CompiledPrompt(template, preamble)
+
+
+def get_prompt_template(preamble: str, version: str | None = None) -> CompiledPrompt:
+    """
+    Returns a prompt template compiled for the model preamble, compiling it
+    the first time and again when its definition or the preamble changes.
+
+    Args:
+        preamble: The model preamble (see ai_helpers.model_preamble).
+        version: The template version instead of VERITAS_PROMPT_TEMPLATE.
+
+    Returns:
+        The CompiledPrompt. Unknown or invalid versions are logged and use
+        the built-in texts under their own version name.
+    """
+    version = version or prompt_template_version()
+    definition = getattr(settings, "VERITAS_PROMPT_TEMPLATES", {}).get(version)
+    key = (version, preamble)
+    entry = _compiled.get(key)
+    if entry is not None and entry[0] == definition:
+        return entry[1]
+    with _lock:
+        compiled = _compile(version, definition, preamble)
+        # Edited preambles leave their old versions behind
+        if len(_compiled) >= _MAX_COMPILED:
+            _compiled.clear()
+        _compiled[key] = (definition, compiled)
+        logger.info(f"Compiled prompt template {compiled.label}")
+        return compiled
+
+
+def reset_prompt_templates() -> None:
+    """
+    Forgets the compiled templates (used by tests).
+    """
+    with _lock:
+        _compiled.clear()
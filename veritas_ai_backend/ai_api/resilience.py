@@ -0,0 +1,367 @@
+"""
+Resilience against upstream incidents: retries, circuit breakers and
+degraded answers.
+
+* Upstream calls failing with a transient error (5xx, 429, timeouts,
+  connection errors) before producing any text are retried up to
+  VERITAS_RETRY_ATTEMPTS times with jittered exponential backoff, but never
+  past the request's deadline: the model's first-chunk deadline when the
+  request is dispatched (see dispatch.py), VERITAS_RETRY_DEADLINE_SECONDS
+  otherwise.
+* Each model has a circuit breaker. After VERITAS_BREAKER_FAILURE_THRESHOLD
+  consecutive failures it opens: calls to the model fail right away with
+  CircuitOpen, and dispatch skips it for the fallback models. After
+  VERITAS_BREAKER_OPEN_SECONDS one probe call is let through; its success
+  closes the breaker, its failure opens it again.
+* Prompts no model can answer because of an outage get a degraded answer
+  from local knowledge instead of an error: the closest data.csv entry, or
+  the most relevant passages of the data file and the model preamble,
+  prefixed with a notice and flagged "degraded".
+
+Breakers are kept per worker process; their state is reported under
+"circuit_breakers" at /api/stats/ and in the veritas_circuit_breakers_open
+metric.
+"""
+# resilience.py
+
+import logging
+import random
+import threading
+import time
+
+import httpx
+from django.conf import settings
+from google.genai import errors as genai_errors
+
+from .ai_helpers import model_preamble
+from .faq import answer_from_faq
+from .metrics import circuit_breakers_open, degraded_answers, upstream_retries
+from .retrieval import PassageIndex, get_passage_index, retrieval_available, split_passages
+from .stats import StatCounters, register
+
+logger = logging.getLogger(__name__)
+
+resilience_stats = StatCounters(
+    "resilience",
+    "retries",
+    "breaker_trips",
+    "short_circuits",
+    "degraded_answers",
+)
+
+# Status codes of API errors worth retrying besides 5xx
+TRANSIENT_STATUS_CODES = (408, 429)
+
+DEGRADED_MODEL_NAME = "local"
+DEGRADED_NOTICE = (
+    "The AI assistant is temporarily unavailable, so this answer was put "
+    "together from saved information and may not fully cover your question."
+)
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a model whose circuit breaker is open.
+    """
+
+    def __init__(self, model: str, retry_after: float):
+        super().__init__(f"Circuit breaker for model {model} is open")
+        self.model = model
+        self.retry_after = max(round(retry_after), 1)
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    Returns True if an upstream error is likely to go away on its own.
+    """
+    if isinstance(error, genai_errors.ServerError):
+        return True
+    if isinstance(error, genai_errors.APIError):
+        return error.code in TRANSIENT_STATUS_CODES
+    return isinstance(error, (httpx.TransportError, TimeoutError, ConnectionError))
+
+
+def upstream_unavailable(error: Exception) -> bool:
+    """
+    Returns True if a generation failed because the AI service is down or
+    overloaded, rather than because of the request.
+    """
+    return isinstance(error, CircuitOpen) or is_transient(error)
+
+
+# Retries
+
+
+def retry_deadline() -> float:
+    """
+    The time.monotonic() deadline for retries of a request that has none of
+    its own.
+    """
+    return time.monotonic() + settings.VERITAS_RETRY_DEADLINE_SECONDS
+
+
+def retry_delay(
+    model: str, error: Exception, retries: int, deadline: float
+) -> float | None:
+    """
+    Seconds to wait before retrying a failed upstream call.
+
+    Args:
+        model: The model that was called.
+        error: The error the call failed with.
+        retries: How many times the call was already retried.
+        deadline: time.monotonic() after which the call may not be retried.
+
+    Returns:
+        The delay, or None if the call should not be retried.
+    """
+    if not is_transient(error) or retries >= settings.VERITAS_RETRY_ATTEMPTS:
+        return None
+    if circuit_breakers.retry_in(model):
+        return None
+    ceiling = min(
+        settings.VERITAS_RETRY_BASE_DELAY_SECONDS * 2**retries,
+        settings.VERITAS_RETRY_MAX_DELAY_SECONDS,
+    )
+    delay = random.uniform(0, ceiling)
+    if time.monotonic() + delay >= deadline:
+        return None
+    resilience_stats.incr("retries")
+    upstream_retries.inc(model=model)
+    logger.warning(
+        f"Retrying model {model} in {delay:.2f}s after a transient error: {error}"
+    )
+    return delay
+
+
+# Circuit breakers
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+def breaker_enabled() -> bool:
+    return getattr(settings, "VERITAS_BREAKER_ENABLED", True)
+
+
+class _Breaker:
+    __slots__ = ("state", "failures", "opened_at", "probe_at")
+
+    def __init__(self):
+        self.state = STATE_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_at = 0.0
+
+
+class CircuitBreakers:
+    """
+    One circuit breaker per model, reported at /api/stats/.
+    """
+
+    def __init__(self, component: str):
+        self.component = component
+        self._lock = threading.Lock()
+        self._breakers: dict[str, _Breaker] = {}
+        register(self)
+
+    def _breaker(self, model: str) -> _Breaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = _Breaker()
+        return breaker
+
+    @staticmethod
+    def _retry_in(breaker: _Breaker, now: float) -> float:
+        """
+        Seconds until the breaker lets the next call through.
+        """
+        if breaker.state == STATE_CLOSED:
+            return 0
+        # Open: until the probe is due. Half open: until the probe in
+        # flight is given up on.
+        since = breaker.opened_at if breaker.state == STATE_OPEN else breaker.probe_at
+        return max(since + settings.VERITAS_BREAKER_OPEN_SECONDS - now, 0)
+
+    def retry_in(self, model: str) -> float:
+        """
+        Seconds until a call to the model is let through, 0 if it is now.
+        """
+        if not breaker_enabled():
+            return 0
+        with self._lock:
+            breaker = self._breakers.get(model)
+            return self._retry_in(breaker, time.monotonic()) if breaker else 0
+
+    def before_call(self, model: str) -> None:
+        """
+        Lets a call to the model through, as the probe if the breaker has
+        been open long enough.
+
+        Raises:
+            CircuitOpen: The breaker is open.
+        """
+        if not breaker_enabled():
+            return
+        with self._lock:
+            breaker = self._breakers.get(model)
+            if breaker is None or breaker.state == STATE_CLOSED:
+                return
+            now = time.monotonic()
+            retry_in = self._retry_in(breaker, now)
+            if retry_in == 0:
+                breaker.state = STATE_HALF_OPEN
+                breaker.probe_at = now
+                logger.info(f"Circuit breaker for model {model} lets a probe call through")
+                return
+        resilience_stats.incr("short_circuits")
+        raise CircuitOpen(model, retry_in)
+
+    def record_success(self, model: str) -> None:
+        with self._lock:
+            breaker = self._breakers.get(model)
+            if breaker is None:
+                return
+            if breaker.state != STATE_CLOSED:
+                circuit_breakers_open.dec(model=model)
+                logger.info(f"Circuit breaker for model {model} closed")
+            breaker.state = STATE_CLOSED
+            breaker.failures = 0
+
+    def record_failure(self, model: str) -> None:
+        if not breaker_enabled():
+            return
+        with self._lock:
+            breaker = self._breaker(model)
+            breaker.failures += 1
+            now = time.monotonic()
+            if breaker.state == STATE_HALF_OPEN:
+                breaker.state, breaker.opened_at = STATE_OPEN, now
+                logger.warning(f"Probe call failed, circuit breaker for model {model} reopened")
+            elif (
+                breaker.state == STATE_CLOSED
+                and breaker.failures >= settings.VERITAS_BREAKER_FAILURE_THRESHOLD
+            ):
+                breaker.state, breaker.opened_at = STATE_OPEN, now
+                circuit_breakers_open.inc(model=model)
+                resilience_stats.incr("breaker_trips")
+                logger.warning(
+                    f"Circuit breaker for model {model} opened after "
+                    f"{breaker.failures} consecutive failures"
+                )
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        Returns the state, consecutive failures and seconds until the next
+        call is let through, per model.
+        """
+        with self._lock:
+            now = time.monotonic()
+            return {
+                model: {
+                    "state": breaker.state,
+                    "failures": breaker.failures,
+                    "retry_in_seconds": round(self._retry_in(breaker, now), 1),
+                }
+                for model, breaker in self._breakers.items()
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._breakers.clear()
+
+
+circuit_breakers = CircuitBreakers("circuit_breakers")
+
+
+def record_upstream_failure(model: str, error: Exception) -> None:
+    """
+    Counts a failed call against the model's breaker if the service is at
+    fault (errors caused by the request don't count).
+    """
+    if is_transient(error):
+        circuit_breakers.record_failure(model)
+
+
+# Degraded answers
+
+
+def degraded_answers_enabled() -> bool:
+    return getattr(settings, "VERITAS_DEGRADED_ANSWERS_ENABLED", True)
+
+
+# (preamble, index of its passages)
+_notes_index: tuple[str, PassageIndex] | None = None
+
+
+def _local_passages(file_path: str, prompt: str) -> list:
+    """
+    The passages of the data file and preamble most relevant to the prompt;
+    only the preamble's if the file's text cannot be extracted.
+    """
+    global _notes_index
+    count = settings.VERITAS_DEGRADED_PASSAGES
+    preamble = model_preamble()
+    if retrieval_available():
+        return get_passage_index(file_path, preamble).search(prompt, count)
+    if _notes_index is None or _notes_index[0] != preamble:
+        _notes_index = (
+            preamble,
+            PassageIndex(
+                split_passages(
+                    preamble,
+                    "notes",
+                    settings.VERITAS_RETRIEVAL_PASSAGE_WORDS,
+                    settings.VERITAS_RETRIEVAL_PASSAGE_OVERLAP_WORDS,
+                )
+            ),
+        )
+    return _notes_index[1].search(prompt, count)
+
+
+def degraded_answer(prompt: str, file_path: str) -> dict | None:
+    """
+    Answers a prompt from local knowledge while the AI service is
+    unavailable.
+
+    Args:
+        prompt: The user's input prompt.
+        file_path: The path to the Veritas data file.
+
+    Returns:
+        The response data, or None if nothing relevant was found.
+    """
+    if not degraded_answers_enabled():
+        return None
+    match = answer_from_faq(prompt, threshold=settings.VERITAS_DEGRADED_FAQ_THRESHOLD)
+    if match:
+        text, source = match.entry.response, "faq"
+    else:
+        try:
+            passages = _local_passages(file_path, prompt)
+        except Exception as e:
+            logger.error(f"Failed to find passages for a degraded answer: {e}")
+            return None
+        if not passages:
+            return None
+        text, source = "\n\n".join(passage.text for passage in passages), "knowledge_base"
+    resilience_stats.incr("degraded_answers")
+    degraded_answers.inc(source=source)
+    logger.warning(f"Serving a degraded answer from the {source}")
+    return {
+        "response": f"{DEGRADED_NOTICE}\n\n{text}",
+        "model": DEGRADED_MODEL_NAME,
+        "source": source,
+        "degraded": True,
+    }
+
+
+def reset_resilience() -> None:
+    """
+    Closes every circuit breaker and resets the counters (used by tests).
+    """
+    global _notes_index
+    circuit_breakers.reset()
+    resilience_stats.reset()
+    _notes_index = None
@@ -0,0 +1,236 @@
+"""
+Cache of generated answers, in front of the Gemini call.
+
+Students ask the same handful of questions over and over. Answers are cached
+under a key built from the normalized prompt, the model, the generation
+parameters and the knowledge base version (hash of the data file and the
+model preamble), so editing either invalidates every entry automatically.
+
+There are two tiers: a per-process LRU with TTL for the hottest entries and a
+shared tier in the Django cache framework (VERITAS_RESPONSE_CACHE_ALIAS, a
+database cache table by default) that every worker reads.
+"""
+# response_cache.py
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .stats import StatCounters
+from .text_index import normalize_text
+
+logger = logging.getLogger(__name__)
+
+cache_stats = StatCounters(
+    "response_cache",
+    "memory_hits",
+    "shared_hits",
+    "misses",
+    "stores",
+    "evictions",
+    "expirations",
+    "bypassed",
+    "shared_errors",
+)
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after a fixed TTL.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                cache_stats.incr("expirations")
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                cache_stats.incr("evictions")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+_memory_cache: TTLCache | None = None
+_memory_cache_lock = threading.Lock()
+
+
+def _memory_tier() -> TTLCache:
+    global _memory_cache
+    max_entries = settings.VERITAS_RESPONSE_CACHE_MAX_ENTRIES
+    ttl = settings.VERITAS_RESPONSE_CACHE_TTL_SECONDS
+    cache = _memory_cache
+    if cache is None or (cache.max_entries, cache.ttl_seconds) != (max_entries, ttl):
+        with _memory_cache_lock:
+            cache = _memory_cache
+            if cache is None or (cache.max_entries, cache.ttl_seconds) != (
+                max_entries,
+                ttl,
+            ):
+                cache = _memory_cache = TTLCache(max_entries, ttl)
+    return cache
+
+
+def _shared_tier():
+    return caches[settings.VERITAS_RESPONSE_CACHE_ALIAS]
+
+
+def cache_enabled(request, validated_data: dict) -> bool:
+    """
+    Returns False if caching is switched off in settings or the request opts
+    out with "use_cache": false or a "Cache-Control: no-cache" header.
+    Jobs, run without a request, pass None.
+    """
+    if not getattr(settings, "VERITAS_RESPONSE_CACHE_ENABLED", True):
+        return False
+    cache_control = request.headers.get("Cache-Control", "").lower() if request else ""
+    if not validated_data.get("use_cache", True) or "no-cache" in cache_control:
+        cache_stats.incr("bypassed")
+        return False
+    return True
+
+
+def response_cache_key(
+    prompt: str, model_name: str, config, kb_version: str, history_digest: str = ""
+) -> str:
+    """
+    Builds the cache key for a generation request.
+
+    Args:
+        prompt: The user's input prompt.
+        model_name: The model the answer is generated with.
+        config: The GenerateContentConfig of the request.
+        kb_version: The knowledge base version from knowledge_base_version().
+        history_digest: ChatHistory.digest() of the chat session turns sent
+            with the prompt; follow-up questions only share answers given
+            after the same conversation.
+
+    Returns:
+        The cache key.
+    """
+    key_parts = [
+        normalize_text(prompt),
+        model_name,
+        config.temperature,
+        config.top_p,
+        config.top_k,
+        config.max_output_tokens,
+        kb_version,
+    ]
+    if history_digest:
+        key_parts.append(history_digest)
+    key_data = json.dumps(key_parts)
+    return "veritas:response:" + hashlib.sha256(key_data.encode()).hexdigest()
+
+
+def get_cached_response(key: str) -> dict | None:
+    """
+    Looks a response up in the memory tier, then the shared tier.
+    """
+    memory = _memory_tier()
+    data = memory.get(key)
+    if data is not None:
+        cache_stats.incr("memory_hits")
+        return data
+
+    try:
+        data = _shared_tier().get(key)
+    except Exception as e:
+        cache_stats.incr("shared_errors")
+        logger.warning(f"Shared response cache unavailable: {e}")
+        data = None
+    if data is not None:
+        cache_stats.incr("shared_hits")
+        memory.set(key, data)
+        return data
+    cache_stats.incr("misses")
+    return None
+
+
+def store_response(key: str, data: dict) -> None:
+    """
+    Stores a response in both tiers.
+    """
+    _memory_tier().set(key, data)
+    cache_stats.incr("stores")
+    try:
+        _shared_tier().set(key, data, settings.VERITAS_RESPONSE_CACHE_TTL_SECONDS)
+    except Exception as e:
+        cache_stats.incr("shared_errors")
+        logger.warning(f"Shared response cache unavailable: {e}")
+
+
+async def aget_cached_response(key: str) -> dict | None:
+    """
+    Async version of get_cached_response.
+    """
+    memory = _memory_tier()
+    data = memory.get(key)
+    if data is not None:
+        cache_stats.incr("memory_hits")
+        return data
+
+    try:
+        data = await _shared_tier().aget(key)
+    except Exception as e:
+        cache_stats.incr("shared_errors")
+        logger.warning(f"Shared response cache unavailable: {e}")
+        data = None
+    if data is not None:
+        cache_stats.incr("shared_hits")
+        memory.set(key, data)
+        return data
+    cache_stats.incr("misses")
+    return None
+
+
+async def astore_response(key: str, data: dict) -> None:
+    """
+    Async version of store_response.
+    """
+    _memory_tier().set(key, data)
+    cache_stats.incr("stores")
+    try:
+        await _shared_tier().aset(
+            key, data, settings.VERITAS_RESPONSE_CACHE_TTL_SECONDS
+        )
+    except Exception as e:
+        cache_stats.incr("shared_errors")
+        logger.warning(f"Shared response cache unavailable: {e}")
+
+
+def clear_memory_cache() -> None:
+    """
+    Empties this process's memory tier.
+    """
+    _memory_tier().clear()
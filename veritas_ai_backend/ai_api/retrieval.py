@@ -0,0 +1,350 @@
+"""
+Retrieval of relevant knowledge base passages for a prompt.
+
+Instead of attaching the whole of Veritas_data.pdf and the model preamble to
+every request, the text of both is split into short overlapping passages and
+indexed with BM25 once per content version. Each prompt is then sent with
+only the top VERITAS_RETRIEVAL_TOP_K passages, which cuts the input tokens
+(and with them upstream latency and cost) by an order of magnitude.
+"""
+# retrieval.py
+
+import functools
+import logging
+import threading
+from collections.abc import Sequence
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .file_registry import file_content_hash
+from .knowledge_store import (
+    KnowledgeStore,
+    MappedRecords,
+    StoreSection,
+    get_knowledge_store,
+    section_inputs,
+    text_hash,
+)
+from .knowledge_bases import drop_slots, resident
+from .stats import StatCounters
+from .text_index import (
+    Bm25Index,
+    FlatBm25Index,
+    FlatPostings,
+    SortedVocabulary,
+    estimate_text_tokens,
+    flatten_postings,
+)
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # pragma: no cover - optional dependency
+    PdfReader = None
+
+logger = logging.getLogger(__name__)
+
+retrieval_stats = StatCounters(
+    "retrieval",
+    "lookups",
+    "retrieved",
+    "fallbacks",
+    "index_builds",
+    "passages_sent",
+    "context_tokens",
+)
+
+CONTEXT_MODE_RETRIEVAL = "retrieval"
+CONTEXT_MODE_FULL = "full"
+
+# Gemini bills each page of an attached PDF as 258 input tokens.
+PDF_PAGE_TOKENS = 258
+
+# Sections of the knowledge base store (see knowledge_store.py)
+PAGES_SECTION = "pages"
+PASSAGES_SECTION = "passages"
+
+
+@dataclass(frozen=True)
+class Passage:
+    source: str
+    text: str
+
+
+def retrieval_available() -> bool:
+    """
+    Returns True if PDF text extraction (pypdf) is installed.
+    """
+    return PdfReader is not None
+
+
+def context_mode() -> str:
+    """
+    Returns the configured context mode, "retrieval" or "full".
+    """
+    mode = getattr(settings, "VERITAS_CONTEXT_MODE", CONTEXT_MODE_RETRIEVAL)
+    if mode == CONTEXT_MODE_RETRIEVAL and retrieval_available():
+        return CONTEXT_MODE_RETRIEVAL
+    return CONTEXT_MODE_FULL
+
+
+def extract_pdf_pages(file_path: str) -> list[str]:
+    """
+    Extracts the text of each page of a PDF.
+
+    Args:
+        file_path: The path to the PDF.
+
+    Returns:
+        The text of each page, in order.
+    """
+    reader = PdfReader(file_path)
+    return [page.extract_text() or "" for page in reader.pages]
+
+
+_page_counts: dict[str, int] = {}
+
+
+def attached_file_tokens(file_path: str) -> int:
+    """
+    Input tokens the data file costs when attached as a PDF, or 0 if its
+    page count cannot be read (pypdf not installed).
+    """
+    if not retrieval_available():
+        return 0
+    content_hash = file_content_hash(file_path)
+    pages = _page_counts.get(content_hash)
+    if pages is None:
+        pages = _page_counts[content_hash] = len(PdfReader(file_path).pages)
+    return pages * PDF_PAGE_TOKENS
+
+
+def split_passages(
+    text: str, source: str, passage_words: int, overlap_words: int
+) -> list[Passage]:
+    """
+    Splits text into passages of about passage_words words, each sharing
+    overlap_words words with the previous one so an answer that straddles a
+    boundary is still retrieved whole.
+    """
+    words = text.split()
+    step = max(passage_words - overlap_words, 1)
+    passages = []
+    for start in range(0, len(words), step):
+        passages.append(Passage(source, " ".join(words[start : start + passage_words])))
+        if start + passage_words >= len(words):
+            break
+    return passages
+
+
+class PassageIndex:
+    """
+    BM25 index over the passages of the knowledge base.
+    """
+
+    def __init__(self, passages: Sequence[Passage], index: Bm25Index | None = None):
+        self.passages = passages
+        self.index = index or Bm25Index([passage.text for passage in passages])
+
+    @classmethod
+    def from_store(cls, store: KnowledgeStore) -> "PassageIndex":
+        """
+        The index over the passages of the store, read in place.
+        """
+        meta = store.meta(PASSAGES_SECTION)
+        mapped = functools.partial(store.array, PASSAGES_SECTION)
+        postings = FlatPostings(
+            SortedVocabulary(store.strings(PASSAGES_SECTION, "vocabulary")),
+            mapped("idf"),
+            mapped("starts"),
+            mapped("documents"),
+            mapped("counts"),
+        )
+        return cls(
+            MappedRecords(
+                Passage,
+                store.strings(PASSAGES_SECTION, "source"),
+                store.strings(PASSAGES_SECTION, "text"),
+            ),
+            FlatBm25Index(
+                mapped("doc_lengths"),
+                meta["average_length"],
+                postings,
+                k1=meta["k1"],
+                b=meta["b"],
+            ),
+        )
+
+    def write_section(self, section: StoreSection) -> None:
+        """
+        Writes the passages and the BM25 index into a store section.
+        """
+        vocabulary, idf, starts, documents, counts = flatten_postings(
+            self.index.idf, self.index.postings
+        )
+        section.add_strings("source", [passage.source for passage in self.passages])
+        section.add_strings("text", [passage.text for passage in self.passages])
+        section.add_strings("vocabulary", vocabulary)
+        section.add_array("idf", "d", idf)
+        section.add_array("starts", "Q", starts)
+        section.add_array("documents", "I", documents)
+        section.add_array("counts", "I", counts)
+        section.add_array("doc_lengths", "I", self.index.doc_lengths)
+        section.meta.update(
+            average_length=self.index.average_length, k1=self.index.k1, b=self.index.b
+        )
+
+    def search(self, query: str, top_k: int) -> list[Passage]:
+        """
+        Returns up to top_k passages relevant to the query, in document order.
+        """
+        results = self.index.search(query, limit=top_k)
+        return [self.passages[doc_index] for doc_index in sorted(i for i, _ in results)]
+
+
+def passages_from_pages(pages: Sequence[str], preamble: str = "") -> list[Passage]:
+    """
+    Splits the pages of the data file and the model preamble into passages.
+    """
+    passage_words = settings.VERITAS_RETRIEVAL_PASSAGE_WORDS
+    overlap_words = settings.VERITAS_RETRIEVAL_PASSAGE_OVERLAP_WORDS
+    passages = []
+    for page_number, page_text in enumerate(pages, start=1):
+        passages.extend(
+            split_passages(page_text, f"page {page_number}", passage_words, overlap_words)
+        )
+    if preamble:
+        passages.extend(split_passages(preamble, "notes", passage_words, overlap_words))
+    return passages
+
+
+def build_passage_index(file_path: str, preamble: str = "") -> PassageIndex:
+    """
+    Extracts and indexes the data file and the model preamble.
+
+    Args:
+        file_path: The path to the Veritas data file.
+        preamble: Additional reference text indexed alongside the file.
+
+    Returns:
+        The PassageIndex.
+    """
+    return PassageIndex(passages_from_pages(extract_pdf_pages(file_path), preamble))
+
+
+def passage_section_inputs(file_hash: str, preamble: str) -> str:
+    """
+    Identifies a passage index: the data file, the preamble and the passage
+    settings.
+    """
+    return section_inputs(
+        PASSAGES_SECTION,
+        file_hash,
+        text_hash(preamble),
+        settings.VERITAS_RETRIEVAL_PASSAGE_WORDS,
+        settings.VERITAS_RETRIEVAL_PASSAGE_OVERLAP_WORDS,
+    )
+
+
+class _IndexSlot:
+    """
+    The passage index of a knowledge base (see knowledge_bases.py).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # ((passage section inputs, store version), index)
+        self.entry: tuple[tuple, PassageIndex] | None = None
+
+
+INDEX_SLOT = "passage_index"
+
+
+def _index_size(index: PassageIndex) -> int:
+    """
+    Rough memory held by an index built from the sources: the passages and
+    their postings. Indexes read from the store are counted with the store.
+    """
+    if isinstance(index.passages, MappedRecords):
+        return 0
+    return 4 * sum(len(passage.text) for passage in index.passages)
+
+
+def get_passage_index(file_path: str, preamble: str = "") -> PassageIndex:
+    """
+    Returns the passage index for the current content of the data file:
+    the one in the knowledge base store if it was ingested from this
+    content, otherwise one built on first use and again whenever the file
+    changes.
+    """
+    inputs = passage_section_inputs(file_content_hash(file_path), preamble)
+    store = get_knowledge_store()
+    if store is None or not store.section_matches(PASSAGES_SECTION, inputs):
+        store = None
+    key = (inputs, store.version if store else None)
+    state = resident()
+    slot = state.slot(INDEX_SLOT, _IndexSlot)
+    entry = slot.entry
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    with slot.lock:
+        entry = slot.entry
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        if store is not None:
+            index = PassageIndex.from_store(store)
+            source = f"knowledge base store {store.version}"
+        else:
+            index = build_passage_index(file_path, preamble)
+            retrieval_stats.incr("index_builds")
+            source = file_path
+        # Only the current version of the file is worth keeping.
+        slot.entry = (key, index)
+        logger.info(f"Indexed {len(index.passages)} knowledge base passages from {source}")
+    state.set_size(INDEX_SLOT, _index_size(index))
+    return index
+
+
+def retrieve_passages(file_path: str, prompt: str, preamble: str = "") -> list[Passage]:
+    """
+    Returns the passages to send with a prompt.
+
+    Args:
+        file_path: The path to the Veritas data file.
+        prompt: The user's input prompt.
+        preamble: Additional reference text indexed alongside the file.
+
+    Returns:
+        Up to VERITAS_RETRIEVAL_TOP_K passages, or an empty list if nothing
+        relevant was found and the full file should be sent instead.
+    """
+    retrieval_stats.incr("lookups")
+    passages = get_passage_index(file_path, preamble).search(
+        prompt, settings.VERITAS_RETRIEVAL_TOP_K
+    )
+    if not passages:
+        retrieval_stats.incr("fallbacks")
+        return []
+    retrieval_stats.incr("retrieved")
+    retrieval_stats.incr("passages_sent", len(passages))
+    retrieval_stats.incr(
+        "context_tokens", sum(estimate_text_tokens(passage.text) for passage in passages)
+    )
+    return passages
+
+
+def format_passages(passages: list[Passage]) -> str:
+    """
+    Formats retrieved passages as the context text sent to the model.
+    """
+    return "\n\n".join(
+        f"[{number}] ({passage.source}) {passage.text}"
+        for number, passage in enumerate(passages, start=1)
+    )
+
+
+def reset_passage_indexes() -> None:
+    """
+    Drops the cached passage indexes (used by tests).
+    """
+    drop_slots(INDEX_SLOT)
@@ -0,0 +1,275 @@
+"""
+Routing of prompts to the cheapest model likely to answer them well.
+
+The default model (VERITAS_AI_MODEL) is an experimental pro model, but most
+prompts are one-line lookups ("what is the motto?") that the much faster
+flash model answers just as well. Requests that don't name a model are
+classified in-process from cheap features of the prompt:
+
+* its length in words,
+* the question type: "lookup" (who/what/when/where/how much...), "open"
+  (why, explain, compare, advice, several questions) or "other",
+* how close it is to a curated data.csv question (FAQ match score),
+* the share of its words found in the knowledge base passages,
+* whether it follows up on earlier turns of a chat session,
+
+and sent to the model of the first VERITAS_ROUTER_RULES rule they satisfy,
+or VERITAS_AI_MODEL if none does. A rule is a dict with a "route" name, a
+"model" and any of the conditions in CONDITIONS. Routed requests still fall
+back to VERITAS_AI_MODEL if their model fails (see dispatch.model_chain).
+
+Responses report the route and why it was taken ("route", "route_reason").
+Routes are counted under "routing" at /api/stats/ and in the
+veritas_routed_requests_total metric. `python manage.py eval_routing`
+replays data.csv with and without routing to show the latency saved per
+route.
+"""
+# routing.py
+
+import logging
+import re
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .faq import get_faq_matcher
+from .metrics import routed_requests
+from .retrieval import get_passage_index, retrieval_available
+from .stats import StatCounters
+from .text_index import normalize_text, tokenize
+
+logger = logging.getLogger(__name__)
+
+routing_stats = StatCounters("routing", "routed", "requested", "default")
+
+ROUTE_DEFAULT = "default"
+ROUTE_REQUESTED = "requested"
+
+QUESTION_LOOKUP = "lookup"
+QUESTION_OPEN = "open"
+QUESTION_OTHER = "other"
+
+# First words of factual questions
+LOOKUP_STARTS = frozenset(
+    """
+    who whom whose what when where which is are was does do did can list name
+    """.split()
+)
+LOOKUP_PHRASES = ("how much", "how many", "how long", "how old", "how far", "how do i contact")
+# Words asking for reasoning, comparisons, advice or writing
+OPEN_WORDS = frozenset(
+    """
+    why explain compare comparison difference differences versus vs better
+    best recommend advise advice pros cons plan strategy describe discuss
+    analyse analyze evaluate summarize summarise essay write
+    """.split()
+)
+# First words of requests for advice ("should I...")
+OPEN_STARTS = frozenset(["should", "how"])
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+
+@dataclass(frozen=True)
+class PromptFeatures:
+    words: int
+    question_type: str
+    faq_score: float
+    kb_coverage: float | None
+    follow_up: bool
+
+
+@dataclass(frozen=True)
+class RoutingDecision:
+    route: str
+    model: str
+    reason: str
+
+    def fields(self) -> dict:
+        """
+        The response fields reporting the decision.
+        """
+        return {"route": self.route, "route_reason": self.reason}
+
+
+def router_enabled() -> bool:
+    return getattr(settings, "VERITAS_ROUTER_ENABLED", True)
+
+
+def question_type(prompt: str) -> str:
+    """
+    Classifies a prompt as a "lookup", "open" or "other" question.
+    """
+    text = normalize_text(prompt)
+    words = _WORD_RE.findall(text)
+    if not words:
+        return QUESTION_OTHER
+    if prompt.count("?") > 1 or OPEN_WORDS.intersection(words):
+        return QUESTION_OPEN
+    if words[0] in LOOKUP_STARTS or text.startswith(LOOKUP_PHRASES):
+        return QUESTION_LOOKUP
+    if words[0] in OPEN_STARTS:
+        return QUESTION_OPEN
+    return QUESTION_OTHER
+
+
+def _faq_score(prompt: str) -> float:
+    matcher = get_faq_matcher()
+    match = matcher.best_match(prompt) if matcher else None
+    return match.score if match else 0.0
+
+
+def _kb_coverage(prompt: str, file_path: str, preamble: str) -> float | None:
+    """
+    Share of the prompt's words found in the knowledge base passages, or
+    None if the data file's text can't be read.
+    """
+    if not retrieval_available():
+        return None
+    tokens = tokenize(prompt)
+    if not tokens:
+        return 0.0
+    index = get_passage_index(file_path, preamble).index
+    return sum(index.covers(token) for token in tokens) / len(tokens)
+
+
+def prompt_features(
+    prompt: str, file_path: str, preamble: str, follow_up: bool = False
+) -> PromptFeatures:
+    """
+    Computes the routing features of a prompt.
+
+    Args:
+        prompt: The user's input prompt.
+        file_path: The path to the Veritas data file.
+        preamble: The model preamble, indexed with the data file.
+        follow_up: True if the prompt continues a chat session.
+
+    Returns:
+        The PromptFeatures.
+    """
+    return PromptFeatures(
+        words=len(prompt.split()),
+        question_type=question_type(prompt),
+        faq_score=_faq_score(prompt),
+        kb_coverage=_kb_coverage(prompt, file_path, preamble),
+        follow_up=follow_up,
+    )
+
+
+# Rule conditions: name -> (test of the features, description for the reason)
+CONDITIONS = {
+    "max_words": (lambda f, v: f.words <= v, lambda f, v: f"{f.words} words <= {v}"),
+    "min_words": (lambda f, v: f.words >= v, lambda f, v: f"{f.words} words >= {v}"),
+    "question_types": (
+        lambda f, v: f.question_type in v,
+        lambda f, v: f"{f.question_type} question",
+    ),
+    "min_faq_score": (
+        lambda f, v: f.faq_score >= v,
+        lambda f, v: f"FAQ match {f.faq_score:.2f} >= {v}",
+    ),
+    "min_kb_coverage": (
+        lambda f, v: f.kb_coverage is not None and f.kb_coverage >= v,
+        lambda f, v: f"knowledge base coverage {f.kb_coverage:.2f} >= {v}",
+    ),
+    "follow_up": (
+        lambda f, v: f.follow_up == v,
+        lambda f, v: "follow-up" if f.follow_up else "new question",
+    ),
+}
+RULE_KEYS = ("route", "model")
+
+
+def _matches(rule: dict, features: PromptFeatures) -> list[str] | None:
+    """
+    Returns the descriptions of the rule's conditions if the features
+    satisfy all of them, None otherwise.
+    """
+    reasons = []
+    for name, value in rule.items():
+        if name in RULE_KEYS:
+            continue
+        test, describe = CONDITIONS[name]
+        if not test(features, value):
+            return None
+        reasons.append(describe(features, value))
+    return reasons
+
+
+def _valid(rule: dict) -> bool:
+    unknown = [name for name in rule if name not in CONDITIONS and name not in RULE_KEYS]
+    if unknown or not all(key in rule for key in RULE_KEYS):
+        logger.error(f"Ignoring invalid routing rule {rule}: unknown or missing keys {unknown}")
+        return False
+    return True
+
+
+def route_prompt(features: PromptFeatures) -> RoutingDecision:
+    """
+    Picks the model for a prompt from its features: the model of the first
+    VERITAS_ROUTER_RULES rule they satisfy, VERITAS_AI_MODEL otherwise.
+    """
+    for rule in settings.VERITAS_ROUTER_RULES:
+        if not _valid(rule):
+            continue
+        reasons = _matches(rule, features)
+        if reasons is not None:
+            return RoutingDecision(
+                rule["route"], rule["model"], ", ".join(reasons) or "rule without conditions"
+            )
+    return RoutingDecision(
+        ROUTE_DEFAULT,
+        settings.VERITAS_AI_MODEL,
+        f"no routing rule matched ({features.question_type} question, {features.words} words)",
+    )
+
+
+def routed_models() -> list[str]:
+    """
+    The models requests may be routed to: VERITAS_AI_MODEL and, with the
+    router on, the models of the valid VERITAS_ROUTER_RULES.
+    """
+    models = [settings.VERITAS_AI_MODEL]
+    if router_enabled():
+        models.extend(rule["model"] for rule in settings.VERITAS_ROUTER_RULES if _valid(rule))
+    return list(dict.fromkeys(models))
+
+
+def route_request(
+    validated_data: dict, prompt: str, file_path: str, preamble: str, follow_up: bool = False
+) -> RoutingDecision:
+    """
+    Decides which model answers a request.
+
+    Args:
+        validated_data: The validated request parameters.
+        prompt: The user's input prompt (after the prompt budget).
+        file_path: The path to the Veritas data file.
+        preamble: The model preamble, indexed with the data file.
+        follow_up: True if the prompt continues a chat session.
+
+    Returns:
+        The RoutingDecision; the requested model if the client named one.
+    """
+    if "model" in validated_data:
+        decision = RoutingDecision(
+            ROUTE_REQUESTED, validated_data["model"], "model requested by the client"
+        )
+    elif not router_enabled():
+        decision = RoutingDecision(ROUTE_DEFAULT, settings.VERITAS_AI_MODEL, "routing disabled")
+    else:
+        try:
+            features = prompt_features(prompt, file_path, preamble, follow_up)
+        except Exception as e:
+            logger.error(f"Failed to classify the prompt, using the default model: {e}")
+            decision = RoutingDecision(
+                ROUTE_DEFAULT, settings.VERITAS_AI_MODEL, "prompt could not be classified"
+            )
+        else:
+            decision = route_prompt(features)
+    routing_stats.incr(decision.route)
+    if decision.route not in (ROUTE_DEFAULT, ROUTE_REQUESTED):
+        routing_stats.incr("routed")
+    routed_requests.inc(route=decision.route, model=decision.model)
+    logger.info(f"Routed to {decision.model} ({decision.route}): {decision.reason}")
+    return decision
@@ -2,8 +2,11 @@
 Serializers for the AI API application.
 """
 
+from django.conf import settings
 from rest_framework import serializers
 
+from .knowledge_bases import knowledge_bases
+
 
 class PromptSerializer(serializers.Serializer):
     """
@@ -34,6 +37,96 @@ class PromptSerializer(serializers.Serializer):
     max_output_tokens = serializers.IntegerField(
         required=False, min_value=1, help_text="Maximum number of tokens to generate"
     )
+    use_cache = serializers.BooleanField(
+        required=False,
+        help_text="Set to false to skip the response cache for this request",
+    )
+    session_id = serializers.UUIDField(
+        required=False,
+        allow_null=True,
+        help_text="The session_id of a previous answer, to ask a follow-up question",
+    )
+    start_session = serializers.BooleanField(
+        required=False,
+        help_text="Set to true to start a chat session; its answer carries the session_id",
+    )
+    knowledge_base = serializers.CharField(
+        required=False,
+        help_text="The knowledge base to answer from (defaults to settings.VERITAS_DEFAULT_KNOWLEDGE_BASE)",
+    )
+
+    deadline_seconds = serializers.FloatField(
+        required=False,
+        min_value=0.1,
+        help_text="Seconds the client will wait for the answer (at most settings.VERITAS_REQUEST_DEADLINE_SECONDS)",
+    )
+
+    def validate_knowledge_base(self, value):
+        if value not in knowledge_bases():
+            raise serializers.ValidationError(f"Unknown knowledge base '{value}'.")
+        return value
+
+
+class BatchPromptSerializer(PromptSerializer):
+    """
+    Serializer for the batch generate input: a list of prompts (or items with
+    their own parameters) plus parameters shared by every item.
+    """
+
+    prompt = None
+    prompts = serializers.ListField(
+        child=serializers.CharField(),
+        required=False,
+        help_text="The prompts to generate answers for",
+    )
+    items = serializers.ListField(
+        child=serializers.DictField(),
+        required=False,
+        help_text="Prompts with per-item parameters, e.g. {'prompt': ..., 'temperature': 0.2}",
+    )
+    concurrency = serializers.IntegerField(
+        required=False,
+        min_value=1,
+        help_text="Maximum number of prompts generated at the same time",
+    )
+
+    def validate(self, attrs):
+        if bool(attrs.get("prompts")) == bool(attrs.get("items")):
+            raise serializers.ValidationError(
+                "Provide a non-empty list of either 'prompts' or 'items'."
+            )
+        count = len(attrs.get("prompts") or attrs.get("items"))
+        if count > settings.VERITAS_BATCH_MAX_ITEMS:
+            raise serializers.ValidationError(
+                f"A batch may contain at most {settings.VERITAS_BATCH_MAX_ITEMS} prompts."
+            )
+        for index, item in enumerate(attrs.get("items") or []):
+            if "knowledge_base" in item:
+                raise serializers.ValidationError(
+                    f"Item {index} sets knowledge_base; set it once for the whole batch."
+                )
+        return attrs
+
+
+class JobSerializer(PromptSerializer):
+    """
+    Serializer for the job input: a generate request plus how to schedule it.
+    """
+
+    # Fields that aren't generate request parameters
+    SCHEDULING_FIELDS = ("priority", "deadline_seconds")
+
+    priority = serializers.IntegerField(
+        required=False,
+        min_value=-10,
+        max_value=10,
+        help_text="Jobs with a higher priority run first (-10 to 10, default 0)",
+    )
+    deadline_seconds = serializers.IntegerField(
+        required=False,
+        min_value=1,
+        help_text="Seconds the job may take before it fails (at most settings.VERITAS_JOB_MAX_DEADLINE_SECONDS)",
+    )
 
 
 class ResponseSerializer(serializers.Serializer):
@@ -54,3 +147,29 @@ class ResponseSerializer(serializers.Serializer):
     total_tokens = serializers.IntegerField(
         help_text="Total number of tokens used", required=False
     )
+    source = serializers.CharField(
+        help_text="Where the answer came from: 'model', 'faq' or 'knowledge_base'",
+        required=False,
+    )
+    confidence = serializers.FloatField(
+        help_text="Match confidence for answers taken from the FAQ", required=False
+    )
+    cached = serializers.BooleanField(
+        help_text="True if the answer was served from the response cache",
+        required=False,
+    )
+    degraded = serializers.BooleanField(
+        help_text="True if the AI service was unavailable and the answer was taken from local knowledge",
+        required=False,
+    )
+    route = serializers.CharField(
+        help_text="The routing decision that picked the model: a VERITAS_ROUTER_RULES route, 'default' or 'requested'",
+        required=False,
+    )
+    route_reason = serializers.CharField(
+        help_text="Why the prompt was routed to the model", required=False
+    )
+    session_id = serializers.UUIDField(
+        help_text="The chat session the answer belongs to; send it with the next prompt",
+        required=False,
+    )
@@ -0,0 +1,329 @@
+"""
+Server-side chat sessions.
+
+A session keeps the turns of one conversation so clients only send the new
+message along with the session id from the previous answer. A client starts
+one with "start_session": true; requests with neither that nor a session id
+are one-off questions and touch no session rows. A new session exists only
+in memory until its first exchange is recorded, which inserts the session
+together with its turns after the answer was given. Each request
+carries the most recent turns that fit VERITAS_SESSION_HISTORY_TOKENS after
+the knowledge base prefix. Once the stored turns outgrow that window, the
+oldest are folded into a running summary (at most
+VERITAS_SESSION_SUMMARY_TOKENS) and deleted, so the prompt and the stored
+rows stay bounded however long the chat runs. The summary is extractive -
+each folded turn keeps the start of the question or the first sentences of
+the answer - so compacting costs no model call.
+
+Sessions expire VERITAS_SESSION_TTL_SECONDS after their last turn. Expired
+sessions are deleted when a worker records an exchange and the last sweep is at
+least VERITAS_SESSION_EVICT_INTERVAL_SECONDS old, or by
+"python manage.py clear_expired_sessions".
+"""
+# sessions.py
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from .models import ChatSession, ChatTurn
+from .stats import StatCounters
+from .text_index import estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+session_stats = StatCounters(
+    "sessions",
+    "created",
+    "resumed",
+    "expired",
+    "turns",
+    "compactions",
+    "compacted_turns",
+    "evicted",
+)
+
+# Words of an answer kept in the summary
+SUMMARY_ANSWER_WORDS = 40
+# Words of a question kept in the summary
+SUMMARY_QUESTION_WORDS = 30
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+_last_eviction = 0.0
+_eviction_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ChatHistory:
+    """
+    What a request sends of its session: the summary of compacted turns and
+    the recent turns as (role, text) pairs, oldest first.
+    """
+
+    summary: str = ""
+    turns: tuple[tuple[str, str], ...] = ()
+
+    def __bool__(self) -> bool:
+        return bool(self.summary or self.turns)
+
+    def digest(self) -> str:
+        """
+        Identifies the history for response cache and coalescing keys; empty
+        for an empty history so first questions share cached answers.
+        """
+        if not self:
+            return ""
+        data = json.dumps([self.summary, self.turns])
+        return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+    def last_user_text(self) -> str:
+        for role, text in reversed(self.turns):
+            if role == ChatTurn.ROLE_USER:
+                return text
+        return ""
+
+
+EMPTY_HISTORY = ChatHistory()
+
+
+def sessions_enabled() -> bool:
+    return getattr(settings, "VERITAS_SESSIONS_ENABLED", True)
+
+
+def _expiry():
+    return timezone.now() + timedelta(seconds=settings.VERITAS_SESSION_TTL_SECONDS)
+
+
+def _window_start(turns: list[ChatTurn], budget: int) -> int:
+    """
+    Index of the first turn of the newest run of turns whose tokens fit
+    the budget. The run starts with a user turn so roles keep alternating.
+    """
+    start, total = len(turns), 0
+    while start > 0 and total + turns[start - 1].tokens <= budget:
+        total += turns[start - 1].tokens
+        start -= 1
+    if start < len(turns) and turns[start].role != ChatTurn.ROLE_USER:
+        start += 1
+    return start
+
+
+def _excerpt(text: str, max_words: int) -> str:
+    """
+    The first sentences of a text, cut at max_words.
+    """
+    words = []
+    for sentence in SENTENCE_END.split(" ".join(text.split())):
+        sentence_words = sentence.split()
+        if words and len(words) + len(sentence_words) > max_words:
+            break
+        words.extend(sentence_words)
+    if len(words) > max_words:
+        return " ".join(words[:max_words]) + " ..."
+    return " ".join(words)
+
+
+def _summary_line(turn: ChatTurn) -> str:
+    if turn.role == ChatTurn.ROLE_USER:
+        return f"User asked: {_excerpt(turn.text, SUMMARY_QUESTION_WORDS)}"
+    return f"Assistant answered: {_excerpt(turn.text, SUMMARY_ANSWER_WORDS)}"
+
+
+def _bounded_summary(lines: list[str]) -> str:
+    """
+    Joins summary lines, dropping the oldest ones beyond
+    VERITAS_SESSION_SUMMARY_TOKENS.
+    """
+    budget = settings.VERITAS_SESSION_SUMMARY_TOKENS
+    kept, total = [], 0
+    for line in reversed(lines):
+        total += estimate_text_tokens(line) + 1
+        if total > budget:
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+
+def _compact(session: ChatSession) -> None:
+    """
+    Folds the turns that no longer fit the history window into the summary
+    and deletes them.
+    """
+    turns = list(session.turns.all())
+    start = _window_start(turns, settings.VERITAS_SESSION_HISTORY_TOKENS)
+    if start == 0:
+        return
+    folded = turns[:start]
+    lines = session.summary.splitlines() if session.summary else []
+    lines.extend(_summary_line(turn) for turn in folded)
+    session.summary = _bounded_summary(lines)
+    session.save(update_fields=["summary", "updated_at"])
+    ChatTurn.objects.filter(id__in=[turn.id for turn in folded]).delete()
+    session_stats.incr("compactions")
+    session_stats.incr("compacted_turns", len(folded))
+
+
+def evict_expired_sessions() -> int:
+    """
+    Deletes expired sessions and their turns.
+
+    Returns:
+        The number of sessions deleted.
+    """
+    _, by_model = ChatSession.objects.filter(expires_at__lte=timezone.now()).delete()
+    count = by_model.get(ChatSession._meta.label, 0)
+    if count:
+        logger.info(f"Evicted {count} expired chat sessions.")
+        session_stats.incr("evicted", count)
+    return count
+
+
+def _maybe_evict() -> None:
+    global _last_eviction
+    with _eviction_lock:
+        now = time.monotonic()
+        interval = settings.VERITAS_SESSION_EVICT_INTERVAL_SECONDS
+        if _last_eviction and now - _last_eviction < interval:
+            return
+        _last_eviction = now
+    try:
+        evict_expired_sessions()
+    except Exception as e:
+        logger.error(f"Failed to evict expired chat sessions: {e}")
+
+
+def load_session(
+    session_id: uuid.UUID | None, start: bool = False
+) -> tuple[ChatSession | None, ChatHistory]:
+    """
+    Opens the session a request continues, or a new one if it asks to start
+    one or its session expired. A new session isn't saved until
+    record_exchange; loading one never writes to the database.
+
+    Args:
+        session_id: The session id sent by the client, if any.
+        start: Whether the client asked to start a session.
+
+    Returns:
+        The session (None if sessions are disabled or the request is a
+        one-off question) and the history to send with the prompt.
+    """
+    if not sessions_enabled() or (session_id is None and not start):
+        return None, EMPTY_HISTORY
+    if session_id is not None:
+        try:
+            session = ChatSession.objects.filter(id=session_id).first()
+        except DatabaseError as e:
+            # Answer without the earlier turns rather than fail the request
+            logger.error(f"Failed to load chat session {session_id}: {e}")
+            return ChatSession(expires_at=_expiry()), EMPTY_HISTORY
+        if session is not None and session.expires_at > timezone.now():
+            try:
+                history = session_history(session)
+            except DatabaseError as e:
+                logger.error(f"Failed to load the turns of chat session {session_id}: {e}")
+                history = EMPTY_HISTORY
+            session_stats.incr("resumed")
+            return session, history
+        session_stats.incr("expired")
+        logger.info(f"Chat session {session_id} is unknown or expired, starting a new one.")
+    return ChatSession(expires_at=_expiry()), EMPTY_HISTORY
+
+
+async def aload_session(
+    session_id: uuid.UUID | None, start: bool = False
+) -> tuple[ChatSession | None, ChatHistory]:
+    """
+    Async version of load_session.
+    """
+    if session_id is None:
+        # Nothing to look up
+        return load_session(session_id, start)
+    if not sessions_enabled():
+        return None, EMPTY_HISTORY
+    return await sync_to_async(load_session)(session_id, start)
+
+
+def session_history(session: ChatSession) -> ChatHistory:
+    """
+    The summary and the newest turns of a session that fit
+    VERITAS_SESSION_HISTORY_TOKENS.
+    """
+    turns = list(session.turns.all())
+    start = _window_start(turns, settings.VERITAS_SESSION_HISTORY_TOKENS)
+    return ChatHistory(
+        summary=session.summary,
+        turns=tuple((turn.role, turn.text) for turn in turns[start:]),
+    )
+
+
+def record_exchange(session: ChatSession | None, prompt: str, answer: str) -> None:
+    """
+    Adds a question and its answer to a session, extends its lifetime and
+    compacts the history if it outgrew the window. A new session is inserted
+    in the same transaction. Does nothing without a session or answer.
+    """
+    if session is None or not answer:
+        return
+    _maybe_evict()
+    created = session._state.adding
+    try:
+        with transaction.atomic():
+            session.expires_at = _expiry()
+            if created:
+                session.save(force_insert=True)
+            else:
+                session.save(update_fields=["expires_at", "updated_at"])
+            ChatTurn.objects.bulk_create(
+                [
+                    ChatTurn(
+                        session=session,
+                        role=role,
+                        text=text,
+                        tokens=estimate_text_tokens(text),
+                    )
+                    for role, text in (
+                        (ChatTurn.ROLE_USER, prompt),
+                        (ChatTurn.ROLE_MODEL, answer.strip()),
+                    )
+                ]
+            )
+            _compact(session)
+    except Exception as e:
+        # The answer was already given; only the follow-up context is lost
+        session._state.adding = created
+        logger.error(f"Failed to record the exchange in chat session {session.id}: {e}")
+        return
+    if created:
+        session_stats.incr("created")
+    session_stats.incr("turns", 2)
+
+
+async def arecord_exchange(session: ChatSession | None, prompt: str, answer: str) -> None:
+    """
+    Async version of record_exchange.
+    """
+    if session is None or not answer:
+        return
+    await sync_to_async(record_exchange)(session, prompt, answer)
+
+
+def reset_sessions() -> None:
+    """
+    Forgets the last eviction time and resets the counters (for tests).
+    """
+    global _last_eviction
+    with _eviction_lock:
+        _last_eviction = 0.0
+    session_stats.reset()
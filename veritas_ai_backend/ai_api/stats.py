@@ -0,0 +1,125 @@
+"""
+In-process counters and latency windows shared by the AI API components.
+"""
+# stats.py
+
+import math
+import threading
+from collections import deque
+
+# Every StatCounters and LatencyWindows instance registers itself here so the stats endpoint
+# can report all components without importing each one explicitly.
+_registry: dict[str, "StatCounters | LatencyWindows"] = {}
+_registry_lock = threading.Lock()
+
+
+def register(source) -> None:
+    """
+    Adds a component to the stats endpoint: any object with a `component`
+    name and a `snapshot()` method.
+    """
+    with _registry_lock:
+        _registry[source.component] = source
+
+
+class StatCounters:
+    """
+    A named group of thread-safe integer counters for one component.
+    """
+
+    def __init__(self, component: str, *names: str):
+        self.component = component
+        self._names = names
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(names, 0)
+        register(self)
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        """
+        Increments a counter, creating it on first use.
+        """
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + amount
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return self._values.get(name, 0)
+
+    def snapshot(self) -> dict[str, int]:
+        """
+        Returns a copy of the current counter values.
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values = dict.fromkeys(self._names, 0)
+
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    """
+    Nearest-rank percentile, e.g. fraction=0.95 for p95.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+class LatencyWindows:
+    """
+    Rolling windows of the most recent latencies (in milliseconds) for one
+    component, one window per name (for example per model).
+    """
+
+    def __init__(self, component: str, size: int = 500):
+        self.component = component
+        self.size = size
+        self._lock = threading.Lock()
+        self._windows: dict[str, deque] = {}
+        register(self)
+
+    def observe(self, name: str, milliseconds: float) -> None:
+        with self._lock:
+            window = self._windows.get(name)
+            if window is None:
+                window = self._windows[name] = deque(maxlen=self.size)
+            window.append(milliseconds)
+
+    def values(self, name: str) -> list[float]:
+        with self._lock:
+            return list(self._windows.get(name, ()))
+
+    def percentile(self, name: str, fraction: float) -> float | None:
+        return percentile(self.values(name), fraction)
+
+    def snapshot(self) -> dict[str, dict]:
+        """
+        Returns the sample count and p50/p95/p99 of every window.
+        """
+        with self._lock:
+            windows = {name: list(window) for name, window in self._windows.items()}
+        return {
+            name: {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50), 2),
+                "p95_ms": round(percentile(values, 0.95), 2),
+                "p99_ms": round(percentile(values, 0.99), 2),
+            }
+            for name, values in windows.items()
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._windows.clear()
+
+
+def snapshot_all() -> dict[str, dict[str, int]]:
+    """
+    Returns the counters and latency windows of every registered component,
+    keyed by component.
+    """
+    with _registry_lock:
+        registered = list(_registry.values())
+    return {counters.component: counters.snapshot() for counters in registered}
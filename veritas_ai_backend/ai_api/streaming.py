@@ -0,0 +1,86 @@
+"""
+Server-sent events (SSE) support for the generate endpoints.
+
+Clients that send ``Accept: text/event-stream`` receive the generation as it
+arrives instead of waiting for the full answer:
+
+    event: chunk
+    data: {"text": "..."}
+
+    event: done
+    data: {"model": "...", "finish_reason": "STOP", "prompt_tokens": 10, ...}
+
+Errors are delivered in-band as ``event: error`` with the same payload the
+JSON endpoints return.
+"""
+# streaming.py
+
+import json
+
+from django.http import HttpResponse, StreamingHttpResponse
+from rest_framework.renderers import BaseRenderer
+
+EVENT_STREAM_CONTENT_TYPE = "text/event-stream"
+
+
+def format_sse_event(event: str, data: dict) -> str:
+    """
+    Formats one server-sent event.
+
+    Args:
+        event: The event name (chunk, done or error).
+        data: The JSON-serializable payload.
+
+    Returns:
+        The encoded event, terminated by a blank line.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def wants_event_stream(request) -> bool:
+    """
+    Returns True if the client asked for a server-sent event stream.
+    """
+    return EVENT_STREAM_CONTENT_TYPE in request.headers.get("Accept", "")
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Renders non-streamed responses (validation and upstream errors) as a
+    single SSE error event, so event-stream clients never get JSON bodies.
+    """
+
+    media_type = EVENT_STREAM_CONTENT_TYPE
+    format = "sse"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return format_sse_event("error", data).encode(self.charset)
+
+
+def event_stream_error_response(
+    payload: dict, status_code: int, headers: dict | None = None
+) -> HttpResponse:
+    """
+    Error response for event-stream clients outside DRF (the async view).
+    """
+    return HttpResponse(
+        format_sse_event("error", payload),
+        status=status_code,
+        content_type=EVENT_STREAM_CONTENT_TYPE,
+        headers=headers,
+    )
+
+
+def event_stream_response(events) -> StreamingHttpResponse:
+    """
+    Wraps an iterator (or async iterator) of encoded events in a streaming
+    response with proxy buffering disabled.
+    """
+    response = StreamingHttpResponse(events, content_type=EVENT_STREAM_CONTENT_TYPE)
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx and similar proxies from buffering the stream.
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -1,3 +1,2704 @@
-from django.test import TestCase
+import asyncio
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DatabaseError, connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from google import genai
+from google.genai import errors as genai_errors
+from google.genai._api_client import BaseApiClient
+
+from .admission import admission_stats, reset_admission
+from .benchmark import FakeGenaiClient, ReplayItem, evaluate_routing, replay, token_f1
+from .budgets import _window_key, budget_stats, trim_text
+from .coalescing import (
+    _shared_cache,
+    _shared_lock_key,
+    coalesce_stats,
+    coalesced_events,
+    reset_coalescing,
+)
+from .cancellation import (
+    RequestDeadlineExceeded,
+    cancellation_stats,
+    request_deadline,
+    reset_cancellation,
+)
+from .client_provider import (
+    PooledApiClient,
+    get_genai_client,
+    reset_genai_client,
+    use_genai_client,
+)
+from .context_cache import context_cache_stats, reset_context_cache
+from .dispatch import dispatch_stats, first_chunk_latency, reset_dispatch
+from .faq import (
+    FaqMatcher,
+    answer_from_faq,
+    faq_stats,
+    get_faq_matcher,
+    load_faq_entries,
+    reload_faq_matcher,
+)
+from .file_registry import (
+    get_file_handle,
+    invalidate_file_handle,
+    registry_stats,
+    reset_file_registry,
+)
+from .ai_helpers import (
+    VERITAS_MODEL_PREAMBLE_TEXT,
+    knowledge_base_version,
+    model_preamble,
+    prompt_template,
+)
+from .ingest import ingest_knowledge_base
+from .jobs import (
+    JobProgress,
+    claim_job,
+    job_stats,
+    reset_jobs,
+    run_job,
+    run_next_job,
+    sweep_jobs,
+)
+from .knowledge_bases import (
+    USAGE_KEY_PREFIX,
+    get_knowledge_base,
+    knowledge_base_stats,
+    most_used_knowledge_bases,
+    reset_knowledge_bases,
+    resident,
+    resident_states,
+)
+from .knowledge_store import get_knowledge_store, knowledge_store_stats, reset_knowledge_store
+from .metrics import flush, reset_metrics
+from .models import (
+    CachedContextHandle,
+    ChatSession,
+    ChatTurn,
+    GenerationJob,
+    UploadedFileHandle,
+)
+from .prompts import VERITAS_SYSTEM_INSTRUCTION_TEXT, reset_prompt_templates
+from .resilience import circuit_breakers, reset_resilience, resilience_stats
+from .response_cache import cache_stats, clear_memory_cache
+from .retrieval import (
+    build_passage_index,
+    get_passage_index,
+    reset_passage_indexes,
+    retrieval_stats,
+    split_passages,
+)
+from .routing import question_type, routing_stats
+from .sessions import reset_sessions, session_stats
+from .stats import percentile
+from .text_index import estimate_text_tokens
+from .views import VERITAS_DATA_FILE_PATH
+from .warmup import reset_warmup, run_warmup, serves_requests
+
+
+def fake_uploaded_file(number, lifetime):
+    return SimpleNamespace(
+        name=f"files/test-{number}",
+        uri=f"https://example.invalid/files/test-{number}",
+        mime_type="application/pdf",
+        expiration_time=timezone.now() + lifetime,
+    )
+
+
+def fake_chunk(text, finish_reason=None, usage=None):
+    return SimpleNamespace(
+        text=text,
+        prompt_feedback=None,
+        candidates=[SimpleNamespace(finish_reason=finish_reason)],
+        usage_metadata=usage,
+    )
+
+
+def fake_stream(chunks):
+    """
+    Yields fake chunks for the given texts; the last one carries the finish
+    reason and usage. Exception instances are raised when reached.
+    """
+    for index, item in enumerate(chunks):
+        if isinstance(item, Exception):
+            raise item
+        if index == len(chunks) - 1:
+            yield fake_chunk(
+                item,
+                finish_reason="STOP",
+                usage=SimpleNamespace(
+                    prompt_token_count=12,
+                    candidates_token_count=len(chunks),
+                    total_token_count=12 + len(chunks),
+                ),
+            )
+        else:
+            yield fake_chunk(item)
+
+
+class FakeFiles:
+    def __init__(self, lifetime=timedelta(hours=48)):
+        self.uploads = 0
+        self.lifetime = lifetime
+
+    def upload(self, file):
+        self.uploads += 1
+        return fake_uploaded_file(self.uploads, self.lifetime)
+
+
+class FakeModels:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.calls = []
+
+    def generate_content_stream(self, model, contents, config):
+        self.calls.append((model, contents, config))
+        return fake_stream(self.chunks)
+
+
+class FakeAsyncFiles:
+    def __init__(self, files):
+        self.files = files
+
+    async def upload(self, file):
+        return self.files.upload(file=file)
+
+
+class FakeAsyncModels:
+    def __init__(self, models, delay):
+        self.models = models
+        self.delay = delay
+
+    async def generate_content_stream(self, model, contents, config):
+        self.models.calls.append((model, contents, config))
+        await asyncio.sleep(self.delay)
+
+        async def stream():
+            for chunk in fake_stream(self.models.chunks):
+                yield chunk
+
+        return stream()
+
+
+def client_error(code, message):
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({"error": {"code": code, "message": message}}).encode()
+    return genai_errors.ClientError(code, response)
+
+
+def server_error(code, message):
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({"error": {"code": code, "message": message}}).encode()
+    return genai_errors.ServerError(code, response)
+
+
+class FlakyModels(FakeModels):
+    """
+    Fake models failing the first calls with the given errors.
+    """
+
+    def __init__(self, errors, chunks=("Hello", " there")):
+        super().__init__(list(chunks))
+        self.errors = list(errors)
+
+    def generate_content_stream(self, model, contents, config):
+        self.calls.append((model, contents, config))
+        if self.errors:
+            raise self.errors.pop(0)
+        return fake_stream(self.chunks)
+
+
+class FakeCaches:
+    def __init__(self, supported=True):
+        self.supported = supported
+        self.created = []
+        self.updated = []
+
+    def create(self, model, config):
+        if not self.supported:
+            raise client_error(400, "Model does not support cached content")
+        self.created.append(config)
+        return SimpleNamespace(
+            name=f"cachedContents/test-{len(self.created)}",
+            expire_time=timezone.now() + timedelta(hours=1),
+        )
+
+    def update(self, name, config):
+        self.updated.append(name)
+        return SimpleNamespace(name=name, expire_time=timezone.now() + timedelta(hours=1))
+
+
+class FakeClient:
+    """
+    Stand-in for genai.Client with the surface used by the views.
+    """
+
+    def __init__(
+        self, chunks=("Hello", " there"), delay=0.0, caching=True, **files_kwargs
+    ):
+        self.files = FakeFiles(**files_kwargs)
+        self.models = FakeModels(list(chunks))
+        self.caches = FakeCaches(supported=caching)
+        self.aio = SimpleNamespace(
+            files=FakeAsyncFiles(self.files),
+            models=FakeAsyncModels(self.models, delay),
+        )
+
+
+class PerModelModels:
+    """
+    Fake models whose answer depends on the model: behaviours maps a model
+    name to (first chunk delay in seconds, chunks), or to an exception.
+    """
+
+    def __init__(self, behaviours):
+        self.behaviours = behaviours
+        self.calls = []
+
+    def _behaviour(self, model):
+        self.calls.append(model)
+        behaviour = self.behaviours[model]
+        if isinstance(behaviour, Exception):
+            raise behaviour
+        return behaviour
+
+    def generate_content_stream(self, model, contents, config):
+        delay, chunks = self._behaviour(model)
+
+        def stream():
+            time.sleep(delay)
+            yield from fake_stream(chunks)
+
+        return stream()
+
+
+class PerModelAsyncModels:
+    def __init__(self, models):
+        self.models = models
+
+    async def generate_content_stream(self, model, contents, config):
+        delay, chunks = self.models._behaviour(model)
+        await asyncio.sleep(delay)
+
+        async def stream():
+            for chunk in fake_stream(chunks):
+                yield chunk
+
+        return stream()
+
+
+class FileRegistryTests(TestCase):
+    def setUp(self):
+        reset_file_registry()
+        handle, self.file_path = tempfile.mkstemp(suffix=".pdf")
+        os.write(handle, b"%PDF-1.4 veritas")
+        os.close(handle)
+        self.addCleanup(os.remove, self.file_path)
+
+    def test_reuses_handle_across_requests(self):
+        client = FakeClient()
+        first = get_file_handle(client, self.file_path)
+        second = get_file_handle(client, self.file_path)
+
+        self.assertEqual(first, second)
+        self.assertEqual(client.files.uploads, 1)
+        self.assertEqual(registry_stats.get("hits"), 1)
+        self.assertEqual(registry_stats.get("misses"), 1)
+
+    def test_handle_is_shared_through_the_database(self):
+        get_file_handle(FakeClient(), self.file_path)
+        reset_file_registry()  # simulate another worker
+
+        client = FakeClient()
+        get_file_handle(client, self.file_path)
+        self.assertEqual(client.files.uploads, 0)
+
+    def test_reuploads_when_file_changes(self):
+        client = FakeClient()
+        get_file_handle(client, self.file_path)
+        with open(self.file_path, "ab") as data_file:
+            data_file.write(b" updated")
+        os.utime(self.file_path, ns=(0, 10**18))
+
+        get_file_handle(client, self.file_path)
+        self.assertEqual(client.files.uploads, 2)
+        self.assertEqual(UploadedFileHandle.objects.count(), 2)
+
+    def test_reuploads_when_handle_expires(self):
+        client = FakeClient(lifetime=timedelta(minutes=1))
+        get_file_handle(client, self.file_path)
+        get_file_handle(client, self.file_path)
+        self.assertEqual(client.files.uploads, 2)
+
+    def test_invalidated_handle_is_uploaded_again(self):
+        client = FakeClient()
+        get_file_handle(client, self.file_path)
+        invalidate_file_handle(self.file_path)
+        get_file_handle(client, self.file_path)
+        self.assertEqual(client.files.uploads, 2)
+
+    def test_waits_for_upload_lease_held_by_another_worker(self):
+        client = FakeClient()
+        content_hash = get_file_handle(client, self.file_path).content_hash
+        reset_file_registry()
+        UploadedFileHandle.objects.filter(content_hash=content_hash).update(
+            uri="",
+            lock_owner="other-worker",
+            lock_expires_at=timezone.now() + timedelta(seconds=30),
+        )
+
+        with self.settings(
+            VERITAS_FILE_UPLOAD_LOCK_TIMEOUT_SECONDS=0,
+            VERITAS_FILE_UPLOAD_POLL_SECONDS=0,
+        ):
+            get_file_handle(client, self.file_path)
+        self.assertEqual(registry_stats.get("lock_waits"), 1)
+        self.assertEqual(client.files.uploads, 2)
+
+
+class ClientProviderTests(TestCase):
+    def setUp(self):
+        reset_genai_client()
+        self.addCleanup(reset_genai_client)
+
+    def test_client_is_built_once_per_process(self):
+        first = get_genai_client()
+        second = get_genai_client()
+        self.assertIs(first, second)
+        self.assertIs(first._api_client._session, second._api_client._session)
+
+    def test_client_is_rebuilt_when_api_key_changes(self):
+        first = get_genai_client()
+        with self.settings(GOOGLE_AI_API_KEY="another-key"):
+            second = get_genai_client()
+        self.assertIsNot(first, second)
+        self.assertEqual(second._api_client.api_key, "another-key")
+
+    def test_requests_reuse_the_pooled_session(self):
+        client = get_genai_client()
+        session = client._api_client._session
+        calls = []
+
+        def fake_request(**kwargs):
+            calls.append(kwargs["url"])
+            response = requests.Response()
+            response.status_code = 200
+            response._content = b"{}"
+            return response
+
+        session.request = fake_request
+        client.models.count_tokens(model="gemini-2.0-flash", contents="hello")
+        client.models.count_tokens(model="gemini-2.0-flash", contents="again")
+        self.assertEqual(len(calls), 2)
+        self.assertIs(client._api_client._session, session)
+
+    def test_overridden_genai_internals_still_exist(self):
+        # PooledApiClient replaces private google-genai methods; an upgrade
+        # that renames them would silently bypass the pools.
+        overridden = {
+            "_request_unauthorized": ["self", "http_request", "stream"],
+            "_async_request": ["self", "http_request", "stream"],
+            "_build_request": ["self", "http_method", "path", "request_dict", "http_options"],
+            "_request": ["self", "http_request", "stream"],
+            "request_streamed": ["self", "http_method", "path", "request_dict", "http_options"],
+            "async_request_streamed": [
+                "self", "http_method", "path", "request_dict", "http_options"
+            ],
+        }
+        for name, parameters in overridden.items():
+            with self.subTest(name=name):
+                method = getattr(BaseApiClient, name, None)
+                self.assertIsNotNone(method)
+                self.assertEqual(list(inspect.signature(method).parameters), parameters)
+        self.assertTrue(hasattr(genai.Client, "_get_api_client"))
+        self.assertIsInstance(get_genai_client()._api_client, PooledApiClient)
+
+
+@override_settings(VERITAS_ROUTER_ENABLED=False)
+class ViewTestCase(TestCase):
+    """
+    Resets the process-local state the generate views keep between requests.
+    Prompts go to VERITAS_AI_MODEL unless a test turns routing on.
+    """
+
+    def setUp(self):
+        reset_file_registry()
+        reset_context_cache()
+        reset_coalescing()
+        reset_dispatch()
+        clear_memory_cache()
+        cache_stats.reset()
+        budget_stats.reset()
+        reset_metrics()
+        reset_sessions()
+        reset_admission()
+        reset_resilience()
+        routing_stats.reset()
+
+
+class GenerateTextViewTests(ViewTestCase):
+
+    @override_settings(VERITAS_CONTEXT_MODE="full")
+    def test_generates_response_with_uploaded_data_file(self):
+        client = FakeClient(chunks=["Monday, ", "October 7th"])
+        with use_genai_client(client):
+            first = self.client.post(
+                reverse("generate-text"),
+                {"prompt": "When do 100-level students resume?"},
+                content_type="application/json",
+            )
+            self.client.post(
+                reverse("generate-text"),
+                {"prompt": "And returning students?"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()["response"], "Monday, October 7th")
+        self.assertEqual(client.files.uploads, 1)
+        self.assertEqual(len(client.models.calls), 2)
+
+    def test_invalid_input_is_rejected(self):
+        response = self.client.post(
+            reverse("generate-text"), {"temperature": 3}, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error"], "Invalid input")
+
+
+class AsyncGenerateTextViewTests(ViewTestCase):
+
+    async def test_response_matches_sync_view_shape(self):
+        with use_genai_client(FakeClient(chunks=["Veritas ", "University"])):
+            response = await self.async_client.post(
+                reverse("generate-text-async"),
+                {"prompt": "What is the name of the school?", "model": "m"},
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json(),
+            {
+                "response": "Veritas University",
+                "model": "m",
+                "source": "model",
+                "prompt_tokens": 12,
+                "completion_tokens": 2,
+                "total_tokens": 14,
+                "route": "requested",
+                "route_reason": "model requested by the client",
+            },
+        )
+
+    async def test_invalid_input_is_rejected(self):
+        response = await self.async_client.post(
+            reverse("generate-text-async"),
+            {"prompt": "hi", "top_p": 2},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("top_p", response.json()["details"])
+
+    # Measures the view alone, without admission control capping the calls
+    @override_settings(VERITAS_CONTEXT_MODE="full", VERITAS_ADMISSION_ENABLED=False)
+    async def test_serves_concurrent_requests_against_slow_upstream(self):
+        upstream_delay = 0.2
+        request_count = 50
+        client = FakeClient(delay=upstream_delay)
+
+        async def ask(number):
+            return await self.async_client.post(
+                reverse("generate-text-async"),
+                {"prompt": f"Question {number}"},
+                content_type="application/json",
+            )
+
+        with use_genai_client(client):
+            started = time.monotonic()
+            responses = await asyncio.gather(*(ask(n) for n in range(request_count)))
+            elapsed = time.monotonic() - started
+
+        self.assertTrue(all(r.status_code == 200 for r in responses))
+        self.assertEqual(len(client.models.calls), request_count)
+        self.assertEqual(client.files.uploads, 1)
+        # Serially this would take request_count * upstream_delay (10s).
+        self.assertLess(elapsed, request_count * upstream_delay / 4)
+
+
+class RetrievalTests(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        retrieval_stats.reset()
+
+    def test_passages_overlap(self):
+        words = " ".join(str(n) for n in range(10))
+        passages = split_passages(words, "page 1", passage_words=4, overlap_words=1)
+        self.assertEqual(
+            [passage.text for passage in passages], ["0 1 2 3", "3 4 5 6", "6 7 8 9"]
+        )
+
+    def test_sends_relevant_passages_instead_of_the_file(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            response = self.client.post(
+                reverse("generate-text"),
+                {"prompt": "When do returning students resume?"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(client.files.uploads, 0)
+        contents = client.models.calls[0][1]
+        self.assertEqual(len(contents), 1)
+        context, prompt = contents[0].parts
+        self.assertIn("resumption", context.text.lower())
+        self.assertEqual(prompt.text, "When do returning students resume?")
+        self.assertEqual(retrieval_stats.get("retrieved"), 1)
+
+    def test_falls_back_to_full_file_without_relevant_passages(self):
+        client = FakeClient(caching=False)
+        with use_genai_client(client):
+            self.client.post(
+                reverse("generate-text"),
+                {"prompt": "Hello"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(client.files.uploads, 1)
+        self.assertEqual(len(client.models.calls[0][1]), 3)
+        self.assertEqual(retrieval_stats.get("fallbacks"), 1)
+
+    def test_context_mode_is_part_of_the_knowledge_base_version(self):
+        retrieval_version = knowledge_base_version(VERITAS_DATA_FILE_PATH)
+        with self.settings(VERITAS_CONTEXT_MODE="full"):
+            full_version = knowledge_base_version(VERITAS_DATA_FILE_PATH)
+        self.assertNotEqual(retrieval_version, full_version)
+
+
+@override_settings(VERITAS_CONTEXT_MODE="full")
+class ContextCacheTests(ViewTestCase):
+
+    def ask(self, prompt="When do returning students resume?"):
+        return self.client.post(
+            reverse("generate-text"), {"prompt": prompt}, content_type="application/json"
+        )
+
+    def test_prefix_is_cached_once_and_referenced_by_name(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.ask()
+            reset_context_cache()  # simulate another worker
+            self.ask("And fresh students?")
+
+        self.assertEqual(len(client.caches.created), 1)
+        self.assertEqual(client.files.uploads, 1)
+        created = client.caches.created[0]
+        self.assertEqual(len(created.contents), 2)
+        self.assertIsNotNone(created.system_instruction)
+        for _, contents, config in client.models.calls:
+            self.assertEqual(len(contents), 1)
+            self.assertEqual(config.cached_content, "cachedContents/test-1")
+        self.assertEqual(context_cache_stats.get("uncached_prompt_tokens"), 12)
+
+    def test_ttl_is_extended_before_expiry(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.ask()
+            reset_context_cache()
+            CachedContextHandle.objects.update(
+                expires_at=timezone.now() + timedelta(seconds=30)
+            )
+            self.ask("And fresh students?")
+
+        self.assertEqual(client.caches.updated, ["cachedContents/test-1"])
+        self.assertEqual(len(client.caches.created), 1)
+
+    def test_unsupported_model_falls_back_to_inline_prefix(self):
+        client = FakeClient(caching=False)
+        with use_genai_client(client):
+            self.ask()
+            self.ask("And fresh students?")
+
+        self.assertEqual(context_cache_stats.get("unsupported"), 1)
+        for _, contents, config in client.models.calls:
+            self.assertEqual(len(contents), 3)
+            self.assertIsNone(config.cached_content)
+
+    def test_rejected_cache_is_recreated(self):
+        client = FakeClient()
+        client.models.chunks = [client_error(404, "Cached content not found")]
+        with use_genai_client(client):
+            original_stream = client.models.generate_content_stream
+
+            def recover_after_first_call(model, contents, config):
+                stream = original_stream(model, contents, config)
+                client.models.chunks = ["Saturday"]
+                return stream
+
+            client.models.generate_content_stream = recover_after_first_call
+            response = self.ask()
+
+        self.assertEqual(response.json()["response"], "Saturday")
+        self.assertEqual(context_cache_stats.get("invalidations"), 1)
+        self.assertEqual(len(client.caches.created), 2)
+        self.assertEqual(client.models.calls[-1][2].cached_content, "cachedContents/test-2")
+
+
+TEMPLATES = {
+    "v1": {},
+    "v2": {
+        "system_instruction": "Answer in one sentence.",
+        "inline_system_instruction": True,
+        "few_shot": [["Who won the 1990 World Cup?", "I don't have that specific information."]],
+    },
+}
+
+
+@override_settings(VERITAS_CONTEXT_MODE="full", VERITAS_PROMPT_TEMPLATES=TEMPLATES)
+class PromptTemplateTests(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_prompt_templates()
+
+    def ask(self, prompt="When do returning students resume?"):
+        return self.client.post(
+            reverse("generate-text"), {"prompt": prompt}, content_type="application/json"
+        )
+
+    @override_settings(VERITAS_CONTEXT_CACHE_ENABLED=False)
+    def test_fixed_parts_are_compiled_once_and_shared(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.ask()
+            self.ask("And fresh students?")
+
+        self.assertIs(prompt_template(), prompt_template())
+        (_, first, _), (_, second, _) = client.models.calls
+        self.assertIs(first[0], second[0])
+        self.assertIs(first[1], second[1])
+        self.assertIs(first[1], prompt_template().preamble_content)
+        self.assertEqual(content_texts(second[2:]), [("user", ["And fresh students?"])])
+        self.assertIsNone(client.models.calls[1][2].system_instruction)
+        self.assertEqual(
+            prompt_template().known_tokens(first[1]),
+            estimate_text_tokens(model_preamble()),
+        )
+
+    @override_settings(VERITAS_CONTEXT_CACHE_ENABLED=False, VERITAS_PROMPT_TEMPLATE="v2")
+    def test_selected_version_adds_its_few_shot_turns_and_system_instruction(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.ask()
+
+        _, contents, config = client.models.calls[0]
+        self.assertEqual(
+            content_texts(contents[2:]),
+            [
+                ("user", ["Who won the 1990 World Cup?"]),
+                ("model", ["I don't have that specific information."]),
+                ("user", ["When do returning students resume?"]),
+            ],
+        )
+        self.assertEqual(config.system_instruction, "Answer in one sentence.")
+        self.assertIn('veritas_prompt_template_requests_total{template="v2"} 1', self.metrics())
+
+    def test_cached_context_holds_the_few_shot_turns(self):
+        client = FakeClient()
+        with use_genai_client(client), self.settings(VERITAS_PROMPT_TEMPLATE="v2"):
+            self.ask()
+
+        created = client.caches.created[0]
+        self.assertEqual(len(created.contents), 4)
+        self.assertEqual(created.system_instruction, "Answer in one sentence.")
+        _, contents, config = client.models.calls[0]
+        self.assertEqual(content_texts(contents), [("user", ["When do returning students resume?"])])
+        self.assertIsNone(config.system_instruction)
+
+    def test_version_is_part_of_cache_keys(self):
+        v1 = knowledge_base_version(VERITAS_DATA_FILE_PATH)
+        with self.settings(VERITAS_PROMPT_TEMPLATE="v2"):
+            v2 = knowledge_base_version(VERITAS_DATA_FILE_PATH)
+        self.assertNotEqual(v1, v2)
+
+        client = FakeClient()
+        with use_genai_client(client):
+            self.ask()
+            with self.settings(VERITAS_PROMPT_TEMPLATE="v2"):
+                self.ask()
+            self.ask()
+        self.assertEqual(len(client.models.calls), 2)
+        self.assertEqual(len(client.caches.created), 2)
+
+    def test_invalid_template_uses_the_built_in_texts(self):
+        with self.settings(VERITAS_PROMPT_TEMPLATES={"v3": {"few_shots": []}}), self.assertLogs(
+            "ai_api.prompts", "ERROR"
+        ):
+            template = prompt_template("v3")
+
+        self.assertEqual(template.version, "v3")
+        self.assertEqual(template.system_instruction, VERITAS_SYSTEM_INSTRUCTION_TEXT)
+        self.assertEqual(template.few_shot_contents, ())
+
+    def metrics(self):
+        return self.client.get(reverse("metrics")).content.decode()
+
+
+class CoalescingTests(ViewTestCase):
+
+    def blocking_producer(self, release):
+        calls = []
+
+        def produce():
+            calls.append(1)
+            yield "chunk", {"text": "Monday"}
+            release.wait(5)
+            yield "done", {"model": "m", "finish_reason": "STOP"}
+
+        return produce, calls
+
+    def test_follower_receives_the_leaders_events(self):
+        release = threading.Event()
+        produce, calls = self.blocking_producer(release)
+        leader = coalesced_events("key", produce)
+        self.assertEqual(next(leader), ("chunk", {"text": "Monday"}))
+
+        followed = []
+        follower = threading.Thread(
+            target=lambda: followed.extend(coalesced_events("key", produce))
+        )
+        follower.start()
+        release.set()
+        rest = list(leader)
+        follower.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(rest, [("done", {"model": "m", "finish_reason": "STOP"})])
+        self.assertEqual(
+            followed,
+            [
+                ("chunk", {"text": "Monday"}),
+                ("done", {"model": "m", "finish_reason": "STOP", "coalesced": True}),
+            ],
+        )
+        self.assertEqual(coalesce_stats.get("saved_calls"), 1)
+
+    def test_follower_generates_itself_when_leader_stalls(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def stalled():
+            release.wait(5)
+            yield "done", {}
+
+        leader = coalesced_events("key", stalled)
+        threading.Thread(target=lambda: list(leader), daemon=True).start()
+        time.sleep(0.05)
+
+        with self.settings(VERITAS_COALESCE_WAIT_SECONDS=0.05):
+            events = list(coalesced_events("key", lambda: iter([("done", {"own": True})])))
+
+        self.assertEqual(events, [("done", {"own": True})])
+        self.assertEqual(coalesce_stats.get("follower_fallbacks"), 1)
+
+    @override_settings(VERITAS_COALESCE_WAIT_SECONDS=5)
+    def test_follower_stops_waiting_at_its_deadline(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def stalled():
+            release.wait(5)
+            yield "done", {}
+
+        leader = coalesced_events("key", stalled)
+        threading.Thread(target=lambda: list(leader), daemon=True).start()
+        time.sleep(0.05)
+        produced = []
+
+        started = time.monotonic()
+        with self.assertRaises(RequestDeadlineExceeded):
+            list(coalesced_events("key", lambda: produced.append(1), time.monotonic() + 0.1))
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(produced, [])
+        self.assertEqual(coalesce_stats.get("follower_fallbacks"), 0)
+
+    @override_settings(
+        VERITAS_COALESCE_SHARED=True,
+        VERITAS_COALESCE_WAIT_SECONDS=5,
+        VERITAS_COALESCE_POLL_SECONDS=0.01,
+    )
+    def test_shared_wait_stops_at_the_deadline(self):
+        _shared_cache().set(_shared_lock_key("key"), "other-worker")
+        produced = []
+
+        started = time.monotonic()
+        with self.assertRaises(RequestDeadlineExceeded):
+            list(coalesced_events("key", lambda: produced.append(1), time.monotonic() + 0.1))
+
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(produced, [])
+
+    @override_settings(VERITAS_COALESCE_SHARED=True, VERITAS_COALESCE_POLL_SECONDS=0)
+    def test_waits_for_answer_generated_by_another_worker(self):
+        cache = _shared_cache()
+        cache.set(_shared_lock_key("key"), "other-worker")
+        cache.set("key", {"response": "Saturday", "model": "m", "source": "model"})
+
+        events = list(coalesced_events("key", lambda: iter(())))
+
+        self.assertEqual(events[0], ("chunk", {"text": "Saturday"}))
+        self.assertTrue(events[1][1]["coalesced"])
+        self.assertEqual(coalesce_stats.get("shared_hits"), 1)
+
+    # One client sending the burst would be rate limited
+    @override_settings(VERITAS_RATE_LIMIT_PER_MINUTE=None)
+    async def test_identical_concurrent_prompts_share_one_upstream_call(self):
+        client = FakeClient(chunks=["Monday, ", "October 7th"], delay=0.1)
+
+        async def ask():
+            return await self.async_client.post(
+                reverse("generate-text-async"),
+                {"prompt": "When do 100-level students resume?"},
+                content_type="application/json",
+            )
+
+        with use_genai_client(client):
+            responses = await asyncio.gather(*(ask() for _ in range(20)))
+
+        self.assertEqual(
+            {r.json()["response"] for r in responses}, {"Monday, October 7th"}
+        )
+        self.assertEqual(len(client.models.calls), 1)
+        self.assertEqual(coalesce_stats.get("saved_calls"), 19)
+
+
+class BatchGenerateTests(ViewTestCase):
+
+    async def post_batch(self, payload, **headers):
+        return await self.async_client.post(
+            reverse("generate-text-batch"),
+            payload,
+            content_type="application/json",
+            headers=headers,
+        )
+
+    @override_settings(VERITAS_CONTEXT_MODE="full")
+    async def test_results_are_returned_in_order_with_per_item_errors(self):
+        client = FakeClient(chunks=["Answer"])
+        with use_genai_client(client):
+            response = await self.post_batch(
+                {
+                    "items": [
+                        {"prompt": "Question one"},
+                        {"prompt": "Question two", "temperature": 5},
+                        {"prompt": "Question three", "temperature": 0.1},
+                    ],
+                    "model": "m",
+                }
+            )
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([r["index"] for r in results], [0, 1, 2])
+        self.assertEqual(results[0]["response"], "Answer")
+        self.assertEqual(results[1]["status"], 400)
+        self.assertIn("temperature", results[1]["details"])
+        self.assertEqual(results[2]["prompt"], "Question three")
+        self.assertEqual(client.models.calls[-1][2].temperature, 0.1)
+        self.assertEqual(client.files.uploads, 1)
+
+    async def test_concurrency_is_bounded_and_failures_are_isolated(self):
+        client = FakeClient(delay=0.05)
+        in_flight, peak = 0, 0
+        generate = client.aio.models.generate_content_stream
+
+        async def tracked(model, contents, config):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            try:
+                if "fail" in contents[-1].parts[-1].text:
+                    raise RuntimeError("upstream down")
+                return await generate(model=model, contents=contents, config=config)
+            finally:
+                in_flight -= 1
+
+        client.aio.models.generate_content_stream = tracked
+        prompts = [f"Question {n}" for n in range(6)] + ["Please fail"]
+        with use_genai_client(client):
+            response = await self.post_batch({"prompts": prompts, "concurrency": 2})
+
+        results = response.json()["results"]
+        self.assertEqual(peak, 2)
+        self.assertEqual(results[-1]["status"], 503)
+        self.assertTrue(all("response" in r for r in results[:-1]))
+
+    async def test_streams_ndjson_as_items_finish(self):
+        with use_genai_client(FakeClient()):
+            response = await self.post_batch(
+                {"prompts": ["Question a", "Question b"]},
+                Accept="application/x-ndjson",
+            )
+            body = "".join([chunk.decode() async for chunk in response.streaming_content])
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(sorted(line["index"] for line in lines), [0, 1])
+        self.assertTrue(all("elapsed_ms" in line for line in lines))
+
+    async def test_requires_prompts(self):
+        response = await self.post_batch({"prompts": []})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_knowledge_base_cannot_be_set_per_item(self):
+        response = await self.post_batch(
+            {"items": [{"prompt": "Question", "knowledge_base": "admissions"}]}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("knowledge_base", str(response.json()["details"]))
+
+    @override_settings(
+        VERITAS_ROUTER_ENABLED=True,
+        VERITAS_AI_MODEL="primary",
+        VERITAS_FALLBACK_MODELS=[],
+        VERITAS_FAQ_ENABLED=False,
+        VERITAS_ROUTER_RULES=[
+            {"route": "lookup", "model": "fast", "question_types": ["lookup"], "max_words": 10}
+        ],
+    )
+    async def test_context_is_prepared_once_for_each_routed_model(self):
+        prepared = []
+
+        async def prepare(client, model_name, file_path):
+            prepared.append(model_name)
+
+        prompts = [
+            "When does school resume?",
+            "When does registration close?",
+            "Why is Veritas better than other universities?",
+        ]
+        with use_genai_client(FakeClient()), mock.patch(
+            "ai_api.views.aprepare_veritas_context", prepare
+        ):
+            response = await self.post_batch({"prompts": prompts})
+
+        models = [result["model"] for result in response.json()["results"]]
+        self.assertEqual(models, ["fast", "fast", "primary"])
+        self.assertEqual(sorted(prepared), ["fast", "primary"])
+
+    @override_settings(VERITAS_RATE_LIMIT_PER_MINUTE=6, VERITAS_RATE_LIMIT_BURST=2)
+    async def test_each_item_takes_a_rate_limit_token(self):
+        with use_genai_client(FakeClient()):
+            response = await self.post_batch({"prompts": [f"Question {n}" for n in range(4)]})
+
+        statuses = sorted(result.get("status", 200) for result in response.json()["results"])
+        self.assertEqual(statuses, [200, 200, 429, 429])
+        self.assertEqual(admission_stats.get("rate_limited"), 2)
+
+
+@override_settings(
+    VERITAS_AI_MODEL="primary",
+    VERITAS_FALLBACK_MODELS=["fallback"],
+    VERITAS_MODEL_DEADLINES={},
+    VERITAS_HEDGE_DEFAULT_DELAY_SECONDS=0.1,
+)
+class ModelDispatchTests(ViewTestCase):
+
+    def client_for(self, **behaviours):
+        client = FakeClient()
+        client.models = PerModelModels(behaviours)
+        client.aio.models = PerModelAsyncModels(client.models)
+        return client
+
+    def test_failing_model_falls_back(self):
+        client = self.client_for(
+            primary=RuntimeError("overloaded"), fallback=(0, ["From ", "fallback"])
+        )
+        with use_genai_client(client):
+            response = self.client.post(
+                reverse("generate-text"),
+                {"prompt": "When is registration?"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["response"], "From fallback")
+        self.assertEqual(response.json()["model"], "fallback")
+        self.assertEqual(client.models.calls, ["primary", "fallback"])
+        self.assertEqual(dispatch_stats.get("fallbacks"), 1)
+
+    def test_slow_model_is_hedged(self):
+        client = self.client_for(primary=(2, ["Slow"]), fallback=(0, ["Fast"]))
+        started = time.monotonic()
+        with use_genai_client(client):
+            response = self.client.post(
+                reverse("generate-text-async"),
+                {"prompt": "When is registration?"},
+                content_type="application/json",
+            )
+
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(response.json()["response"], "Fast")
+        self.assertEqual(response.json()["model"], "fallback")
+        self.assertEqual(dispatch_stats.get("hedges"), 1)
+        self.assertEqual(dispatch_stats.get("hedge_wins"), 1)
+        self.assertEqual(first_chunk_latency.values("served"), first_chunk_latency.values("fallback"))
+
+    @override_settings(VERITAS_HEDGE_ENABLED=False, VERITAS_MODEL_DEADLINES={"primary": 0.1})
+    def test_model_missing_its_deadline_falls_back(self):
+        client = self.client_for(primary=(2, ["Slow"]), fallback=(0, ["Fast"]))
+        with use_genai_client(client):
+            response = self.client.post(
+                reverse("generate-text"),
+                {"prompt": "When is registration?"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.json()["response"], "Fast")
+        self.assertEqual(dispatch_stats.get("deadline_exceeded"), 1)
+        self.assertEqual(dispatch_stats.get("hedges"), 0)
+
+    def test_explicitly_requested_model_does_not_fall_back(self):
+        client = self.client_for(
+            primary=RuntimeError("overloaded"), fallback=(0, ["From fallback"])
+        )
+        with use_genai_client(client):
+            response = self.client.post(
+                reverse("generate-text"),
+                {"prompt": "When is registration?", "model": "primary"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(client.models.calls, ["primary"])
+
+
+@override_settings(
+    VERITAS_ROUTER_ENABLED=True,
+    VERITAS_AI_MODEL="primary",
+    VERITAS_FALLBACK_MODELS=[],
+    VERITAS_MODEL_DEADLINES={},
+    VERITAS_HEDGE_ENABLED=False,
+    VERITAS_FAQ_ENABLED=False,
+    VERITAS_ROUTER_RULES=[
+        {"route": "lookup", "model": "fast", "question_types": ["lookup"], "max_words": 10}
+    ],
+)
+class RoutingTests(ViewTestCase):
+
+    def client_for(self, **behaviours):
+        client = FakeClient()
+        client.models = PerModelModels(behaviours)
+        client.aio.models = PerModelAsyncModels(client.models)
+        return client
+
+    def generate(self, client, url="generate-text", **data):
+        with use_genai_client(client):
+            return self.client.post(reverse(url), data, content_type="application/json")
+
+    def test_question_types(self):
+        self.assertEqual(question_type("When does school resume?"), "lookup")
+        self.assertEqual(question_type("How much is the hostel fee?"), "lookup")
+        self.assertEqual(question_type("Why should I study law here?"), "open")
+        self.assertEqual(question_type("Compare the two hostels"), "open")
+        self.assertEqual(question_type("Should I defer my admission?"), "open")
+        self.assertEqual(question_type("Tell me about the library"), "other")
+
+    def test_lookup_is_routed_to_the_rule_model(self):
+        client = self.client_for(fast=(0, ["Monday"]), primary=(0, ["Slow Monday"]))
+        response = self.generate(client, prompt="When does school resume?")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["model"], "fast")
+        self.assertEqual(response.json()["route"], "lookup")
+        self.assertEqual(response.json()["route_reason"], "lookup question, 4 words <= 10")
+        self.assertEqual(client.models.calls, ["fast"])
+        self.assertEqual(routing_stats.get("routed"), 1)
+
+    async def test_async_view_routes_too(self):
+        client = self.client_for(fast=(0, ["Monday"]), primary=(0, ["Slow Monday"]))
+        with use_genai_client(client):
+            response = await self.async_client.post(
+                reverse("generate-text-async"),
+                {"prompt": "When does school resume?"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.json()["model"], "fast")
+        self.assertEqual(response.json()["route"], "lookup")
+
+    def test_open_question_goes_to_the_default_model(self):
+        client = self.client_for(fast=(0, ["Short"]), primary=(0, ["Considered answer"]))
+        response = self.generate(client, prompt="Why is Veritas better than other universities?")
+
+        self.assertEqual(response.json()["model"], "primary")
+        self.assertEqual(response.json()["route"], "default")
+        self.assertIn("open question", response.json()["route_reason"])
+        self.assertEqual(routing_stats.get("default"), 1)
+
+    def test_requested_model_is_not_routed(self):
+        client = self.client_for(fast=(0, ["Monday"]), primary=(0, ["Slow Monday"]))
+        response = self.generate(client, prompt="When does school resume?", model="primary")
+
+        self.assertEqual(response.json()["model"], "primary")
+        self.assertEqual(response.json()["route"], "requested")
+        self.assertEqual(routing_stats.get("routed"), 0)
+
+    def test_failing_routed_model_falls_back_to_the_default_model(self):
+        client = self.client_for(fast=RuntimeError("overloaded"), primary=(0, ["Monday"]))
+        response = self.generate(client, prompt="When does school resume?")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["model"], "primary")
+        self.assertEqual(client.models.calls, ["fast", "primary"])
+
+    def test_invalid_rules_are_skipped(self):
+        rules = [
+            {"route": "typo", "model": "fast", "max_wrds": 10},
+            {"route": "short", "model": "fast", "max_words": 3},
+            {"route": "any", "model": "other"},
+        ]
+        client = self.client_for(fast=(0, ["Short"]), other=(0, ["Other"]))
+        with self.settings(VERITAS_ROUTER_RULES=rules), self.assertLogs(
+            "ai_api.routing", "ERROR"
+        ) as logs:
+            response = self.generate(client, prompt="When does school resume?")
+
+        self.assertIn("max_wrds", logs.output[0])
+        self.assertEqual(response.json()["model"], "other")
+        self.assertEqual(response.json()["route"], "any")
+
+
+class TokenBudgetTests(ViewTestCase):
+
+    def post(self, prompt, **extra):
+        return self.client.post(
+            reverse("generate-text"),
+            {"prompt": prompt},
+            content_type="application/json",
+            **extra,
+        )
+
+    def test_usage_is_returned(self):
+        with use_genai_client(FakeClient(chunks=["Monday"])):
+            response = self.post("When do classes resume?")
+
+        self.assertEqual(response.json()["prompt_tokens"], 12)
+        self.assertEqual(response.json()["total_tokens"], 13)
+
+    @override_settings(VERITAS_MAX_PROMPT_TOKENS=10)
+    def test_long_prompt_is_rejected_before_the_model(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            response = self.post("word " * 100)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(response.json()["limit"], 10)
+        self.assertEqual(client.models.calls, [])
+
+    @override_settings(VERITAS_MAX_PROMPT_TOKENS=10, VERITAS_PROMPT_OVERFLOW="trim")
+    def test_long_prompt_can_be_trimmed(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            response = self.post("start " + "filler " * 100 + "question?")
+
+        self.assertEqual(response.status_code, 200)
+        sent = client.models.calls[0][1][-1].parts[-1].text
+        self.assertTrue(sent.startswith("start"))
+        self.assertTrue(sent.endswith("question?"))
+        self.assertLessEqual(len(sent), 40)
+        self.assertEqual(budget_stats.get("prompts_trimmed"), 1)
+
+    @override_settings(VERITAS_CONTEXT_MODE="full", VERITAS_MAX_INPUT_TOKENS=100)
+    def test_oversized_request_is_rejected_before_the_model(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            response = self.post("When do classes resume?")
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(client.models.calls, [])
+        self.assertEqual(budget_stats.get("inputs_rejected"), 1)
+
+    @override_settings(VERITAS_CLIENT_TOKEN_BUDGET=20)
+    def test_client_budget_is_charged_and_enforced(self):
+        with use_genai_client(FakeClient(chunks=["Monday"])):
+            first = self.post("When do classes resume?")
+            second = self.post("When does registration close?")
+            other_client = self.post(
+                "When does registration close?", REMOTE_ADDR="10.0.0.2"
+            )
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertGreater(second.json()["retry_after"], 0)
+        self.assertEqual(other_client.status_code, 200)
+        self.assertEqual(budget_stats.get("charged_tokens"), 26)
+
+    @override_settings(
+        VERITAS_CLIENT_TOKEN_BUDGET=1000,
+        VERITAS_CLIENT_ID_HEADER="X-Client-Id",
+        VERITAS_RATE_LIMIT_PER_MINUTE=None,
+    )
+    async def test_coalesced_follower_is_not_charged(self):
+        client = FakeClient(chunks=["Monday, ", "October 7th"], delay=0.1)
+
+        async def ask(client_id):
+            return await self.async_client.post(
+                reverse("generate-text-async"),
+                {"prompt": "When do 100-level students resume?"},
+                content_type="application/json",
+                headers={"X-Client-Id": client_id},
+            )
+
+        with use_genai_client(client):
+            leader = asyncio.create_task(ask("leader"))
+            await asyncio.sleep(0.05)
+            follower = await ask("follower")
+            await leader
+
+        self.assertEqual(follower.json()["response"], "Monday, October 7th")
+        self.assertEqual(len(client.models.calls), 1)
+        cache = caches[settings.VERITAS_RESPONSE_CACHE_ALIAS]
+        self.assertEqual(await cache.aget(_window_key("follower")[0], 0), 0)
+        self.assertEqual(await cache.aget(_window_key("leader")[0], 0), 14)
+
+    def test_trim_text_keeps_both_ends(self):
+        trimmed = trim_text("a" * 50 + "b" * 50, 10)
+        self.assertTrue(trimmed.startswith("a"))
+        self.assertTrue(trimmed.endswith("b"))
+        self.assertLessEqual(len(trimmed), 40)
+
+
+class MetricsTests(ViewTestCase):
+
+    def metrics(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        return response.content.decode()
+
+    def test_stages_are_timed(self):
+        with use_genai_client(FakeClient()):
+            self.client.post(
+                reverse("generate-text"),
+                {"prompt": "When do classes resume?"},
+                content_type="application/json",
+            )
+
+        text = self.metrics()
+        for stage in ("validation", "client", "first_chunk", "stream", "serialization"):
+            self.assertIn(f'veritas_stage_seconds_count{{stage="{stage}"}} 1', text)
+        self.assertIn('veritas_stage_seconds_bucket{stage="stream",le="+Inf"} 1', text)
+        self.assertIn('veritas_requests_in_flight{endpoint="generate"} 0', text)
+        self.assertIn(
+            'veritas_component_events_total{component="response_cache",event="misses"} 1', text
+        )
+
+    # One failed call, not retried
+    @override_settings(VERITAS_RETRY_ATTEMPTS=0)
+    def test_upstream_errors_are_counted_by_type(self):
+        with use_genai_client(FakeClient(chunks=[client_error(429, "Quota exceeded")])):
+            self.client.post(
+                reverse("generate-text"),
+                {"prompt": "When do classes resume?", "model": "m"},
+                content_type="application/json",
+            )
+
+        self.assertIn(
+            'veritas_upstream_errors_total{type="ClientError",code="429"} 1', self.metrics()
+        )
+
+    def test_values_of_other_workers_are_added(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            VERITAS_METRICS_DIR=directory
+        ):
+            with use_genai_client(FakeClient()):
+                self.client.post(
+                    reverse("generate-text"),
+                    {"prompt": "When do classes resume?"},
+                    content_type="application/json",
+                )
+            flush()
+            own_file = os.path.join(directory, f"worker-{os.getpid()}.json")
+            # A worker that has exited: its counters count, its gauges don't
+            os.rename(own_file, os.path.join(directory, "worker-999999999.json"))
+            reset_metrics()
+            with use_genai_client(FakeClient()):
+                self.client.post(
+                    reverse("generate-text"),
+                    {"prompt": "When do classes start?"},
+                    content_type="application/json",
+                )
+            text = self.metrics()
+
+        self.assertIn('veritas_stage_seconds_count{stage="stream"} 2', text)
+        self.assertIn('veritas_requests_in_flight{endpoint="generate"} 0', text)
+
+
+class TracingTests(ViewTestCase):
+
+    def post(self, headers=None):
+        return self.client.post(
+            reverse("generate-text"),
+            {"prompt": "When do classes resume?"},
+            content_type="application/json",
+            headers=headers,
+        )
+
+    def test_stages_are_returned_in_server_timing(self):
+        with use_genai_client(FakeClient()):
+            response = self.post()
+
+        timing = response["Server-Timing"]
+        for stage in ("validation", "faq", "client", "cache", "upstream", "first_chunk"):
+            self.assertIn(f"{stage};", timing)
+        self.assertRegex(timing, r"total;dur=[0-9.]+$")
+        self.assertTrue(response["X-Veritas-Trace-Id"])
+
+    @override_settings(VERITAS_SLOW_TRACE_SECONDS=0)
+    def test_slow_requests_are_logged(self):
+        with use_genai_client(FakeClient()), self.assertLogs("veritas.traces") as logs:
+            response = self.post()
+
+        trace = json.loads(logs.records[0].getMessage())
+        self.assertEqual(trace["trace_id"], response["X-Veritas-Trace-Id"])
+        self.assertIn("stream", [span["name"] for span in trace["spans"]])
+
+    def test_profiling_requires_staff_or_token(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            VERITAS_PROFILE_DIR=directory, VERITAS_PROFILE_TOKEN="secret"
+        ), use_genai_client(FakeClient()):
+            refused = self.post({"X-Veritas-Profile": "cprofile"})
+            profiled = self.post(
+                {"X-Veritas-Profile": "cprofile", "X-Veritas-Profile-Token": "secret"}
+            )
+            sampled = self.post(
+                {"X-Veritas-Profile": "sample", "X-Veritas-Profile-Token": "secret"}
+            )
+
+            self.assertNotIn("X-Veritas-Profile-Id", refused)
+            self.assertTrue(
+                os.path.exists(os.path.join(directory, profiled["X-Veritas-Profile-Id"]))
+            )
+            self.assertTrue(sampled["X-Veritas-Profile-Id"].endswith(".folded"))
+
+    async def test_staff_session_may_profile_async_views(self):
+        staff = await User.objects.acreate(username="staff", is_staff=True)
+        await self.async_client.aforce_login(staff)
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            VERITAS_PROFILE_DIR=directory
+        ), use_genai_client(FakeClient()):
+            response = await self.async_client.post(
+                reverse("generate-text-async"),
+                {"prompt": "When do classes resume?"},
+                content_type="application/json",
+                headers={"X-Veritas-Profile": "cprofile"},
+            )
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(
+                os.path.exists(os.path.join(directory, response["X-Veritas-Profile-Id"]))
+            )
+
+
+class AdmissionTests(ViewTestCase):
+
+    def post(self, prompt="When do classes resume?", address="10.0.0.1"):
+        return self.client.post(
+            reverse("generate-text"),
+            {"prompt": prompt},
+            content_type="application/json",
+            REMOTE_ADDR=address,
+        )
+
+    def take_slot(self, lease=60):
+        caches[settings.VERITAS_RESPONSE_CACHE_ALIAS].add(
+            "veritas:upstream:slot:0", "other-worker", lease
+        )
+
+    @override_settings(VERITAS_RATE_LIMIT_PER_MINUTE=6, VERITAS_RATE_LIMIT_BURST=2)
+    def test_client_over_its_rate_limit_gets_429(self):
+        with use_genai_client(FakeClient()):
+            statuses = [self.post(f"Question {n}?").status_code for n in range(2)]
+            limited = self.post("Question 2?")
+            other_client = self.post("Question 3?", address="10.0.0.2")
+
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(limited.status_code, 429)
+        self.assertEqual(limited["Retry-After"], "10")
+        self.assertEqual(other_client.status_code, 200)
+
+    @override_settings(
+        VERITAS_RATE_LIMIT_PER_MINUTE=6,
+        VERITAS_RATE_LIMIT_BURST=1,
+        VERITAS_MAX_CONCURRENT_UPSTREAM=1,
+    )
+    def test_missing_cache_table_admits_requests_and_logs_once(self):
+        missing = DatabaseError("no such table: veritas_response_cache")
+        broken = mock.Mock(
+            **{f"{name}.side_effect": missing for name in ("get", "set", "get_many", "add")}
+        )
+        with use_genai_client(FakeClient()), mock.patch(
+            "ai_api.admission._shared_cache", return_value=broken
+        ), self.assertLogs("ai_api.admission", "WARNING") as logs:
+            statuses = [self.post(f"Question {n}?").status_code for n in range(3)]
+
+        self.assertEqual(statuses, [200, 200, 200])
+        errors = [record for record in logs.records if record.levelname == "ERROR"]
+        self.assertEqual(len(errors), 1)
+        self.assertIn("createcachetable", errors[0].getMessage())
+        self.assertEqual(admission_stats.get("unavailable"), 6)
+
+    @override_settings(VERITAS_MAX_CONCURRENT_UPSTREAM=1, VERITAS_UPSTREAM_QUEUE_SIZE=0)
+    def test_full_queue_gets_503_without_calling_the_model(self):
+        self.take_slot()
+        client = FakeClient()
+        with use_genai_client(client):
+            response = self.post()
+            faq_answer = self.post("Who is the Vice-Chancellor of Veritas University?")
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+        self.assertEqual(client.models.calls, [])
+        self.assertEqual(faq_answer.status_code, 200)
+        self.assertIn(
+            'veritas_admission_rejections_total{reason="queue_full"} 1',
+            self.client.get(reverse("metrics")).content.decode(),
+        )
+
+    @override_settings(
+        VERITAS_MAX_CONCURRENT_UPSTREAM=1,
+        VERITAS_UPSTREAM_QUEUE_WAIT_SECONDS=2,
+        VERITAS_UPSTREAM_SLOT_POLL_SECONDS=0.01,
+    )
+    def test_queued_request_gets_the_slot_of_a_crashed_worker(self):
+        # Never released; the lease runs out
+        self.take_slot(lease=1)
+        with use_genai_client(FakeClient()):
+            response = self.post()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(admission_stats.get("queued"), 1)
+        self.assertEqual(admission_stats.get("admitted"), 1)
+
+    @override_settings(
+        VERITAS_MAX_CONCURRENT_UPSTREAM=1,
+        VERITAS_UPSTREAM_QUEUE_WAIT_SECONDS=0.1,
+        VERITAS_UPSTREAM_SLOT_POLL_SECONDS=0.01,
+    )
+    async def test_async_view_times_out_waiting_for_a_slot(self):
+        await sync_to_async(self.take_slot)()
+        with use_genai_client(FakeClient()):
+            response = await self.async_client.post(
+                reverse("generate-text-async"),
+                {"prompt": "When do classes resume?"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(admission_stats.get("queue_timeout"), 1)
+
+
+@override_settings(
+    VERITAS_RETRY_BASE_DELAY_SECONDS=0.01,
+    VERITAS_BREAKER_FAILURE_THRESHOLD=2,
+    VERITAS_CONTEXT_CACHE_ENABLED=False,
+)
+class ResilienceTests(ViewTestCase):
+
+    def post(self, url_name="generate-text", **extra):
+        return self.client.post(
+            reverse(url_name),
+            {"prompt": "Tell me about research at the university", "model": "m"},
+            content_type="application/json",
+            **extra,
+        )
+
+    def flaky_client(self, *errors):
+        client = FakeClient()
+        client.models = FlakyModels(errors)
+        return client
+
+    def trip_breaker(self, model="m"):
+        for _ in range(settings.VERITAS_BREAKER_FAILURE_THRESHOLD):
+            circuit_breakers.record_failure(model)
+
+    def test_transient_error_is_retried(self):
+        client = self.flaky_client(server_error(503, "Overloaded"))
+        with use_genai_client(client):
+            response = self.post()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["response"], "Hello there")
+        self.assertEqual(len(client.models.calls), 2)
+        self.assertEqual(resilience_stats.get("retries"), 1)
+        self.assertEqual(circuit_breakers.snapshot()["m"]["state"], "closed")
+
+    def test_request_errors_are_not_retried(self):
+        client = self.flaky_client(client_error(400, "Invalid argument"))
+        with use_genai_client(client):
+            response = self.post()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(client.models.calls), 1)
+        self.assertNotIn("m", circuit_breakers.snapshot())
+
+    @override_settings(VERITAS_RETRY_ATTEMPTS=0)
+    def test_open_breaker_short_circuits_with_degraded_answers(self):
+        client = self.flaky_client(*[server_error(500, "Internal")] * 5)
+        with use_genai_client(client):
+            responses = [self.post() for _ in range(3)]
+
+        self.assertEqual(len(client.models.calls), 2)
+        self.assertEqual(resilience_stats.get("short_circuits"), 1)
+        data = responses[-1].json()
+        self.assertEqual(responses[-1].status_code, 200)
+        self.assertTrue(data["degraded"])
+        self.assertEqual(data["model"], "local")
+        self.assertTrue(data["response"].startswith("The AI assistant is temporarily unavailable"))
+        self.assertNotIn("prompt_tokens", data)
+
+        stats = self.client.get(reverse("stats")).json()
+        self.assertEqual(stats["circuit_breakers"]["m"]["state"], "open")
+        metrics = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn('veritas_circuit_breakers_open{model="m"} 1', metrics)
+
+    @override_settings(VERITAS_BREAKER_OPEN_SECONDS=0.05)
+    def test_successful_probe_closes_breaker(self):
+        self.trip_breaker()
+        time.sleep(0.06)
+        with use_genai_client(FakeClient()):
+            response = self.post()
+
+        self.assertEqual(response.json()["response"], "Hello there")
+        self.assertEqual(circuit_breakers.snapshot()["m"]["state"], "closed")
+
+    @override_settings(VERITAS_AI_MODEL="primary", VERITAS_FALLBACK_MODELS=["fallback"])
+    def test_dispatch_skips_model_with_open_breaker(self):
+        self.trip_breaker("primary")
+        client = FakeClient()
+        with use_genai_client(client):
+            response = self.client.post(
+                reverse("generate-text-async"),
+                {"prompt": "Tell me about research at the university"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.json()["model"], "fallback")
+        self.assertEqual([call[0] for call in client.models.calls], ["fallback"])
+
+    def test_degraded_answer_is_streamed(self):
+        self.trip_breaker()
+        with use_genai_client(FakeClient()):
+            response = self.post(url_name="generate-text-async", HTTP_ACCEPT="text/event-stream")
+
+        events = read_events(response)
+        self.assertEqual(events[0][0], "chunk")
+        self.assertEqual(events[-1][0], "done")
+        self.assertTrue(events[-1][1]["degraded"])
+
+    @override_settings(VERITAS_DEGRADED_ANSWERS_ENABLED=False)
+    def test_open_breaker_without_degraded_answers_gets_503(self):
+        self.trip_breaker()
+        with use_genai_client(FakeClient()):
+            response = self.post()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], str(settings.VERITAS_BREAKER_OPEN_SECONDS))
+
+    @override_settings(VERITAS_CONTEXT_MODE="full")
+    def test_failed_upload_falls_back_to_passages(self):
+        client = FakeClient()
+        client.files.upload = mock.Mock(side_effect=server_error(503, "Unavailable"))
+        with use_genai_client(client):
+            response = self.post()
+
+        self.assertEqual(response.status_code, 200)
+        _, contents, _ = client.models.calls[0]
+        texts = content_texts(contents)
+        self.assertTrue(texts[0][1][0].startswith("These are excerpts from the school's data"))
+
+
+class WarmupTests(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_warmup()
+
+    def post(self):
+        return self.client.post(
+            reverse("generate-text"),
+            {"prompt": "Tell me about research at the university"},
+            content_type="application/json",
+        )
+
+    def test_readiness_follows_warmup(self):
+        response = self.client.get("/api/health/ready")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["status"], "pending")
+
+        client = FakeClient()
+        with use_genai_client(client):
+            report = run_warmup()
+
+        self.assertEqual(report["status"], "ready")
+        self.assertEqual(report["errors"], {})
+        self.assertEqual(client.files.uploads, 1)
+        response = self.client.get(reverse("health-ready"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("data_file", response.json()["steps_ms"])
+
+    @override_settings(VERITAS_WARMUP_ON_STARTUP=False)
+    def test_ready_without_warmup(self):
+        response = self.client.get(reverse("health-ready"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["status"], "ready")
+
+    def test_first_request_is_reported(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            run_warmup()
+            self.post()
+            self.post()
+
+        warmup = self.client.get(reverse("stats")).json()["warmup"]
+        self.assertTrue(warmup["first_request_warm"])
+        self.assertIsNotNone(warmup["first_request_ms"])
+        # The request found the data file uploaded
+        self.assertEqual(client.files.uploads, 1)
+
+    def test_cold_first_request_is_reported(self):
+        with use_genai_client(FakeClient()):
+            self.post()
+
+        warmup = self.client.get(reverse("stats")).json()["warmup"]
+        self.assertFalse(warmup["first_request_warm"])
+
+    @override_settings(
+        VERITAS_CONTEXT_MODE="full",
+        VERITAS_ROUTER_ENABLED=True,
+        VERITAS_AI_MODEL="primary",
+        VERITAS_FALLBACK_MODELS=["fallback"],
+        VERITAS_ROUTER_RULES=[
+            {"route": "lookup", "model": "fast", "question_types": ["lookup"]},
+            {"route": "broken", "model": "never", "colour": "red"},
+        ],
+    )
+    def test_cached_context_is_created_for_every_routed_model(self):
+        client = FakeClient()
+        models = []
+        create = client.caches.create
+
+        def record(model, config):
+            models.append(model)
+            return create(model=model, config=config)
+
+        client.caches.create = record
+        with use_genai_client(client):
+            report = run_warmup()
+
+        self.assertEqual(report["errors"], {})
+        self.assertEqual(models, ["primary", "fallback", "fast"])
+
+    def test_failed_step_still_makes_worker_ready(self):
+        client = FakeClient()
+        client.files.upload = mock.Mock(side_effect=server_error(503, "Unavailable"))
+        with use_genai_client(client):
+            report = run_warmup()
+
+        self.assertEqual(report["status"], "ready")
+        self.assertIn("data_file", report["errors"])
+        self.assertEqual(self.client.get(reverse("health-ready")).status_code, 200)
+
+    def test_management_commands_do_not_serve_requests(self):
+        with mock.patch("sys.argv", ["manage.py", "migrate"]):
+            self.assertFalse(serves_requests())
+        with mock.patch("sys.argv", ["manage.py", "runserver", "--noreload"]):
+            self.assertTrue(serves_requests())
+        with mock.patch("sys.argv", ["gunicorn", "veritas_ai_backend.wsgi"]):
+            self.assertTrue(serves_requests())
+        with mock.patch("sys.argv", ["/venv/lib/uvicorn/__main__.py", "app"]):
+            self.assertTrue(serves_requests())
+
+    def test_scripts_do_not_serve_requests_unless_told(self):
+        for argv in (["-"], ["scripts/bench.py"], [""]):
+            with self.subTest(argv=argv), mock.patch("sys.argv", argv):
+                self.assertFalse(serves_requests())
+        with mock.patch("sys.argv", ["-"]), mock.patch.dict(
+            os.environ, {"VERITAS_SERVES_REQUESTS": "1"}
+        ):
+            self.assertTrue(serves_requests())
+        with mock.patch("sys.argv", ["gunicorn"]), mock.patch.dict(
+            os.environ, {"VERITAS_SERVES_REQUESTS": "0"}
+        ):
+            self.assertFalse(serves_requests())
+
+
+def content_texts(contents):
+    return [
+        (content.role, [part.text for part in content.parts if part.text])
+        for content in contents
+    ]
+
+
+@override_settings(VERITAS_CONTEXT_MODE="full", VERITAS_CONTEXT_CACHE_ENABLED=False)
+class SessionTests(ViewTestCase):
+
+    def post(self, prompt, session_id=None):
+        data = {"prompt": prompt, "model": "m"}
+        if session_id:
+            data["session_id"] = session_id
+        else:
+            data["start_session"] = True
+        response = self.client.post(
+            reverse("generate-text"), data, content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 200)
+        return response.json()["session_id"]
+
+    def test_follow_up_is_sent_with_earlier_turns(self):
+        client = FakeClient(chunks=["Monday, ", "October 7th"])
+        with use_genai_client(client):
+            session_id = self.post("When do 100-level students resume?")
+            self.assertEqual(self.post("And returning students?", session_id), session_id)
+
+        _, contents, _ = client.models.calls[1]
+        self.assertEqual(
+            content_texts(contents)[2:],
+            [
+                ("user", ["When do 100-level students resume?"]),
+                ("model", ["Monday, October 7th"]),
+                ("user", ["And returning students?"]),
+            ],
+        )
+        self.assertEqual(session_stats.get("resumed"), 1)
+
+    @override_settings(VERITAS_SESSION_HISTORY_TOKENS=40, VERITAS_SESSION_SUMMARY_TOKENS=60)
+    def test_long_chat_is_compacted_into_a_bounded_summary(self):
+        client = FakeClient(chunks=["The bursar's office opens at 8am."])
+        with use_genai_client(client):
+            session_id = self.post("Question number 0 about fees?")
+            for number in range(1, 8):
+                self.post(f"Question number {number} about fees?", session_id)
+
+        session = ChatSession.objects.get()
+        self.assertLessEqual(sum(session.turns.values_list("tokens", flat=True)), 40)
+        self.assertIn("User asked: Question number 5 about fees?", session.summary)
+        self.assertNotIn("Question number 0", session.summary)
+        self.assertLessEqual(len(session.summary) / 4, 60)
+        _, contents, _ = client.models.calls[-1]
+        first_turn = content_texts(contents)[2]
+        self.assertTrue(first_turn[1][0].startswith("Summary of our conversation so far:"))
+        self.assertGreater(session_stats.get("compactions"), 0)
+
+    def test_expired_session_is_replaced_and_evicted(self):
+        expired = ChatSession.objects.create(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        ChatTurn.objects.create(session=expired, role="user", text="Hi", tokens=1)
+        with use_genai_client(FakeClient()):
+            session_id = self.post("When do classes resume?", str(expired.id))
+
+        self.assertNotEqual(session_id, str(expired.id))
+        self.assertFalse(ChatSession.objects.filter(id=expired.id).exists())
+        self.assertFalse(ChatTurn.objects.filter(session_id=expired.id).exists())
+        self.assertEqual(session_stats.get("evicted"), 1)
+
+    def test_one_off_faq_answer_does_not_touch_the_database(self):
+        with use_genai_client(FakeClient()), CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse("generate-text"),
+                {"prompt": "Who is the Vice-Chancellor of Veritas University?"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.json()["source"], "faq")
+        # Only the rate limiter's cache rows
+        session_tables = (ChatSession._meta.db_table, ChatTurn._meta.db_table)
+        self.assertEqual(
+            [query["sql"] for query in queries if any(t in query["sql"] for t in session_tables)],
+            [],
+        )
+        self.assertNotIn("session_id", response.json())
+
+    def test_new_session_is_saved_with_its_first_exchange(self):
+        with use_genai_client(FakeClient(chunks=["Yes."])):
+            session_id = self.post("Is there a chess club on campus?")
+
+        session = ChatSession.objects.get()
+        self.assertEqual(str(session.id), session_id)
+        self.assertEqual(session.turns.count(), 2)
+        self.assertEqual(session_stats.get("created"), 1)
+
+    def test_session_that_cannot_be_read_is_answered_without_history(self):
+        with use_genai_client(FakeClient()):
+            session_id = self.post("Can students keep cars?")
+        client = FakeClient()
+        locked = DatabaseError("database table is locked")
+        with use_genai_client(client), mock.patch.object(
+            ChatSession.objects, "filter", side_effect=locked
+        ):
+            self.post("And bicycles?", session_id)
+
+        _, contents, _ = client.models.calls[0]
+        self.assertEqual(content_texts(contents)[2:], [("user", ["And bicycles?"])])
+
+    def test_follow_up_does_not_reuse_answer_cached_without_history(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.post("Is there a chess club on campus?")
+            session_id = self.post("Can students keep cars?")
+            self.post("Is there a chess club on campus?", session_id)
+
+        self.assertEqual(len(client.models.calls), 3)
+
+
+@override_settings(VERITAS_JOB_WORKERS=0, VERITAS_FAQ_ENABLED=False)
+class JobTests(ViewTestCase):
+    """
+    Jobs are run on the test thread with run_next_job instead of a pool.
+    """
+
+    def setUp(self):
+        super().setUp()
+        reset_jobs()
+
+    def enqueue(self, **data):
+        return self.client.post(
+            reverse("jobs"),
+            {"prompt": "Tell me about the library", **data},
+            content_type="application/json",
+        )
+
+    def job_status(self, job_id):
+        return self.client.get(reverse("job-detail", args=[job_id])).json()
+
+    def test_job_is_queued_then_run(self):
+        response = self.enqueue(max_output_tokens=4096)
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()["id"]
+        self.assertEqual(response["Location"], reverse("job-detail", args=[job_id]))
+        self.assertEqual(response.json()["status"], "queued")
+        self.assertEqual(response.json()["position"], 0)
+
+        with use_genai_client(FakeClient(chunks=["The library ", "opens at 8am"])):
+            run_next_job("test-worker")
+
+        job = self.job_status(job_id)
+        self.assertEqual(job["status"], "succeeded")
+        self.assertEqual(job["result"]["response"], "The library opens at 8am")
+        self.assertEqual(job["partial_text"], "The library opens at 8am")
+        self.assertIsNotNone(job["expires_at"])
+        self.assertEqual(job_stats.get("succeeded"), 1)
+
+    @override_settings(VERITAS_JOB_PROGRESS_SECONDS=0)
+    def test_partial_text_is_saved_while_generating(self):
+        job_id = self.enqueue().json()["id"]
+        saved = []
+        flush = JobProgress.flush
+
+        def record(progress):
+            flush(progress)
+            saved.append(GenerationJob.objects.get(id=job_id).partial_text)
+
+        with use_genai_client(FakeClient(chunks=["One ", "two ", "three"])):
+            with mock.patch.object(JobProgress, "flush", record):
+                run_next_job("test-worker")
+        self.assertEqual(saved, ["One ", "One two ", "One two three"])
+
+    def test_higher_priority_runs_first(self):
+        self.enqueue(prompt="Routine question")
+        urgent = self.enqueue(prompt="Urgent question", priority=5).json()["id"]
+        self.assertEqual(self.enqueue(prompt="Later question").json()["position"], 2)
+
+        self.assertEqual(str(claim_job("test-worker").id), urgent)
+
+    @override_settings(VERITAS_JOB_PROGRESS_SECONDS=0)
+    def test_cancelled_job_stops_at_next_update(self):
+        job_id = self.enqueue().json()["id"]
+        job = claim_job("test-worker")
+        cancelled = self.client.post(reverse("job-cancel", args=[job_id]))
+        self.assertEqual(cancelled.json()["status"], "cancelled")
+
+        with use_genai_client(FakeClient(chunks=["Partial", " answer"])):
+            run_job(job)
+
+        job = self.job_status(job_id)
+        self.assertEqual(job["status"], "cancelled")
+        self.assertIsNone(job["result"])
+        self.assertEqual(job_stats.get("succeeded"), 0)
+        again = self.client.post(reverse("job-cancel", args=[job_id]))
+        self.assertEqual(again.status_code, 409)
+
+    @override_settings(VERITAS_JOB_PROGRESS_SECONDS=0)
+    def test_cancelled_job_stops_while_the_model_sends_nothing(self):
+        reset_cancellation()
+        client = FakeClient()
+        client.models = SlowModels(count=3, interval=2)
+        job_id = self.enqueue().json()["id"]
+        check = JobProgress.cancelled
+        cancelled = []
+
+        def cancel_then_check(progress):
+            # Cancels the job the first time dispatch looks, while the model
+            # is still working on its first chunk
+            if not cancelled:
+                response = self.client.post(reverse("job-cancel", args=[job_id]))
+                cancelled.append(response.json()["status"])
+            return check(progress)
+
+        started = time.monotonic()
+        with use_genai_client(client):
+            with mock.patch.object(JobProgress, "cancelled", cancel_then_check):
+                run_next_job("test-worker")
+
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(cancelled, ["cancelled"])
+        job = self.job_status(job_id)
+        self.assertEqual(job["status"], "cancelled")
+        self.assertEqual(job["partial_text"], "")
+        self.assertEqual(cancellation_stats.get("disconnects"), 1)
+        self.assertTrue(client.models.closed.wait(5))
+
+    def test_deadline_fails_queued_and_running_jobs(self):
+        queued = self.enqueue(deadline_seconds=60).json()["id"]
+        running = self.enqueue().json()["id"]
+        GenerationJob.objects.filter(id=queued).update(deadline=timezone.now())
+        job = claim_job("test-worker")
+        self.assertEqual(str(job.id), running)
+        job.deadline = timezone.now()
+
+        with use_genai_client(FakeClient()):
+            run_job(job)
+            sweep_jobs()
+
+        for job_id in (queued, running):
+            job = self.job_status(job_id)
+            self.assertEqual(job["status"], "failed")
+            self.assertEqual(job["error"]["status"], 504)
+        self.assertEqual(job_stats.get("deadline_exceeded"), 2)
+
+    def test_deadline_stops_a_model_that_sent_nothing_yet(self):
+        reset_cancellation()
+        client = FakeClient()
+        client.models = SlowModels(count=3, interval=1)
+        job_id = self.enqueue().json()["id"]
+        GenerationJob.objects.filter(id=job_id).update(
+            deadline=timezone.now() + timedelta(seconds=0.3)
+        )
+
+        started = time.monotonic()
+        with use_genai_client(client):
+            run_next_job("test-worker")
+
+        self.assertLess(time.monotonic() - started, 0.9)
+        job = self.job_status(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["error"]["status"], 504)
+        self.assertEqual(job_stats.get("deadline_exceeded"), 1)
+        self.assertEqual(cancellation_stats.get("deadlines"), 1)
+        self.assertTrue(client.models.closed.wait(5))
+
+    @override_settings(VERITAS_JOB_MAX_ATTEMPTS=2)
+    def test_lapsed_lease_is_queued_again_then_failed(self):
+        job_id = self.enqueue().json()["id"]
+        for expected in ("queued", "failed"):
+            claim_job("dead-worker")
+            GenerationJob.objects.filter(id=job_id).update(lease_expires_at=timezone.now())
+            sweep_jobs()
+            self.assertEqual(self.job_status(job_id)["status"], expected)
+        self.assertEqual(job_stats.get("requeued"), 1)
+
+    def test_expired_job_is_gone(self):
+        job_id = self.enqueue().json()["id"]
+        with use_genai_client(FakeClient()):
+            run_next_job("test-worker")
+        GenerationJob.objects.filter(id=job_id).update(expires_at=timezone.now())
+
+        response = self.client.get(reverse("job-detail", args=[job_id]))
+        self.assertEqual(response.status_code, 404)
+        sweep_jobs()
+        self.assertFalse(GenerationJob.objects.exists())
+
+    @override_settings(VERITAS_JOB_MAX_QUEUED_PER_CLIENT=1)
+    def test_full_queue_is_rejected(self):
+        self.assertEqual(self.enqueue().status_code, 202)
+        response = self.enqueue()
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+        self.assertEqual(job_stats.get("rejected"), 1)
+
+
+class BenchmarkTests(ViewTestCase):
+
+    def test_scoring_helpers(self):
+        self.assertEqual(percentile([5, 1, 3, 2, 4], 0.5), 3)
+        self.assertEqual(percentile(list(range(1, 101)), 0.99), 99)
+        self.assertEqual(token_f1("Monday, October 7th", "Monday, October 7th"), 1.0)
+        self.assertEqual(token_f1("I don't know", "Monday, October 7th"), 0.0)
+
+    @override_settings(VERITAS_FAQ_ENABLED=False)
+    def test_replay_reports_latency_calls_and_scores(self):
+        items = [
+            ReplayItem("When do returning students resume?", "Saturday, October 12th"),
+            ReplayItem("What is the hostel curfew?", "Zebra quartz xylophone"),
+        ]
+        client = FakeGenaiClient(
+            knowledge_text="Returning students resume on Saturday, October 12th.",
+            references={item.prompt: item.reference for item in items},
+        )
+        with self.settings(VERITAS_CONTEXT_MODE="full"):
+            summary = replay(items * 2, client).summary()
+
+        self.assertEqual(summary["requests"], 4)
+        self.assertEqual(summary["sources"], {"model": 2, "cache": 2})
+        self.assertEqual(summary["upstream_calls"]["generations"], 2)
+        self.assertEqual(summary["score"]["correct"], 2)
+        self.assertIn("first_chunk", summary["latency"])
+        self.assertEqual(summary["latency"]["request"]["count"], 4)
+
+    @override_settings(
+        VERITAS_CONTEXT_MODE="full",
+        VERITAS_AI_MODEL="primary",
+        VERITAS_ROUTER_RULES=[{"route": "lookup", "model": "fast", "question_types": ["lookup"]}],
+    )
+    def test_routing_evaluation_reports_latency_per_route(self):
+        items = [
+            ReplayItem("When do returning students resume?"),
+            ReplayItem("Why do returning students resume on Saturday?"),
+        ]
+        client = FakeGenaiClient(
+            knowledge_text="Returning students resume on Saturday, October 12th.",
+            first_chunk_latency=0.05,
+            model_first_chunk_latency={"fast": 0.0},
+        )
+        report = evaluate_routing(items, client, VERITAS_DATA_FILE_PATH)
+
+        self.assertEqual(set(report["routes"]), {"lookup", "default"})
+        self.assertEqual(report["routes"]["lookup"]["model"], "fast")
+        self.assertGreater(report["routes"]["lookup"]["saved_ms_per_request"], 20)
+        self.assertEqual(report["generations_by_model"]["baseline"], {"primary": 2})
+        self.assertEqual(report["generations_by_model"]["routed"], {"fast": 1, "primary": 1})
+
+
+def read_events(response):
+    """
+    Parses a server-sent event response into (event, data) pairs.
+    """
+    body = b"".join(response.streaming_content).decode()
+    return parse_events(body)
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+class EventStreamTests(ViewTestCase):
+
+    def post_stream(self, payload, url_name="generate-text"):
+        return self.client.post(
+            reverse(url_name),
+            payload,
+            content_type="application/json",
+            HTTP_ACCEPT="text/event-stream",
+        )
+
+    def test_streams_chunks_then_done_event(self):
+        with use_genai_client(FakeClient(chunks=["Saturday, ", "October 12th"])):
+            response = self.post_stream({"prompt": "Returning students?", "model": "m"})
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        events = read_events(response)
+        self.assertEqual(
+            events,
+            [
+                ("chunk", {"text": "Saturday, "}),
+                ("chunk", {"text": "October 12th"}),
+                (
+                    "done",
+                    {
+                        "model": "m",
+                        "finish_reason": "STOP",
+                        "prompt_tokens": 12,
+                        "completion_tokens": 2,
+                        "total_tokens": 14,
+                        "route": "requested",
+                        "route_reason": "model requested by the client",
+                    },
+                ),
+            ],
+        )
+
+    def test_error_after_first_chunk_is_sent_in_band(self):
+        client = FakeClient(chunks=["Partial", RuntimeError("connection reset")])
+        with use_genai_client(client):
+            response = self.post_stream({"prompt": "Hello"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            read_events(response),
+            [
+                ("chunk", {"text": "Partial"}),
+                ("error", {"error": "Error communicating with the AI service."}),
+            ],
+        )
+
+    def test_error_before_first_chunk_keeps_status_code(self):
+        client = FakeClient(chunks=[RuntimeError("upstream down")])
+        with use_genai_client(client):
+            response = self.post_stream({"prompt": "Hello"})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(
+            parse_events(response.content.decode()),
+            [("error", {"error": "Error communicating with the AI service."})],
+        )
+
+    def test_validation_errors_are_sent_as_error_event(self):
+        response = self.post_stream({"prompt": ""})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(parse_events(response.content.decode())[0][0], "error")
+
+    async def test_async_view_streams_events(self):
+        with use_genai_client(FakeClient(chunks=["A", "B"])):
+            response = await self.async_client.post(
+                reverse("generate-text-async"),
+                {"prompt": "Hello"},
+                content_type="application/json",
+                headers={"Accept": "text/event-stream"},
+            )
+            body = "".join([chunk.decode() async for chunk in response.streaming_content])
+
+        events = parse_events(body)
+        self.assertEqual([event for event, _ in events], ["chunk", "chunk", "done"])
+        self.assertEqual(events[-1][1]["finish_reason"], "STOP")
+
+
+class SlowModels(FakeModels):
+    """
+    Fake models producing a chunk every `interval` seconds; `closed` is set
+    when a stream is closed before its end.
+    """
+
+    def __init__(self, count=50, interval=0.02):
+        super().__init__([f"word{number} " for number in range(count)])
+        self.interval = interval
+        self.closed = threading.Event()
+
+    def generate_content_stream(self, model, contents, config):
+        self.calls.append((model, contents, config))
+
+        def stream():
+            try:
+                for chunk in fake_stream(self.chunks):
+                    time.sleep(self.interval)
+                    yield chunk
+            except GeneratorExit:
+                self.closed.set()
+                raise
+
+        return stream()
+
+
+class StalledModels(SlowModels):
+    """
+    Fake models that send nothing until `release` is set.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def generate_content_stream(self, model, contents, config):
+        self.calls.append((model, contents, config))
+
+        def stream():
+            try:
+                self.release.wait()
+                yield from fake_stream(self.chunks)
+            except GeneratorExit:
+                self.closed.set()
+                raise
+
+        return stream()
+
+
+class SlowAsyncModels:
+    def __init__(self, models):
+        self.models = models
+
+    async def generate_content_stream(self, model, contents, config):
+        self.models.calls.append((model, contents, config))
+
+        async def stream():
+            finished = False
+            try:
+                for chunk in fake_stream(self.models.chunks):
+                    await asyncio.sleep(self.models.interval)
+                    yield chunk
+                finished = True
+            finally:
+                if not finished:
+                    self.models.closed.set()
+
+        return stream()
+
+
+@override_settings(
+    VERITAS_AI_MODEL="m",
+    VERITAS_FALLBACK_MODELS=[],
+    VERITAS_CANCEL_DEFAULT_ANSWER_TOKENS=100,
+)
+class CancellationTests(ViewTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_cancellation()
+        self.genai_client = FakeClient()
+        self.models = self.genai_client.models = SlowModels()
+        self.genai_client.aio.models = SlowAsyncModels(self.models)
+
+    def post(self, url_name="generate-text", stream=False, **data):
+        headers = {"HTTP_ACCEPT": "text/event-stream"} if stream else {}
+        with use_genai_client(self.genai_client):
+            return self.client.post(
+                reverse(url_name),
+                {"prompt": "Tell me about research at the university", **data},
+                content_type="application/json",
+                **headers,
+            )
+
+    def test_deadline_comes_from_the_request_within_the_limit(self):
+        factory = RequestFactory()
+        request = factory.post("/", HTTP_X_VERITAS_DEADLINE_SECONDS="2")
+        now = time.monotonic()
+        with self.settings(VERITAS_REQUEST_DEADLINE_SECONDS=5):
+            self.assertAlmostEqual(request_deadline(request, {}) - now, 2, delta=0.5)
+            self.assertAlmostEqual(
+                request_deadline(request, {"deadline_seconds": 1}) - now, 1, delta=0.5
+            )
+            self.assertAlmostEqual(
+                request_deadline(factory.post("/"), {"deadline_seconds": 60}) - now, 5, delta=0.5
+            )
+            invalid = factory.post("/", HTTP_X_VERITAS_DEADLINE_SECONDS="soon")
+            self.assertAlmostEqual(request_deadline(invalid, {}) - now, 5, delta=0.5)
+        with self.settings(VERITAS_REQUEST_DEADLINE_SECONDS=None):
+            self.assertIsNone(request_deadline(factory.post("/"), {}))
+
+    def test_deadline_before_the_answer_returns_504(self):
+        self.models.interval = 0.5
+        response = self.post(deadline_seconds=0.2)
+
+        self.assertEqual(response.status_code, 504)
+        self.assertIn("deadline", response.json()["error"])
+        self.assertEqual(cancellation_stats.get("deadlines"), 1)
+        self.assertEqual(cancellation_stats.get("tokens_saved"), 100)
+        self.assertTrue(self.models.closed.wait(2))
+
+    def test_deadline_stops_a_model_that_sends_nothing(self):
+        # Without dispatch, and dispatched to the model alone
+        for overrides in (
+            {"VERITAS_MODEL_DISPATCH_ENABLED": False},
+            {"VERITAS_HEDGE_ENABLED": False},
+        ):
+            with self.subTest(**overrides), self.settings(**overrides):
+                reset_cancellation()
+                self.models = self.genai_client.models = StalledModels()
+                self.addCleanup(self.models.release.set)
+                started = time.monotonic()
+                response = self.post(deadline_seconds=0.3)
+
+                self.assertLess(time.monotonic() - started, 1.5)
+                self.assertEqual(response.status_code, 504)
+                self.assertEqual(cancellation_stats.get("deadlines"), 1)
+                self.models.release.set()
+                self.assertTrue(self.models.closed.wait(2))
+
+    async def test_deadline_stops_an_async_model_that_sends_nothing(self):
+        self.models.interval = 60
+        started = time.monotonic()
+        with self.settings(VERITAS_MODEL_DISPATCH_ENABLED=False):
+            with use_genai_client(self.genai_client):
+                response = await self.async_client.post(
+                    reverse("generate-text-async"),
+                    {
+                        "prompt": "Tell me about research at the university",
+                        "deadline_seconds": 0.3,
+                    },
+                    content_type="application/json",
+                )
+
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(response.status_code, 504)
+        self.assertTrue(self.models.closed.is_set())
+        self.assertEqual(cancellation_stats.get("deadlines"), 1)
+
+    def test_deadline_mid_stream_ends_with_an_error_event(self):
+        response = self.post(stream=True, deadline_seconds=0.3)
+
+        events = read_events(response)
+        self.assertEqual(events[0][0], "chunk")
+        self.assertEqual(events[-1][0], "error")
+        self.assertIn("deadline", events[-1][1]["error"])
+        self.assertTrue(self.models.closed.wait(2))
+        self.assertEqual(cancellation_stats.get("deadlines"), 1)
+
+    def test_disconnected_stream_closes_the_upstream_stream(self):
+        response = self.post(stream=True)
+        content = iter(response.streaming_content)
+        self.assertIn(b"event: chunk", next(content))
+        # What the server does when writing to the client fails
+        response.close()
+
+        self.assertTrue(self.models.closed.wait(2))
+        self.assertEqual(cancellation_stats.get("disconnects"), 1)
+        self.assertGreater(cancellation_stats.get("tokens_saved"), 0)
+        self.assertIn(
+            'veritas_cancelled_generations_total{reason="disconnect",model="m"} 1',
+            self.client.get(reverse("metrics")).content.decode(),
+        )
+
+    async def test_cancelled_async_request_closes_the_upstream_stream(self):
+        with use_genai_client(self.genai_client):
+            request = asyncio.ensure_future(
+                self.async_client.post(
+                    reverse("generate-text-async"),
+                    {"prompt": "Tell me about research at the university"},
+                    content_type="application/json",
+                )
+            )
+            await asyncio.sleep(0.3)
+            # What the server does when the client disconnects
+            request.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await request
+
+        self.assertTrue(self.models.closed.is_set())
+        self.assertEqual(cancellation_stats.get("disconnects"), 1)
+
+
+class FaqTests(TestCase):
+    def setUp(self):
+        handle, self.csv_path = tempfile.mkstemp(suffix=".csv")
+        os.write(
+            handle,
+            b"prompt,response,,,\n"
+            b"When is the resumption date for 100-level students?,Monday, October 7th,2024,,\n"
+            b"What is the motto of Veritas University?,Veritas in Caritate,,,\n",
+        )
+        os.close(handle)
+        self.addCleanup(os.remove, self.csv_path)
+        # Cleanups run in reverse: rebuild from the real CSV once the
+        # override is gone.
+        self.addCleanup(reload_faq_matcher)
+        overrides = self.settings(VERITAS_FAQ_CSV_PATH=self.csv_path)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        reload_faq_matcher()
+        faq_stats.reset()
+
+    def test_responses_with_unquoted_commas_are_joined(self):
+        entries = load_faq_entries(self.csv_path)
+        self.assertEqual(entries[0].response, "Monday, October 7th,2024")
+
+    def test_close_match_is_answered_without_the_model(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            response = self.client.post(
+                reverse("generate-text"),
+                {"prompt": "what is the motto of veritas university"},
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.json()["response"], "Veritas in Caritate")
+        self.assertEqual(response.json()["source"], "faq")
+        self.assertEqual(client.models.calls, [])
+        self.assertEqual(faq_stats.get("hits"), 1)
+
+    def test_unrelated_prompt_falls_through(self):
+        self.assertIsNone(answer_from_faq("Explain how AI works"))
+        self.assertEqual(faq_stats.get("misses"), 1)
+
+    def test_threshold_is_configurable(self):
+        prompt = "When is the resumption date for 100-level students?"
+        with self.settings(VERITAS_FAQ_MATCH_THRESHOLD=1.01):
+            self.assertIsNone(answer_from_faq(prompt))
+        self.assertIsNotNone(answer_from_faq(prompt))
+
+    def test_csv_changes_are_picked_up_without_restart(self):
+        with open(self.csv_path, "a") as csv_file:
+            csv_file.write("Who is the Bursar?,Mr. Example,,,\n")
+        os.utime(self.csv_path, ns=(0, 10**18))
+
+        with self.settings(VERITAS_FAQ_RELOAD_CHECK_SECONDS=0):
+            match = answer_from_faq("Who is the bursar?")
+        self.assertEqual(match.entry.response, "Mr. Example")
+
+
+class KnowledgeStoreTests(TestCase):
+    def setUp(self):
+        store_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(store_dir.cleanup)
+        self.store_dir = store_dir.name
+        handle, self.csv_path = tempfile.mkstemp(suffix=".csv")
+        os.write(
+            handle,
+            b"prompt,response\nWhat is the motto of Veritas University?,Veritas in Caritate\n",
+        )
+        os.close(handle)
+        self.addCleanup(os.remove, self.csv_path)
+        self.preamble_path = os.path.join(self.store_dir, "preamble.txt")
+        # Cleanups run in reverse: forget the temporary store once the
+        # overrides are gone.
+        for reset in (reset_knowledge_store, reset_passage_indexes, reload_faq_matcher):
+            self.addCleanup(reset)
+        overrides = self.settings(
+            VERITAS_KB_STORE_DIR=self.store_dir,
+            VERITAS_KB_RELOAD_CHECK_SECONDS=0,
+            VERITAS_FAQ_CSV_PATH=self.csv_path,
+            VERITAS_FAQ_RELOAD_CHECK_SECONDS=0,
+            VERITAS_PREAMBLE_PATH=self.preamble_path,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        reset_knowledge_store()
+        reset_passage_indexes()
+
+    def ingest(self, **kwargs):
+        return ingest_knowledge_base(VERITAS_DATA_FILE_PATH, **kwargs)
+
+    def test_store_answers_like_the_sources(self):
+        self.ingest()
+        built = build_passage_index(VERITAS_DATA_FILE_PATH, VERITAS_MODEL_PREAMBLE_TEXT)
+        with mock.patch("ai_api.retrieval.extract_pdf_pages") as extract:
+            mapped = get_passage_index(VERITAS_DATA_FILE_PATH, model_preamble())
+            for prompt in ("When do returning students resume?", "bursar email", "hostel fees"):
+                self.assertEqual(mapped.search(prompt, 3), built.search(prompt, 3))
+        extract.assert_not_called()
+
+        matcher = get_faq_matcher()
+        expected = FaqMatcher(load_faq_entries(self.csv_path))
+        match = matcher.best_match("what is the motto of veritas university")
+        self.assertEqual(match, expected.best_match("what is the motto of veritas university"))
+        self.assertEqual(knowledge_store_stats.get("loads"), 1)
+
+    def test_only_changed_sources_are_reprocessed(self):
+        first = self.ingest()
+        self.assertTrue(first["written"])
+        self.assertEqual(set(first["sections"].values()), {"built"})
+
+        unchanged = self.ingest()
+        self.assertFalse(unchanged["written"])
+        self.assertEqual(unchanged["version"], first["version"])
+
+        with open(self.csv_path, "a", encoding="utf-8") as csv_file:
+            csv_file.write("Who is the Bursar?,Mr. Example\n")
+        with mock.patch("ai_api.ingest.extract_pdf_pages") as extract:
+            second = self.ingest()
+        extract.assert_not_called()
+        self.assertTrue(second["written"])
+        self.assertEqual(second["sections"]["faq"], "built")
+        self.assertEqual(second["sections"]["pages"], "reused")
+        self.assertEqual(second["sections"]["passages"], "reused")
+
+    def test_workers_switch_to_a_new_version(self):
+        self.ingest()
+        first = get_knowledge_store()
+        self.assertEqual(model_preamble(), VERITAS_MODEL_PREAMBLE_TEXT)
+
+        with open(self.preamble_path, "w", encoding="utf-8") as preamble_file:
+            preamble_file.write("The library opens at 8am on weekdays.")
+        report = self.ingest()
+
+        self.assertEqual(report["sections"]["passages"], "built")
+        self.assertEqual(get_knowledge_store().version, report["version"])
+        self.assertEqual(model_preamble(), "The library opens at 8am on weekdays.")
+        passages = get_passage_index(VERITAS_DATA_FILE_PATH, model_preamble()).search(
+            "library opening hours", 1
+        )
+        self.assertEqual(passages[0].source, "notes")
+        # Requests still holding the old version can keep reading it
+        self.assertEqual(first.strings("preamble", "text")[0], VERITAS_MODEL_PREAMBLE_TEXT)
+
+    def test_stale_store_falls_back_to_the_sources(self):
+        self.ingest()
+        with self.settings(VERITAS_RETRIEVAL_PASSAGE_WORDS=50):
+            index = get_passage_index(VERITAS_DATA_FILE_PATH, model_preamble())
+        self.assertEqual(type(index.index).__name__, "Bm25Index")
+
+
+class KnowledgeBaseTests(ViewTestCase):
+    def setUp(self):
+        super().setUp()
+        reset_knowledge_bases()
+        store_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(store_dir.cleanup)
+        csv_path = os.path.join(store_dir.name, "admissions.csv")
+        with open(csv_path, "w", encoding="utf-8") as csv_file:
+            csv_file.write("prompt,response\nHow much is the application fee?,Ten thousand naira\n")
+        overrides = self.settings(
+            VERITAS_KNOWLEDGE_BASES={
+                "admissions": {
+                    "data_file": VERITAS_DATA_FILE_PATH,
+                    "faq_csv": csv_path,
+                    "store_dir": os.path.join(store_dir.name, "store"),
+                },
+                "bursary": {"data_file": VERITAS_DATA_FILE_PATH},
+            }
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # Cleanups run in reverse: forget the bases once the overrides are gone
+        self.addCleanup(reset_knowledge_bases)
+
+    def ask(self, **data):
+        return self.client.post(
+            reverse("generate-text"),
+            {"prompt": "how much is the application fee", **data},
+            content_type="application/json",
+        )
+
+    def test_requests_use_their_knowledge_base(self):
+        client = FakeClient(chunks=["Please contact admissions"])
+        with use_genai_client(client):
+            admissions = self.ask(knowledge_base="admissions")
+            default = self.ask()
+
+        self.assertEqual(admissions.json()["response"], "Ten thousand naira")
+        self.assertEqual(admissions.json()["source"], "faq")
+        self.assertEqual(default.json()["response"], "Please contact admissions")
+        self.assertEqual(len(client.models.calls), 1)
+        self.assertEqual(
+            [state.base.name for state in resident_states()], ["admissions", "default"]
+        )
+
+    def test_unknown_knowledge_base_is_rejected(self):
+        response = self.ask(knowledge_base="library")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("knowledge_base", response.json()["details"])
+
+    @override_settings(VERITAS_KB_MAX_RESIDENT=2)
+    def test_least_recently_used_base_is_evicted(self):
+        default = resident(get_knowledge_base())
+        resident(get_knowledge_base("admissions"))
+        self.assertIs(resident(get_knowledge_base()), default)
+        resident(get_knowledge_base("bursary"))
+
+        self.assertEqual(
+            [state.base.name for state in resident_states()], ["default", "bursary"]
+        )
+        self.assertEqual(knowledge_base_stats.get("loads"), 3)
+        self.assertEqual(knowledge_base_stats.get("evictions"), 1)
+
+    def test_most_used_bases_are_warmed_up(self):
+        cache = caches[settings.VERITAS_RESPONSE_CACHE_ALIAS]
+        cache.set(USAGE_KEY_PREFIX + "admissions", 3)
+        cache.set(USAGE_KEY_PREFIX + "bursary", 8)
+        self.addCleanup(cache.delete_many, [USAGE_KEY_PREFIX + name for name in ("admissions", "bursary")])
+
+        bases = most_used_knowledge_bases(1)
+        self.assertEqual([base.name for base in bases], ["default", "bursary"])
+
+        reset_warmup()
+        self.addCleanup(reset_warmup)
+        with use_genai_client(FakeClient()), self.settings(VERITAS_KB_WARMUP_COUNT=1):
+            report = run_warmup()
+        self.assertIn("bursary.faq", report["steps_ms"])
+        self.assertNotIn("bursary.client", report["steps_ms"])
+        self.assertNotIn("admissions.faq", report["steps_ms"])
+
+
+class ResponseCacheTests(ViewTestCase):
+    def post(self, payload, **extra):
+        return self.client.post(
+            reverse("generate-text"), payload, content_type="application/json", **extra
+        )
+
+    def test_repeated_prompt_is_served_from_cache(self):
+        client = FakeClient(chunks=["Cached ", "answer"])
+        with use_genai_client(client):
+            first = self.post({"prompt": "Where is the main campus?"})
+            second = self.post({"prompt": "  where is the MAIN campus "})
+
+        self.assertEqual(len(client.models.calls), 1)
+        self.assertEqual(second.json()["response"], first.json()["response"])
+        self.assertTrue(second.json()["cached"])
+        self.assertEqual(cache_stats.get("memory_hits"), 1)
+
+    def test_shared_tier_serves_other_workers(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.post({"prompt": "Where is the main campus?"})
+            clear_memory_cache()  # simulate another worker
+            response = self.post({"prompt": "Where is the main campus?"})
+
+        self.assertTrue(response.json()["cached"])
+        self.assertEqual(cache_stats.get("shared_hits"), 1)
+        self.assertEqual(len(client.models.calls), 1)
+
+    def test_generation_params_are_part_of_the_key(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.post({"prompt": "Where is the main campus?", "temperature": 0.1})
+            self.post({"prompt": "Where is the main campus?", "temperature": 0.2})
+        self.assertEqual(len(client.models.calls), 2)
+
+    def test_request_can_bypass_cache(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.post({"prompt": "Where is the main campus?"})
+            self.post({"prompt": "Where is the main campus?", "use_cache": False})
+            self.post({"prompt": "Where is the main campus?"}, HTTP_CACHE_CONTROL="no-cache")
+        self.assertEqual(len(client.models.calls), 3)
+        self.assertEqual(cache_stats.get("bypassed"), 2)
+
+    def test_knowledge_base_change_invalidates_entries(self):
+        client = FakeClient()
+        with use_genai_client(client):
+            self.post({"prompt": "Where is the main campus?"})
+            with mock.patch("ai_api.ai_helpers.PREAMBLE_HASH", "edited preamble"):
+                self.post({"prompt": "Where is the main campus?"})
+        self.assertEqual(len(client.models.calls), 2)
+
+    def test_streamed_answer_is_cached(self):
+        client = FakeClient(chunks=["Streamed"])
+        with use_genai_client(client):
+            streamed = self.post(
+                {"prompt": "Where is the main campus?"}, HTTP_ACCEPT="text/event-stream"
+            )
+            read_events(streamed)
+            response = self.post({"prompt": "Where is the main campus?"})
+
+        self.assertEqual(response.json()["response"], "Streamed")
+        self.assertEqual(len(client.models.calls), 1)
+
+    def test_memory_tier_evicts_least_recently_used(self):
+        with self.settings(VERITAS_RESPONSE_CACHE_MAX_ENTRIES=1):
+            with use_genai_client(FakeClient()):
+                self.post({"prompt": "First question"})
+                self.post({"prompt": "Second question"})
+        self.assertEqual(cache_stats.get("evictions"), 1)
@@ -0,0 +1,290 @@
+"""
+Small lexical text index used to match prompts against local knowledge.
+"""
+# text_index.py
+
+import bisect
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Sequence
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Words that carry no meaning for matching questions against each other.
+STOPWORDS = frozenset(
+    """
+    a about am an and any are as at be been being but by can could did do does
+    for from had has have how i if in into is it its me my of on or our please
+    should so than that the their them then there these they this those to
+    us was we were what when where which who whom why will with would you your
+    """.split()
+)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Lowercases text and collapses punctuation and whitespace to single spaces.
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return " ".join(_TOKEN_RE.findall(text))
+
+
+def _stem(token: str) -> str:
+    # Light suffix stripping so "students"/"student" and "dates"/"date" match.
+    for suffix in ("ing", "es", "ed", "s"):
+        if len(token) > len(suffix) + 2 and token.endswith(suffix):
+            return token[: -len(suffix)]
+    return token
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits text into normalized, stemmed tokens without stopwords.
+    """
+    return [
+        _stem(token) for token in normalize_text(text).split() if token not in STOPWORDS
+    ]
+
+
+class TfidfIndex:
+    """
+    TF-IDF index scored by cosine similarity, so scores fall between 0 and 1
+    and can be compared against a fixed confidence threshold.
+    """
+
+    def __init__(self, documents: list[str]):
+        tokenized = [tokenize(document) for document in documents]
+        self.size = len(documents)
+        document_frequency = Counter(
+            token for tokens in tokenized for token in set(tokens)
+        )
+        self.idf = {
+            token: math.log((1 + self.size) / (1 + frequency)) + 1
+            for token, frequency in document_frequency.items()
+        }
+        # token -> [(document index, normalized weight)]
+        self.postings: dict[str, list[tuple[int, float]]] = defaultdict(list)
+        for doc_index, tokens in enumerate(tokenized):
+            for token, weight in self._weights(tokens).items():
+                self.postings[token].append((doc_index, weight))
+
+    def _idf(self, token: str) -> float | None:
+        return self.idf.get(token)
+
+    def _postings(self, token: str) -> Iterable[tuple[int, float]]:
+        return self.postings.get(token, ())
+
+    def _weights(self, tokens: list[str]) -> dict[str, float]:
+        weights = {}
+        for token, count in Counter(tokens).items():
+            idf = self._idf(token)
+            if idf is not None:
+                weights[token] = (1 + math.log(count)) * idf
+        norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+        if not norm:
+            return {}
+        return {token: weight / norm for token, weight in weights.items()}
+
+    def search(self, query: str, limit: int = 1) -> list[tuple[int, float]]:
+        """
+        Returns up to `limit` (document index, cosine similarity) pairs,
+        best first.
+        """
+        scores: dict[int, float] = defaultdict(float)
+        for token, query_weight in self._weights(tokenize(query)).items():
+            for doc_index, doc_weight in self._postings(token):
+                scores[doc_index] += query_weight * doc_weight
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+class Bm25Index:
+    """
+    Okapi BM25 index for ranking passages against a query.
+    """
+
+    def __init__(self, documents: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        tokenized = [tokenize(document) for document in documents]
+        self.size = len(documents)
+        self.doc_lengths = [len(tokens) for tokens in tokenized]
+        self.average_length = sum(self.doc_lengths) / self.size if self.size else 0.0
+        document_frequency = Counter(
+            token for tokens in tokenized for token in set(tokens)
+        )
+        self.idf = {
+            token: math.log(1 + (self.size - frequency + 0.5) / (frequency + 0.5))
+            for token, frequency in document_frequency.items()
+        }
+        # token -> [(document index, term frequency)]
+        self.postings: dict[str, list[tuple[int, int]]] = defaultdict(list)
+        for doc_index, tokens in enumerate(tokenized):
+            for token, count in Counter(tokens).items():
+                self.postings[token].append((doc_index, count))
+
+    def _idf(self, token: str) -> float | None:
+        return self.idf.get(token)
+
+    def _postings(self, token: str) -> Iterable[tuple[int, int]]:
+        return self.postings.get(token, ())
+
+    def covers(self, token: str) -> bool:
+        """
+        Returns True if a (tokenized) word occurs in any document.
+        """
+        return self._idf(token) is not None
+
+    def search(self, query: str, limit: int = 5) -> list[tuple[int, float]]:
+        """
+        Returns up to `limit` (document index, BM25 score) pairs with a
+        positive score, best first.
+        """
+        scores: dict[int, float] = defaultdict(float)
+        for token in set(tokenize(query)):
+            idf = self._idf(token)
+            if idf is None:
+                continue
+            for doc_index, count in self._postings(token):
+                length_norm = 1 - self.b + self.b * (
+                    self.doc_lengths[doc_index] / self.average_length
+                )
+                scores[doc_index] += idf * (
+                    count * (self.k1 + 1) / (count + self.k1 * length_norm)
+                )
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+# Tokens whose vocabulary position FlatPostings remembers
+POSITION_CACHE_SIZE = 10_000
+
+
+class SortedVocabulary:
+    """
+    Looks up tokens by binary search in a sorted sequence of tokens, such
+    as the memory-mapped vocabulary of the knowledge base store.
+    """
+
+    def __init__(self, tokens: Sequence[str]):
+        self.tokens = tokens
+
+    def index(self, token: str) -> int | None:
+        position = bisect.bisect_left(self.tokens, token)
+        if position < len(self.tokens) and self.tokens[position] == token:
+            return position
+        return None
+
+
+class FlatPostings:
+    """
+    Postings of every token stored back to back in flat arrays: the
+    postings of token i are at positions starts[i] to starts[i + 1].
+    """
+
+    def __init__(
+        self,
+        vocabulary: SortedVocabulary,
+        idf: Sequence[float],
+        starts: Sequence[int],
+        documents: Sequence[int],
+        values: Sequence,
+    ):
+        self.vocabulary = vocabulary
+        self.idf_values = idf
+        self.starts = starts
+        self.documents = documents
+        self.values = values
+        self._positions: dict[str, int | None] = {}
+
+    def position(self, token: str) -> int | None:
+        position = self._positions.get(token, -1)
+        if position == -1:
+            # Bounded, since queries bring arbitrary tokens
+            if len(self._positions) >= POSITION_CACHE_SIZE:
+                self._positions.clear()
+            position = self._positions[token] = self.vocabulary.index(token)
+        return position
+
+    def idf(self, token: str) -> float | None:
+        position = self.position(token)
+        return None if position is None else self.idf_values[position]
+
+    def postings(self, token: str) -> Iterable[tuple]:
+        position = self.position(token)
+        if position is None:
+            return ()
+        start, end = self.starts[position], self.starts[position + 1]
+        return zip(self.documents[start:end], self.values[start:end])
+
+
+class FlatTfidfIndex(TfidfIndex):
+    """
+    TfidfIndex over precomputed flat arrays (see SortedVocabulary), scoring
+    exactly like the index it was exported from.
+    """
+
+    def __init__(self, size: int, postings: FlatPostings):
+        self.size = size
+        self._flat = postings
+
+    def _idf(self, token: str) -> float | None:
+        return self._flat.idf(token)
+
+    def _postings(self, token: str) -> Iterable[tuple[int, float]]:
+        return self._flat.postings(token)
+
+
+class FlatBm25Index(Bm25Index):
+    """
+    Bm25Index over precomputed flat arrays (see SortedVocabulary), scoring
+    exactly like the index it was exported from.
+    """
+
+    def __init__(
+        self,
+        doc_lengths: Sequence[int],
+        average_length: float,
+        postings: FlatPostings,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.k1 = k1
+        self.b = b
+        self.size = len(doc_lengths)
+        self.doc_lengths = doc_lengths
+        self.average_length = average_length
+        self._flat = postings
+
+    def _idf(self, token: str) -> float | None:
+        return self._flat.idf(token)
+
+    def _postings(self, token: str) -> Iterable[tuple[int, int]]:
+        return self._flat.postings(token)
+
+
+def flatten_postings(idf: dict[str, float], postings: dict[str, list[tuple]]) -> tuple:
+    """
+    Exports the postings of an index as flat arrays.
+
+    Returns:
+        The sorted vocabulary, the idf of each token, the start of each
+        token's postings (plus the end of the last) and the document and
+        value of every posting.
+    """
+    vocabulary = sorted(idf)
+    starts, documents, values = [0], [], []
+    for token in vocabulary:
+        for doc_index, value in postings.get(token, ()):
+            documents.append(doc_index)
+            values.append(value)
+        starts.append(len(documents))
+    return vocabulary, [idf[token] for token in vocabulary], starts, documents, values
+
+
+def estimate_text_tokens(text: str) -> int:
+    """
+    Rough token count for English text (about four characters per token),
+    good enough for comparing prompt sizes without calling the API.
+    """
+    return math.ceil(len(text) / 4)
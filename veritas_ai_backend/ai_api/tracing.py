@@ -0,0 +1,374 @@
+"""
+Per-request tracing, Server-Timing headers and on-demand profiling.
+
+TracingMiddleware starts a Trace for every API request. Code on the request
+path records spans into it: every metrics.timed() stage does, and span()
+wraps anything else. The spans are returned in a Server-Timing header (for
+streamed answers, the spans up to the first chunk), and requests slower than
+VERITAS_SLOW_TRACE_SECONDS are logged in full to the "veritas.traces"
+logger, which settings.py sends to a rotating file when
+VERITAS_TRACE_LOG_FILE is set.
+
+Staff can profile a single request in production by sending
+"X-Veritas-Profile: cprofile" (cProfile) or "X-Veritas-Profile: sample"
+(samples the request thread's stack every
+VERITAS_PROFILE_SAMPLE_INTERVAL_SECONDS), together with
+"X-Veritas-Profile-Token: <VERITAS_PROFILE_TOKEN>" unless they are logged in
+as staff. The profile is written to VERITAS_PROFILE_DIR under the name given
+in the X-Veritas-Profile-Id response header.
+
+The profilers observe the thread the middleware runs on. Under WSGI that is
+the request's own thread. Under ASGI it is the event loop: async views share
+it with other requests, so their profiles include whatever else ran
+meanwhile, and sync views (GenerateTextView, JobsView, ...) run in Django's
+worker thread, so their work is missing from the profile. Profile sync views
+through a WSGI server, or through their async counterpart
+(/api/generate/async/).
+"""
+# tracing.py
+
+import cProfile
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+trace_logger = logging.getLogger("veritas.traces")
+
+TRACE_ID_HEADER = "X-Veritas-Trace-Id"
+PROFILE_HEADER = "X-Veritas-Profile"
+PROFILE_TOKEN_HEADER = "X-Veritas-Profile-Token"
+PROFILE_ID_HEADER = "X-Veritas-Profile-Id"
+PROFILE_MODE_CPROFILE = "cprofile"
+PROFILE_MODE_SAMPLE = "sample"
+
+
+@dataclass
+class Span:
+    name: str
+    # Seconds from the start of the request
+    start: float
+    duration: float
+    description: str = ""
+
+
+class Trace:
+    """
+    The spans recorded while handling one request.
+    """
+
+    def __init__(self, method: str, path: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.spans: list[Span] = []
+
+    def add(self, name: str, started: float, duration: float, description: str = "") -> None:
+        """
+        Records a span that began at perf_counter() value `started`.
+        """
+        self.spans.append(Span(name, started - self.started, duration, description))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        """
+        The spans as a Server-Timing header value, spans with the same name
+        added up, followed by the total so far.
+        """
+        totals: dict[str, list] = {}
+        for span in list(self.spans):
+            total = totals.setdefault(span.name, [0.0, span.description])
+            total[0] += span.duration
+        entries = []
+        for name, (duration, description) in totals.items():
+            entry = name
+            if description:
+                entry += f';desc="{description.replace(chr(34), "")}"'
+            entries.append(f"{entry};dur={duration * 1000:.1f}")
+        entries.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(entries)
+
+    def as_dict(self) -> dict:
+        return {
+            "trace_id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "duration_ms": round(self.elapsed() * 1000, 1),
+            "spans": [
+                {
+                    **asdict(span),
+                    "start": round(span.start * 1000, 1),
+                    "duration": round(span.duration * 1000, 1),
+                }
+                for span in list(self.spans)
+            ],
+        }
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("veritas_trace", default=None)
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+def record_span(name: str, started: float, duration: float, description: str = "") -> None:
+    """
+    Adds a span to the current request's trace, if there is one.
+    """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, started, duration, description)
+
+
+class span:
+    """
+    Context manager recording a span in the current request's trace:
+
+        with span("retrieval"):
+            ...
+    """
+
+    __slots__ = ("name", "description", "trace", "started")
+
+    def __init__(self, name: str, description: str = ""):
+        self.name = name
+        self.description = description
+
+    def __enter__(self):
+        self.trace = _current_trace.get()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.trace is not None:
+            self.trace.add(
+                self.name, self.started, time.perf_counter() - self.started, self.description
+            )
+
+
+# Profiling
+
+
+class _CProfiler:
+    suffix = ".prof"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self) -> None:
+        self.profile.enable()
+
+    def stop(self, path: str) -> str:
+        self.profile.disable()
+        self.profile.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(20)
+        return summary.getvalue()
+
+
+class _StackSampler:
+    """
+    Samples the stack of one thread at a fixed interval and writes the
+    counts as collapsed stacks (the input format of flame graph tools).
+    """
+
+    suffix = ".folded"
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="veritas-stack-sampler"
+        )
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, path: str) -> str:
+        self._stopped.set()
+        self._thread.join()
+        with open(path, "w", encoding="utf-8") as folded_file:
+            for stack, count in self.stacks.most_common():
+                folded_file.write(f"{stack} {count}\n")
+        return f"{sum(self.stacks.values())} samples"
+
+
+def _profile_mode(request) -> str | None:
+    mode = request.headers.get(PROFILE_HEADER, "").lower()
+    if mode not in (PROFILE_MODE_CPROFILE, PROFILE_MODE_SAMPLE):
+        return None
+    return mode
+
+
+def _token_matches(request) -> bool:
+    token = getattr(settings, "VERITAS_PROFILE_TOKEN", None)
+    supplied = request.headers.get(PROFILE_TOKEN_HEADER)
+    return bool(token and supplied and hmac.compare_digest(token, supplied))
+
+
+def _is_staff(user) -> bool:
+    return bool(user is not None and user.is_authenticated and user.is_staff)
+
+
+def _may_profile(request) -> bool:
+    return _token_matches(request) or _is_staff(getattr(request, "user", None))
+
+
+async def _amay_profile(request) -> bool:
+    """
+    Async version of _may_profile; the session behind request.user is
+    loaded from the database, which can't be done on the event loop.
+    """
+    if _token_matches(request):
+        return True
+    if not hasattr(request, "auser"):
+        return False
+    return _is_staff(await request.auser())
+
+
+def _start_profiler(request, mode: str | None, allowed: bool):
+    if mode is None:
+        return None
+    if not allowed:
+        logger.warning(f"Ignoring unauthorized profiling request for {request.path}")
+        return None
+    if mode == PROFILE_MODE_CPROFILE:
+        profiler = _CProfiler()
+    else:
+        profiler = _StackSampler(settings.VERITAS_PROFILE_SAMPLE_INTERVAL_SECONDS)
+    profiler.start()
+    return profiler
+
+
+def _stop_profiler(profiler, trace: Trace, response) -> None:
+    directory = settings.VERITAS_PROFILE_DIR
+    file_name = f"{trace.id}{profiler.suffix}"
+    try:
+        os.makedirs(directory, exist_ok=True)
+        summary = profiler.stop(os.path.join(directory, file_name))
+    except Exception as e:
+        logger.error(f"Failed to write profile {file_name}: {e}")
+        return
+    response[PROFILE_ID_HEADER] = file_name
+    trace_logger.info(f"Profile {file_name} for {trace.method} {trace.path}:\n{summary}")
+
+
+# Middleware
+
+
+def tracing_enabled() -> bool:
+    return getattr(settings, "VERITAS_TRACING_ENABLED", True)
+
+
+def _log_if_slow(trace: Trace) -> None:
+    if trace.elapsed() >= settings.VERITAS_SLOW_TRACE_SECONDS:
+        trace_logger.warning(json.dumps(trace.as_dict()))
+
+
+def _log_after_stream(content, trace: Trace):
+    try:
+        yield from content
+    finally:
+        _log_if_slow(trace)
+
+
+async def _alog_after_stream(content, trace: Trace):
+    try:
+        async for chunk in content:
+            yield chunk
+    finally:
+        _log_if_slow(trace)
+
+
+class TracingMiddleware:
+    """
+    Traces API requests (paths under VERITAS_TRACE_PATH_PREFIX), adds the
+    Server-Timing header and runs profiling requested by staff.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def _traced(self, request) -> bool:
+        return tracing_enabled() and request.path.startswith(
+            settings.VERITAS_TRACE_PATH_PREFIX
+        )
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self._traced(request):
+            return self.get_response(request)
+        trace = Trace(request.method, request.path)
+        mode = _profile_mode(request)
+        profiler = _start_profiler(request, mode, mode is not None and _may_profile(request))
+        token = _current_trace.set(trace)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_trace.reset(token)
+        return self._finish(trace, profiler, response)
+
+    async def __acall__(self, request):
+        if not self._traced(request):
+            return await self.get_response(request)
+        trace = Trace(request.method, request.path)
+        mode = _profile_mode(request)
+        allowed = mode is not None and await _amay_profile(request)
+        profiler = _start_profiler(request, mode, allowed)
+        token = _current_trace.set(trace)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_trace.reset(token)
+        return self._finish(trace, profiler, response)
+
+    def _finish(self, trace: Trace, profiler, response):
+        if profiler is not None:
+            # Streamed answers are profiled up to their first chunk
+            _stop_profiler(profiler, trace, response)
+        response["Server-Timing"] = trace.server_timing()
+        response[TRACE_ID_HEADER] = trace.id
+        if not response.streaming:
+            _log_if_slow(trace)
+        elif response.is_async:
+            response.streaming_content = _alog_after_stream(response.streaming_content, trace)
+        else:
+            response.streaming_content = _log_after_stream(response.streaming_content, trace)
+        return response
@@ -2,9 +2,32 @@
 URL patterns for the AI API application.
 """
 
-from django.urls import path
-from .views import GenerateTextView
+from django.urls import path, re_path
+from .views import (
+    AsyncGenerateTextView,
+    BatchGenerateTextView,
+    GenerateTextView,
+    JobCancelView,
+    JobDetailView,
+    JobsView,
+    MetricsView,
+    ReadinessView,
+    StatsView,
+)
 
 urlpatterns = [
     path("generate/", GenerateTextView.as_view(), name="generate-text"),
+    path(
+        "generate/async/", AsyncGenerateTextView.as_view(), name="generate-text-async"
+    ),
+    path(
+        "generate/batch/", BatchGenerateTextView.as_view(), name="generate-text-batch"
+    ),
+    path("jobs/", JobsView.as_view(), name="jobs"),
+    path("jobs/<uuid:job_id>/", JobDetailView.as_view(), name="job-detail"),
+    path("jobs/<uuid:job_id>/cancel/", JobCancelView.as_view(), name="job-cancel"),
+    path("stats/", StatsView.as_view(), name="stats"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
+    # Probes are often configured without the trailing slash
+    re_path(r"^health/ready/?$", ReadinessView.as_view(), name="health-ready"),
 ]
@@ -4,27 +4,417 @@ Views for the AI API application.
 """
 # views.py
 
+import asyncio
+import itertools
+import json
 import logging
 import os
+from collections.abc import Awaitable, Callable
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework.parsers import JSONParser
-from google import genai
-from google.genai import types
+from rest_framework.renderers import JSONRenderer
 
 # Local imports
-from .serializers import PromptSerializer, ResponseSerializer
-from .ai_helpers import build_veritas_chat_contents  # <-- Import the helper function
+from .serializers import (
+    BatchPromptSerializer,
+    JobSerializer,
+    PromptSerializer,
+    ResponseSerializer,
+)
+from .admission import (
+    RateLimited,
+    UpstreamBusy,
+    aadmitted_events,
+    acheck_rate_limit,
+    admitted_events,
+    check_rate_limit,
+)
+from .ai_helpers import (
+    BlockedPromptError,
+    aprepare_veritas_context,
+    knowledge_base_version,
+    model_preamble,
+)
+from .budgets import (
+    ClientBudgetExceeded,
+    TokenBudgetExceeded,
+    acharge_client_tokens,
+    acheck_client_budget,
+    apply_prompt_budget,
+    charge_client_tokens,
+    check_client_budget,
+    client_identifier,
+    usage_tokens,
+)
+from .cancellation import RequestCancelled, RequestDeadlineExceeded, request_deadline
+from .client_provider import get_genai_client
+from .faq import FaqMatch, answer_from_faq
+from .batch import run_batch
+from .coalescing import acoalesced_events, coalesced_events
+from .dispatch import (
+    DeadlineExceeded,
+    adispatch_veritas_events,
+    dispatch_veritas_events,
+    model_chain,
+)
+from .generation import acollect_events, build_generate_content_config, collect_events
+from .jobs import (
+    STOPPED_CANCELLED,
+    STOPPED_DEADLINE,
+    JobProgress,
+    JobStopped,
+    QueueFull,
+    cancel_job,
+    enqueue_job,
+    get_job,
+    job_payload,
+)
+from .knowledge_bases import (
+    KnowledgeBase,
+    aknowledge_base_events,
+    current_knowledge_base,
+    get_knowledge_base,
+    knowledge_base_events,
+    record_request,
+    use_knowledge_base,
+)
+from .metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE,
+    atimed_events,
+    in_flight,
+    metrics_enabled,
+    render_metrics,
+    timed,
+    timed_events,
+)
+from .response_cache import (
+    aget_cached_response,
+    astore_response,
+    cache_enabled,
+    get_cached_response,
+    response_cache_key,
+    store_response,
+)
+from .resilience import CircuitOpen, degraded_answer, upstream_unavailable
+from .routing import route_request
+from .sessions import aload_session, arecord_exchange, load_session, record_exchange
+from .stats import snapshot_all
+from .text_index import estimate_text_tokens
+from .tracing import span
+from .warmup import first_request, is_ready, warmup_state
+from .streaming import (
+    EventStreamRenderer,
+    event_stream_error_response,
+    event_stream_response,
+    format_sse_event,
+    wants_event_stream,
+)
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-# Path to the Veritas data file - update this to the actual path on your server
-VERITAS_DATA_FILE_PATH = os.path.join(
-    settings.BASE_DIR, "veritas_data", "Veritas_data.pdf"
-)
+# Path to the default knowledge base's data file (VERITAS_DATA_FILE_PATH);
+# requests use the data file of their knowledge base
+VERITAS_DATA_FILE_PATH = os.fspath(settings.VERITAS_DATA_FILE_PATH)
+
+
+def _check_generate_request(serializer: PromptSerializer) -> tuple[dict, int] | None:
+    """
+    Validates a generate request and the server configuration it needs.
+
+    Returns:
+        None if the request can proceed, otherwise the error payload and
+        HTTP status to respond with.
+    """
+    # Validate input data
+    if not serializer.is_valid():
+        logger.warning(f"Invalid input received: {serializer.errors}")
+        return (
+            {"error": "Invalid input", "details": serializer.errors},
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+    # Get prompt from validated data
+    if not serializer.validated_data.get("prompt", ""):
+        logger.warning("Request received with empty prompt.")
+        return {"error": "Prompt is required"}, status.HTTP_400_BAD_REQUEST
+
+    return _check_server_configuration(
+        get_knowledge_base(serializer.validated_data.get("knowledge_base"))
+    )
+
+
+def _check_server_configuration(base: KnowledgeBase | None = None) -> tuple[dict, int] | None:
+    """
+    Checks the API key and data file every generation needs.
+
+    Args:
+        base: The knowledge base whose data file is needed, by default the
+            current one.
+
+    Returns:
+        None if generation can proceed, otherwise the error payload and
+        HTTP status to respond with.
+    """
+    # Check if API key is configured
+    if not settings.GOOGLE_AI_API_KEY:  # Ensure this setting exists
+        logger.error("Google AI API key is not configured in settings.")
+        return (
+            {"error": "Google AI API key is not configured."},
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+
+    # Check if the Veritas data file exists *before* attempting complex logic
+    # Note: The helper function also checks, providing redundancy.
+    data_file_path = (base or current_knowledge_base()).data_file_path
+    if not os.path.exists(data_file_path):
+        logger.error(f"Veritas data file not found at {data_file_path}")
+        return (
+            {"error": "Required data file not found on the server."},
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    return None
+
+
+def _generation_error(e: Exception) -> tuple[dict, int]:
+    """
+    Maps an exception raised while generating to an error payload and status.
+    """
+    if isinstance(e, ImportError):
+        logger.critical(f"Failed to import required libraries: {str(e)}")
+        return (
+            {
+                "error": f"Server configuration error: Required libraries are not installed: {str(e)}"
+            },
+            status.HTTP_500_INTERNAL_SERVER_ERROR,
+        )
+    if isinstance(e, TokenBudgetExceeded):
+        logger.warning(f"Request over its token budget: {e}")
+        return (
+            {"error": str(e), "tokens": e.tokens, "limit": e.budget},
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        )
+    if isinstance(e, RateLimited):
+        logger.warning(f"Client over its rate limit: {e}")
+        return (
+            {
+                "error": "Too many requests, please slow down.",
+                "retry_after": e.retry_after,
+            },
+            status.HTTP_429_TOO_MANY_REQUESTS,
+        )
+    if isinstance(e, UpstreamBusy):
+        logger.warning(f"Request turned away by admission control: {e}")
+        return (
+            {"error": str(e), "retry_after": e.retry_after},
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    if isinstance(e, QueueFull):
+        logger.warning(f"Job turned away: {e}")
+        return (
+            {"error": str(e), "retry_after": e.retry_after},
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    if isinstance(e, CircuitOpen):
+        logger.warning(f"Not calling the AI service: {e}")
+        return (
+            {
+                "error": "The AI service is temporarily unavailable.",
+                "retry_after": e.retry_after,
+            },
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    if isinstance(e, ClientBudgetExceeded):
+        logger.warning(f"Client over its token budget: {e}")
+        return (
+            {
+                "error": "Token budget used up, please try again later.",
+                "retry_after": e.retry_after,
+            },
+            status.HTTP_429_TOO_MANY_REQUESTS,
+        )
+    if isinstance(e, RequestDeadlineExceeded):
+        logger.warning(f"Request deadline passed: {e}")
+        return (
+            {"error": "The answer wasn't ready within the request's deadline."},
+            status.HTTP_504_GATEWAY_TIMEOUT,
+        )
+    if isinstance(e, DeadlineExceeded):
+        logger.warning(f"No model answered within its deadline: {e}")
+        return (
+            {"error": "Timed out waiting for the AI service."},
+            status.HTTP_504_GATEWAY_TIMEOUT,
+        )
+    if isinstance(e, BlockedPromptError):
+        logger.warning(f"Prompt blocked by API: {e}")
+        return (
+            {"error": "Request blocked due to safety concerns.", "details": str(e)},
+            status.HTTP_400_BAD_REQUEST,
+        )
+    logger.exception(
+        f"An unexpected error occurred calling Google AI API: {str(e)}"
+    )  # Use exception for traceback
+    # Use 503 for external service issues
+    return (
+        {"error": "Error communicating with the AI service."},
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
+
+FAQ_MODEL_NAME = "faq"
+
+
+def _faq_output(match: FaqMatch) -> dict:
+    """
+    Response data for a prompt answered from the curated FAQ.
+    """
+    return {
+        "response": match.entry.response,
+        "model": FAQ_MODEL_NAME,
+        "source": "faq",
+        "confidence": round(match.score, 3),
+    }
+
+
+def _answer_events(output_data: dict):
+    """
+    A ready-made answer (FAQ or cache) as a single chunk followed by the done
+    event carrying the rest of the response data.
+    """
+    done_data = {key: value for key, value in output_data.items() if key != "response"}
+    done_data.setdefault("finish_reason", "STOP")
+    yield format_sse_event("chunk", {"text": output_data["response"]})
+    yield format_sse_event("done", done_data)
+
+
+USAGE_FIELDS = ("prompt_tokens", "completion_tokens", "total_tokens")
+
+
+def _model_output(text: str, model_name: str, usage: dict | None = None) -> dict:
+    """
+    Response data for a model answer, with the token usage reported for the
+    generation when given (cached answers are stored without it).
+    """
+    output = {"response": text.strip(), "model": model_name, "source": "model"}
+    if usage is not None:
+        output.update({field: usage.get(field) for field in USAGE_FIELDS})
+    return output
+
+
+def _degraded_output(error: Exception, prompt: str) -> dict | None:
+    """
+    Response data from local knowledge for a prompt the model could not
+    answer because the AI service is down, or None to report the error.
+    """
+    if not upstream_unavailable(error):
+        return None
+    return degraded_answer(prompt, current_knowledge_base().data_file_path)
+
+
+def _knowledge_base(validated_data: dict) -> KnowledgeBase:
+    """
+    The knowledge base a validated request asked for (the default one if it
+    named none), counted for the metrics and warm-up.
+    """
+    base = get_knowledge_base(validated_data.get("knowledge_base"))
+    record_request(base)
+    return base
+
+
+def _session_fields(session) -> dict:
+    """
+    Response data naming the chat session an answer belongs to.
+    """
+    return {"session_id": str(session.id)} if session is not None else {}
+
+
+def _retry_headers(payload: dict) -> dict:
+    """
+    Retry-After for errors that say when to try again.
+    """
+    if payload.get("retry_after") is None:
+        return {}
+    return {"Retry-After": str(payload["retry_after"])}
+
+
+def _error_response(payload: dict, status_code: int) -> Response:
+    return Response(payload, status=status_code, headers=_retry_headers(payload))
+
+
+def _json_error(payload: dict, status_code: int) -> JsonResponse:
+    return JsonResponse(payload, status=status_code, headers=_retry_headers(payload))
+
+
+def _event_stream_error(payload: dict, status_code: int) -> HttpResponse:
+    return event_stream_error_response(payload, status_code, _retry_headers(payload))
+
+
+def _encode_events(first_event, events, on_complete=None, done_fields=None):
+    """
+    Encodes (event, data) pairs as SSE, turning an error raised mid-stream
+    into an in-band error event. If the client goes away (the server closes
+    the stream), the events are closed, which stops the generation.
+
+    Args:
+        first_event: The already received first (event, data) pair.
+        events: The remaining events.
+        on_complete: Optional callable receiving the full text and the done
+            event data once the stream finished.
+        done_fields: Optional data added to the done event.
+    """
+    parts = []
+    try:
+        for event, data in itertools.chain([first_event], events):
+            if event == "chunk":
+                parts.append(data["text"])
+            elif event == "done":
+                if on_complete:
+                    on_complete("".join(parts), data)
+                if done_fields:
+                    data = {**data, **done_fields}
+            yield format_sse_event(event, data)
+    except Exception as e:
+        payload, _ = _generation_error(e)
+        yield format_sse_event("error", payload)
+    finally:
+        events.close()
+
+
+async def _aencode_events(first_event, events, on_complete=None, done_fields=None):
+    """
+    Async version of _encode_events; on_complete is awaited. The server
+    cancels the task reading the stream when the client disconnects.
+    """
+    async def all_events():
+        yield first_event
+        async for event in events:
+            yield event
+
+    parts = []
+    try:
+        async for event, data in all_events():
+            if event == "chunk":
+                parts.append(data["text"])
+            elif event == "done":
+                if on_complete:
+                    await on_complete("".join(parts), data)
+                if done_fields:
+                    data = {**data, **done_fields}
+            yield format_sse_event(event, data)
+    except Exception as e:
+        payload, _ = _generation_error(e)
+        yield format_sse_event("error", payload)
+    finally:
+        await events.aclose()
 
 
 class GenerateTextView(APIView):
@@ -34,11 +424,15 @@ class GenerateTextView(APIView):
     """
 
     parser_classes = (JSONParser,)
+    renderer_classes = (JSONRenderer, EventStreamRenderer)
 
     def post(self, request):
         """
         Process a prompt with the Veritas data and return AI-generated text.
 
+        Clients sending "Accept: text/event-stream" get the answer as
+        server-sent events while it is generated (see streaming.py).
+
         Request body:
             {
                 "prompt": "Text prompt to send to the AI model",
@@ -46,144 +440,856 @@ class GenerateTextView(APIView):
                 "temperature": 1.0 (optional),
                 "top_p": 0.95 (optional),
                 "top_k": 64 (optional),
-                "max_output_tokens": 8192 (optional)
+                "max_output_tokens": 8192 (optional),
+                "session_id": "..." (optional - continues a chat session),
+                "start_session": true (optional - starts a chat session),
+                "deadline_seconds": 30 (optional - see cancellation.py)
             }
+
+        Answers in a session carry the session_id to send with the next
+        prompt; the server keeps the conversation (see sessions.py).
         """
-        # Validate input data
-        serializer = PromptSerializer(data=request.data)
-        if not serializer.is_valid():
-            logger.warning(f"Invalid input received: {serializer.errors}")
-            return Response(
-                {"error": "Invalid input", "details": serializer.errors},
-                status=status.HTTP_400_BAD_REQUEST,
-            )
+        with in_flight("generate"), first_request():
+            return self._generate(request)
 
-        # Get prompt from validated data
-        prompt = serializer.validated_data.get("prompt", "")
-        if not prompt:
-            logger.warning("Request received with empty prompt.")
-            return Response(
-                {"error": "Prompt is required"},
-                status=status.HTTP_400_BAD_REQUEST,
+    def _generate(self, request):
+        # Clients over their rate limit are turned away before anything else
+        client_id = client_identifier(request)
+        with timed("admission"):
+            try:
+                check_rate_limit(client_id)
+            except RateLimited as e:
+                return _error_response(*_generation_error(e))
+
+        with timed("validation"):
+            serializer = PromptSerializer(data=request.data)
+            error = _check_generate_request(serializer)
+            if error:
+                return _error_response(*error)
+
+            try:
+                # Overlong prompts are trimmed or rejected before anything else
+                prompt = apply_prompt_budget(serializer.validated_data["prompt"])
+            except TokenBudgetExceeded as e:
+                return _error_response(*_generation_error(e))
+
+        # The rest is answered from the requested knowledge base
+        base = _knowledge_base(serializer.validated_data)
+        with use_knowledge_base(base):
+            return self._generate_from(request, client_id, serializer, prompt, base)
+
+    def _generate_from(
+        self,
+        request,
+        client_id: str,
+        serializer: PromptSerializer,
+        prompt: str,
+        base: KnowledgeBase,
+    ):
+        """
+        Answers a validated prompt from its knowledge base, the current one:
+        FAQ, then the response cache, then the model.
+        """
+        # The model is only waited for until the request's deadline
+        deadline = request_deadline(request, serializer.validated_data)
+
+        # Follow-up questions are sent with the earlier turns of their session
+        with span("session"):
+            session, history = load_session(
+                serializer.validated_data.get("session_id"),
+                serializer.validated_data.get("start_session", False),
             )
 
-        model_name = serializer.validated_data.get(
-            "model",
-            settings.VERITAS_AI_MODEL,  # Ensure this setting exists
-        )
+        # Curated answers from data.csv skip the model entirely
+        with span("faq"):
+            faq_match = answer_from_faq(prompt)
+        if faq_match:
+            output_data = {**_faq_output(faq_match), **_session_fields(session)}
+            record_exchange(session, prompt, output_data["response"])
+            return self._answer(request, output_data)
+
+        # The rest go to the cheapest model likely to answer them well
+        with span("routing"):
+            decision = route_request(
+                serializer.validated_data,
+                prompt,
+                base.data_file_path,
+                model_preamble(),
+                follow_up=bool(history and history.last_user_text()),
+            )
+        model_name = decision.model
         logger.info(f"Processing prompt for model: {model_name}")
+        answer_fields = {**decision.fields(), **_session_fields(session)}
 
-        # Check if API key is configured
-        api_key = settings.GOOGLE_AI_API_KEY  # Ensure this setting exists
-        if not api_key:
-            logger.error("Google AI API key is not configured in settings.")
-            return Response(
-                {"error": "Google AI API key is not configured."},
-                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        with timed("client"):
+            # Shared, pooled client; rebuilt automatically if the key changes
+            client = get_genai_client()
+            generate_content_config = build_generate_content_config(
+                serializer.validated_data
             )
 
-        # Check if the Veritas data file exists *before* attempting complex logic
-        # Note: The helper function also checks, providing redundancy.
-        if not os.path.exists(VERITAS_DATA_FILE_PATH):
-            logger.error(f"Veritas data file not found at {VERITAS_DATA_FILE_PATH}")
-            return Response(
-                {"error": "Required data file not found on the server."},
-                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        # Identifies identical requests, for the cache and for coalescing
+        request_key = response_cache_key(
+            prompt,
+            model_name,
+            generate_content_config,
+            knowledge_base_version(base.data_file_path),
+            history.digest(),
+        )
+        cache_key = None
+        if cache_enabled(request, serializer.validated_data):
+            cache_key = request_key
+            with span("cache"):
+                cached = get_cached_response(cache_key)
+            if cached:
+                logger.info(f"Serving cached response for model {model_name}.")
+                record_exchange(session, prompt, cached["response"])
+                return self._answer(request, {**cached, "cached": True, **answer_fields})
+
+        # FAQ and cached answers are free; generations count against the
+        # client's token budget
+        try:
+            check_client_budget(client_id, estimate_text_tokens(prompt))
+        except ClientBudgetExceeded as e:
+            return _error_response(*_generation_error(e))
+
+        def remember(text, done_data):
+            # Followers of a coalesced generation made no upstream call
+            if not done_data.get("coalesced"):
+                charge_client_tokens(client_id, usage_tokens(done_data))
+            record_exchange(session, prompt, text)
+            # Only complete answers are worth serving again
+            if cache_key and done_data.get("finish_reason") == "STOP":
+                store_response(
+                    cache_key, _model_output(text, done_data.get("model", model_name))
+                )
+
+        # Identical prompts already being generated share that generation;
+        # the others wait for an upstream call slot. Slow or failing models
+        # are hedged / backed by the fallback models
+        models = model_chain(model_name, explicit="model" in serializer.validated_data)
+        # Streamed events are produced after the view returned; each one is
+        # produced with the knowledge base current
+        events = knowledge_base_events(
+            base,
+            timed_events(
+                coalesced_events(
+                    request_key,
+                    lambda: admitted_events(
+                        dispatch_veritas_events(
+                            client,
+                            models,
+                            prompt,
+                            generate_content_config,
+                            base.data_file_path,
+                            history,
+                            deadline,
+                        )
+                    ),
+                    deadline,
+                )
+            ),
+        )
+        if wants_event_stream(request):
+            try:
+                # Wait for the first event so errors before any output still
+                # get a proper status code.
+                first_event = next(events)
+            except Exception as e:
+                return self._failed(request, e, prompt, session)
+            return event_stream_response(
+                _encode_events(
+                    first_event,
+                    events,
+                    on_complete=remember,
+                    done_fields=answer_fields,
+                )
             )
 
         try:
-            # Configure the client with API key
-            client = genai.Client(api_key=api_key)
+            text, done_data = collect_events(events)
+        except Exception as e:
+            return self._failed(request, e, prompt, session)
+
+        remember(text, done_data)
+        # Prepare output data
+        output_data = {
+            **_model_output(text, done_data.get("model", model_name), done_data),
+            **answer_fields,
+        }
+        logger.info(f"Successfully generated response from model {model_name}.")
+
+        # Serialize and return the response
+        with timed("serialization"):
+            response_serializer = ResponseSerializer(output_data)
+            return Response(response_serializer.data)
+
+    def _answer(self, request, output_data: dict):
+        """
+        Responds with a ready-made answer, as JSON or as an event stream.
+        """
+        if wants_event_stream(request):
+            return event_stream_response(_answer_events(output_data))
+        return Response(ResponseSerializer(output_data).data)
+
+    def _failed(self, request, e: Exception, prompt: str, session):
+        """
+        Responds to a failed generation with a degraded answer if the AI
+        service is down, otherwise with the error.
+        """
+        output_data = _degraded_output(e, prompt)
+        if output_data:
+            return self._answer(request, {**output_data, **_session_fields(session)})
+        return _error_response(*_generation_error(e))
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncGenerateTextView(View):
+    """
+    Async counterpart of GenerateTextView for ASGI deployments.
+
+    Uses client.aio for the data file upload and the streamed generation, so
+    a single worker process can hold many in-flight chats while it waits on
+    the upstream API. Accepts the same request body and returns the same
+    response shape as GenerateTextView, including server-sent events for
+    "Accept: text/event-stream" clients.
+    """
 
-            # --- Use the helper function to build contents ---
-            contents = build_veritas_chat_contents(
-                client=client, file_path=VERITAS_DATA_FILE_PATH, prompt=prompt
+    http_method_names = ["post", "options"]
+
+    async def post(self, request):
+        with in_flight("generate_async"), first_request():
+            return await self._generate(request)
+
+    async def _generate(self, request):
+        streaming = wants_event_stream(request)
+        error_response = _event_stream_error if streaming else _json_error
+
+        client_id = client_identifier(request)
+        with timed("admission"):
+            try:
+                await acheck_rate_limit(client_id)
+            except RateLimited as e:
+                return error_response(*_generation_error(e))
+
+        with timed("validation"):
+            try:
+                data = json.loads(request.body or b"{}")
+            except ValueError as e:
+                return JsonResponse(
+                    {"detail": f"JSON parse error - {e}"},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            serializer = PromptSerializer(data=data)
+            error = _check_generate_request(serializer)
+            if error:
+                return error_response(*error)
+
+            try:
+                prompt = apply_prompt_budget(serializer.validated_data["prompt"])
+            except TokenBudgetExceeded as e:
+                return error_response(*_generation_error(e))
+
+        base = _knowledge_base(serializer.validated_data)
+        with use_knowledge_base(base):
+            return await self._generate_from(
+                streaming, request, client_id, serializer, prompt, base
             )
 
-            # The helper function now handles fallback, so contents should always be a list.
-            # A check for None could be added if the helper might return it on critical failure.
-            # if contents is None:
-            #     logger.error("Failed to build chat contents critically.")
-            #     return Response(
-            #         {"error": "Failed to prepare data for AI model."},
-            #         status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            #     )
-
-            # Configuration for generation
-            # Keep system instruction here as it's part of the generation config, not the history
-            system_instruction = [
-                types.Part.from_text(
-                    text="You are An AI chatbot for Veritas University Abuja. You will answer questions respectfully and give accurate answers based primarily on the provided document and context. If the answer isn't in the document or context, state that you don't have that specific information."
-                ),
-            ]
-            generate_content_config = types.GenerateContentConfig(
-                temperature=serializer.validated_data.get(
-                    "temperature", 0.9
-                ),  # Adjusted default temp
-                top_p=serializer.validated_data.get("top_p", 0.95),
-                top_k=serializer.validated_data.get("top_k", 64),
-                max_output_tokens=serializer.validated_data.get(
-                    "max_output_tokens", 8192
-                ),
-                response_mime_type="text/plain",
-                # system_instruction=system_instruction # Use if model supports it correctly
+    async def _generate_from(
+        self,
+        streaming: bool,
+        request,
+        client_id: str,
+        serializer: PromptSerializer,
+        prompt: str,
+        base: KnowledgeBase,
+    ):
+        """
+        Async version of GenerateTextView._generate_from.
+        """
+        error_response = _event_stream_error if streaming else _json_error
+        deadline = request_deadline(request, serializer.validated_data)
+
+        with span("session"):
+            session, history = await aload_session(
+                serializer.validated_data.get("session_id"),
+                serializer.validated_data.get("start_session", False),
             )
 
-            logger.info(
-                f"Sending request to Gemini model '{model_name}' with {len(contents)} content parts."
+        with span("faq"):
+            faq_match = answer_from_faq(prompt)
+        if faq_match:
+            output_data = {**_faq_output(faq_match), **_session_fields(session)}
+            await arecord_exchange(session, prompt, output_data["response"])
+            return self._answer(streaming, output_data)
+
+        with span("routing"):
+            # Classifying may index the data file, which blocks
+            decision = await sync_to_async(route_request, thread_sensitive=False)(
+                serializer.validated_data,
+                prompt,
+                base.data_file_path,
+                model_preamble(),
+                follow_up=bool(history and history.last_user_text()),
             )
-            # Generate content - Pass system instruction if applicable/desired
-            # Note: System Instruction placement depends on the exact model and API version.
-            # Sometimes it's part of GenerateContentConfig, sometimes prepended to 'contents'.
-            # Check the genai library documentation for your specific model.
-            # For now, assuming it's in the config:
-            response_stream = client.models.generate_content_stream(
-                model=model_name,
-                contents=contents,
-                config=generate_content_config,
-                # If system_instruction should be part of contents:
-                # contents=[types.Content(parts=system_instruction, role='system')] + contents
+        model_name = decision.model
+        logger.info(f"Processing async prompt for model: {model_name}")
+        answer_fields = {**decision.fields(), **_session_fields(session)}
+
+        with timed("client"):
+            client = get_genai_client()
+            generate_content_config = build_generate_content_config(
+                serializer.validated_data
             )
 
-            response_text = ""
-            for chunk in response_stream:
-                # Add basic error handling for chunks if needed (e.g., chunk.prompt_feedback)
-                try:
-                    response_text += chunk.text
-                except ValueError:
-                    logger.warning(
-                        f"Received chunk without text, possibly finish reason: {chunk.candidates[0].finish_reason}"
-                    )
-                except Exception as chunk_err:
-                    logger.error(f"Error processing chunk: {chunk_err}")
+        request_key = response_cache_key(
+            prompt,
+            model_name,
+            generate_content_config,
+            knowledge_base_version(base.data_file_path),
+            history.digest(),
+        )
+        cache_key = None
+        if cache_enabled(request, serializer.validated_data):
+            cache_key = request_key
+            with span("cache"):
+                cached = await aget_cached_response(cache_key)
+            if cached:
+                logger.info(f"Serving cached response for model {model_name}.")
+                await arecord_exchange(session, prompt, cached["response"])
+                return self._answer(streaming, {**cached, "cached": True, **answer_fields})
 
-            # Prepare output data
-            output_data = {"response": response_text.strip(), "model": model_name}
-            logger.info(f"Successfully generated response from model {model_name}.")
+        try:
+            await acheck_client_budget(client_id, estimate_text_tokens(prompt))
+        except ClientBudgetExceeded as e:
+            return error_response(*_generation_error(e))
 
-            # Serialize and return the response
-            response_serializer = ResponseSerializer(output_data)
-            return Response(response_serializer.data)
+        async def remember(text, done_data):
+            if not done_data.get("coalesced"):
+                await acharge_client_tokens(client_id, usage_tokens(done_data))
+            await arecord_exchange(session, prompt, text)
+            if cache_key and done_data.get("finish_reason") == "STOP":
+                await astore_response(
+                    cache_key, _model_output(text, done_data.get("model", model_name))
+                )
+
+        models = model_chain(model_name, explicit="model" in serializer.validated_data)
+        events = aknowledge_base_events(
+            base,
+            atimed_events(
+                acoalesced_events(
+                    request_key,
+                    lambda: aadmitted_events(
+                        adispatch_veritas_events(
+                            client,
+                            models,
+                            prompt,
+                            generate_content_config,
+                            base.data_file_path,
+                            history,
+                            deadline,
+                        )
+                    ),
+                    deadline,
+                )
+            ),
+        )
+        if streaming:
+            try:
+                first_event = await anext(events)
+            except Exception as e:
+                return await self._failed(streaming, e, prompt, session)
+            return event_stream_response(
+                _aencode_events(
+                    first_event,
+                    events,
+                    on_complete=remember,
+                    done_fields=answer_fields,
+                )
+            )
+
+        try:
+            text, done_data = await acollect_events(events)
+        except Exception as e:
+            return await self._failed(streaming, e, prompt, session)
+
+        await remember(text, done_data)
+        output_data = {
+            **_model_output(text, done_data.get("model", model_name), done_data),
+            **answer_fields,
+        }
+        logger.info(f"Successfully generated async response from model {model_name}.")
+        with timed("serialization"):
+            return JsonResponse(ResponseSerializer(output_data).data)
+
+    def _answer(self, streaming: bool, output_data: dict):
+        if streaming:
+            return event_stream_response(_answer_events(output_data))
+        return JsonResponse(ResponseSerializer(output_data).data)
+
+    async def _failed(self, streaming: bool, e: Exception, prompt: str, session):
+        # Finding passages may index the data file, which blocks
+        output_data = await sync_to_async(_degraded_output, thread_sensitive=False)(
+            e, prompt
+        )
+        if output_data:
+            return self._answer(streaming, {**output_data, **_session_fields(session)})
+        error_response = _event_stream_error if streaming else _json_error
+        return error_response(*_generation_error(e))
+
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# Parameters that may be shared by all batch items or set per item
+BATCH_ITEM_PARAMS = ("model", "temperature", "top_p", "max_output_tokens", "use_cache")
+
+
+async def _abatch_answer(
+    request, client, data: dict, prepare_context: Callable[[str], Awaitable[None]]
+) -> dict:
+    """
+    Answers one batch item: FAQ, then the response cache, then the model.
 
-        except ImportError as e:
-            logger.critical(f"Failed to import required libraries: {str(e)}")
-            return Response(
-                {
-                    "error": f"Server configuration error: Required libraries are not installed: {str(e)}"
-                },
-                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+    Args:
+        request: The batch request.
+        client: The Google AI client.
+        data: The item's parameters.
+        prepare_context: Prepares the shared context for the model the item
+            is routed to, once per model and batch.
+
+    Returns:
+        The response data, or {"error": ..., "status": ...} if the item
+        failed.
+    """
+    # Each item counts against the client's rate limit like a request
+    try:
+        await acheck_rate_limit(client_identifier(request))
+    except RateLimited as e:
+        payload, status_code = _generation_error(e)
+        return {**payload, "status": status_code}
+
+    serializer = PromptSerializer(data=data)
+    if not serializer.is_valid():
+        return {
+            "error": "Invalid input",
+            "details": serializer.errors,
+            "status": status.HTTP_400_BAD_REQUEST,
+        }
+
+    try:
+        prompt = apply_prompt_budget(serializer.validated_data["prompt"])
+    except TokenBudgetExceeded as e:
+        payload, status_code = _generation_error(e)
+        return {**payload, "status": status_code}
+    faq_match = answer_from_faq(prompt)
+    if faq_match:
+        return _faq_output(faq_match)
+    data_file_path = current_knowledge_base().data_file_path
+    decision = await sync_to_async(route_request, thread_sensitive=False)(
+        serializer.validated_data, prompt, data_file_path, model_preamble()
+    )
+    model_name = decision.model
+
+    generate_content_config = build_generate_content_config(serializer.validated_data)
+    request_key = response_cache_key(
+        prompt,
+        model_name,
+        generate_content_config,
+        knowledge_base_version(data_file_path),
+    )
+    cache_key = None
+    if cache_enabled(request, serializer.validated_data):
+        cache_key = request_key
+        cached = await aget_cached_response(cache_key)
+        if cached:
+            return {**cached, "cached": True, **decision.fields()}
+
+    await prepare_context(model_name)
+    client_id = client_identifier(request)
+    models = model_chain(model_name, explicit="model" in serializer.validated_data)
+    try:
+        await acheck_client_budget(client_id, estimate_text_tokens(prompt))
+        text, done_data = await acollect_events(
+            atimed_events(
+                acoalesced_events(
+                    request_key,
+                    lambda: aadmitted_events(
+                        adispatch_veritas_events(
+                            client,
+                            models,
+                            prompt,
+                            generate_content_config,
+                            data_file_path,
+                        )
+                    ),
+                )
             )
-        except types.generation_types.BlockedPromptException as e:
-            logger.warning(f"Prompt blocked by API: {e}")
-            return Response(
-                {"error": "Request blocked due to safety concerns.", "details": str(e)},
+        )
+    except Exception as e:
+        output_data = await sync_to_async(_degraded_output, thread_sensitive=False)(
+            e, prompt
+        )
+        if output_data:
+            return output_data
+        payload, status_code = _generation_error(e)
+        return {**payload, "status": status_code}
+
+    await acharge_client_tokens(client_id, usage_tokens(done_data))
+    model_name = done_data.get("model", model_name)
+    if cache_key and done_data.get("finish_reason") == "STOP":
+        await astore_response(cache_key, _model_output(text, model_name))
+    return {**_model_output(text, model_name, done_data), **decision.fields()}
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class BatchGenerateTextView(View):
+    """
+    Generates answers for many prompts in one request.
+
+    The shared context (passage index or uploaded data file) is built once
+    for each model the prompts are routed to, and the prompts are generated
+    concurrently, at most "concurrency" at a time
+    (VERITAS_BATCH_CONCURRENCY by default and at most). Each prompt takes a
+    rate limit token; a rate limited, failing or timed out prompt gets an
+    error result and the rest of the batch completes. Batch prompts are
+    answered on their own: session_id is ignored, and knowledge_base can
+    only be set for the whole batch.
+
+    Request body:
+        {
+            "prompts": ["...", "..."] or
+            "items": [{"prompt": "...", "temperature": 0.2}, ...],
+            "model", "temperature", "top_p", "max_output_tokens",
+            "use_cache": shared parameters (optional),
+            "concurrency": 4 (optional)
+        }
+
+    Responds with {"results": [...]} in request order, or with one JSON line
+    per prompt as it finishes for "Accept: application/x-ndjson" clients.
+    """
+
+    http_method_names = ["post", "options"]
+
+    async def post(self, request):
+        with in_flight("batch"):
+            return await self._generate(request)
+
+    async def _generate(self, request):
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError as e:
+            return JsonResponse(
+                {"detail": f"JSON parse error - {e}"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        except Exception as e:
-            logger.exception(
-                f"An unexpected error occurred calling Google AI API: {str(e)}"
-            )  # Use exception for traceback
-            return Response(
-                {"error": f"Error communicating with the AI service."},
-                status=status.HTTP_503_SERVICE_UNAVAILABLE,  # Use 503 for external service issues
+
+        serializer = BatchPromptSerializer(data=data)
+        if not serializer.is_valid():
+            logger.warning(f"Invalid batch input received: {serializer.errors}")
+            return _json_error(
+                {"error": "Invalid input", "details": serializer.errors},
+                status.HTTP_400_BAD_REQUEST,
+            )
+        validated = serializer.validated_data
+        base = _knowledge_base(validated)
+        error = _check_server_configuration(base)
+        if error:
+            return _json_error(*error)
+
+        shared = {key: data[key] for key in BATCH_ITEM_PARAMS if key in data}
+        items = [
+            {**shared, **item}
+            for item in validated.get("items")
+            or [{"prompt": prompt} for prompt in validated["prompts"]]
+        ]
+        concurrency = min(
+            validated.get("concurrency", settings.VERITAS_BATCH_CONCURRENCY),
+            settings.VERITAS_BATCH_CONCURRENCY,
+        )
+        logger.info(f"Processing batch of {len(items)} prompts, concurrency {concurrency}.")
+
+        client = get_genai_client()
+        # Routed items may use different models; the first item of each
+        # prepares its context and the others wait for it
+        preparing: dict[str, asyncio.Task] = {}
+
+        async def prepare_context(model_name):
+            task = preparing.get(model_name)
+            if task is None:
+                task = preparing[model_name] = asyncio.ensure_future(
+                    aprepare_veritas_context(client, model_name, base.data_file_path)
+                )
+            # A timed out item mustn't cancel it for the others
+            await asyncio.shield(task)
+
+        async def answer(item):
+            # Items run in tasks of their own, possibly after the view returned
+            with use_knowledge_base(base):
+                result = await _abatch_answer(request, client, item, prepare_context)
+            return {"prompt": item.get("prompt"), **result}
+
+        results = run_batch(
+            items, answer, concurrency, settings.VERITAS_BATCH_ITEM_TIMEOUT_SECONDS
+        )
+        if NDJSON_CONTENT_TYPE in request.headers.get("Accept", ""):
+
+            async def lines():
+                async for result in results:
+                    yield json.dumps(result, default=str) + "\n"
+
+            response = StreamingHttpResponse(lines(), content_type=NDJSON_CONTENT_TYPE)
+            response["X-Accel-Buffering"] = "no"
+            return response
+
+        ordered = sorted([result async for result in results], key=lambda r: r["index"])
+        return JsonResponse({"results": ordered})
+
+
+def answer_job(params: dict, client_id: str, progress: JobProgress) -> dict:
+    """
+    Answers a generation job (see jobs.py) like GenerateTextView: FAQ, then
+    the response cache, then the model, whose answer is streamed into the
+    job's partial text.
+
+    Args:
+        params: The generate request parameters the job was queued with.
+        client_id: The client the job's tokens are charged to.
+        progress: Collects the answer and notices when the job stops.
+
+    Returns:
+        The response data, or {"error": ..., "status": ...} if the job failed.
+
+    Raises:
+        JobStopped: The job was cancelled or missed its deadline; the model
+            stream has been closed.
+    """
+    serializer = PromptSerializer(data=params)
+    error = _check_generate_request(serializer)
+    if error:
+        payload, status_code = error
+        return {**payload, "status": status_code}
+    validated = serializer.validated_data
+
+    try:
+        prompt = apply_prompt_budget(validated["prompt"])
+    except TokenBudgetExceeded as e:
+        payload, status_code = _generation_error(e)
+        return {**payload, "status": status_code}
+
+    base = _knowledge_base(validated)
+    with use_knowledge_base(base):
+        return _answer_job_from(validated, prompt, client_id, progress, base)
+
+
+def _answer_job_from(
+    validated: dict, prompt: str, client_id: str, progress: JobProgress, base: KnowledgeBase
+) -> dict:
+    """
+    Answers a job's validated prompt from its knowledge base, the current
+    one.
+    """
+    session, history = load_session(
+        validated.get("session_id"), validated.get("start_session", False)
+    )
+    faq_match = answer_from_faq(prompt)
+    if faq_match:
+        output_data = {**_faq_output(faq_match), **_session_fields(session)}
+        record_exchange(session, prompt, output_data["response"])
+        return output_data
+
+    decision = route_request(
+        validated,
+        prompt,
+        base.data_file_path,
+        model_preamble(),
+        follow_up=bool(history and history.last_user_text()),
+    )
+    model_name = decision.model
+    answer_fields = {**decision.fields(), **_session_fields(session)}
+
+    client = get_genai_client()
+    generate_content_config = build_generate_content_config(validated)
+    request_key = response_cache_key(
+        prompt,
+        model_name,
+        generate_content_config,
+        knowledge_base_version(base.data_file_path),
+        history.digest(),
+    )
+    cache_key = None
+    if cache_enabled(None, validated):
+        cache_key = request_key
+        cached = get_cached_response(cache_key)
+        if cached:
+            record_exchange(session, prompt, cached["response"])
+            return {**cached, "cached": True, **answer_fields}
+
+    models = model_chain(model_name, explicit="model" in validated)
+    deadline = progress.monotonic_deadline()
+    try:
+        check_client_budget(client_id, estimate_text_tokens(prompt))
+        text, done_data = collect_events(
+            progress.track(
+                timed_events(
+                    coalesced_events(
+                        request_key,
+                        lambda: admitted_events(
+                            dispatch_veritas_events(
+                                client,
+                                models,
+                                prompt,
+                                generate_content_config,
+                                base.data_file_path,
+                                history,
+                                deadline=deadline,
+                                cancelled=progress.cancelled,
+                            )
+                        ),
+                        deadline,
+                    )
+                )
+            )
+        )
+    except JobStopped:
+        raise
+    except RequestCancelled:
+        # Noticed while the model sent nothing
+        raise JobStopped(STOPPED_CANCELLED)
+    except RequestDeadlineExceeded:
+        # Also when the model hadn't sent a chunk by the job's deadline
+        raise JobStopped(STOPPED_DEADLINE)
+    except Exception as e:
+        output_data = _degraded_output(e, prompt)
+        if output_data:
+            return {**output_data, **_session_fields(session)}
+        payload, status_code = _generation_error(e)
+        return {**payload, "status": status_code}
+
+    charge_client_tokens(client_id, usage_tokens(done_data))
+    record_exchange(session, prompt, text)
+    model_name = done_data.get("model", model_name)
+    if cache_key and done_data.get("finish_reason") == "STOP":
+        store_response(cache_key, _model_output(text, model_name))
+    return {**_model_output(text, model_name, done_data), **answer_fields}
+
+
+class JobsView(APIView):
+    """
+    Queues a generation as a job (see jobs.py), for answers too long to wait
+    for on one connection.
+    """
+
+    parser_classes = (JSONParser,)
+
+    def post(self, request):
+        """
+        Queues a generation and responds right away with 202 and the job;
+        poll GET /api/jobs/<id>/ for its status, partial text and result.
+
+        Request body: a generate request (see GenerateTextView.post) plus
+            "priority": 0 (optional - -10 to 10, higher runs first),
+            "deadline_seconds": 600 (optional - capped by
+            VERITAS_JOB_MAX_DEADLINE_SECONDS)
+        """
+        client_id = client_identifier(request)
+        try:
+            check_rate_limit(client_id)
+        except RateLimited as e:
+            return _error_response(*_generation_error(e))
+
+        serializer = JobSerializer(data=request.data)
+        error = _check_generate_request(serializer)
+        if error:
+            return _error_response(*error)
+
+        params = {
+            key: value
+            for key, value in serializer.data.items()
+            if key not in JobSerializer.SCHEDULING_FIELDS
+        }
+        # The job runs without the request; keep its opt-out of the cache
+        if "no-cache" in request.headers.get("Cache-Control", "").lower():
+            params["use_cache"] = False
+        try:
+            job = enqueue_job(
+                params,
+                client_id,
+                priority=serializer.validated_data.get("priority", 0),
+                deadline_seconds=serializer.validated_data.get("deadline_seconds"),
             )
+        except QueueFull as e:
+            return _error_response(*_generation_error(e))
+        return Response(
+            job_payload(job),
+            status=status.HTTP_202_ACCEPTED,
+            headers={"Location": reverse("job-detail", args=[job.id])},
+        )
+
+
+class JobDetailView(APIView):
+    """
+    API endpoint reporting a job's status, partial text and result.
+    """
+
+    def get(self, request, job_id):
+        job = get_job(job_id)
+        if job is None:
+            return _error_response({"error": "Job not found."}, status.HTTP_404_NOT_FOUND)
+        return Response(job_payload(job))
+
+
+class JobCancelView(APIView):
+    """
+    API endpoint cancelling a queued or running job.
+    """
+
+    def post(self, request, job_id):
+        cancelled = cancel_job(job_id)
+        job = get_job(job_id)
+        if job is None:
+            return _error_response({"error": "Job not found."}, status.HTTP_404_NOT_FOUND)
+        if not cancelled:
+            return _error_response(
+                {"error": f"Job already {job.status}.", **job_payload(job)},
+                status.HTTP_409_CONFLICT,
+            )
+        return Response(job_payload(job))
+
+
+class MetricsView(View):
+    """
+    Prometheus metrics in the text exposition format (see metrics.py).
+    """
+
+    http_method_names = ["get", "options"]
+
+    def get(self, request):
+        if not metrics_enabled():
+            raise Http404("Metrics are disabled.")
+        return HttpResponse(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+class ReadinessView(View):
+    """
+    Readiness probe for the load balancer: 200 once the worker finished its
+    warm-up (see warmup.py), 503 while it is still cold.
+    """
+
+    http_method_names = ["get", "head", "options"]
+
+    def get(self, request):
+        state = warmup_state.snapshot()
+        if is_ready():
+            return JsonResponse({**state, "status": "ready"})
+        return JsonResponse(state, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+class StatsView(APIView):
+    """
+    API endpoint reporting the in-process counters of the AI API components.
+    """
+
+    def get(self, request):
+        return Response(snapshot_all())
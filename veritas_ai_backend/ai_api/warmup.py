@@ -0,0 +1,326 @@
+"""
+Warm-up of a worker before it takes traffic.
+
+The first request after a deploy or restart used to pay for every cold cost:
+building the FAQ and passage indexes, constructing the Gemini client,
+uploading (or looking up) the data file, creating the cached context and
+opening the first connection. Warm-up does all of it ahead of time, in a
+background thread started by AiApiConfig.ready() in processes that serve
+requests (VERITAS_WARMUP_ON_STARTUP, see serves_requests), or with
+"python manage.py warmup" before the server starts. /api/health/ready
+reports the worker ready only once its warm-up finished, so the load
+balancer keeps traffic away from cold workers.
+
+The data steps run for the default knowledge base and for the
+VERITAS_KB_WARMUP_COUNT most used other bases (by their request counts in
+the shared cache, see knowledge_bases.py), whose steps are reported as
+"<base>.<step>". Less used bases are loaded by their first request.
+
+A failed step is logged and reported, but doesn't keep the worker out of
+service: requests fall back as they would have without it.
+
+Step timings and the latency of the worker's first generate request (and
+whether it arrived warm) are reported under "warmup" at /api/stats/ and in
+the veritas_warmup_seconds and veritas_first_request_seconds metrics.
+"""
+# warmup.py
+
+import logging
+import os
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from google.genai import types
+
+from .ai_helpers import model_preamble, prepare_cached_context
+from .client_provider import get_genai_client
+from .dispatch import model_chain
+from .faq import get_faq_matcher
+from .file_registry import get_file_handle
+from .knowledge_bases import current_knowledge_base, most_used_knowledge_bases, use_knowledge_base
+from .metrics import first_request_seconds, warmup_seconds
+from .retrieval import CONTEXT_MODE_RETRIEVAL, context_mode, get_passage_index
+from .routing import routed_models
+from .stats import register
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_RUNNING = "running"
+STATUS_READY = "ready"
+
+WARMUP_PROMPT = "ping"
+
+# Programs whose processes serve requests (WSGI and ASGI servers)
+SERVER_PROGRAMS = ("gunicorn", "uvicorn", "daphne", "hypercorn", "uwsgi", "granian")
+# "1" or "0" overrides what serves_requests() guesses from the command line
+SERVES_REQUESTS_ENV = "VERITAS_SERVES_REQUESTS"
+
+
+def warmup_enabled() -> bool:
+    return getattr(settings, "VERITAS_WARMUP_ON_STARTUP", True)
+
+
+class WarmupState:
+    """
+    Progress of the worker's warm-up and its first request, reported at
+    /api/stats/.
+    """
+
+    def __init__(self, component: str):
+        self.component = component
+        self._lock = threading.Lock()
+        self.reset()
+        register(self)
+
+    def reset(self) -> None:
+        with self._lock:
+            self.status = STATUS_PENDING
+            self.steps: dict[str, float] = {}
+            self.errors: dict[str, str] = {}
+            self.total_ms: float | None = None
+            self.first_request_ms: float | None = None
+            self.first_request_warm: bool | None = None
+
+    def record_first_request(self, milliseconds: float) -> bool | None:
+        """
+        Records the latency of the first request.
+
+        Returns:
+            Whether the worker was warm, or None if this isn't the first
+            request.
+        """
+        with self._lock:
+            if self.first_request_ms is not None:
+                return None
+            self.first_request_ms = round(milliseconds, 2)
+            self.first_request_warm = self.status == STATUS_READY
+            return self.first_request_warm
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "status": self.status,
+                "total_ms": self.total_ms,
+                "steps_ms": dict(self.steps),
+                "errors": dict(self.errors),
+                "first_request_ms": self.first_request_ms,
+                "first_request_warm": self.first_request_warm,
+            }
+
+
+warmup_state = WarmupState("warmup")
+
+
+def is_ready() -> bool:
+    """
+    Returns True once the worker's warm-up finished, or if it doesn't warm
+    up.
+    """
+    return warmup_state.status == STATUS_READY or not warmup_enabled()
+
+
+# Steps
+
+
+def _data_file_path() -> str:
+    return current_knowledge_base().data_file_path
+
+
+def _warm_faq() -> None:
+    get_faq_matcher()
+
+
+def _warm_passage_index() -> None:
+    if context_mode() == CONTEXT_MODE_RETRIEVAL:
+        get_passage_index(_data_file_path(), model_preamble())
+
+
+def _warm_client() -> None:
+    get_genai_client()
+
+
+def _warm_data_file() -> None:
+    # Requests in retrieval mode still attach the file when no passage is
+    # relevant, so it is uploaded in either mode.
+    get_file_handle(get_genai_client(), _data_file_path())
+
+
+def _warm_cached_context() -> None:
+    """
+    Creates the cached context of every model a request may be routed to
+    or fall back to, so routed requests find theirs too.
+    """
+    models = dict.fromkeys(
+        chained for model in routed_models() for chained in model_chain(model)
+    )
+    errors = []
+    for model in models:
+        try:
+            prepare_cached_context(get_genai_client(), model, _data_file_path())
+        except Exception as e:
+            errors.append(f"{model}: {e}")
+    if errors:
+        raise RuntimeError("; ".join(errors))
+
+
+def _warm_generation() -> None:
+    """
+    A one-token generation, so the first request finds the connection to
+    the API open.
+    """
+    stream = get_genai_client().models.generate_content_stream(
+        model=settings.VERITAS_AI_MODEL,
+        contents=WARMUP_PROMPT,
+        config=types.GenerateContentConfig(max_output_tokens=1),
+    )
+    for _ in stream:
+        pass
+
+
+WARMUP_STEPS = (
+    ("faq", _warm_faq),
+    ("passage_index", _warm_passage_index),
+    ("client", _warm_client),
+    ("data_file", _warm_data_file),
+    ("cached_context", _warm_cached_context),
+    ("generation", _warm_generation),
+)
+# Steps that don't depend on the knowledge base, run once
+SHARED_STEPS = ("client", "generation")
+
+
+def _warmup_bases() -> list:
+    count = min(
+        getattr(settings, "VERITAS_KB_WARMUP_COUNT", 0),
+        max(getattr(settings, "VERITAS_KB_MAX_RESIDENT", 1) - 1, 0),
+    )
+    return most_used_knowledge_bases(count)
+
+
+def _steps() -> list[tuple]:
+    """
+    Returns the (name, function, knowledge base) steps to run, the default
+    base's first.
+    """
+    steps = list(WARMUP_STEPS)
+    if not getattr(settings, "VERITAS_WARMUP_GENERATION", False):
+        steps = [step for step in steps if step[0] != "generation"]
+    bases = _warmup_bases()
+    planned = [(name, function, bases[0]) for name, function in steps]
+    for base in bases[1:]:
+        planned.extend(
+            (f"{base.name}.{name}", function, base)
+            for name, function in steps
+            if name not in SHARED_STEPS
+        )
+    return planned
+
+
+_run_lock = threading.Lock()
+
+
+def run_warmup() -> dict:
+    """
+    Runs the warm-up steps and marks the worker ready.
+
+    Returns:
+        The warm-up report: status, total and per-step milliseconds, and
+        the errors of failed steps.
+    """
+    with _run_lock:
+        if warmup_state.status == STATUS_READY:
+            return warmup_state.snapshot()
+        warmup_state.status = STATUS_RUNNING
+        started = time.perf_counter()
+        for name, function, base in _steps():
+            step_started = time.perf_counter()
+            try:
+                with use_knowledge_base(base):
+                    function()
+            except Exception as e:
+                logger.error(f"Warm-up step {name} failed: {e}")
+                warmup_state.errors[name] = str(e)
+            elapsed = time.perf_counter() - step_started
+            warmup_seconds.observe(elapsed, step=name)
+            warmup_state.steps[name] = round(elapsed * 1000, 2)
+        warmup_state.total_ms = round((time.perf_counter() - started) * 1000, 2)
+        warmup_state.status = STATUS_READY
+        logger.info(f"Warm-up finished in {warmup_state.total_ms}ms: {warmup_state.steps}")
+        return warmup_state.snapshot()
+
+
+def serves_requests() -> bool:
+    """
+    Returns True in processes that serve requests: runserver (not its
+    autoreloader process) and the servers in SERVER_PROGRAMS, also when run
+    with "python -m". Management commands, shells and scripts that call
+    django.setup() get neither warm-up nor job workers. Set
+    VERITAS_SERVES_REQUESTS=1 for another server, or 0 to turn both off.
+    """
+    override = os.environ.get(SERVES_REQUESTS_ENV)
+    if override is not None:
+        return override.strip().lower() in ("1", "true", "yes")
+    argv = getattr(sys, "argv", None) or [""]
+    program = os.path.basename(argv[0])
+    if program == "__main__.py":
+        # python -m gunicorn
+        program = os.path.basename(os.path.dirname(argv[0]))
+    if program in ("manage.py", "django-admin"):
+        if argv[1:2] != ["runserver"]:
+            return False
+        return "--noreload" in argv or os.environ.get("RUN_MAIN") == "true"
+    return program in SERVER_PROGRAMS
+
+
+def start_warmup() -> threading.Thread:
+    """
+    Runs the warm-up in a background thread so the server starts accepting
+    (health check) connections right away.
+    """
+
+    def run():
+        try:
+            run_warmup()
+        finally:
+            # The file registry and context cache use the database
+            connections.close_all()
+
+    thread = threading.Thread(target=run, daemon=True, name="veritas-warmup")
+    thread.start()
+    return thread
+
+
+class first_request:
+    """
+    Context manager timing the worker's first generate request.
+    """
+
+    __slots__ = ("started",)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if warmup_state.first_request_ms is not None:
+            return
+        elapsed = time.perf_counter() - self.started
+        warm = warmup_state.record_first_request(elapsed * 1000)
+        if warm is None:
+            return
+        first_request_seconds.observe(elapsed, warm=str(warm).lower())
+        logger.info(
+            f"First request served in {elapsed * 1000:.0f}ms "
+            f"({'warm' if warm else 'cold'})"
+        )
+
+
+def reset_warmup() -> None:
+    """
+    Marks the worker cold again (used by tests and benchmarks).
+    """
+    warmup_state.reset()
@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -48,6 +49,8 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # After authentication, so staff sessions may request profiling
+    "ai_api.tracing.TracingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -152,3 +155,320 @@ DEFAULT_GEMINI_MODEL = "gemini-2.0-flash"
 # VERITAS_AI_MODEL = " tunedModels/veritasai1-asmlxpf43sd9"
 
 VERITAS_AI_MODEL = "gemini-2.0-pro-exp-02-05"
+
+# Uploaded file handles are treated as expired this many seconds before the
+# expiration time reported by the Files API.
+VERITAS_FILE_HANDLE_EXPIRY_MARGIN_SECONDS = 600
+
+# How long a worker may hold the upload lease for the data file before other
+# workers stop waiting for it.
+VERITAS_FILE_UPLOAD_LOCK_TIMEOUT_SECONDS = 60
+
+# Maximum number of pooled keep-alive connections the shared Google AI client
+# keeps open per process.
+VERITAS_GENAI_POOL_MAXSIZE = 32
+
+# The Veritas data file sent to the model (the default knowledge base's)
+VERITAS_DATA_FILE_PATH = BASE_DIR / "veritas_data" / "Veritas_data.pdf"
+
+# Curated prompt/response pairs answered locally without calling the model.
+VERITAS_FAQ_ENABLED = True
+VERITAS_FAQ_CSV_PATH = BASE_DIR.parent / "data.csv"
+# Minimum cosine similarity (0.0 to 1.0) between a prompt and an FAQ prompt
+# for the curated answer to be returned.
+VERITAS_FAQ_MATCH_THRESHOLD = 0.7
+# How often workers check data.csv for changes.
+VERITAS_FAQ_RELOAD_CHECK_SECONDS = 5
+
+# Caches: the "responses" alias is the shared tier of the generated answer
+# cache, a table in the project database (create it with
+# `python manage.py createcachetable`).
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "responses": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "veritas_response_cache",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+# Generated answer cache, keyed by normalized prompt, model, generation
+# parameters and knowledge base version.
+VERITAS_RESPONSE_CACHE_ENABLED = True
+VERITAS_RESPONSE_CACHE_ALIAS = "responses"
+VERITAS_RESPONSE_CACHE_TTL_SECONDS = 6 * 60 * 60
+# Entries kept in each worker's in-memory tier.
+VERITAS_RESPONSE_CACHE_MAX_ENTRIES = 512
+
+# How the knowledge base is sent with each prompt: "retrieval" sends only the
+# passages of Veritas_data.pdf relevant to the prompt, "full" attaches the
+# whole file and the model preamble. Retrieval needs pypdf and falls back to
+# the full file when nothing relevant is found.
+VERITAS_CONTEXT_MODE = "retrieval"
+# Number of passages sent per prompt.
+VERITAS_RETRIEVAL_TOP_K = 6
+# Passage length, and the words each passage shares with the previous one.
+VERITAS_RETRIEVAL_PASSAGE_WORDS = 120
+VERITAS_RETRIEVAL_PASSAGE_OVERLAP_WORDS = 30
+
+# Upstream context caching of the fixed prefix (system instruction, data file
+# and preamble) sent when the whole data file is used.
+VERITAS_CONTEXT_CACHE_ENABLED = True
+VERITAS_CONTEXT_CACHE_TTL_SECONDS = 60 * 60
+# The TTL is extended when less than this is left.
+VERITAS_CONTEXT_CACHE_REFRESH_MARGIN_SECONDS = 5 * 60
+# How long to wait before trying again for a model that rejected caching.
+VERITAS_CONTEXT_CACHE_RETRY_SECONDS = 60 * 60
+
+# Identical prompts that arrive while the same answer is being generated wait
+# for it instead of calling the model again.
+VERITAS_COALESCE_ENABLED = True
+# Longest a waiting request accepts no progress from the one it follows
+# before generating the answer itself.
+VERITAS_COALESCE_WAIT_SECONDS = 60
+# Also coalesce across workers through a lock in the shared response cache.
+VERITAS_COALESCE_SHARED = False
+VERITAS_COALESCE_POLL_SECONDS = 0.5
+
+# Batch generate endpoint: maximum prompts per batch, default (and maximum)
+# number generated at the same time, and per-prompt timeout.
+VERITAS_BATCH_MAX_ITEMS = 500
+VERITAS_BATCH_CONCURRENCY = 8
+VERITAS_BATCH_ITEM_TIMEOUT_SECONDS = 120
+
+# Requests that don't name a model are dispatched over VERITAS_AI_MODEL and
+# then these models (see ai_api/dispatch.py).
+VERITAS_MODEL_DISPATCH_ENABLED = True
+VERITAS_FALLBACK_MODELS = [DEFAULT_GEMINI_MODEL]
+# Seconds a model has to produce its first chunk before the next one is tried.
+VERITAS_MODEL_DEADLINES = {VERITAS_AI_MODEL: 30, DEFAULT_GEMINI_MODEL: 20}
+VERITAS_MODEL_DEFAULT_DEADLINE_SECONDS = 30
+# A request to the default model still silent after this percentile of its
+# recent first-chunk latencies is hedged with the first fallback model.
+VERITAS_HEDGE_ENABLED = True
+VERITAS_HEDGE_PERCENTILE = 0.95
+# Below this many samples the default delay is used instead.
+VERITAS_HEDGE_MIN_SAMPLES = 20
+VERITAS_HEDGE_MIN_DELAY_SECONDS = 1.0
+VERITAS_HEDGE_DEFAULT_DELAY_SECONDS = 5.0
+
+# Seconds a generate request may take (see ai_api/cancellation.py); clients
+# can ask for less with "deadline_seconds" or the X-Veritas-Deadline-Seconds
+# header. None means no limit.
+VERITAS_REQUEST_DEADLINE_SECONDS = 120
+# Expected answer length of a model that hasn't answered often enough yet,
+# for the tokens saved by cancelled generations.
+VERITAS_CANCEL_DEFAULT_ANSWER_TOKENS = 400
+
+# Token budgets (see ai_api/budgets.py); None switches a limit off. Longest
+# prompt accepted, and whether longer ones are rejected or trimmed.
+VERITAS_MAX_PROMPT_TOKENS = 2000
+VERITAS_PROMPT_OVERFLOW = "reject"  # or "trim"
+# Largest assembled request (knowledge base context plus prompt).
+VERITAS_MAX_INPUT_TOKENS = 32000
+# Ask the model for an exact count when the estimate is within this fraction
+# of VERITAS_MAX_INPUT_TOKENS.
+VERITAS_EXACT_TOKEN_COUNT = False
+VERITAS_EXACT_TOKEN_COUNT_MARGIN = 0.8
+# Tokens each client may use per window, keyed by remote address or, behind
+# a proxy, by the first address in this header (e.g. "X-Forwarded-For").
+VERITAS_CLIENT_TOKEN_BUDGET = 200000
+VERITAS_CLIENT_TOKEN_WINDOW_SECONDS = 60 * 60
+VERITAS_CLIENT_ID_HEADER = None
+
+# Prometheus metrics at /api/metrics/ (see ai_api/metrics.py). With several
+# worker processes, point VERITAS_METRICS_DIR at a directory they share; each
+# worker writes its values there at most every VERITAS_METRICS_FLUSH_SECONDS.
+VERITAS_METRICS_ENABLED = True
+VERITAS_METRICS_DIR = os.environ.get("VERITAS_METRICS_DIR")
+VERITAS_METRICS_FLUSH_SECONDS = 5
+
+# Per-request tracing (see ai_api/tracing.py): spans of requests under this
+# prefix are returned in a Server-Timing header, and requests slower than
+# VERITAS_SLOW_TRACE_SECONDS are logged in full to the "veritas.traces"
+# logger (a rotating file when VERITAS_TRACE_LOG_FILE is set).
+VERITAS_TRACING_ENABLED = True
+VERITAS_TRACE_PATH_PREFIX = "/api/"
+VERITAS_SLOW_TRACE_SECONDS = 5.0
+VERITAS_TRACE_LOG_FILE = os.environ.get("VERITAS_TRACE_LOG_FILE")
+# Staff (or callers sending this token in X-Veritas-Profile-Token) may
+# profile a request with "X-Veritas-Profile: cprofile" or "sample".
+VERITAS_PROFILE_TOKEN = os.environ.get("VERITAS_PROFILE_TOKEN")
+VERITAS_PROFILE_DIR = os.environ.get(
+    "VERITAS_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "veritas-profiles")
+)
+VERITAS_PROFILE_SAMPLE_INTERVAL_SECONDS = 0.005
+
+# Server-side chat sessions (see ai_api/sessions.py). Follow-up questions are
+# sent with the newest turns that fit VERITAS_SESSION_HISTORY_TOKENS; older
+# turns are folded into a summary of at most VERITAS_SESSION_SUMMARY_TOKENS.
+VERITAS_SESSIONS_ENABLED = True
+VERITAS_SESSION_HISTORY_TOKENS = 1500
+VERITAS_SESSION_SUMMARY_TOKENS = 300
+# Sessions expire this long after their last turn; expired ones are deleted
+# at most every VERITAS_SESSION_EVICT_INTERVAL_SECONDS per worker.
+VERITAS_SESSION_TTL_SECONDS = 2 * 60 * 60
+VERITAS_SESSION_EVICT_INTERVAL_SECONDS = 10 * 60
+
+# Admission control (see ai_api/admission.py), shared by all workers through
+# the response cache. Each client (identified like the token budget) may
+# send VERITAS_RATE_LIMIT_PER_MINUTE generate requests a minute, in bursts of
+# up to VERITAS_RATE_LIMIT_BURST; None switches a limit off.
+VERITAS_ADMISSION_ENABLED = True
+VERITAS_RATE_LIMIT_PER_MINUTE = 30
+VERITAS_RATE_LIMIT_BURST = 10
+# At most this many generations call the model at once; up to
+# VERITAS_UPSTREAM_QUEUE_SIZE more wait VERITAS_UPSTREAM_QUEUE_WAIT_SECONDS
+# for a slot, the rest get 503.
+VERITAS_MAX_CONCURRENT_UPSTREAM = 16
+VERITAS_UPSTREAM_QUEUE_SIZE = 32
+VERITAS_UPSTREAM_QUEUE_WAIT_SECONDS = 5
+VERITAS_UPSTREAM_SLOT_POLL_SECONDS = 0.1
+# Slots still held after this long (by a crashed worker) are freed.
+VERITAS_UPSTREAM_SLOT_LEASE_SECONDS = 5 * 60
+
+# Upstream resilience (see ai_api/resilience.py). Transient failures are
+# retried up to VERITAS_RETRY_ATTEMPTS times with jittered exponential
+# backoff, within the model's deadline (VERITAS_RETRY_DEADLINE_SECONDS for
+# requests that aren't dispatched).
+VERITAS_RETRY_ATTEMPTS = 2
+VERITAS_RETRY_BASE_DELAY_SECONDS = 0.5
+VERITAS_RETRY_MAX_DELAY_SECONDS = 4
+VERITAS_RETRY_DEADLINE_SECONDS = 30
+# A model's circuit breaker opens after this many consecutive failures and
+# lets a probe call through VERITAS_BREAKER_OPEN_SECONDS later.
+VERITAS_BREAKER_ENABLED = True
+VERITAS_BREAKER_FAILURE_THRESHOLD = 5
+VERITAS_BREAKER_OPEN_SECONDS = 30
+# While the AI service is down, prompts are answered from data.csv (matching
+# at least this confidence) or the most relevant knowledge base passages.
+VERITAS_DEGRADED_ANSWERS_ENABLED = True
+VERITAS_DEGRADED_FAQ_THRESHOLD = 0.35
+VERITAS_DEGRADED_PASSAGES = 2
+
+# Workers warm up (indexes, client, data file upload, cached context) in the
+# background when they start; /api/health/ready answers 200 once done.
+# VERITAS_WARMUP_GENERATION also sends a one-token generation to open the
+# connection to the API.
+VERITAS_WARMUP_ON_STARTUP = True
+VERITAS_WARMUP_GENERATION = False
+
+# Knowledge base store written by "python manage.py ingest_kb" and
+# memory-mapped by the workers, which switch to a new version within
+# VERITAS_KB_RELOAD_CHECK_SECONDS. Sources changed since the last ingest (and
+# everything, without a store) are indexed in-process as before.
+VERITAS_KB_STORE_ENABLED = True
+VERITAS_KB_STORE_DIR = BASE_DIR / "veritas_data" / "kb_store"
+VERITAS_KB_RELOAD_CHECK_SECONDS = 5
+# Old versions kept besides the current one
+VERITAS_KB_KEEP_VERSIONS = 2
+# Model preamble ingested instead of the built-in text when this file exists
+VERITAS_PREAMBLE_PATH = BASE_DIR / "veritas_data" / "preamble.txt"
+
+# Knowledge bases requests pick with "knowledge_base" (see
+# ai_api/knowledge_bases.py). The default one is made of the settings above;
+# each other base names its "data_file" and optionally its "faq_csv" (no FAQ
+# without one), "preamble" file and "store_dir" (VERITAS_KB_STORE_DIR / name
+# by default). Ingest each with "python manage.py ingest_kb --knowledge-base
+# NAME" (or --all).
+VERITAS_DEFAULT_KNOWLEDGE_BASE = "default"
+VERITAS_KNOWLEDGE_BASES = {
+    # "admissions": {
+    #     "data_file": BASE_DIR / "veritas_data" / "admissions.pdf",
+    #     "faq_csv": BASE_DIR / "veritas_data" / "admissions.csv",
+    # },
+}
+# Bases a worker keeps loaded (indexes, mapped store), least recently used
+# dropped first, and the memory they may take together
+VERITAS_KB_MAX_RESIDENT = 4
+VERITAS_KB_MAX_RESIDENT_BYTES = 256 * 1024 * 1024
+# Most used bases (besides the default one) loaded during warm-up
+VERITAS_KB_WARMUP_COUNT = 2
+
+# Requests that don't name a model go to the model of the first rule their
+# prompt satisfies, VERITAS_AI_MODEL if none (see ai_api/routing.py for the
+# conditions). Rules are tried in order, so list cheap models first.
+VERITAS_ROUTER_ENABLED = True
+VERITAS_ROUTER_RULES = [
+    # Short factual questions about what the knowledge base covers
+    {
+        "route": "lookup",
+        "model": DEFAULT_GEMINI_MODEL,
+        "question_types": ["lookup"],
+        "max_words": 25,
+        "min_kb_coverage": 0.5,
+    },
+    # Close to a curated question, though not enough to answer from data.csv
+    {
+        "route": "faq_like",
+        "model": DEFAULT_GEMINI_MODEL,
+        "question_types": ["lookup", "other"],
+        "max_words": 40,
+        "min_faq_score": 0.3,
+    },
+]
+
+# Prompt template versions: the fixed parts of every request, compiled once
+# (see ai_api/prompts.py). Keys left out use the built-in texts:
+# system_instruction, document_intro, passages_intro, few_shot (list of
+# [question, answer]) and inline_system_instruction. Switch
+# VERITAS_PROMPT_TEMPLATE to compare versions; the version is part of the
+# cached answer and cached context keys.
+VERITAS_PROMPT_TEMPLATE = "v1"
+VERITAS_PROMPT_TEMPLATES = {
+    "v1": {},
+    # Shows the model how to decline questions the knowledge base doesn't cover
+    "v2": {
+        "inline_system_instruction": True,
+        "few_shot": [
+            [
+                "What will the weather be like on campus tomorrow?",
+                "I don't have that specific information.",
+            ],
+        ],
+    },
+}
+
+# Generation jobs (see ai_api/jobs.py), queued in the database through
+# /api/jobs/. Each process serving requests runs VERITAS_JOB_WORKERS job
+# threads; set it to 0 to run them with "python manage.py run_jobs" instead.
+VERITAS_JOB_WORKERS = 2
+# Jobs waiting to run, in total and per client, before new ones get 503
+VERITAS_JOB_MAX_QUEUED = 100
+VERITAS_JOB_MAX_QUEUED_PER_CLIENT = 5
+# How often idle workers look for jobs queued by other processes
+VERITAS_JOB_POLL_SECONDS = 2
+# How often a running job's partial text is saved (and cancellation noticed)
+VERITAS_JOB_PROGRESS_SECONDS = 1
+# A running job not heard from for this long (its worker died) is queued
+# again, at most VERITAS_JOB_MAX_ATTEMPTS times in all.
+VERITAS_JOB_LEASE_SECONDS = 5 * 60
+VERITAS_JOB_MAX_ATTEMPTS = 2
+# Default and maximum time a job may take from being queued
+VERITAS_JOB_MAX_DEADLINE_SECONDS = 15 * 60
+# Finished jobs are deleted this long after they finish
+VERITAS_JOB_RESULT_TTL_SECONDS = 60 * 60
+VERITAS_JOB_SWEEP_INTERVAL_SECONDS = 60
+
+if VERITAS_TRACE_LOG_FILE:
+    LOGGING = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "handlers": {
+            "slow_traces": {
+                "class": "logging.handlers.RotatingFileHandler",
+                "filename": VERITAS_TRACE_LOG_FILE,
+                "maxBytes": 10 * 1024 * 1024,
+                "backupCount": 5,
+            },
+        },
+        "loggers": {
+            "veritas.traces": {
+                "handlers": ["slow_traces"],
+                "level": "INFO",
+                "propagate": False,
+            },
+        },
+    }
@@ -13,15 +13,44 @@ export async function POST(request: Request) {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
+        // Pass through "text/event-stream" so the backend streams the answer
+        Accept: request.headers.get("Accept") ?? "application/json",
       },
       body: JSON.stringify(body),
     });
 
+    // Forward the backend's per-stage timings so they show up in the
+    // browser's network panel
+    const timingHeaders: Record<string, string> = {};
+    for (const name of ["Server-Timing", "X-Veritas-Trace-Id"]) {
+      const value = response.headers.get(name);
+      if (value) {
+        timingHeaders[name] = value;
+      }
+    }
+
+    // Stream server-sent events straight through instead of waiting for the
+    // full generation
+    const contentType = response.headers.get("Content-Type") ?? "";
+    if (contentType.startsWith("text/event-stream")) {
+      return new Response(response.body, {
+        status: response.status,
+        headers: {
+          "Content-Type": "text/event-stream",
+          "Cache-Control": "no-cache",
+          ...timingHeaders,
+        },
+      });
+    }
+
     // Get the response data
     const data = await response.json();
 
     // Return the response
-    return NextResponse.json(data, { status: response.status });
+    return NextResponse.json(data, {
+      status: response.status,
+      headers: timingHeaders,
+    });
   } catch (error) {
     console.error("Error in chat API route:", error);
     return NextResponse.json(
@@ -1,4 +1,4 @@
-import { useState, useCallback } from "react";
+import { useState, useCallback, useRef } from "react";
 import {
   Message,
   ChatState,
@@ -8,12 +8,50 @@ import {
 } from "@/types";
 import { generateId } from "@/lib/utils";
 
+type StreamEvent = { event: string; data: Record<string, any> };
+
+/**
+ * Reads server-sent events from a response body, calling onEvent for each one
+ */
+async function readEventStream(
+  body: ReadableStream<Uint8Array>,
+  onEvent: (event: StreamEvent) => void
+) {
+  const reader = body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    // Events are separated by a blank line
+    let boundary = buffer.indexOf("\n\n");
+    while (boundary !== -1) {
+      const block = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      boundary = buffer.indexOf("\n\n");
+
+      let event = "message";
+      let data = "";
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event: ")) event = line.slice(7);
+        else if (line.startsWith("data: ")) data += line.slice(6);
+      }
+      if (data) onEvent({ event, data: JSON.parse(data) });
+    }
+  }
+}
+
 export function useChat() {
   const [state, setState] = useState<ChatState>({
     messages: [],
     isLoading: false,
     error: null,
   });
+  // The backend keeps the conversation; follow-ups only send its id
+  const sessionId = useRef<string | null>(null);
 
   const addMessage = useCallback(
     (content: string, role: "user" | "assistant") => {
@@ -34,6 +72,17 @@ export function useChat() {
     []
   );
 
+  const appendToMessage = useCallback((id: string, text: string) => {
+    setState((prev) => ({
+      ...prev,
+      messages: prev.messages.map((message) =>
+        message.id === id
+          ? { ...message, content: message.content + text }
+          : message
+      ),
+    }));
+  }, []);
+
   const sendMessage = useCallback(
     async (content: string) => {
       // Add user message to chat
@@ -48,16 +97,48 @@ export function useChat() {
           prompt: content,
           temperature: 0.7,
         };
+        // Continue the conversation, or ask the server to start one
+        if (sessionId.current) promptRequest.session_id = sessionId.current;
+        else promptRequest.start_session = true;
 
         // Send request to our Next.js API endpoint that will proxy to Django backend
         const response = await fetch("/api/chat", {
           method: "POST",
           headers: {
             "Content-Type": "application/json",
+            // Ask for server-sent events so the answer appears as it is generated
+            Accept: "text/event-stream",
           },
           body: JSON.stringify(promptRequest),
         });
 
+        const contentType = response.headers.get("Content-Type") ?? "";
+        if (contentType.startsWith("text/event-stream") && response.body) {
+          let assistantMessage: Message | null = null;
+          let streamError: string | null = null;
+
+          await readEventStream(response.body, ({ event, data }) => {
+            if (event === "chunk") {
+              if (!assistantMessage) {
+                assistantMessage = addMessage("", "assistant");
+                // Stop the spinner once the first text arrives
+                setState((prev) => ({ ...prev, isLoading: false }));
+              }
+              appendToMessage(assistantMessage.id, data.text);
+            } else if (event === "done") {
+              if (data.session_id) sessionId.current = data.session_id;
+            } else if (event === "error") {
+              streamError =
+                (data as BackendErrorResponse).error ||
+                "Failed to get response";
+            }
+          });
+
+          if (streamError) throw new Error(streamError);
+          setState((prev) => ({ ...prev, isLoading: false }));
+          return;
+        }
+
         const data = await response.json();
 
         if (!response.ok) {
@@ -68,6 +149,7 @@ export function useChat() {
 
         // Handle successful response
         const responseData = data as BackendPromptResponse;
+        if (responseData.session_id) sessionId.current = responseData.session_id;
 
         // Add AI response to chat
         addMessage(responseData.response, "assistant");
@@ -86,10 +168,11 @@ export function useChat() {
         }));
       }
     },
-    [addMessage]
+    [addMessage, appendToMessage]
   );
 
   const clearChat = useCallback(() => {
+    sessionId.current = null;
     setState({ messages: [], isLoading: false, error: null });
   }, []);
 
@@ -16,6 +16,8 @@ export type BackendPromptRequest = {
   model?: string;
   temperature?: number;
   max_output_tokens?: number;
+  session_id?: string;
+  start_session?: boolean;
 };
 
 export type BackendPromptResponse = {
@@ -24,6 +26,7 @@ export type BackendPromptResponse = {
   prompt_tokens?: number;
   completion_tokens?: number;
   total_tokens?: number;
+  session_id?: string;
 };
 
 export type BackendErrorResponse = {